@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# encoding : utf-8
+"""
+simulate pulls of synthetic images to compare the download orders of `registry_client.download`
+
+every stream downloads at the same bandwidth after the same latency, at most `concurrency` streams at a time,
+the next blob in the order starts as soon as a stream is free, like `Downloader.download_all` does.
+
+    python benchmarks/download_order.py --concurrency 3 --images 200
+"""
+
+import argparse
+import heapq
+import pathlib
+import random
+import statistics
+from typing import Callable, Dict, List, Tuple
+
+from registry_client.digest import Digest
+from registry_client.download import BlobTask, DownloadOrder
+from registry_client.reference import CanonicalReference
+
+MiB = 1024 * 1024
+
+
+def uniform(rand: random.Random) -> List[int]:
+    return [rand.randint(1, 64) * MiB for _ in range(rand.randint(3, 12))]
+
+
+def long_tail(rand: random.Random) -> List[int]:
+    """
+    a few large layers among many small ones, the usual shape of an application image
+    """
+    return [int(rand.lognormvariate(0, 2) * MiB) + 1 for _ in range(rand.randint(5, 20))]
+
+
+def big_base(rand: random.Random) -> List[int]:
+    """
+    a large base layer first, small layers of the application after it
+    """
+    return [rand.randint(200, 800) * MiB, *(rand.randint(1, 8) * MiB for _ in range(rand.randint(3, 10)))]
+
+
+def big_last(rand: random.Random) -> List[int]:
+    """
+    the worst case of the manifest order, the largest layer is the last one
+    """
+    return [*(rand.randint(1, 30) * MiB for _ in range(rand.randint(3, 10))), rand.randint(200, 800) * MiB]
+
+
+DISTRIBUTIONS: Dict[str, Callable[[random.Random], List[int]]] = {
+    "uniform": uniform,
+    "long-tail": long_tail,
+    "big-base": big_base,
+    "big-last": big_last,
+}
+
+
+def make_tasks(sizes: List[int]) -> List[BlobTask]:
+    return [
+        BlobTask(
+            ref=CanonicalReference(path="library/bench", digest=Digest.from_bytes(str(index).encode())),
+            target=pathlib.Path(str(index)),
+            size=size,
+        )
+        for index, size in enumerate(sizes)
+    ]
+
+
+def simulate(tasks: List[BlobTask], concurrency: int, bandwidth: float, latency: float) -> Tuple[float, float]:
+    """
+    return the seconds until every blob is done and until the first blob is done
+    """
+    free_at = [0.0] * concurrency
+    finished = []
+    for task in tasks:
+        start = heapq.heappop(free_at)
+        end = start + latency + task.size / bandwidth
+        finished.append(end)
+        heapq.heappush(free_at, end)
+    return max(finished), min(finished)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=3)
+    parser.add_argument("--bandwidth", type=float, default=20, help="MiB/s of a stream")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds before the first byte of a blob")
+    parser.add_argument("--images", type=int, default=200, help="images of every distribution")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    print(f"{args.images} images, {args.concurrency} streams of {args.bandwidth} MiB/s, latency {args.latency}s")
+    print(f"{'distribution':<12} {'order':<15} {'makespan':>9} {'vs manifest':>12} {'first done':>11}")
+    for name, distribution in DISTRIBUTIONS.items():
+        images = [make_tasks(distribution(rand)) for _ in range(args.images)]
+        baseline = None
+        for order in DownloadOrder:
+            results = [
+                simulate(order.policy(tasks), args.concurrency, args.bandwidth * MiB, args.latency) for tasks in images
+            ]
+            makespan = statistics.mean(total for total, _ in results)
+            first = statistics.mean(first for _, first in results)
+            baseline = baseline or makespan
+            print(f"{name:<12} {order.value:<15} {makespan:>8.2f}s {makespan / baseline - 1:>+11.1%} {first:>10.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,26 @@
 #!/usr/bin/env python3
 # encoding : utf-8
 # create at: 2022/9/24-下午4:31
+import asyncio
 import base64
 import datetime
+import json
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from typing import Dict, NamedTuple, Optional, Tuple, Union
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 from pydantic import BaseModel
 
@@ -22,12 +37,67 @@ import iso8601
 import requests
 from loguru import logger
 
-from registry_client.scope import Scope
+from registry_client.capabilities import (
+    GLOBAL_CAPABILITY_CACHE,
+    CapabilityCache,
+    host_of,
+)
+from registry_client.events import Events, TokenFetched
+from registry_client.mirror import (
+    AsyncMirrorAuth,
+    HostStats,
+    MirrorAuth,
+    MirrorPool,
+    is_mirrored,
+)
+from registry_client.retry import RetryPolicy
+from registry_client.scope import EmptyScope, RepositoryScope, Scope
+from registry_client.throttle import GLOBAL_RATE_LIMITER, RateLimiter, is_blob_request
+from registry_client.token_cache import TokenKey, TokenStore
 
 TOKEN_CACHE_MIN_TIME = 60
+# a token used this many seconds before it's treated as expired is refreshed in the background
+TOKEN_REFRESH_AHEAD = 60
+# the scopes asked by a token request for many repositories, which keeps its url short
+DEFAULT_SCOPES_PER_TOKEN = 50
 AUTH_TYPE = Union[httpx._types.AuthTypes, Scope, None]
 
-GLOBAL_TOKEN_CACHE: Dict[str, "Token"] = {}
+
+DEFAULT_MAX_CONNECTIONS = 100
+DEFAULT_KEEPALIVE_EXPIRY = 30
+# the options of AuthClient used by its client requesting tokens as well
+TOKEN_CLIENT_OPTIONS = ("verify", "cert", "http2", "limits", "timeout", "proxies", "trust_env")
+
+
+def pool_limits(streams: int, keepalive_expiry: float = DEFAULT_KEEPALIVE_EXPIRY) -> httpx.Limits:
+    """
+    keep a connection alive for every request in flight, so the next blob reuses the connection of the last one.
+    streams: the requests in flight at most, e.g. the concurrent downloads by their segments
+    """
+    return httpx.Limits(
+        max_connections=max(DEFAULT_MAX_CONNECTIONS, streams),
+        # and a few for manifests and configs
+        max_keepalive_connections=streams + 4,
+        keepalive_expiry=keepalive_expiry,
+    )
+
+
+def http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _client_options(kwargs: Dict) -> Dict:
+    """
+    fall back to HTTP/1.1 if http2 is asked but h2 isn't installed
+    """
+    if kwargs.get("http2") and not http2_available():
+        logger.warning("http2 needs the h2 package, install registry_client[http2], use HTTP/1.1 instead")
+        kwargs = {**kwargs, "http2": False}
+    return kwargs
 
 
 def encode_auth(username: str, password: str) -> str:
@@ -45,6 +115,13 @@ class Token:
     def expired(self) -> bool:
         return False
 
+    @property
+    def expires_in(self) -> Optional[float]:
+        """
+        seconds until the token expires, None if it never does
+        """
+        return None
+
     @property
     def token(self) -> Dict[str, str]:
         raise NotImplementedError
@@ -100,6 +177,223 @@ class BearerToken(Token):
             return True
         return (self._expired_at - now).total_seconds() <= TOKEN_CACHE_MIN_TIME
 
+    @property
+    def expires_in(self) -> Optional[float]:
+        return (self._expired_at - datetime.datetime.now(tz=self._expired_at.tzinfo)).total_seconds()
+
+    @property
+    def expired_at(self) -> datetime.datetime:
+        return self._expired_at
+
+    @property
+    def value(self) -> str:
+        return self.access_token or self._token
+
+    @classmethod
+    def restore(cls, value: str, expired_at: float) -> "BearerToken":
+        """
+        a token stored before, expired_at is a unix time
+        """
+        token = cls.__new__(cls)
+        token._expired_at = datetime.datetime.fromtimestamp(expired_at, tz=datetime.timezone.utc)
+        token.access_token = value
+        token._token = value
+        return token
+
+
+class TokenCache:
+    """
+    The tokens of registries keyed by `TokenKey`, shared by the threads of a process.
+    With a `TokenStore` tokens are kept on disk as well, so short-lived processes and parallel workers reuse them.
+    Concurrent requests needing the token of the same key wait for a single token request, see `fetch`.
+    A token used shortly before it expires is refreshed in the background, see `refresh`.
+    """
+
+    def __init__(self, store: Optional[TokenStore] = None, refresh_ahead: float = TOKEN_REFRESH_AHEAD):
+        """
+        refresh_ahead: refresh a token used within this many seconds before it's treated as expired, 0 disables it
+        """
+        self.store = store
+        self.refresh_ahead = refresh_ahead
+        self._tokens: Dict[TokenKey, Token] = {}
+        self._lock = threading.Lock()
+        self._fetch_locks: Dict[TokenKey, threading.Lock] = {}
+        self._futures: Dict[TokenKey, asyncio.Future] = {}
+        self._refreshing: Set[TokenKey] = set()
+        self._tasks: Set[asyncio.Future] = set()
+
+    def get(self, key: TokenKey) -> Optional[Token]:
+        """
+        the token of key which isn't expired, None if there isn't one
+        """
+        with self._lock:
+            token = self._tokens.get(key)
+        if token is not None and not token.expired:
+            return token
+        store = self.store
+        entry = store.get(key) if store is not None else None
+        if entry is None:
+            return None
+        token = BearerToken.restore(*entry)
+        if token.expired:
+            return None
+        with self._lock:
+            self._tokens[key] = token
+        return token
+
+    def put(self, key: TokenKey, token: Token):
+        with self._lock:
+            self._tokens[key] = token
+        store = self.store
+        if store is not None and isinstance(token, BearerToken):
+            store.put(key, token.value, token.expired_at.timestamp())
+
+    def _usable(self, key: TokenKey, rejected: Optional[Token]) -> Optional[Token]:
+        token = self.get(key)
+        if token is None or (rejected is not None and token.token == rejected.token):
+            return None
+        return token
+
+    def fetch(self, key: TokenKey, fetch: Callable[[], Token], rejected: Optional[Token] = None) -> Token:
+        """
+        request the token of key once for all the threads asking for it at the same time, they share the result.
+        rejected: the token the registry has just refused, a new token cached meanwhile is used instead of it
+        """
+        with self._lock:
+            lock = self._fetch_locks.setdefault(key, threading.Lock())
+        with lock:
+            token = self._usable(key, rejected)
+            if token is None:
+                token = fetch()
+                self.put(key, token)
+            return token
+
+    async def async_fetch(
+        self, key: TokenKey, fetch: Callable[[], Awaitable[Token]], rejected: Optional[Token] = None
+    ) -> Token:
+        """
+        the same as `fetch` for the tasks of an event loop
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            token = self._usable(key, rejected)
+            if token is not None:
+                return token
+            with self._lock:
+                future = self._futures.get(key)
+                # a future of another loop can't be awaited here, the loop may have been closed as well
+                if future is None or future.get_loop() is not loop:
+                    future = loop.create_future()
+                    self._futures[key] = future
+                    break
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # the task fetching the token was cancelled, fetch it again
+        try:
+            token = await fetch()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # the waiters raise it, no one has to retrieve it
+            future.exception()
+            raise
+        else:
+            self.put(key, token)
+            future.set_result(token)
+            return token
+        finally:
+            with self._lock:
+                if self._futures.get(key) is future:
+                    del self._futures[key]
+
+    def _start_refresh(self, key: TokenKey, token: Token) -> bool:
+        expires_in = token.expires_in
+        if expires_in is None or expires_in > TOKEN_CACHE_MIN_TIME + self.refresh_ahead:
+            return False
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+        return True
+
+    def refresh(self, key: TokenKey, token: Token, fetch: Callable[[], Token]):
+        """
+        fetch a new token of key in a background thread if token expires soon,
+        the requests go on with token meanwhile and use the new one once it's cached
+        """
+        if not self._start_refresh(key, token):
+            return
+
+        def run():
+            try:
+                self.fetch(key, fetch, rejected=token)
+            except Exception as e:
+                logger.warning(f"failed to refresh the token of {key.scope}: {e!r}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=run, name="token-refresh", daemon=True).start()
+
+    def async_refresh(self, key: TokenKey, token: Token, fetch: Callable[[], Awaitable[Token]]):
+        """
+        the same as `refresh` by a task of the running loop
+        """
+        if not self._start_refresh(key, token):
+            return
+
+        async def run():
+            try:
+                await self.async_fetch(key, fetch, rejected=token)
+            except Exception as e:
+                logger.warning(f"failed to refresh the token of {key.scope}: {e!r}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        task = asyncio.ensure_future(run())
+        # the loop only keeps a weak reference of its tasks
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def remove(self, key: TokenKey):
+        with self._lock:
+            self._tokens.pop(key, None)
+        if self.store is not None:
+            self.store.remove(key)
+
+    def clear_memory(self):
+        with self._lock:
+            self._tokens.clear()
+
+    def __contains__(self, key: TokenKey) -> bool:
+        return self.get(key) is not None
+
+
+GLOBAL_TOKEN_CACHE = TokenCache()
+
+
+def granted_access(token: str) -> Optional[Dict[Tuple[str, str], Set[str]]]:
+    """
+    the actions granted to every (type, name) by the `access` claim of a JWT token, None if it isn't a JWT
+    """
+    parts = token.split(".")
+    if len(parts) != 3:
+        return None
+    try:
+        claims = json.loads(base64.urlsafe_b64decode(parts[1] + "=" * (-len(parts[1]) % 4)))
+        access: Dict[Tuple[str, str], Set[str]] = {}
+        for item in claims.get("access") or []:
+            access.setdefault((item["type"], item["name"]), set()).update(item.get("actions") or [])
+        return access
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
 
 class RegistryChallenge(NamedTuple):
     scheme: ChallengeScheme
@@ -127,7 +421,23 @@ def parse_challenge(auth_header: str) -> RegistryChallenge:
 
 
 class BearerAuth(httpx.Auth):
-    def __init__(self, username: str, password: str, challenge: RegistryChallenge, scope: Scope):
+    def __init__(
+        self,
+        username: str,
+        password: str,
+        challenge: RegistryChallenge,
+        scope: Scope,
+        events: Optional[Events] = None,
+        client: Union[httpx.Client, httpx.AsyncClient, None] = None,
+        token_cache: Optional[TokenCache] = None,
+        preemptive: bool = False,
+    ):
+        """
+        events: receives a `TokenFetched` for every token requested
+        client: requests tokens with its pooled connections, a new client is used for every token by default
+        token_cache: `GLOBAL_TOKEN_CACHE` by default
+        preemptive: request the token before sending a request without one, instead of waiting for its 401
+        """
         assert challenge.scheme == ChallengeScheme.Bearer
         self._username = username
         self._password = password
@@ -135,23 +445,46 @@ class BearerAuth(httpx.Auth):
         self._auth_header = {"Authorization": f"Basic {token}"}
         self._challenge = challenge
         self._scope = scope
+        self._events = events
+        self._client = client
+        self._token_cache = token_cache or GLOBAL_TOKEN_CACHE
+        self._preemptive = preemptive
+
+    @property
+    def token_key(self) -> TokenKey:
+        return self.key_of(self._scope)
+
+    def key_of(self, scope: Scope) -> TokenKey:
+        return TokenKey(self._challenge.realm, self._challenge.service, self._username, str(scope))
 
     def auth_flow(self, request: httpx.Request):
         scope = str(self._scope)
-        token_from_cache = GLOBAL_TOKEN_CACHE.get(scope)
-        if token_from_cache and not token_from_cache.expired:
+        key = self.token_key
+
+        def fetch() -> Token:
+            return self._build_auth_header(request=request, scope=scope, challenge=self._challenge)
+
+        token_from_cache = self._token_cache.get(key)
+        if token_from_cache is None and self._preemptive:
+            token_from_cache = self._token_cache.fetch(key, fetch)
+        if token_from_cache is not None:
+            self._token_cache.refresh(key, token_from_cache, fetch)
             request.headers.update(token_from_cache.token)
         response = yield request
         if response.status_code != 401:
             # If the response is not a 401 then we don't
             # need to build an authenticated request.
             return
-        token = self._build_auth_header(request=request, scope=scope, challenge=self._challenge)
-        GLOBAL_TOKEN_CACHE[scope] = token
+        token = self._token_cache.fetch(key, fetch, rejected=token_from_cache)
         request.headers.update(token.token)
         yield request
 
-    def _build_auth_header(self, request: httpx.Request, scope: str, challenge: RegistryChallenge):
+    def _token_request(
+        self, request: httpx.Request, scope: Union[str, List[str]], challenge: RegistryChallenge
+    ) -> Tuple[Dict[str, Union[str, List[str]]], Optional[Dict[str, str]]]:
+        """
+        scope: a list asks for a token of many scopes, by a `scope` parameter for each
+        """
         params = {
             "scope": scope,
             "service": challenge.service,
@@ -161,9 +494,94 @@ class BearerAuth(httpx.Auth):
         header = self._auth_header
         if request.url.netloc.endswith(b"docker.io") and not (self._username or self._password):
             header = None
-        resp = httpx.Client().get(challenge.realm, headers=header, params=params)
+        return params, header
+
+    def _token_fetched(
+        self, scope: Union[str, List[str]], challenge: RegistryChallenge, started: float, resp: httpx.Response
+    ):
+        if self._events is not None and self._events.active:
+            elapsed = time.monotonic() - started
+            scope = scope if isinstance(scope, str) else " ".join(scope)
+            self._events.emit(TokenFetched(challenge.realm, challenge.service, scope, elapsed, resp.status_code))
+
+    def _build_auth_header(self, request: httpx.Request, scope: Union[str, List[str]], challenge: RegistryChallenge):
+        params, header = self._token_request(request, scope, challenge)
+        started = time.monotonic()
+        if self._client is not None:
+            resp = self._client.get(challenge.realm, headers=header, params=params)
+        else:
+            with httpx.Client() as client:
+                resp = client.get(challenge.realm, headers=header, params=params)
+        self._token_fetched(scope, challenge, started, resp)
         return BearerToken(resp)
 
+    def fetch_scopes(self, request: httpx.Request, scopes: List[RepositoryScope]) -> List[RepositoryScope]:
+        """
+        request a token of many scopes at once, and cache it for every scope it grants.
+        return the scopes granted, the others get a token of their own on their first 401
+        """
+        try:
+            token = self._build_auth_header(request, [str(scope) for scope in scopes], self._challenge)
+        except (httpx.HTTPError, ValueError) as e:
+            logger.warning(f"failed to request a token of {len(scopes)} scopes: {e!r}")
+            return []
+        return self._cache_granted(token, scopes)
+
+    def _cache_granted(self, token: BearerToken, scopes: List[RepositoryScope]) -> List[RepositoryScope]:
+        access = granted_access(token.value)
+        # an opaque token may grant all of them, a scope it doesn't grant falls back to its own token on a 401
+        granted = [
+            scope
+            for scope in scopes
+            if access is None or set(scope.actions) <= access.get(("repository", scope.repo_name), set())
+        ]
+        for scope in granted:
+            self._token_cache.put(self.key_of(scope), token)
+        return granted
+
+
+class AsyncBearerAuth(BearerAuth):
+    async def async_auth_flow(self, request: httpx.Request):
+        scope = str(self._scope)
+        key = self.token_key
+
+        def fetch() -> Awaitable[Token]:
+            return self._async_build_auth_header(request=request, scope=scope, challenge=self._challenge)
+
+        token_from_cache = self._token_cache.get(key)
+        if token_from_cache is None and self._preemptive:
+            token_from_cache = await self._token_cache.async_fetch(key, fetch)
+        if token_from_cache is not None:
+            self._token_cache.async_refresh(key, token_from_cache, fetch)
+            request.headers.update(token_from_cache.token)
+        response = yield request
+        if response.status_code != 401:
+            return
+        token = await self._token_cache.async_fetch(key, fetch, rejected=token_from_cache)
+        request.headers.update(token.token)
+        yield request
+
+    async def _async_build_auth_header(
+        self, request: httpx.Request, scope: Union[str, List[str]], challenge: RegistryChallenge
+    ):
+        params, header = self._token_request(request, scope, challenge)
+        started = time.monotonic()
+        if self._client is not None:
+            resp = await self._client.get(challenge.realm, headers=header, params=params)
+        else:
+            async with httpx.AsyncClient() as client:
+                resp = await client.get(challenge.realm, headers=header, params=params)
+        self._token_fetched(scope, challenge, started, resp)
+        return BearerToken(resp)
+
+    async def async_fetch_scopes(self, request: httpx.Request, scopes: List[RepositoryScope]) -> List[RepositoryScope]:
+        try:
+            token = await self._async_build_auth_header(request, [str(scope) for scope in scopes], self._challenge)
+        except (httpx.HTTPError, ValueError) as e:
+            logger.warning(f"failed to request a token of {len(scopes)} scopes: {e!r}")
+            return []
+        return self._cache_granted(token, scopes)
+
 
 def request_hook(request: httpx.Request):
     logger.debug(f"{request.method} {request.url} {request.headers}")
@@ -173,15 +591,101 @@ def response_hook(response: httpx.Response):
     logger.debug(f"RESPONSE: {response.status_code} {response.url} {response.headers}")
 
 
+async def async_request_hook(request: httpx.Request):
+    request_hook(request)
+
+
+async def async_response_hook(response: httpx.Response):
+    response_hook(response)
+
+
+def select_auth(
+    need_auth: bool,
+    challenge: Optional[RegistryChallenge],
+    username: str,
+    password: str,
+    auth_by: Union[Tuple[str, str], Scope],
+    bearer_auth_class=BearerAuth,
+    events: Optional[Events] = None,
+    client: Union[httpx.Client, httpx.AsyncClient, None] = None,
+    token_cache: Optional[TokenCache] = None,
+    preemptive: bool = False,
+) -> httpx.Auth:
+    if not need_auth:
+        return httpx.Auth()
+    if isinstance(auth_by, tuple):
+        return httpx.BasicAuth(*auth_by)
+    elif challenge.scheme == ChallengeScheme.Basic:
+        return httpx.BasicAuth(username, password)
+    elif challenge.scheme == ChallengeScheme.Bearer and isinstance(auth_by, Scope):
+        return bearer_auth_class(
+            username,
+            password,
+            challenge,
+            auth_by,
+            events=events,
+            client=client,
+            token_cache=token_cache,
+            preemptive=preemptive,
+        )
+    return httpx.Auth()
+
+
+def _record_ping(capabilities: CapabilityCache, url: httpx.URL, resp: httpx.Response) -> str:
+    """
+    record what the response of `GET /v2/` tells about the host of url, return its challenge
+    """
+    auth_header = resp.headers.get("www-authenticate", "")
+    capabilities.update(host_of(url), challenge=auth_header, http2=resp.http_version == "HTTP/2")
+    return auth_header
+
+
 class AuthClient(httpx.Client):
     #
-    def __init__(self, *args, **kwargs):
+    def __init__(
+        self,
+        *args,
+        mirrors: Optional[List[str]] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        events: Optional[Events] = None,
+        retry: Optional[RetryPolicy] = None,
+        token_cache: Optional[TokenCache] = None,
+        preemptive_auth: bool = True,
+        capabilities: Optional[CapabilityCache] = None,
+        **kwargs,
+    ):
+        """
+        mirrors: registry mirrors serving the same images as base_url, see `MirrorPool`.
+            They are pulled from anonymously, the credentials are only sent to base_url
+        rate_limiter: limits the blob requests and their content, `GLOBAL_RATE_LIMITER` by default
+        events: receives the timings of token requests and the retries of requests
+        retry: how failed GET and HEAD requests are sent again, `RetryPolicy()` by default
+        token_cache: the tokens of the registry and its mirrors, `GLOBAL_TOKEN_CACHE` by default
+        preemptive_auth: send the first request of a scope with its token instead of waiting for a 401,
+            once the registry is known to ask for bearer tokens
+        capabilities: what the registry and its mirrors are known to do, `GLOBAL_CAPABILITY_CACHE` by default.
+            The challenge of a registry is taken from it instead of pinging the registry
+        http2, limits: multiplex the requests to a host over a connection, and how many are kept alive,
+            see `pool_limits`. Tokens are requested with the same options from a pool of their own
+        """
         self.__need_auth = True
         self._username = ""
         self._password = ""
+        kwargs = _client_options(kwargs)
         super(AuthClient, self).__init__(*args, **kwargs)
+        self._token_client = httpx.Client(**{key: kwargs[key] for key in TOKEN_CLIENT_OPTIONS if key in kwargs})
         self.__challenge: Optional[RegistryChallenge] = None
         self.event_hooks = {"request": [request_hook], "response": [response_hook]}
+        self.mirrors = MirrorPool(mirrors, self.base_url) if mirrors else None
+        self.rate_limiter = rate_limiter or GLOBAL_RATE_LIMITER
+        self.events = events or Events()
+        self.retry = retry or RetryPolicy()
+        self.token_cache = token_cache or GLOBAL_TOKEN_CACHE
+        self.preemptive_auth = preemptive_auth
+        self.capabilities = capabilities or GLOBAL_CAPABILITY_CACHE
+        self.__mirror_challenges: Dict[bytes, Optional[RegistryChallenge]] = {}
+        self.__probe_lock = threading.Lock()
+        self.__ping_lock = threading.Lock()
 
     @property
     def need_auth(self) -> bool:
@@ -192,33 +696,366 @@ class AuthClient(httpx.Client):
         return self.__challenge
 
     def ping(self):
-        c = httpx.Client(base_url=self.base_url)
-        resp = c.get("/v2/")
-        _auth_header = resp.headers.get("www-authenticate")
-        if not _auth_header:
+        resp = self._ping_host(self.base_url)
+        self._use_challenge(_record_ping(self.capabilities, self.base_url, resp))
+
+    def _use_challenge(self, auth_header: str):
+        if not auth_header:
             # docker registry proxy, like: `hub-mirror.c.163.com`
             self.__need_auth = False
             return
-        self.__challenge = parse_challenge(auth_header=_auth_header)
+        self.__challenge = parse_challenge(auth_header=auth_header)
+
+    def _discover(self):
+        """
+        learn the challenge of the registry from its capabilities, ping it if they aren't known
+        """
+        record = self.capabilities.get(host_of(self.base_url))
+        if record is None or record.challenge is None:
+            self.ping()
+        else:
+            self._use_challenge(record.challenge)
+
+    def _discover_once(self):
+        """
+        threads sending the first requests to a registry at the same time wait for the same discovery
+        """
+        if self.__challenge is None and self.__need_auth:
+            with self.__ping_lock:
+                if self.__challenge is None and self.__need_auth:
+                    self._discover()
+
+    def _ping_host(self, url: httpx.URL) -> httpx.Response:
+        """
+        GET /v2/ of url without auth, its connection is kept alive for the requests after it
+        """
+        request = self.build_request("GET", url.join("/v2/"))
+        resp = super(AuthClient, self).send(request, auth=httpx.Auth())
+        resp.close()
+        return resp
 
     def new_auth(self, auth_by: Optional[Union[Tuple[str, str], Scope]] = None) -> httpx.Auth:
         if auth_by is None:
             return httpx.Auth()
-        if self.__challenge is None:
-            self.ping()
+        if self.mirrors is not None:
+            return MirrorAuth(lambda url: self._host_auth(url, auth_by))
+        return self._host_auth(self.base_url, auth_by)
+
+    def _host_auth(self, url: httpx.URL, auth_by: Union[Tuple[str, str], Scope]) -> httpx.Auth:
+        host = self.mirrors.get(url) if self.mirrors is not None else None
+        if host is not None and host is not self.mirrors.fallback:
+            if url.netloc not in self.__mirror_challenges:
+                self._probe_mirror(host)
+            challenge = self.__mirror_challenges.get(url.netloc)
+            return select_auth(
+                challenge is not None,
+                challenge,
+                "",
+                "",
+                auth_by,
+                events=self.events,
+                client=self._token_client,
+                token_cache=self.token_cache,
+                preemptive=self.preemptive_auth,
+            )
+        self._discover_once()
+        return select_auth(
+            self.__need_auth,
+            self.__challenge,
+            self._username,
+            self._password,
+            auth_by,
+            events=self.events,
+            client=self._token_client,
+            token_cache=self.token_cache,
+            preemptive=self.preemptive_auth,
+        )
+
+    def _probe_mirror(self, host: HostStats):
+        started = time.monotonic()
+        try:
+            resp = self._ping_host(host.url)
+        except httpx.TransportError as e:
+            self.mirrors.record_failure(host, e)
+            return
+        if resp.status_code >= 500:
+            self.mirrors.record_failure(host, f"status {resp.status_code}")
+            return
+        self.mirrors.record_success(host, time.monotonic() - started)
+        _auth_header = _record_ping(self.capabilities, host.url, resp)
+        self.__mirror_challenges[host.url.netloc] = parse_challenge(_auth_header) if _auth_header else None
+
+    def prefetch_tokens(
+        self, scopes: List[RepositoryScope], scopes_per_token: int = DEFAULT_SCOPES_PER_TOKEN
+    ) -> List[RepositoryScope]:
+        """
+        request the tokens of many repositories by a few token requests, instead of a token request for each one.
+        Scopes which have a token cached are skipped. A registry may grant only some scopes of a token request,
+        or refuse to give a token of many scopes, the others get a token of their own on their first 401.
+        Mirrors request their own tokens as usual.
+        return the scopes granted
+        """
+        self._discover_once()
+        if not self.__need_auth or self.__challenge.scheme != ChallengeScheme.Bearer:
+            return []
+        auth = BearerAuth(
+            self._username,
+            self._password,
+            self.__challenge,
+            EmptyScope(),
+            events=self.events,
+            client=self._token_client,
+            token_cache=self.token_cache,
+        )
+        missing = [scope for scope in scopes if auth.key_of(scope) not in self.token_cache]
+        request = self.build_request("GET", "/v2/")
+        granted: List[RepositoryScope] = []
+        for start in range(0, len(missing), scopes_per_token):
+            chunk = auth.fetch_scopes(request, missing[start : start + scopes_per_token])
+            if not chunk:
+                # the registry doesn't give tokens of many scopes
+                break
+            granted.extend(chunk)
+        return granted
+
+    def probe_mirrors(self):
+        """
+        measure the latency of every mirror by pinging them at the same time
+        """
+        with ThreadPoolExecutor(max_workers=len(self.mirrors.mirrors), thread_name_prefix="probe") as executor:
+            list(executor.map(self._probe_mirror, self.mirrors.mirrors))
+        self.mirrors.probed = True
+
+    def send(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        return self.retry.send(request, lambda retry_request: self._send(retry_request, **kwargs), self.events.emit)
+
+    def _send(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        if self.mirrors is None or not is_mirrored(request):
+            return self._send_to_host(request, **kwargs)
+        if not self.mirrors.probed:
+            with self.__probe_lock:
+                if not self.mirrors.probed:
+                    self.probe_mirrors()
+        return self.mirrors.send(request, lambda mirror_request: self._send_to_host(mirror_request, **kwargs))
+
+    def _send_to_host(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        if self.rate_limiter.unlimited or not is_blob_request(request):
+            return super(AuthClient, self).send(request, **kwargs)
+        host = request.url.host
+        self.rate_limiter.throttle_request(host)
+        resp = super(AuthClient, self).send(request, **kwargs)
+        self.rate_limiter.throttle_response(host, resp)
+        return resp
+
+    def _build_auth(self, auth: Optional[httpx._types.AuthTypes]) -> Optional[httpx.Auth]:
         if not self.__need_auth:
             return httpx.Auth()
-        if isinstance(auth_by, tuple):
-            return httpx.BasicAuth(*auth_by)
-        elif self.challenge.scheme == ChallengeScheme.Basic:
-            return httpx.BasicAuth(self._username, self._password)
-        elif self.challenge.scheme == ChallengeScheme.Bearer and isinstance(auth_by, Scope):
-            return BearerAuth(self._username, self._password, self.__challenge, auth_by)
-        return httpx.Auth()
+        if isinstance(auth, tuple):
+            self._username, self._password = auth
+        return super(AuthClient, self)._build_auth(auth)
+
+    def close(self):
+        self._token_client.close()
+        super(AuthClient, self).close()
+
+    def __exit__(self, *args):
+        self._token_client.close()
+        super(AuthClient, self).__exit__(*args)
+
+
+class AsyncAuthClient(httpx.AsyncClient):
+    def __init__(
+        self,
+        *args,
+        mirrors: Optional[List[str]] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        events: Optional[Events] = None,
+        retry: Optional[RetryPolicy] = None,
+        token_cache: Optional[TokenCache] = None,
+        preemptive_auth: bool = True,
+        capabilities: Optional[CapabilityCache] = None,
+        **kwargs,
+    ):
+        self.__need_auth = True
+        self._username = ""
+        self._password = ""
+        kwargs = _client_options(kwargs)
+        super(AsyncAuthClient, self).__init__(*args, **kwargs)
+        self._token_client = httpx.AsyncClient(**{key: kwargs[key] for key in TOKEN_CLIENT_OPTIONS if key in kwargs})
+        self.__challenge: Optional[RegistryChallenge] = None
+        self.__ping_lock: Optional[asyncio.Lock] = None
+        self.event_hooks = {"request": [async_request_hook], "response": [async_response_hook]}
+        self.mirrors = MirrorPool(mirrors, self.base_url) if mirrors else None
+        self.rate_limiter = rate_limiter or GLOBAL_RATE_LIMITER
+        self.events = events or Events()
+        self.retry = retry or RetryPolicy()
+        self.token_cache = token_cache or GLOBAL_TOKEN_CACHE
+        self.preemptive_auth = preemptive_auth
+        self.capabilities = capabilities or GLOBAL_CAPABILITY_CACHE
+        self.__mirror_challenges: Dict[bytes, Optional[RegistryChallenge]] = {}
+        self.__probe_lock: Optional[asyncio.Lock] = None
+
+    @property
+    def need_auth(self) -> bool:
+        return self.__need_auth
+
+    @property
+    def challenge(self) -> RegistryChallenge:
+        return self.__challenge
+
+    async def ping(self):
+        resp = await self._ping_host(self.base_url)
+        self._use_challenge(_record_ping(self.capabilities, self.base_url, resp))
+
+    def _use_challenge(self, auth_header: str):
+        if not auth_header:
+            self.__need_auth = False
+            return
+        self.__challenge = parse_challenge(auth_header=auth_header)
+
+    async def _discover(self):
+        record = self.capabilities.get(host_of(self.base_url))
+        if record is None or record.challenge is None:
+            await self.ping()
+        else:
+            self._use_challenge(record.challenge)
+
+    async def _ping_host(self, url: httpx.URL) -> httpx.Response:
+        request = self.build_request("GET", url.join("/v2/"))
+        resp = await super(AsyncAuthClient, self).send(request, auth=httpx.Auth())
+        await resp.aclose()
+        return resp
+
+    async def new_auth(self, auth_by: Optional[Union[Tuple[str, str], Scope]] = None) -> httpx.Auth:
+        if auth_by is None:
+            return httpx.Auth()
+        if self.mirrors is not None:
+            return AsyncMirrorAuth(lambda url: self._host_auth(url, auth_by))
+        return await self._host_auth(self.base_url, auth_by)
+
+    async def _host_auth(self, url: httpx.URL, auth_by: Union[Tuple[str, str], Scope]) -> httpx.Auth:
+        host = self.mirrors.get(url) if self.mirrors is not None else None
+        if host is not None and host is not self.mirrors.fallback:
+            if url.netloc not in self.__mirror_challenges:
+                await self._probe_mirror(host)
+            challenge = self.__mirror_challenges.get(url.netloc)
+            return select_auth(
+                challenge is not None,
+                challenge,
+                "",
+                "",
+                auth_by,
+                bearer_auth_class=AsyncBearerAuth,
+                events=self.events,
+                client=self._token_client,
+                token_cache=self.token_cache,
+                preemptive=self.preemptive_auth,
+            )
+        if self.__challenge is None and self.__need_auth:
+            # the lock must be created inside the running loop
+            if self.__ping_lock is None:
+                self.__ping_lock = asyncio.Lock()
+            async with self.__ping_lock:
+                if self.__challenge is None and self.__need_auth:
+                    await self._discover()
+        return select_auth(
+            self.__need_auth,
+            self.__challenge,
+            self._username,
+            self._password,
+            auth_by,
+            bearer_auth_class=AsyncBearerAuth,
+            events=self.events,
+            client=self._token_client,
+            token_cache=self.token_cache,
+            preemptive=self.preemptive_auth,
+        )
+
+    async def _probe_mirror(self, host: HostStats):
+        started = time.monotonic()
+        try:
+            resp = await self._ping_host(host.url)
+        except httpx.TransportError as e:
+            self.mirrors.record_failure(host, e)
+            return
+        if resp.status_code >= 500:
+            self.mirrors.record_failure(host, f"status {resp.status_code}")
+            return
+        self.mirrors.record_success(host, time.monotonic() - started)
+        _auth_header = _record_ping(self.capabilities, host.url, resp)
+        self.__mirror_challenges[host.url.netloc] = parse_challenge(_auth_header) if _auth_header else None
+
+    async def prefetch_tokens(
+        self, scopes: List[RepositoryScope], scopes_per_token: int = DEFAULT_SCOPES_PER_TOKEN
+    ) -> List[RepositoryScope]:
+        """
+        the same as `AuthClient.prefetch_tokens`
+        """
+        if self.__challenge is None and self.__need_auth:
+            await self._discover()
+        if not self.__need_auth or self.__challenge.scheme != ChallengeScheme.Bearer:
+            return []
+        auth = AsyncBearerAuth(
+            self._username,
+            self._password,
+            self.__challenge,
+            EmptyScope(),
+            events=self.events,
+            client=self._token_client,
+            token_cache=self.token_cache,
+        )
+        missing = [scope for scope in scopes if auth.key_of(scope) not in self.token_cache]
+        request = self.build_request("GET", "/v2/")
+        granted: List[RepositoryScope] = []
+        for start in range(0, len(missing), scopes_per_token):
+            chunk = await auth.async_fetch_scopes(request, missing[start : start + scopes_per_token])
+            if not chunk:
+                break
+            granted.extend(chunk)
+        return granted
+
+    async def probe_mirrors(self):
+        await asyncio.gather(*(self._probe_mirror(host) for host in self.mirrors.mirrors))
+        self.mirrors.probed = True
+
+    async def send(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        return await self.retry.async_send(
+            request, lambda retry_request: self._send(retry_request, **kwargs), self.events.emit
+        )
+
+    async def _send(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        if self.mirrors is None or not is_mirrored(request):
+            return await self._send_to_host(request, **kwargs)
+        if not self.mirrors.probed:
+            if self.__probe_lock is None:
+                self.__probe_lock = asyncio.Lock()
+            async with self.__probe_lock:
+                if not self.mirrors.probed:
+                    await self.probe_mirrors()
+        return await self.mirrors.async_send(
+            request, lambda mirror_request: self._send_to_host(mirror_request, **kwargs)
+        )
+
+    async def _send_to_host(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        if self.rate_limiter.unlimited or not is_blob_request(request):
+            return await super(AsyncAuthClient, self).send(request, **kwargs)
+        host = request.url.host
+        await self.rate_limiter.async_throttle_request(host)
+        resp = await super(AsyncAuthClient, self).send(request, **kwargs)
+        await self.rate_limiter.async_throttle_response(host, resp)
+        return resp
 
     def _build_auth(self, auth: Optional[httpx._types.AuthTypes]) -> Optional[httpx.Auth]:
         if not self.__need_auth:
             return httpx.Auth()
         if isinstance(auth, tuple):
             self._username, self._password = auth
-        return super(AuthClient, self)._build_auth(auth)
+        return super(AsyncAuthClient, self)._build_auth(auth)
+
+    async def aclose(self):
+        await self._token_client.aclose()
+        await super(AsyncAuthClient, self).aclose()
+
+    async def __aexit__(self, *args):
+        await self._token_client.aclose()
+        await super(AsyncAuthClient, self).__aexit__(*args)
@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+# encoding : utf-8
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, Optional, Tuple
+
+from loguru import logger
+
+from registry_client.digest import Digest
+
+if sys.platform == "win32":
+    import msvcrt
+else:
+    import fcntl
+
+
+class FileLock:
+    """
+    An exclusive lock between processes and threads, based on a lock file.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self._thread_lock = threading.Lock()
+        self._file: Optional[BinaryIO] = None
+
+    def acquire(self):
+        self._thread_lock.acquire()
+        try:
+            self._file = open(self.path, "a+b")
+            if sys.platform == "win32":
+                self._file.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:  # LK_LOCK gives up after 10 seconds
+                        continue
+            else:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        except BaseException:
+            if self._file is not None:
+                self._file.close()
+            self._thread_lock.release()
+            raise
+
+    def release(self):
+        try:
+            if sys.platform == "win32":
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+        finally:
+            self._file = None
+            self._thread_lock.release()
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    hit_bytes: int = 0
+    added_bytes: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class BlobCache:
+    """
+    A content addressable blob store on local disk, it can be shared by processes.
+
+    ├── blobs
+    │  └── sha256
+    │     └── 2db29710123e3e53a794f2694094b9b4338aa9ee5c40b930cb8063a1be392c54
+    ├── ingest
+    └── lock
+
+    Blobs are added by renaming a complete file into blobs, so a blob in the cache is always complete.
+    The mtime of a blob is the last time it was used, the least recently used blobs are evicted
+    when the cache is larger than `max_size`.
+    """
+
+    def __init__(self, root: pathlib.Path, max_size: Optional[int] = None):
+        """
+        root: the cache directory
+        max_size: max bytes of all blobs, None means unlimited
+        """
+        self.root = root
+        self.max_size = max_size
+        self.blobs_dir = root.joinpath("blobs")
+        self.ingest_dir = root.joinpath("ingest")
+        self.blobs_dir.mkdir(parents=True, exist_ok=True)
+        self.ingest_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = FileLock(root.joinpath("lock"))
+        self._stats_lock = threading.Lock()
+        self.stats = CacheStats()
+
+    def path(self, digest: Digest) -> pathlib.Path:
+        return self.blobs_dir.joinpath(digest.algom.value, digest.hex)
+
+    def _hit(self, path: pathlib.Path) -> bool:
+        try:
+            size = path.stat().st_size
+            os.utime(path)
+        except FileNotFoundError:
+            with self._stats_lock:
+                self.stats.misses += 1
+            return False
+        with self._stats_lock:
+            self.stats.hits += 1
+            self.stats.hit_bytes += size
+        return True
+
+    def exists(self, digest: Digest) -> bool:
+        return self.path(digest).exists()
+
+    def open(self, digest: Digest) -> Optional[BinaryIO]:
+        """
+        return None if the blob isn't cached
+        """
+        path = self.path(digest)
+        if not self._hit(path):
+            return None
+        try:
+            return open(path, "rb")
+        except FileNotFoundError:  # evicted by another process
+            return None
+
+    def read_bytes(self, digest: Digest) -> Optional[bytes]:
+        f = self.open(digest)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def copy_to(self, digest: Digest, target: pathlib.Path) -> bool:
+        """
+        hard link or copy the blob to target, return False if the blob isn't cached
+        """
+        path = self.path(digest)
+        if not self._hit(path):
+            return False
+        try:
+            _link_or_copy(path, target)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def ingest_path(self, digest: Digest) -> pathlib.Path:
+        """
+        a unique path to write a blob before adding it, it is on the same file system as the cache
+        """
+        return self.ingest_dir.joinpath(f"{digest.hex}.{uuid.uuid4().hex}")
+
+    def add(self, digest: Digest, source: pathlib.Path, move: bool = False):
+        """
+        add a verified blob to the cache
+        move: move source into the cache instead of linking or copying it
+        """
+        tmp_path = self.ingest_path(digest)
+        if move:
+            shutil.move(str(source), str(tmp_path))
+        else:
+            _link_or_copy(source, tmp_path)
+        self._commit(digest, tmp_path)
+
+    def add_bytes(self, digest: Digest, content: bytes):
+        tmp_path = self.ingest_path(digest)
+        tmp_path.write_bytes(content)
+        self._commit(digest, tmp_path)
+
+    def _commit(self, digest: Digest, tmp_path: pathlib.Path):
+        path = self.path(digest)
+        path.parent.mkdir(exist_ok=True)
+        size = tmp_path.stat().st_size
+        with self._lock:
+            os.replace(tmp_path, path)
+            os.utime(path)
+            with self._stats_lock:
+                self.stats.added_bytes += size
+            self._evict()
+
+    def remove(self, digest: Digest):
+        with self._lock:
+            path = self.path(digest)
+            if path.exists():
+                path.unlink()
+
+    def size(self) -> int:
+        return sum(path.stat().st_size for path in self.blobs_dir.glob("*/*"))
+
+    def evict(self):
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        if self.max_size is None:
+            return
+        blobs = []
+        total = 0
+        for path in self.blobs_dir.glob("*/*"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            blobs.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        blobs.sort()
+        for _, size, path in blobs:
+            if total <= self.max_size:
+                break
+            logger.debug(f"evict blob {path.name} from cache")
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            with self._stats_lock:
+                self.stats.evictions += 1
+
+    def clean_ingest(self, max_age: int = 24 * 3600):
+        """
+        remove the files left by crashed processes
+        """
+        now = time.time()
+        for path in self.ingest_dir.iterdir():
+            try:
+                if now - path.stat().st_mtime > max_age:
+                    path.unlink()
+            except FileNotFoundError:
+                pass
+
+
+DEFAULT_MAX_MEMORY_ENTRIES = 1024
+DEFAULT_TAG_TTL = 300
+
+
+@dataclass
+class TagEntry:
+    """
+    the digest a tag pointed to, revalidated by etag once it isn't fresh
+    """
+
+    digest: Digest
+    etag: Optional[str]
+    checked_at: float
+
+    def is_fresh(self, ttl: float) -> bool:
+        return time.time() - self.checked_at < ttl
+
+
+class ManifestCache:
+    """
+    A two tier cache of manifests and image configs, an in-memory LRU over an optional directory.
+
+    ├── digests
+    │  └── sha256
+    │     └── 2db29710123e3e53a794f2694094b9b4338aa9ee5c40b930cb8063a1be392c54
+    └── tags
+       └── 0b5d0bb1c4a8e9f5d2a6d3b2a8f3e1c1b8f4c7d2e6f5a9b3c4d8e7f6a5b4c3d2
+
+    The content of a digest never changes, digest entries are kept forever.
+    A tag may be pushed again at any time, its entry is only used for `tag_ttl` seconds without asking the registry.
+    """
+
+    def __init__(
+        self,
+        root: Optional[pathlib.Path] = None,
+        max_memory_entries: int = DEFAULT_MAX_MEMORY_ENTRIES,
+        tag_ttl: float = DEFAULT_TAG_TTL,
+    ):
+        """
+        root: the cache directory, None means memory only
+        max_memory_entries: max number of digest entries kept in memory
+        tag_ttl: seconds a tag entry is used before revalidating it
+        """
+        self.root = root
+        self.max_memory_entries = max_memory_entries
+        self.tag_ttl = tag_ttl
+        self._digests: "OrderedDict[str, Tuple[str, bytes]]" = OrderedDict()
+        self._tags: Dict[str, TagEntry] = {}
+        self._lock = threading.Lock()
+        self.stats = CacheStats()
+        if root is not None:
+            root.joinpath("digests").mkdir(parents=True, exist_ok=True)
+            root.joinpath("tags").mkdir(parents=True, exist_ok=True)
+
+    def _digest_path(self, digest: Digest) -> pathlib.Path:
+        return self.root.joinpath("digests", digest.algom.value, digest.hex)
+
+    def _tag_path(self, key: str) -> pathlib.Path:
+        return self.root.joinpath("tags", hashlib.sha256(key.encode()).hexdigest())
+
+    def get(self, digest: Digest) -> Optional[Tuple[str, bytes]]:
+        """
+        return the media type and content of digest, None if it isn't cached
+        """
+        with self._lock:
+            entry = self._digests.get(digest.value)
+            if entry is not None:
+                self._digests.move_to_end(digest.value)
+                self.stats.hits += 1
+                return entry
+        entry = None
+        if self.root is not None:
+            try:
+                media_type, _, content = self._digest_path(digest).read_bytes().partition(b"\n")
+                entry = media_type.decode(), content
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            self.stats.hits += 1
+            self._remember(digest, entry)
+        return entry
+
+    def put(self, digest: Digest, media_type: str, content: bytes):
+        """
+        add verified content of digest
+        """
+        entry = media_type or "", content
+        with self._lock:
+            self._remember(digest, entry)
+            self.stats.added_bytes += len(content)
+        if self.root is not None:
+            path = self._digest_path(digest)
+            path.parent.mkdir(exist_ok=True)
+            _write_atomic(path, entry[0].encode() + b"\n" + content)
+
+    def _remember(self, digest: Digest, entry: Tuple[str, bytes]):
+        self._digests[digest.value] = entry
+        self._digests.move_to_end(digest.value)
+        while len(self._digests) > self.max_memory_entries:
+            self._digests.popitem(last=False)
+            self.stats.evictions += 1
+
+    def get_tag(self, key: str) -> Optional[TagEntry]:
+        """
+        the last known entry of a tag, fresh or not
+        """
+        with self._lock:
+            entry = self._tags.get(key)
+        if entry is not None or self.root is None:
+            return entry
+        try:
+            data = json.loads(self._tag_path(key).read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+        entry = TagEntry(digest=Digest(data["digest"]), etag=data.get("etag"), checked_at=data["checked_at"])
+        with self._lock:
+            self._tags[key] = entry
+        return entry
+
+    def put_tag(self, key: str, digest: Digest, etag: Optional[str] = None):
+        """
+        record the digest a tag points to now
+        """
+        entry = TagEntry(digest=digest, etag=etag, checked_at=time.time())
+        with self._lock:
+            self._tags[key] = entry
+        if self.root is not None:
+            data = {"key": key, "digest": digest.value, "etag": etag, "checked_at": entry.checked_at}
+            _write_atomic(self._tag_path(key), json.dumps(data).encode())
+
+    def clear_memory(self):
+        with self._lock:
+            self._digests.clear()
+            self._tags.clear()
+
+
+def _write_atomic(path: pathlib.Path, content: bytes):
+    tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}")
+    tmp_path.write_bytes(content)
+    os.replace(tmp_path, path)
+
+
+def _link_or_copy(source: pathlib.Path, target: pathlib.Path):
+    if target.exists():
+        target.unlink()
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# encoding : utf-8
+import dataclasses
+import hashlib
+import json
+import pathlib
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import httpx
+from loguru import logger
+
+from registry_client.cache import _write_atomic
+
+DEFAULT_CAPABILITY_TTL = 3600
+
+
+def host_of(url: httpx.URL) -> str:
+    return url.netloc.decode()
+
+
+@dataclass
+class HostCapabilities:
+    """
+    what a registry host is known to do, None means it isn't known yet
+
+    challenge: the `www-authenticate` header of `GET /v2/`, "" if it doesn't ask for auth
+    http2: `GET /v2/` was answered over HTTP/2
+    ranges: blobs are answered 206 to range requests
+    head_digest: HEAD of a manifest has `docker-content-digest`, otherwise the digest can only be computed by GET
+    redirects: blobs are redirected, e.g. to a CDN
+    """
+
+    host: str
+    checked_at: float
+    challenge: Optional[str] = None
+    http2: Optional[bool] = None
+    ranges: Optional[bool] = None
+    head_digest: Optional[bool] = None
+    redirects: Optional[bool] = None
+
+    def is_fresh(self, ttl: float) -> bool:
+        return time.time() - self.checked_at < ttl
+
+
+class CapabilityCache:
+    """
+    The capabilities of registry hosts learned from the responses, in memory over an optional directory
+    shared by the processes using it.
+
+    └── 0b5d0bb1c4a8e9f5d2a6d3b2a8f3e1c1b8f4c7d2e6f5a9b3c4d8e7f6a5b4c3d2
+
+    A registry may be reconfigured at any time, a record is forgotten `ttl` seconds after it was created
+    and learned again from the next responses.
+    """
+
+    def __init__(self, root: Optional[pathlib.Path] = None, ttl: float = DEFAULT_CAPABILITY_TTL):
+        """
+        root: the cache directory, None means memory only
+        ttl: seconds a record is used
+        """
+        self.root = root
+        self.ttl = ttl
+        self._hosts: Dict[str, HostCapabilities] = {}
+        self._lock = threading.Lock()
+
+    def _path(self, host: str) -> pathlib.Path:
+        return self.root.joinpath(hashlib.sha256(host.encode()).hexdigest())
+
+    def get(self, host: str) -> Optional[HostCapabilities]:
+        """
+        the capabilities of host, None if they aren't known or have expired
+        """
+        with self._lock:
+            record = self._hosts.get(host)
+        if record is None and self.root is not None:
+            record = self._load(host)
+            if record is not None:
+                with self._lock:
+                    self._hosts.setdefault(host, record)
+        if record is None or not record.is_fresh(self.ttl):
+            return None
+        return record
+
+    def _load(self, host: str) -> Optional[HostCapabilities]:
+        path = self._path(host)
+        try:
+            data = json.loads(path.read_text())
+            record = HostCapabilities(**data)
+        except FileNotFoundError:
+            return None
+        except (ValueError, TypeError) as e:
+            logger.debug(f"ignore capability file {path}: {e}")
+            return None
+        return record if record.host == host else None
+
+    def update(self, host: str, **capabilities) -> HostCapabilities:
+        """
+        record what host is known to do now, the record is only written if it changes
+        """
+        if self.root is not None and host not in self._hosts:
+            self.get(host)
+        with self._lock:
+            record = self._hosts.get(host)
+            if record is None or not record.is_fresh(self.ttl):
+                record = HostCapabilities(host=host, checked_at=time.time())
+            elif all(getattr(record, name) == value for name, value in capabilities.items()):
+                return record
+            record = dataclasses.replace(record, **capabilities)
+            self._hosts[host] = record
+        if self.root is not None:
+            self.root.mkdir(parents=True, exist_ok=True)
+            _write_atomic(self._path(host), json.dumps(dataclasses.asdict(record)).encode())
+        return record
+
+    def remove(self, host: str):
+        with self._lock:
+            self._hosts.pop(host, None)
+        if self.root is not None:
+            try:
+                self._path(host).unlink()
+            except FileNotFoundError:
+                pass
+
+    def clear_memory(self):
+        with self._lock:
+            self._hosts.clear()
+
+    def supports_ranges(self, host: str) -> bool:
+        """
+        False only if host is known to ignore range requests
+        """
+        record = self.get(host)
+        return record is None or record.ranges is not False
+
+    def sends_head_digest(self, host: str) -> bool:
+        """
+        False only if host is known to answer HEAD of a manifest without its digest
+        """
+        record = self.get(host)
+        return record is None or record.head_digest is not False
+
+
+GLOBAL_CAPABILITY_CACHE = CapabilityCache()
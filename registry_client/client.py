@@ -1,23 +1,48 @@
 #!/usr/bin/env python3
 # encoding : utf-8
 # create at: 2022/9/24-下午4:06
+import asyncio
+import contextlib
+import dataclasses
 import json
 import pathlib
 import re
+import shutil
 import tempfile
 import typing
-from typing import List, Optional, Union
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import AsyncIterator, Iterator, List, Optional, Union
 
 import httpx
 from loguru import logger
 
 from registry_client import errors, spec
-from registry_client.auth import AuthClient
+from registry_client.auth import AsyncAuthClient, AuthClient, TokenCache, pool_limits
+from registry_client.cache import BlobCache, ManifestCache
+from registry_client.capabilities import CapabilityCache
+from registry_client.compression import compression_from_media_type
 from registry_client.digest import Digest
-from registry_client.export import ImageV2Tar, OCIImageTar
-from registry_client.image import BlobClient, ImageClient, ImageFormat
+from registry_client.download import (
+    DEFAULT_MAX_CONCURRENT_DOWNLOADS,
+    DEFAULT_MAX_SEGMENTS,
+    DEFAULT_SEGMENT_THRESHOLD,
+    AsyncDownloader,
+    BlobTask,
+    Downloader,
+    SchedulePolicy,
+    largest_first,
+)
+from registry_client.events import Event, EventQueue, Events, PullFinished
+from registry_client.export import ImageV2Tar, OCIImageTar, TarStreamWriter
+from registry_client.image import (
+    AsyncBlobClient,
+    AsyncImageClient,
+    BlobClient,
+    ImageClient,
+    ImageFormat,
+)
 from registry_client.media_types import ImageMediaType, OCIImageMediaType
-from registry_client.platforms import Platform
+from registry_client.platforms import Platform, filter_by_platform
 from registry_client.reference import (
     CanonicalReference,
     DigestReference,
@@ -26,7 +51,11 @@ from registry_client.reference import (
     TaggedReference,
     parse_normalized_named,
 )
-from registry_client.repo import RepoClient
+from registry_client.repo import AsyncRepoClient, RepoClient
+from registry_client.retry import RetryPolicy
+from registry_client.scope import RepositoryScope
+from registry_client.seed import Seed
+from registry_client.throttle import RateLimiter
 from registry_client.utlis import (
     DEFAULT_REGISTRY_HOST,
     DEFAULT_REPO,
@@ -34,6 +63,424 @@ from registry_client.utlis import (
 )
 
 
+def _prepare_save_dir(save_dir: pathlib.Path):
+    if save_dir.exists():
+        assert save_dir.is_dir(), Exception("save_dir must be a directory")
+    if not save_dir.exists():
+        save_dir.mkdir(parents=True)
+
+
+def _image_save_path(ref: Reference, save_dir: pathlib.Path) -> pathlib.Path:
+    return save_dir.joinpath(f"{re.sub(r'[.:/]', '_', ref.name)}_{ref.target}.tar")
+
+
+def _repo_tag(base_url: httpx.URL, reference: TaggedReference):
+    assert reference != ""
+    if isinstance(reference, (CanonicalReference, DigestReference)):
+        return None
+    if isinstance(reference, NamedReference):
+        reference = TaggedReference(reference.domain, reference.path, "latest")
+    target = reference.target
+    result = reference.path.split("/", 1)
+    if base_url.netloc.decode() == DEFAULT_REGISTRY_HOST:
+        if len(result) == 2 and result[0] == DEFAULT_REPO:
+            return f"{result[-1]}:{target}"
+        return f"{reference.path}:{target}"
+    return str(reference)
+
+
+DEFAULT_MAX_CONCURRENT_INSPECTS = 8
+
+
+class InspectResult(typing.NamedTuple):
+    """
+    the image config of name, or the error raised while inspecting it
+    """
+
+    name: str
+    image: Optional[spec.Image] = None
+    error: Optional[Exception] = None
+
+
+def _group_by_repository(
+    image_names: typing.Iterable[str],
+) -> typing.Tuple[List[InspectResult], typing.Dict[str, List[typing.Tuple[str, Reference]]]]:
+    """
+    parse image names and group them by repository, names failed to parse are returned as results
+    """
+    invalid: List[InspectResult] = []
+    repositories: typing.Dict[str, List[typing.Tuple[str, Reference]]] = {}
+    for name in image_names:
+        try:
+            ref = parse_normalized_named(name)
+        except Exception as e:
+            invalid.append(InspectResult(name, error=e))
+            continue
+        repositories.setdefault(ref.path, []).append((name, ref))
+    return invalid, repositories
+
+
+_Key = typing.TypeVar("_Key")
+_Result = typing.TypeVar("_Result")
+
+
+def _run_by_repository(
+    func: typing.Callable[[_Key, Reference], _Result],
+    repositories: typing.Dict[str, List[typing.Tuple[_Key, Reference]]],
+    concurrency: int,
+) -> Iterator[typing.Tuple[_Key, Future]]:
+    """
+    call func on every reference with `concurrency` workers, yield its key and future as soon as it is done.
+    The first reference of a repository is done before the others, so they reuse its token
+    """
+    pending = dict(repositories)
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="image") as executor:
+        futures: typing.Dict[Future, typing.Tuple[str, _Key]] = {}
+
+        def submit(key: _Key, ref: Reference):
+            futures[executor.submit(func, key, ref)] = (ref.path, key)
+
+        for refs in pending.values():
+            submit(*refs[0])
+        try:
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    repository, key = futures.pop(future)
+                    for other_key, ref in pending.pop(repository, [])[1:]:
+                        submit(other_key, ref)
+                    yield key, future
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+async def _async_run_by_repository(
+    func: typing.Callable[[_Key, Reference], typing.Awaitable[_Result]],
+    repositories: typing.Dict[str, List[typing.Tuple[_Key, Reference]]],
+    concurrency: int,
+) -> AsyncIterator[typing.Tuple[_Key, Optional[_Result], Optional[Exception]]]:
+    """
+    the asyncio version of `_run_by_repository`, the result or the error of every reference is yielded
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    results: asyncio.Queue = asyncio.Queue()
+
+    async def run(key: _Key, ref: Reference):
+        async with semaphore:
+            try:
+                result = key, await func(key, ref), None
+            except Exception as e:
+                result = key, None, e
+        await results.put(result)
+
+    async def run_repository(refs: List[typing.Tuple[_Key, Reference]]):
+        await run(*refs[0])
+        await asyncio.gather(*(run(key, ref) for key, ref in refs[1:]))
+
+    tasks = [asyncio.ensure_future(run_repository(refs)) for refs in repositories.values()]
+    try:
+        for _ in range(sum(len(refs) for refs in repositories.values())):
+            yield await results.get()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _group_by_index(refs: List[Reference]) -> typing.Dict[str, List[typing.Tuple[int, Reference]]]:
+    repositories: typing.Dict[str, List[typing.Tuple[int, Reference]]] = {}
+    for index, ref in enumerate(refs):
+        repositories.setdefault(ref.path, []).append((index, ref))
+    return repositories
+
+
+class _ResolvedImage(typing.NamedTuple):
+    """
+    name: the repo tag saved in the image tar
+    ref: the reference of the image config
+    """
+
+    name: str
+    ref: CanonicalReference
+    manifest: httpx.Response
+    config: httpx.Response
+
+
+def _plan_docker_v2_layers(
+    ref: CanonicalReference,
+    save_dir: pathlib.Path,
+    manifest: httpx.Response,
+    image_config: httpx.Response,
+    resumable: bool = False,
+    keep_compressed: bool = False,
+) -> List[BlobTask]:
+    """
+    keep_compressed: save layers as downloaded instead of decompressing them, `docker load` accepts both
+    """
+    manifest_spec = spec.Manifest(**manifest.json())
+    image_config_spec = spec.Image(**image_config.json())
+    layer_id_generator = diff_ids_to_chain_ids(image_config_spec.rootfs.diff_ids)
+
+    tasks: List[BlobTask] = []
+    for index, layer_id in enumerate(layer_id_generator):
+        layer_desc = manifest_spec.layers[index]
+        new_ref = CanonicalReference(ref.domain, ref.path, digest=layer_desc.digest)
+        layer_path = save_dir.joinpath(Digest(layer_id).hex, "layer.tar")
+        tasks.append(
+            BlobTask(
+                ref=new_ref,
+                target=layer_path,
+                compression=compression_from_media_type(layer_desc.media_type),
+                decompress=not keep_compressed,
+                diff_id=image_config_spec.rootfs.diff_ids[index],
+                resumable=resumable,
+                size=layer_desc.size,
+            )
+        )
+    return tasks
+
+
+def _docker_v2_files(
+    save_dir: pathlib.Path, image_name: str, tasks: List[BlobTask], image_config: httpx.Response
+) -> typing.Dict[str, bytes]:
+    """
+    the files of a docker v2 image except layers, keyed by their path in the image
+    """
+    layer_path_list = [str(task.target.relative_to(save_dir).as_posix()) for task in tasks]
+    image_config_name = Digest.from_bytes(image_config.content).hex
+    data = [
+        {
+            "Config": image_config_name,
+            "RepoTags": [image_name] if image_name else [],
+            "Layers": layer_path_list,
+        }
+    ]
+    return {image_config_name: image_config.content, "manifest.json": json.dumps(data).encode()}
+
+
+def _plan_oci_blobs(
+    ref: CanonicalReference,
+    save_dir: pathlib.Path,
+    manifest: httpx.Response,
+    image_config: httpx.Response,
+    resumable: bool = False,
+) -> List[BlobTask]:
+    layer_save_dir = save_dir.joinpath("blobs")
+    diff_ids = spec.Image(**image_config.json()).rootfs.diff_ids
+    tasks: typing.Dict[Digest, BlobTask] = {}
+    for index, layer_spec in enumerate(spec.Manifest(**manifest.json()).layers):
+        target_digest = layer_spec.digest
+        if target_digest in tasks:
+            continue
+        target_temp = layer_save_dir.joinpath(f"{target_digest.algom.value}/{target_digest.hex}")
+        new_ref = CanonicalReference(ref.domain, ref.path, digest=target_digest)
+        tasks[target_digest] = BlobTask(
+            ref=new_ref,
+            target=target_temp,
+            compression=compression_from_media_type(layer_spec.media_type),
+            diff_id=diff_ids[index] if index < len(diff_ids) else None,
+            resumable=resumable,
+            size=layer_spec.size,
+        )
+    return list(tasks.values())
+
+
+def _oci_files(image_name: str, manifest: httpx.Response, image_config: httpx.Response) -> typing.Dict[str, bytes]:
+    """
+    the files of an oci image except layers, keyed by their path in the image
+    """
+
+    def blob_path(content: bytes) -> str:
+        d = Digest.from_bytes(content)
+        return f"blobs/{d.algom.value}/{d.hex}"
+
+    index = spec.Index(
+        mediaType=OCIImageMediaType.MediaTypeImageIndex,
+        manifests=[
+            spec.Descriptor(
+                mediaType=OCIImageMediaType.MediaTypeImageManifest,
+                digest=Digest.from_bytes(manifest.content),
+                size=len(manifest.content),
+                annotations={spec.AnnotationsKey.AnnotationBaseImageName.value: image_name},
+            )
+        ],
+    ).json(exclude_none=True, by_alias=True)
+    return {
+        blob_path(image_config.content): image_config.content,
+        spec.ImageLayoutFile: json.dumps(spec.ImageLayout().dict(by_alias=True)).encode(),
+        blob_path(manifest.content): manifest.content,
+        "index.json": index.encode(),
+    }
+
+
+def _plan_unique_blobs(images: List[_ResolvedImage], save_dir: pathlib.Path) -> List[BlobTask]:
+    """
+    the blobs of all images, a blob shared by images is downloaded from the repo of the first one
+    """
+    tasks: typing.Dict[Digest, BlobTask] = {}
+    for image in images:
+        for task in _plan_oci_blobs(image.ref, save_dir, image.manifest, image.config):
+            tasks.setdefault(task.ref.digest, task)
+    _make_parent_dirs(list(tasks.values()))
+    return list(tasks.values())
+
+
+def _fill_from_seed(
+    seed: pathlib.Path,
+    cache: BlobCache,
+    image: _ResolvedImage,
+    image_format: ImageFormat,
+    keep_compressed: bool = False,
+):
+    """
+    add the blobs of image found in seed to cache, so they aren't downloaded
+    """
+    if image_format == ImageFormat.V2:
+        tasks = _plan_docker_v2_layers(
+            image.ref, pathlib.Path(), image.manifest, image.config, keep_compressed=keep_compressed
+        )
+    else:
+        tasks = _plan_oci_blobs(image.ref, pathlib.Path(), image.manifest, image.config)
+    with Seed(seed) as seed_image:
+        seed_image.fill(cache, tasks)
+
+
+INDEX_MEDIA_TYPES = (
+    ImageMediaType.MediaTypeDockerSchema2ManifestList.value,
+    OCIImageMediaType.MediaTypeImageIndex.value,
+)
+# buildkit stores the attestations of an image in a manifest of the index, referring to the image by digest
+ATTESTATION_REFERENCE_DIGEST = "vnd.docker.reference.digest"
+
+
+def _check_manifest(resp: httpx.Response, ref: CanonicalReference):
+    if resp.status_code == 404:
+        raise errors.ImageNotFoundError(ref)
+    resp.raise_for_status()
+    digest = Digest.from_bytes(resp.content, ref.digest.algom)
+    if digest != ref.digest:
+        raise errors.ErrDigestMismatch(ref.digest, digest)
+
+
+def _select_manifests(index: httpx.Response, platforms: Optional[List[Platform]] = None) -> List[spec.Descriptor]:
+    """
+    the manifests of index matching any of platforms and the attestation manifests referring to them,
+    None means all manifests
+    """
+    manifests = spec.Index(**index.json()).manifests
+    if platforms is None:
+        return manifests
+    images = [desc for desc in manifests if not (desc.annotations or {}).get(ATTESTATION_REFERENCE_DIGEST)]
+    selected = set()
+    for platform in platforms:
+        match_manifests = filter_by_platform(images, target_platform=platform)
+        if not match_manifests:
+            raise errors.ImageNotFoundError(f"index {Digest.from_bytes(index.content)} for platform {platform}")
+        selected.add(match_manifests[0].digest.value)
+    return [
+        desc
+        for desc in manifests
+        if desc.digest.value in selected or (desc.annotations or {}).get(ATTESTATION_REFERENCE_DIGEST) in selected
+    ]
+
+
+def _plan_layout_blobs(
+    ref: CanonicalReference, save_dir: pathlib.Path, manifests: List[httpx.Response]
+) -> List[BlobTask]:
+    """
+    the configs and layers of manifests, a blob shared by manifests is downloaded once.
+    Manifests are read as plain json, attestation layers have media types unknown to `spec`
+    """
+    tasks: typing.Dict[str, BlobTask] = {}
+    for manifest in manifests:
+        content = manifest.json()
+        for desc in [content["config"], *content["layers"]]:
+            digest = Digest(desc["digest"])
+            if digest.value in tasks:
+                continue
+            tasks[digest.value] = BlobTask(
+                ref=CanonicalReference(ref.domain, ref.path, digest=digest),
+                target=save_dir.joinpath("blobs", digest.algom.value, digest.hex),
+                compression=None,
+                decompress=False,
+                size=desc["size"],
+            )
+    return list(tasks.values())
+
+
+def _oci_index_files(
+    image_name: Optional[str], index: httpx.Response, manifests: List[httpx.Response]
+) -> typing.Dict[str, bytes]:
+    """
+    the files of an oci layout except blobs, its index.json refers to the original index
+    """
+    files = {spec.ImageLayoutFile: json.dumps(spec.ImageLayout().dict(by_alias=True)).encode()}
+    for resp in [index, *manifests]:
+        digest = Digest.from_bytes(resp.content)
+        files[f"blobs/{digest.algom.value}/{digest.hex}"] = resp.content
+    annotations = {spec.AnnotationsKey.AnnotationBaseImageName.value: image_name} if image_name else None
+    files["index.json"] = (
+        spec.Index(
+            mediaType=OCIImageMediaType.MediaTypeImageIndex,
+            manifests=[
+                spec.Descriptor(
+                    mediaType=index.headers.get("Content-Type"),
+                    digest=Digest.from_bytes(index.content),
+                    size=len(index.content),
+                    annotations=annotations,
+                )
+            ],
+        )
+        .json(exclude_none=True, by_alias=True)
+        .encode()
+    )
+    return files
+
+
+def _write_files(save_dir: pathlib.Path, files: typing.Dict[str, bytes]):
+    for name, content in files.items():
+        path = save_dir.joinpath(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+
+
+def _streamable(tasks: List[BlobTask]) -> bool:
+    """
+    blobs of known sizes can be streamed into a tar, a decompressed layer is sized only once it is downloaded
+    """
+    return all(task.size is not None and not task.decompress for task in tasks)
+
+
+def _make_parent_dirs(tasks: List[BlobTask]):
+    for task in tasks:
+        task.target.parent.mkdir(parents=True, exist_ok=True)
+
+
+def _staging_dir(
+    work_dir: pathlib.Path, image_format: ImageFormat, manifest: httpx.Response, keep_compressed: bool = False
+) -> pathlib.Path:
+    """
+    the same image always uses the same staging dir in work_dir, so an interrupted pull can be resumed
+    """
+    layout = f"{image_format.value}_compressed" if keep_compressed else image_format.value
+    staging_dir = work_dir.joinpath(f"{layout}_{Digest.from_bytes(manifest.content).hex}")
+    staging_dir.mkdir(parents=True, exist_ok=True)
+    return staging_dir
+
+
+def _tar_image(
+    image_format: ImageFormat, src_dir: pathlib.Path, target_path: pathlib.Path, verified: bool = False
+) -> pathlib.Path:
+    if image_format == ImageFormat.OCI:
+        image_path = OCIImageTar(src_dir=src_dir, target_path=target_path, verified=verified).do()
+    elif image_format == ImageFormat.V2:
+        image_path = ImageV2Tar(src_dir=src_dir, target_path=target_path, verified=verified).do()
+    else:
+        raise RuntimeError(f"Invalid Image Format: {image_format}")
+    assert image_path.exists() and image_path.is_file(), RuntimeError("Image Pull Failed")
+    return image_path
+
+
 class RegistryClient:
     def __init__(
         self,
@@ -41,18 +488,79 @@ class RegistryClient:
         username: str = "",
         password: str = "",
         skip_verify=False,
+        max_concurrent_downloads: int = DEFAULT_MAX_CONCURRENT_DOWNLOADS,
+        blob_cache: Optional[BlobCache] = None,
+        segment_threshold: Optional[int] = DEFAULT_SEGMENT_THRESHOLD,
+        max_segments: int = DEFAULT_MAX_SEGMENTS,
+        manifest_cache: Optional[ManifestCache] = None,
+        prefer_head: bool = False,
+        mirrors: Optional[List[str]] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        schedule: SchedulePolicy = largest_first,
+        events: Optional[Events] = None,
+        retry: Optional[RetryPolicy] = None,
+        http2: bool = False,
+        limits: Optional[httpx.Limits] = None,
+        token_cache: Optional[TokenCache] = None,
+        preemptive_auth: bool = True,
+        capabilities: Optional[CapabilityCache] = None,
     ):
+        """
+        blob_cache: a local blob cache shared by pulls, blobs in it aren't downloaded again
+        segment_threshold: layers larger than it are downloaded in `max_segments` parallel byte ranges,
+            None disables it
+        manifest_cache: caches manifests, image configs and the digests of tags, see `ManifestCache`
+        prefer_head: resolve tags by HEAD, see `ImageClient`
+        mirrors: mirrors of host such as pull-through caches, tried in the order of their health and latency
+            before host itself, see `MirrorPool`
+        rate_limiter: the bandwidth and request rate limits of blob downloads, shared with other clients given
+            the same limiter, `GLOBAL_RATE_LIMITER` by default
+        schedule: the order layers are started in, see `DownloadOrder`
+        events: receives the progress and timings of downloads and token requests, see `registry_client.events`
+        retry: how failed requests are sent again and interrupted downloads are resumed, see `RetryPolicy`
+        http2: multiplex the requests to a registry over a connection, needs `registry_client[http2]`
+        limits: the connection pool, kept large enough for every download and segment by default
+        token_cache: the tokens shared with other clients given the same cache, `GLOBAL_TOKEN_CACHE` by default,
+            see `TokenStore` to keep them on disk
+        preemptive_auth: send requests with their tokens at first instead of waiting for a 401, see `AuthClient`
+        capabilities: what registries are known to do, shared with other clients given the same cache so a new client
+            doesn't ping the registry, `GLOBAL_CAPABILITY_CACHE` by default, see `CapabilityCache`
+        """
         self._username = username
         self._password = password
+        self.events = events or Events()
         self.client = AuthClient(
             base_url=host,
             auth=(username, password),
             verify=not skip_verify,
             follow_redirects=True,
+            mirrors=mirrors,
+            rate_limiter=rate_limiter,
+            events=self.events,
+            retry=retry,
+            http2=http2,
+            limits=limits or pool_limits(max_concurrent_downloads * max(max_segments, 1)),
+            token_cache=token_cache,
+            preemptive_auth=preemptive_auth,
+            capabilities=capabilities,
         )
         self._registry_client = RepoClient(self.client)
-        self._image_client = ImageClient(self.client)
+        self.blob_cache = blob_cache
+        self.manifest_cache = manifest_cache
+        self._image_client = ImageClient(
+            self.client, blob_cache=blob_cache, manifest_cache=manifest_cache, prefer_head=prefer_head
+        )
         self._blob_client = BlobClient(self.client)
+        self._downloader = Downloader(
+            self._blob_client,
+            max_concurrent_downloads=max_concurrent_downloads,
+            cache=blob_cache,
+            segment_threshold=segment_threshold,
+            max_segments=max_segments,
+            schedule=schedule,
+            events=self.events,
+            retry=retry,
+        )
 
     def catalog(self, count: Optional[int] = None, last: Optional[str] = None) -> List[str]:
         """
@@ -115,31 +623,79 @@ class RegistryClient:
         logger.info(f"delete image:{image_name} success")
         return True
 
-    def _get_manifest_digest(self, ref: Reference) -> CanonicalReference:
-        manifest_digest = self._image_client.get_manifest_digest(ref)
-        return CanonicalReference(ref.domain, ref.path, digest=manifest_digest)
-
-    def _get_manifest(self, ref: CanonicalReference, platform: Platform) -> httpx.Response:
-        manifest_content_resp = self._image_client.get_manifest(ref)
-        return self._image_client._handle_manifest(manifest_content_resp, ref, platform)
+    def _get_manifest(self, ref: Reference, platform: Platform) -> httpx.Response:
+        digest_ref, manifest_content_resp = self._image_client.resolve_manifest(ref)
+        return self._image_client._handle_manifest(manifest_content_resp, digest_ref, platform)
 
     def inspect_image(self, image_name: str, platform: Platform) -> spec.Image:
-        ref = parse_normalized_named(image_name)
+        return self._inspect(parse_normalized_named(image_name), platform)
 
-        digest_ref = self._get_manifest_digest(ref)
-        manifest_resp = self._get_manifest(digest_ref, platform)
+    def _inspect(self, ref: Reference, platform: Platform) -> spec.Image:
+        manifest_resp = self._get_manifest(ref, platform)
         manifest = spec.Manifest(**manifest_resp.json())
 
         image_digest_ref = CanonicalReference(ref.domain, ref.path, digest=manifest.config.digest)
         resp = self._image_client.get_config(image_digest_ref)
         return spec.Image(**resp.json())
 
+    def _inspect_result(self, name: str, ref: Reference, platform: Platform) -> InspectResult:
+        try:
+            return InspectResult(name, image=self._inspect(ref, platform))
+        except Exception as e:
+            return InspectResult(name, error=e)
+
+    def inspect_images(
+        self,
+        image_names: typing.Iterable[str],
+        platform: Optional[Platform] = None,
+        concurrency: int = DEFAULT_MAX_CONCURRENT_INSPECTS,
+    ) -> typing.Iterator[InspectResult]:
+        """
+        inspect many images with `concurrency` workers, results are yielded as soon as they are ready,
+        not in the order of image_names. An error is returned in the result of its image instead of being raised.
+        The tokens of the repositories are requested together at first, see `AuthClient.prefetch_tokens`,
+        and the first image of a repository is inspected before the others, so they reuse its token.
+
+        Usage:
+            for result in client.inspect_images(["alpine:3.16", "alpine:3.17", "busybox"]):
+                print(result.name, result.error or result.image.architecture)
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be greater than 0")
+        invalid, repositories = _group_by_repository(image_names)
+        yield from invalid
+        self._prefetch_tokens(repositories)
+        results = _run_by_repository(
+            lambda name, ref: self._inspect_result(name, ref, platform), repositories, concurrency
+        )
+        with contextlib.closing(results):
+            for _, future in results:
+                yield future.result()
+
+    def _prefetch_tokens(self, repositories: typing.Iterable[str]):
+        try:
+            self.client.prefetch_tokens([RepositoryScope(repository, actions=["pull"]) for repository in repositories])
+        except Exception as e:
+            # every repository requests its own token then
+            logger.warning(f"failed to prefetch tokens: {e!r}")
+
+    def _resolve_image(self, ref: Reference, platform: Platform) -> _ResolvedImage:
+        manifest_resp = self._get_manifest(ref, platform)
+        manifest = spec.Manifest(**manifest_resp.json())
+
+        image_digest_ref = CanonicalReference(ref.domain, ref.path, digest=manifest.config.digest)
+        image_config_resp = self._image_client.get_config(image_digest_ref)
+        return _ResolvedImage(self.repo_tag(ref), image_digest_ref, manifest_resp, image_config_resp)
+
     def pull_image(
         self,
         image_name: str,
         save_dir: pathlib.Path,
         platform: Platform = Platform(),
         image_format: ImageFormat = ImageFormat.V2,
+        work_dir: Optional[pathlib.Path] = None,
+        keep_compressed: bool = False,
+        seed: Optional[pathlib.Path] = None,
     ) -> pathlib.Path:
         """
         pull image and tar
@@ -147,59 +703,246 @@ class RegistryClient:
         :param save_dir: where to save the final image tar
         :param platform: image platform
         :param image_format: tar to `Docker V2` or `OCI`
+        :param work_dir: where to keep the downloading blobs, pull the same image with the same work_dir again
+            resumes the interrupted downloads, the image tar is written while downloading by default
+        :param keep_compressed: keep the layers of a `Docker V2` image compressed as downloaded
+        :param seed: a previous pull of the image, an oci layout or a `Docker V2` image, a directory or a tar.
+            Blobs found in it are reused by digest, only the others are downloaded
         :return: image save path
         :rtype: pathlib.Path
         """
         ref = parse_normalized_named(image_name)
-        if save_dir.exists():
-            assert save_dir.is_dir(), Exception("save_dir must be a directory")
-        if not save_dir.exists():
-            save_dir.mkdir(parents=True)
-        tmp_dir = tempfile.TemporaryDirectory(prefix="image_download_")
-        temp_dir_path = pathlib.Path(tmp_dir.name)
-        temp_dir_path.mkdir(exist_ok=True)
-        image_name = self.repo_tag(ref)
-
-        digest_ref = self._get_manifest_digest(ref)
-        manifest_resp = self._get_manifest(digest_ref, platform)
-        manifest = spec.Manifest(**manifest_resp.json())
+        _prepare_save_dir(save_dir)
+        image = self._resolve_image(ref, platform)
+        image_save_path = _image_save_path(ref, save_dir)
 
-        image_digest_ref = CanonicalReference(ref.domain, ref.path, digest=manifest.config.digest)
-        image_config_resp = self._image_client.get_config(image_digest_ref)
-        image_config = spec.Image(**image_config_resp.json())
-        target = ref.target
-        image_save_path = save_dir.joinpath(f"{re.sub(r'[.:/]', '_', ref.name)}_{target}.tar")
+        with contextlib.ExitStack() as stack:
+            downloader = self._downloader
+            if seed is not None:
+                cache = self.blob_cache
+                if cache is None:
+                    cache = BlobCache(pathlib.Path(stack.enter_context(tempfile.TemporaryDirectory(prefix="seed_"))))
+                _fill_from_seed(seed, cache, image, image_format, keep_compressed)
+                downloader = downloader.with_cache(cache)
 
-        if image_format == ImageFormat.OCI:
-            self._pull_oci_image(
-                ref=image_digest_ref,
-                image_name=image_name,
-                save_dir=temp_dir_path,
-                manifest=manifest_resp,
-                image_config=image_config_resp,
+            if work_dir is None:
+                return self._export_to_file(
+                    image_save_path, image, image_format, keep_compressed=keep_compressed, downloader=downloader
+                )
+
+            staging_dir = _staging_dir(work_dir, image_format, image.manifest, keep_compressed)
+            pull_options = dict(
+                ref=image.ref,
+                image_name=image.name,
+                save_dir=staging_dir,
+                manifest=image.manifest,
+                image_config=image.config,
+                resumable=True,
+                downloader=downloader,
             )
-            image_path = OCIImageTar(src_dir=temp_dir_path, target_path=image_save_path).do()
+            if image_format == ImageFormat.OCI:
+                self._pull_oci_image(**pull_options)
+            elif image_format == ImageFormat.V2:
+                self._pull_docker_v2_image(**pull_options, keep_compressed=keep_compressed)
+            else:
+                raise RuntimeError(f"Invalid Image Format: {image_format}")
+        # every blob is verified while downloading
+        image_path = _tar_image(image_format, staging_dir, image_save_path, verified=True)
+        shutil.rmtree(staging_dir)
+        return image_path
+
+    def pull_image_events(self, image_name: str, save_dir: pathlib.Path, **kwargs) -> Iterator[Event]:
+        """
+        pull image by `pull_image` in a background thread, and yield the events of the client meanwhile.
+        The last event is `PullFinished`, the error of the pull is raised instead.
+        Events of other pulls by the client at the same time are yielded as well,
+        the pull goes on even if the iteration stops early
+        """
+        events = self.events.subscribe(EventQueue())
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pull")
+        future = executor.submit(self.pull_image, image_name, save_dir, **kwargs)
+        future.add_done_callback(lambda _: events.close())
+        executor.shutdown(wait=False)
+        try:
+            yield from events
+        finally:
+            self.events.unsubscribe(events)
+        yield PullFinished(image_name, future.result())
+
+    def pull_images(
+        self,
+        image_names: List[str],
+        save_dir: pathlib.Path,
+        platform: Platform = Platform(),
+        image_format: ImageFormat = ImageFormat.V2,
+        keep_compressed: bool = False,
+        concurrency: int = DEFAULT_MAX_CONCURRENT_INSPECTS,
+    ) -> List[pathlib.Path]:
+        """
+        pull many images, a blob shared by them is downloaded only once.
+        The tokens of their repositories are requested together, see `AuthClient.prefetch_tokens`,
+        and the manifests of the images are resolved by `concurrency` workers like `inspect_images` does.
+        The unique blobs of all images are downloaded into `blob_cache` with `max_concurrent_downloads` at first,
+        then every image tar is written from it. A temporary cache is used if the client has no `blob_cache`,
+        blobs evicted from a small `blob_cache` before their images are written will be downloaded again.
+        :return: image save paths in the order of image_names
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be greater than 0")
+        refs = [parse_normalized_named(image_name) for image_name in image_names]
+        _prepare_save_dir(save_dir)
+        repositories = _group_by_index(refs)
+        self._prefetch_tokens(repositories)
+        images: List[_ResolvedImage] = [None] * len(refs)
+        resolved = _run_by_repository(lambda _, ref: self._resolve_image(ref, platform), repositories, concurrency)
+        with contextlib.closing(resolved):
+            for index, future in resolved:
+                images[index] = future.result()
+        with tempfile.TemporaryDirectory(prefix="image_download_") as tmp_dir:
+            tmp_path = pathlib.Path(tmp_dir)
+            downloader = self._downloader.with_cache(self.blob_cache or BlobCache(tmp_path.joinpath("cache")))
+            tasks = _plan_unique_blobs(images, tmp_path)
+            logger.info(f"download {len(tasks)} unique blobs of {len(images)} images")
+            downloader.download_all(tasks)
+            for path in tmp_path.joinpath("blobs").glob("*/*"):
+                path.unlink()
+            return [
+                self._export_to_file(
+                    _image_save_path(ref, save_dir), image, image_format, keep_compressed, downloader=downloader
+                )
+                for ref, image in zip(refs, images)
+            ]
+
+    def pull_index(
+        self,
+        image_name: str,
+        save_dir: pathlib.Path,
+        platforms: Optional[List[Platform]] = None,
+    ) -> pathlib.Path:
+        """
+        pull a multi-platform image into one oci image tar, whose index.json refers to the original index.
+        The manifests of `platforms` and their blobs are downloaded concurrently, blobs shared by platforms
+        such as attestation layers are downloaded once.
+        :param image_name: image name
+        :param save_dir: where to save the image tar
+        :param platforms: the platforms to keep, None means every manifest of the index
+        :return: image save path
+        """
+        ref = parse_normalized_named(image_name)
+        _prepare_save_dir(save_dir)
+        index_ref, index = self._image_client.resolve_manifest(ref)
+        _check_manifest(index, index_ref)
+        if index.headers.get("Content-Type") in INDEX_MEDIA_TYPES:
+            manifest_refs = [
+                CanonicalReference(ref.domain, ref.path, digest=desc.digest)
+                for desc in _select_manifests(index, platforms)
+            ]
+            max_workers = self._downloader.max_concurrent_downloads
+            with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="manifest") as executor:
+                manifests = list(executor.map(self._fetch_manifest, manifest_refs))
+        else:
+            manifests = [index]
+
+        image_save_path = _image_save_path(ref, save_dir)
+        tasks = _plan_layout_blobs(index_ref, pathlib.Path(), manifests)
+        logger.info(f"download {len(tasks)} unique blobs of {len(manifests)} manifests")
+        try:
+            with open(image_save_path, "wb") as f:
+                archive = TarStreamWriter(f)
+                for name, content in _oci_index_files(self.repo_tag(ref), index, manifests).items():
+                    archive.add_bytes(name, content)
+                self._add_blobs(archive, tasks, self._downloader)
+                archive.close()
+        except BaseException:
+            if image_save_path.exists():
+                image_save_path.unlink()
+            raise
+        return image_save_path
+
+    def _fetch_manifest(self, ref: CanonicalReference) -> httpx.Response:
+        resp = self._image_client.get_manifest(ref)
+        _check_manifest(resp, ref)
+        return resp
+
+    def export_image(
+        self,
+        image_name: str,
+        fileobj: typing.BinaryIO,
+        platform: Platform = Platform(),
+        image_format: ImageFormat = ImageFormat.V2,
+        keep_compressed: bool = False,
+    ):
+        """
+        pull image and write the image tar to fileobj while downloading, fileobj needn't be seekable
+
+        Usage:
+            client.export_image("hello-world:latest", sys.stdout.buffer)
+        """
+        image = self._resolve_image(parse_normalized_named(image_name), platform)
+        self._export(fileobj, image, image_format, keep_compressed=keep_compressed)
+
+    def _export_to_file(
+        self,
+        path: pathlib.Path,
+        image: _ResolvedImage,
+        image_format: ImageFormat,
+        keep_compressed: bool = False,
+        downloader: Optional[Downloader] = None,
+    ) -> pathlib.Path:
+        try:
+            with open(path, "wb") as f:
+                self._export(f, image, image_format, keep_compressed=keep_compressed, downloader=downloader)
+        except BaseException:
+            if path.exists():
+                path.unlink()
+            raise
+        return path
+
+    def _export(
+        self,
+        fileobj: typing.BinaryIO,
+        image: _ResolvedImage,
+        image_format: ImageFormat,
+        keep_compressed: bool = False,
+        downloader: Optional[Downloader] = None,
+    ):
+        downloader = downloader or self._downloader
+        ref, manifest, image_config = image.ref, image.manifest, image.config
+        archive = TarStreamWriter(fileobj)
+        if image_format == ImageFormat.OCI:
+            for name, content in _oci_files(image.name, manifest, image_config).items():
+                archive.add_bytes(name, content)
+            self._add_blobs(archive, _plan_oci_blobs(ref, pathlib.Path(), manifest, image_config), downloader)
         elif image_format == ImageFormat.V2:
-            self._pull_docker_v2_image(
-                ref=image_digest_ref,
-                image_name=image_name,
-                save_dir=temp_dir_path,
-                manifest=manifest_resp,
-                image_config=image_config_resp,
-            )
-            image_path = ImageV2Tar(src_dir=temp_dir_path, target_path=image_save_path).do()
+            tasks = _plan_docker_v2_layers(ref, pathlib.Path(), manifest, image_config, keep_compressed=keep_compressed)
+            for name, content in _docker_v2_files(pathlib.Path(), image.name, tasks, image_config).items():
+                archive.add_bytes(name, content)
+            self._add_blobs(archive, tasks, downloader)
         else:
             raise RuntimeError(f"Invalid Image Format: {image_format}")
-        assert image_path.exists() and image_path.is_file(), RuntimeError("Image Pull Failed")
-        return image_path
+        archive.close()
 
-    def _download_blob(self, ref: CanonicalReference, target: pathlib.Path, content_encoding=None):
-        with open(target, "wb") as f:
-            with self._blob_client.get(ref, stream=True) as resp:
-                if content_encoding is not None:
-                    resp.headers["content-encoding"] = content_encoding
-                for content in resp.iter_bytes():
-                    f.write(content)
+    @staticmethod
+    def _add_blobs(archive: TarStreamWriter, tasks: List[BlobTask], downloader: Downloader):
+        """
+        download blobs concurrently and add them to archive in the order of tasks, named by their relative targets.
+        Blobs of known sizes are streamed into their entries, decompressed layers are sized only once downloaded,
+        so they are spooled in a temporary directory, a few ahead of the tar
+        """
+        if _streamable(tasks):
+            with contextlib.closing(downloader.stream_iter(tasks)) as pipes:
+                for task, pipe in zip(tasks, pipes):
+                    with archive.open(task.target.as_posix(), task.size) as entry:
+                        for content in pipe:
+                            entry.write(content)
+            return
+        with tempfile.TemporaryDirectory(prefix="image_download_") as tmp_dir:
+            spooled = [dataclasses.replace(task, target=pathlib.Path(tmp_dir, task.target)) for task in tasks]
+            _make_parent_dirs(spooled)
+            with contextlib.closing(downloader.download_iter(spooled)) as paths:
+                for task, path in zip(tasks, paths):
+                    archive.add_file(task.target.as_posix(), path)
+                    path.unlink()
 
     def _pull_docker_v2_image(
         self,
@@ -208,44 +951,16 @@ class RegistryClient:
         save_dir: pathlib.Path,
         manifest: httpx.Response,
         image_config: httpx.Response,
+        resumable: bool = False,
+        keep_compressed: bool = False,
+        downloader: Optional[Downloader] = None,
     ):
-        manifest_spec = spec.Manifest(**manifest.json())
-        image_config_spec = spec.Image(**image_config.json())
-        layer_id_generator = diff_ids_to_chain_ids(image_config_spec.rootfs.diff_ids)
-
-        layer_path_list = []
-        for index, layer_id in enumerate(layer_id_generator):
-            layer_save_dir = save_dir.joinpath(Digest(layer_id).hex)
-            layer_save_dir.mkdir()
-            layer_desc = manifest_spec.layers[index]
-            new_ref = ref
-            new_ref.digest = layer_desc.digest
-            layer_path = layer_save_dir.joinpath("layer.tar")
-            encoding = (
-                "gzip"
-                if layer_desc.media_type
-                in (
-                    ImageMediaType.MediaTypeDockerSchema2LayerGzip,
-                    OCIImageMediaType.MediaTypeImageLayerGzip,
-                )
-                else None
-            )
-            self._download_blob(new_ref, layer_path, content_encoding=encoding)
-            layer_path_list.append(str(layer_path.relative_to(save_dir).as_posix()))
-
-        image_config_digest = Digest.from_bytes(image_config.content)
-        image_config_path = save_dir.joinpath(image_config_digest.hex)
-        image_config_path.write_bytes(image_config.content)
-
-        data = [
-            {
-                "Config": image_config_path.name,
-                "RepoTags": [image_name] if image_name else [],
-                "Layers": layer_path_list,
-            }
-        ]
-        with open(save_dir.joinpath("manifest.json"), "w") as out_file:
-            json.dump(data, out_file)
+        tasks = _plan_docker_v2_layers(
+            ref, save_dir, manifest, image_config, resumable=resumable, keep_compressed=keep_compressed
+        )
+        _make_parent_dirs(tasks)
+        (downloader or self._downloader).download_all(tasks)
+        _write_files(save_dir, _docker_v2_files(save_dir, image_name, tasks, image_config))
 
     def _pull_oci_image(
         self,
@@ -254,59 +969,437 @@ class RegistryClient:
         save_dir: pathlib.Path,
         manifest: httpx.Response,
         image_config: httpx.Response,
+        resumable: bool = False,
+        downloader: Optional[Downloader] = None,
     ):
-        def write_json(content: bytes) -> typing.Tuple[Digest, pathlib.Path]:
-            d = Digest.from_bytes(content)
-            p = layer_save_dir.joinpath(f"{d.algom.value}/{d.hex}")
-            p.parent.mkdir(exist_ok=True)
-            p.write_bytes(content)
-            return d, p
-
-        layer_save_dir = save_dir.joinpath("blobs")
-        layer_save_dir.mkdir(parents=True)
-        layers: typing.List[spec.Descriptor] = []
-        for layer_spec in spec.Manifest(**manifest.json()).layers:
-            target_digest = layer_spec.digest
-            target_temp = layer_save_dir.joinpath(f"{target_digest.algom.value}/{target_digest.hex}")
-            if target_temp.exists():
-                continue
-            target_temp.parent.mkdir(exist_ok=True)
-            new_ref = ref
-            new_ref.digest = target_digest
-            self._download_blob(new_ref, target_temp)
-            size = target_temp.stat().st_size
-            layers.append(spec.Descriptor(mediaType=layer_spec.media_type, digest=target_digest, size=size))
-        write_json(image_config.content)
+        tasks = _plan_oci_blobs(ref, save_dir, manifest, image_config, resumable=resumable)
+        _make_parent_dirs(tasks)
+        (downloader or self._downloader).download_all(tasks)
+        _write_files(save_dir, _oci_files(image_name, manifest, image_config))
 
-        with save_dir.joinpath(spec.ImageLayoutFile).open("w", encoding="utf-8") as f:
-            json.dump(spec.ImageLayout().dict(by_alias=True), f)
+    def repo_tag(self, reference: TaggedReference):
+        return _repo_tag(self.client.base_url, reference)
 
-        manifest_digest, manifest_path = write_json(manifest.content)
 
-        index = spec.Index(
-            mediaType=OCIImageMediaType.MediaTypeImageIndex,
-            manifests=[
-                spec.Descriptor(
-                    mediaType=OCIImageMediaType.MediaTypeImageManifest,
-                    digest=manifest_digest,
-                    size=manifest_path.stat().st_size,
-                    annotations={spec.AnnotationsKey.AnnotationBaseImageName.value: image_name},
+class AsyncRegistryClient:
+    """
+    the asyncio version of `RegistryClient`, use it as an async context manager or call `aclose` when done
+    """
+
+    def __init__(
+        self,
+        host="https://registry-1.docker.io",
+        username: str = "",
+        password: str = "",
+        skip_verify=False,
+        max_concurrent_downloads: int = DEFAULT_MAX_CONCURRENT_DOWNLOADS,
+        blob_cache: Optional[BlobCache] = None,
+        segment_threshold: Optional[int] = DEFAULT_SEGMENT_THRESHOLD,
+        max_segments: int = DEFAULT_MAX_SEGMENTS,
+        manifest_cache: Optional[ManifestCache] = None,
+        prefer_head: bool = False,
+        mirrors: Optional[List[str]] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        schedule: SchedulePolicy = largest_first,
+        events: Optional[Events] = None,
+        retry: Optional[RetryPolicy] = None,
+        http2: bool = False,
+        limits: Optional[httpx.Limits] = None,
+        token_cache: Optional[TokenCache] = None,
+        preemptive_auth: bool = True,
+        capabilities: Optional[CapabilityCache] = None,
+    ):
+        """
+        the same options as `RegistryClient`
+        """
+        self._username = username
+        self._password = password
+        self.events = events or Events()
+        self.client = AsyncAuthClient(
+            base_url=host,
+            auth=(username, password),
+            verify=not skip_verify,
+            follow_redirects=True,
+            mirrors=mirrors,
+            rate_limiter=rate_limiter,
+            events=self.events,
+            retry=retry,
+            http2=http2,
+            limits=limits or pool_limits(max_concurrent_downloads * max(max_segments, 1)),
+            token_cache=token_cache,
+            preemptive_auth=preemptive_auth,
+            capabilities=capabilities,
+        )
+        self._registry_client = AsyncRepoClient(self.client)
+        self.blob_cache = blob_cache
+        self.manifest_cache = manifest_cache
+        self._image_client = AsyncImageClient(
+            self.client, blob_cache=blob_cache, manifest_cache=manifest_cache, prefer_head=prefer_head
+        )
+        self._blob_client = AsyncBlobClient(self.client)
+        self._downloader = AsyncDownloader(
+            self._blob_client,
+            max_concurrent_downloads=max_concurrent_downloads,
+            cache=blob_cache,
+            segment_threshold=segment_threshold,
+            max_segments=max_segments,
+            schedule=schedule,
+            events=self.events,
+            retry=retry,
+        )
+
+    async def __aenter__(self) -> "AsyncRegistryClient":
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def catalog(self, count: Optional[int] = None, last: Optional[str] = None) -> List[str]:
+        resp = await self._registry_client.list(count, last)
+        resp.raise_for_status()
+        return resp.json().get("repositories", [])
+
+    async def list_tags(self, image_name: str, limit: Optional[int] = None, last: Optional[str] = None) -> List[str]:
+        ref = parse_normalized_named(image_name)
+        assert isinstance(ref, NamedReference), Exception("No tag or digest allowed in reference")
+        resp = await self._image_client.list_tag(ref, limit, last)
+        if resp.status_code in [401, 404]:
+            logger.warning("image may be dont exist, return empty list")
+            return []
+        resp.raise_for_status()
+        tags = resp.json().get("tags", None)
+        return tags if tags is not None else []
+
+    async def delete_image(self, image_name: str):
+        ref = parse_normalized_named(image_name)
+        if not isinstance(ref, CanonicalReference):
+            raise errors.ErrNameNotCanonical()
+        resp = await self._image_client.delete(ref)
+        if resp.status_code == 404:
+            raise errors.ImageNotFoundError(image_name)
+        resp.raise_for_status()
+        logger.info(f"delete image:{image_name} success")
+        return True
+
+    async def _get_manifest(self, ref: Reference, platform: Platform) -> httpx.Response:
+        digest_ref, manifest_content_resp = await self._image_client.resolve_manifest(ref)
+        return await self._image_client._handle_manifest(manifest_content_resp, digest_ref, platform)
+
+    async def inspect_image(self, image_name: str, platform: Platform) -> spec.Image:
+        return await self._inspect(parse_normalized_named(image_name), platform)
+
+    async def _inspect(self, ref: Reference, platform: Platform) -> spec.Image:
+        manifest_resp = await self._get_manifest(ref, platform)
+        manifest = spec.Manifest(**manifest_resp.json())
+
+        image_digest_ref = CanonicalReference(ref.domain, ref.path, digest=manifest.config.digest)
+        resp = await self._image_client.get_config(image_digest_ref)
+        return spec.Image(**resp.json())
+
+    async def inspect_images(
+        self,
+        image_names: typing.Iterable[str],
+        platform: Optional[Platform] = None,
+        concurrency: int = DEFAULT_MAX_CONCURRENT_INSPECTS,
+    ) -> typing.AsyncIterator[InspectResult]:
+        """
+        inspect many images, the same as `RegistryClient.inspect_images`
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be greater than 0")
+        invalid, repositories = _group_by_repository(image_names)
+        for result in invalid:
+            yield result
+        await self._prefetch_tokens(repositories)
+        results = _async_run_by_repository(lambda name, ref: self._inspect(ref, platform), repositories, concurrency)
+        try:
+            async for name, image, error in results:
+                yield InspectResult(name, image=image, error=error)
+        finally:
+            await results.aclose()
+
+    async def iter_blob(self, ref: CanonicalReference, chunk_size: Optional[int] = None) -> typing.AsyncIterator[bytes]:
+        """
+        stream a blob without buffering it in memory
+
+        Usage:
+            async for content in client.iter_blob(ref):
+                ...
+        """
+        async for content in self._blob_client.iter_bytes(ref, chunk_size=chunk_size):
+            yield content
+
+    async def _prefetch_tokens(self, repositories: typing.Iterable[str]):
+        try:
+            await self.client.prefetch_tokens(
+                [RepositoryScope(repository, actions=["pull"]) for repository in repositories]
+            )
+        except Exception as e:
+            logger.warning(f"failed to prefetch tokens: {e!r}")
+
+    async def _resolve_image(self, ref: Reference, platform: Platform) -> _ResolvedImage:
+        manifest_resp = await self._get_manifest(ref, platform)
+        manifest = spec.Manifest(**manifest_resp.json())
+
+        image_digest_ref = CanonicalReference(ref.domain, ref.path, digest=manifest.config.digest)
+        image_config_resp = await self._image_client.get_config(image_digest_ref)
+        return _ResolvedImage(_repo_tag(self.client.base_url, ref), image_digest_ref, manifest_resp, image_config_resp)
+
+    async def pull_image(
+        self,
+        image_name: str,
+        save_dir: pathlib.Path,
+        platform: Platform = Platform(),
+        image_format: ImageFormat = ImageFormat.V2,
+        work_dir: Optional[pathlib.Path] = None,
+        keep_compressed: bool = False,
+        seed: Optional[pathlib.Path] = None,
+    ) -> pathlib.Path:
+        """
+        pull image and tar, the same as `RegistryClient.pull_image`
+        """
+        ref = parse_normalized_named(image_name)
+        _prepare_save_dir(save_dir)
+        image = await self._resolve_image(ref, platform)
+        image_save_path = _image_save_path(ref, save_dir)
+
+        with contextlib.ExitStack() as stack:
+            downloader = self._downloader
+            if seed is not None:
+                cache = self.blob_cache
+                if cache is None:
+                    cache = BlobCache(pathlib.Path(stack.enter_context(tempfile.TemporaryDirectory(prefix="seed_"))))
+                # verifying the seed reads every reused blob, keep it away from the event loop
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(None, _fill_from_seed, seed, cache, image, image_format, keep_compressed)
+                downloader = downloader.with_cache(cache)
+
+            if work_dir is None:
+                return await self._export_to_file(
+                    image_save_path, image, image_format, keep_compressed=keep_compressed, downloader=downloader
                 )
-            ],
-        ).json(exclude_none=True, by_alias=True)
-        with open(save_dir.joinpath("index.json"), "w") as f:
-            f.write(index)
 
-    def repo_tag(self, reference: TaggedReference):
-        assert reference != ""
-        if isinstance(reference, (CanonicalReference, DigestReference)):
-            return None
-        if isinstance(reference, NamedReference):
-            reference = TaggedReference(reference.domain, reference.path, "latest")
-        target = reference.target
-        result = reference.path.split("/", 1)
-        if self.client.base_url.netloc.decode() == DEFAULT_REGISTRY_HOST:
-            if len(result) == 2 and result[0] == DEFAULT_REPO:
-                return f"{result[-1]}:{target}"
-            return f"{reference.path}:{target}"
-        return str(reference)
+            staging_dir = _staging_dir(work_dir, image_format, image.manifest, keep_compressed)
+            plan_args = (image.ref, staging_dir, image.manifest, image.config, True)
+            if image_format == ImageFormat.OCI:
+                tasks = _plan_oci_blobs(*plan_args)
+                _make_parent_dirs(tasks)
+                await downloader.download_all(tasks)
+                _write_files(staging_dir, _oci_files(image.name, image.manifest, image.config))
+            elif image_format == ImageFormat.V2:
+                tasks = _plan_docker_v2_layers(*plan_args, keep_compressed=keep_compressed)
+                _make_parent_dirs(tasks)
+                await downloader.download_all(tasks)
+                _write_files(staging_dir, _docker_v2_files(staging_dir, image.name, tasks, image.config))
+            else:
+                raise RuntimeError(f"Invalid Image Format: {image_format}")
+        # checking and taring read every file, keep them away from the event loop
+        loop = asyncio.get_event_loop()
+        image_path = await loop.run_in_executor(None, _tar_image, image_format, staging_dir, image_save_path, True)
+        shutil.rmtree(staging_dir)
+        return image_path
+
+    async def pull_image_events(self, image_name: str, save_dir: pathlib.Path, **kwargs) -> AsyncIterator[Event]:
+        """
+        the asyncio version of `RegistryClient.pull_image_events`, the pull is cancelled if the iteration stops early
+        """
+        loop = asyncio.get_event_loop()
+        events: asyncio.Queue = asyncio.Queue()
+
+        def listener(event: Event):
+            # events may come from the threads of the executor
+            loop.call_soon_threadsafe(events.put_nowait, event)
+
+        self.events.subscribe(listener)
+        task = asyncio.ensure_future(self.pull_image(image_name, save_dir, **kwargs))
+        task.add_done_callback(lambda _: events.put_nowait(None))
+        try:
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                yield event
+        finally:
+            self.events.unsubscribe(listener)
+            if not task.done():
+                task.cancel()
+        yield PullFinished(image_name, task.result())
+
+    async def pull_images(
+        self,
+        image_names: List[str],
+        save_dir: pathlib.Path,
+        platform: Platform = Platform(),
+        image_format: ImageFormat = ImageFormat.V2,
+        keep_compressed: bool = False,
+        concurrency: int = DEFAULT_MAX_CONCURRENT_INSPECTS,
+    ) -> List[pathlib.Path]:
+        """
+        pull many images, the same as `RegistryClient.pull_images`
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be greater than 0")
+        refs = [parse_normalized_named(image_name) for image_name in image_names]
+        _prepare_save_dir(save_dir)
+        repositories = _group_by_index(refs)
+        await self._prefetch_tokens(repositories)
+        images: List[_ResolvedImage] = [None] * len(refs)
+        resolved = _async_run_by_repository(
+            lambda _, ref: self._resolve_image(ref, platform), repositories, concurrency
+        )
+        try:
+            async for index, image, error in resolved:
+                if error is not None:
+                    raise error
+                images[index] = image
+        finally:
+            await resolved.aclose()
+        with tempfile.TemporaryDirectory(prefix="image_download_") as tmp_dir:
+            tmp_path = pathlib.Path(tmp_dir)
+            downloader = self._downloader.with_cache(self.blob_cache or BlobCache(tmp_path.joinpath("cache")))
+            tasks = _plan_unique_blobs(images, tmp_path)
+            logger.info(f"download {len(tasks)} unique blobs of {len(images)} images")
+            await downloader.download_all(tasks)
+            for path in tmp_path.joinpath("blobs").glob("*/*"):
+                path.unlink()
+            return [
+                await self._export_to_file(
+                    _image_save_path(ref, save_dir), image, image_format, keep_compressed, downloader=downloader
+                )
+                for ref, image in zip(refs, images)
+            ]
+
+    async def pull_index(
+        self,
+        image_name: str,
+        save_dir: pathlib.Path,
+        platforms: Optional[List[Platform]] = None,
+    ) -> pathlib.Path:
+        """
+        pull a multi-platform image into one oci image tar, the same as `RegistryClient.pull_index`
+        """
+        ref = parse_normalized_named(image_name)
+        _prepare_save_dir(save_dir)
+        index_ref, index = await self._image_client.resolve_manifest(ref)
+        _check_manifest(index, index_ref)
+        if index.headers.get("Content-Type") in INDEX_MEDIA_TYPES:
+            manifests = list(
+                await asyncio.gather(
+                    *(
+                        self._fetch_manifest(CanonicalReference(ref.domain, ref.path, digest=desc.digest))
+                        for desc in _select_manifests(index, platforms)
+                    )
+                )
+            )
+        else:
+            manifests = [index]
+
+        image_save_path = _image_save_path(ref, save_dir)
+        tasks = _plan_layout_blobs(index_ref, pathlib.Path(), manifests)
+        logger.info(f"download {len(tasks)} unique blobs of {len(manifests)} manifests")
+        image_name = _repo_tag(self.client.base_url, ref)
+        try:
+            with open(image_save_path, "wb") as f:
+                archive = TarStreamWriter(f)
+                for name, content in _oci_index_files(image_name, index, manifests).items():
+                    archive.add_bytes(name, content)
+                await self._add_blobs(archive, tasks, self._downloader)
+                archive.close()
+        except BaseException:
+            if image_save_path.exists():
+                image_save_path.unlink()
+            raise
+        return image_save_path
+
+    async def _fetch_manifest(self, ref: CanonicalReference) -> httpx.Response:
+        resp = await self._image_client.get_manifest(ref)
+        _check_manifest(resp, ref)
+        return resp
+
+    async def export_image(
+        self,
+        image_name: str,
+        fileobj: typing.BinaryIO,
+        platform: Platform = Platform(),
+        image_format: ImageFormat = ImageFormat.V2,
+        keep_compressed: bool = False,
+    ):
+        """
+        pull image and write the image tar to fileobj while downloading, the same as `RegistryClient.export_image`
+        """
+        image = await self._resolve_image(parse_normalized_named(image_name), platform)
+        await self._export(fileobj, image, image_format, keep_compressed=keep_compressed)
+
+    async def _export_to_file(
+        self,
+        path: pathlib.Path,
+        image: _ResolvedImage,
+        image_format: ImageFormat,
+        keep_compressed: bool = False,
+        downloader: Optional[AsyncDownloader] = None,
+    ) -> pathlib.Path:
+        try:
+            with open(path, "wb") as f:
+                await self._export(f, image, image_format, keep_compressed=keep_compressed, downloader=downloader)
+        except BaseException:
+            if path.exists():
+                path.unlink()
+            raise
+        return path
+
+    async def _export(
+        self,
+        fileobj: typing.BinaryIO,
+        image: _ResolvedImage,
+        image_format: ImageFormat,
+        keep_compressed: bool = False,
+        downloader: Optional[AsyncDownloader] = None,
+    ):
+        downloader = downloader or self._downloader
+        ref, manifest, image_config = image.ref, image.manifest, image.config
+        archive = TarStreamWriter(fileobj)
+        if image_format == ImageFormat.OCI:
+            for name, content in _oci_files(image.name, manifest, image_config).items():
+                archive.add_bytes(name, content)
+            await self._add_blobs(archive, _plan_oci_blobs(ref, pathlib.Path(), manifest, image_config), downloader)
+        elif image_format == ImageFormat.V2:
+            tasks = _plan_docker_v2_layers(ref, pathlib.Path(), manifest, image_config, keep_compressed=keep_compressed)
+            for name, content in _docker_v2_files(pathlib.Path(), image.name, tasks, image_config).items():
+                archive.add_bytes(name, content)
+            await self._add_blobs(archive, tasks, downloader)
+        else:
+            raise RuntimeError(f"Invalid Image Format: {image_format}")
+        archive.close()
+
+    @staticmethod
+    async def _add_blobs(archive: TarStreamWriter, tasks: List[BlobTask], downloader: AsyncDownloader):
+        """
+        the asyncio version of `RegistryClient._add_blobs`
+        """
+        if _streamable(tasks):
+            pipes = downloader.stream_iter(tasks)
+            try:
+                index = 0
+                async for pipe in pipes:
+                    with archive.open(tasks[index].target.as_posix(), tasks[index].size) as entry:
+                        async for content in pipe:
+                            entry.write(content)
+                    index += 1
+            finally:
+                await pipes.aclose()
+            return
+        with tempfile.TemporaryDirectory(prefix="image_download_") as tmp_dir:
+            spooled = [dataclasses.replace(task, target=pathlib.Path(tmp_dir, task.target)) for task in tasks]
+            _make_parent_dirs(spooled)
+            paths = downloader.download_iter(spooled)
+            try:
+                index = 0
+                async for path in paths:
+                    archive.add_file(tasks[index].target.as_posix(), path)
+                    path.unlink()
+                    index += 1
+            finally:
+                await paths.aclose()
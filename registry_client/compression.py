@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# encoding : utf-8
+import bz2
+import lzma
+import zlib
+from enum import Enum
+from typing import BinaryIO, Callable, Optional, Union
+
+from registry_client.digest import CHUNK_SIZE, Algorithm, Digest, Digester
+from registry_client.media_types import ImageMediaType, OCIImageMediaType
+
+BZIP_MAGIC = b"\x42\x5a\x68"
+GZIP_MAGIC = b"\x1f\x8b\x08"
+XZ_MAGIC = b"\xfd\x37\x7a\x58\x5a\x00"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+class Compression(Enum):
+    Gzip = "gzip"
+    Zstd = "zstd"
+    Bzip2 = "bzip2"
+    Xz = "xz"
+
+
+MEDIA_TYPE_COMPRESSION = {
+    ImageMediaType.MediaTypeDockerSchema2LayerGzip: Compression.Gzip,
+    ImageMediaType.MediaTypeDockerSchema2LayerForeignGzip: Compression.Gzip,
+    OCIImageMediaType.MediaTypeImageLayerGzip: Compression.Gzip,
+    OCIImageMediaType.MediaTypeImageLayerNonDistributableGzip: Compression.Gzip,
+    OCIImageMediaType.MediaTypeImageLayerZstd: Compression.Zstd,
+    OCIImageMediaType.MediaTypeImageLayerNonDistributableZstd: Compression.Zstd,
+}
+
+MAGIC_COMPRESSION = {
+    GZIP_MAGIC: Compression.Gzip,
+    ZSTD_MAGIC: Compression.Zstd,
+    BZIP_MAGIC: Compression.Bzip2,
+    XZ_MAGIC: Compression.Xz,
+}
+MAGIC_SIZE = max(len(magic) for magic in MAGIC_COMPRESSION)
+
+
+def compression_from_media_type(media_type: Union[ImageMediaType, OCIImageMediaType]) -> Optional[Compression]:
+    return MEDIA_TYPE_COMPRESSION.get(media_type)
+
+
+def detect_compression(header: bytes) -> Optional[Compression]:
+    """
+    sniff the compression from the first `MAGIC_SIZE` bytes, None means uncompressed
+    """
+    for magic, compression in MAGIC_COMPRESSION.items():
+        if header.startswith(magic):
+            return compression
+    return None
+
+
+class StreamDecompressor:
+    """
+    decompress a stream chunk by chunk, concatenated streams such as multi-member gzip are supported
+    """
+
+    def __init__(self, factory: Callable):
+        self._factory = factory
+        self._decompressor = factory()
+
+    def decompress(self, content: bytes) -> bytes:
+        result = []
+        while content:
+            result.append(self._decompressor.decompress(content))
+            if not self._decompressor.eof:
+                break
+            content = self._decompressor.unused_data
+            self._decompressor = self._factory()
+        return b"".join(result)
+
+    def flush(self) -> bytes:
+        flush = getattr(self._decompressor, "flush", None)
+        return flush() if flush else b""
+
+
+class GzipDecompressor(StreamDecompressor):
+    def __init__(self):
+        super(GzipDecompressor, self).__init__(lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
+
+
+def new_decompressor(compression: Optional[Compression]) -> Optional[StreamDecompressor]:
+    """
+    return None if the compression is unsupported
+    """
+    if compression == Compression.Gzip:
+        return GzipDecompressor()
+    if compression == Compression.Bzip2:
+        return StreamDecompressor(bz2.BZ2Decompressor)
+    if compression == Compression.Xz:
+        return StreamDecompressor(lzma.LZMADecompressor)
+    return None
+
+
+def uncompressed_digest(f: BinaryIO, algorithm: Algorithm) -> Optional[Digest]:
+    """
+    the digest of the uncompressed content of a file, which is never written anywhere.
+    return None if the compression is unsupported
+    """
+    header = f.read(MAGIC_SIZE)
+    compression = detect_compression(header)
+    decompressor = new_decompressor(compression)
+    if compression is not None and decompressor is None:
+        return None
+    digester = Digester(algorithm)
+    f.seek(0)
+    for content in iter(lambda: f.read(CHUNK_SIZE), b""):
+        digester.update(decompressor.decompress(content) if decompressor else content)
+    if decompressor:
+        digester.update(decompressor.flush())
+    return digester.digest()
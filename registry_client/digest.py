@@ -30,6 +30,7 @@ class Algorithm(Enum):
 
 
 DEFAULT_ALGORITHM = Algorithm.SHA256
+CHUNK_SIZE = 1024 * 1024
 
 
 class Digest(UserString):
@@ -75,9 +76,12 @@ class Digest(UserString):
         return self.data
 
     @classmethod
-    def from_file(cls, f: pathlib.Path) -> "Digest":
+    def from_file(cls, f: pathlib.Path, algorithm: Algorithm = DEFAULT_ALGORITHM) -> "Digest":
+        digester = Digester(algorithm)
         with open(f, "rb") as in_file:
-            return cls.from_bytes(in_file.read())
+            for content in iter(lambda: in_file.read(CHUNK_SIZE), b""):
+                digester.update(content)
+        return digester.digest()
 
     @classmethod
     def from_bytes(cls, content: bytes, algorithm: Algorithm = DEFAULT_ALGORITHM) -> "Digest":
@@ -105,3 +109,21 @@ class Digest(UserString):
     def validate_bytes(self, content: bytes, algorithm: Algorithm = DEFAULT_ALGORITHM):
         new_digest = self.from_bytes(content, algorithm)
         return self == new_digest
+
+
+class Digester:
+    """
+    calculate a digest incrementally, for content which is too large to keep in memory
+    """
+
+    def __init__(self, algorithm: Algorithm = DEFAULT_ALGORITHM):
+        self.algorithm = algorithm
+        self._hash = Digest._get_hasher(algorithm)()
+        self.size = 0
+
+    def update(self, content: bytes):
+        self._hash.update(content)
+        self.size += len(content)
+
+    def digest(self) -> Digest:
+        return Digest(f"{self.algorithm.value}:{self._hash.hexdigest()}")
@@ -0,0 +1,1341 @@
+#!/usr/bin/env python3
+# encoding : utf-8
+import asyncio
+import collections
+import contextlib
+import copy
+import dataclasses
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import (
+    FIRST_EXCEPTION,
+    Executor,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass
+from enum import Enum
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    BinaryIO,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+import httpx
+from loguru import logger
+
+from registry_client import errors
+from registry_client.cache import BlobCache
+from registry_client.capabilities import CapabilityCache, host_of
+from registry_client.compression import (
+    MAGIC_SIZE,
+    Compression,
+    detect_compression,
+    new_decompressor,
+)
+from registry_client.digest import CHUNK_SIZE, Digest, Digester
+from registry_client.events import (
+    BlobFailed,
+    BlobFinished,
+    BlobProgress,
+    BlobStarted,
+    Events,
+)
+from registry_client.image import AsyncBlobClient, BlobClient
+from registry_client.reference import CanonicalReference
+from registry_client.retry import RetryPolicy
+
+DEFAULT_MAX_CONCURRENT_DOWNLOADS = 3
+DEFAULT_MAX_RESUME_ATTEMPTS = 3
+PARTIAL_SUFFIX = ".partial"
+STATE_SUFFIX = ".partial.json"
+STATE_SAVE_INTERVAL = 8 * 1024 * 1024
+DEFAULT_SEGMENT_THRESHOLD = 256 * 1024 * 1024
+DEFAULT_MAX_SEGMENTS = 4
+PIPE_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+@dataclass
+class BlobTask:
+    """
+    ref: the blob to download, `ref.digest` is checked against the downloaded content
+    target: where to save the blob
+    compression: how the blob is compressed, None means uncompressed
+    decompress: save the uncompressed content instead of the blob itself
+    diff_id: the digest of the uncompressed content, from `rootfs.diff_ids` of the image config
+    resumable: keep the partial blob beside target when the download fails, and resume from it next time
+    size: the size of the blob from its descriptor, large blobs are downloaded in segments
+    """
+
+    ref: CanonicalReference
+    target: pathlib.Path
+    compression: Optional[Compression] = None
+    decompress: bool = False
+    diff_id: Optional[Digest] = None
+    resumable: bool = False
+    size: Optional[int] = None
+
+
+# the order blobs are started in, given the blobs in manifest order
+SchedulePolicy = Callable[[List[BlobTask]], List[BlobTask]]
+
+
+def manifest_order(tasks: List[BlobTask]) -> List[BlobTask]:
+    return list(tasks)
+
+
+def largest_first(tasks: List[BlobTask]) -> List[BlobTask]:
+    """
+    a pull takes at least as long as its largest blob, starting it first keeps the other slots busy meanwhile.
+    blobs of unknown size are started last
+    """
+    return sorted(tasks, key=lambda task: -task.size if task.size is not None else 1)
+
+
+def smallest_first(tasks: List[BlobTask]) -> List[BlobTask]:
+    """
+    the most blobs done early, for early feedback
+    """
+    return sorted(tasks, key=lambda task: task.size if task.size is not None else float("inf"))
+
+
+class DownloadOrder(Enum):
+    Manifest = "manifest"
+    LargestFirst = "largest-first"
+    SmallestFirst = "smallest-first"
+
+    @property
+    def policy(self) -> SchedulePolicy:
+        return {
+            DownloadOrder.Manifest: manifest_order,
+            DownloadOrder.LargestFirst: largest_first,
+            DownloadOrder.SmallestFirst: smallest_first,
+        }[self]
+
+
+@dataclass
+class Segment:
+    """
+    a byte range of a blob, `end` is inclusive like the Range header
+    """
+
+    start: int
+    end: int
+    received: int = 0
+
+    @property
+    def position(self) -> int:
+        return self.start + self.received
+
+    @property
+    def remaining(self) -> int:
+        return self.end + 1 - self.position
+
+    def write(self, f: BinaryIO, content: bytes):
+        content = content[: self.remaining]
+        f.write(content)
+        self.received += len(content)
+
+
+def split_segments(size: int, count: int) -> List[Segment]:
+    step = max(-(-size // count), 1)
+    return [Segment(start, min(start + step, size) - 1) for start in range(0, size, step)]
+
+
+class BlobWriter:
+    """
+    Write a blob while it arrives, the digest of the blob and the digest of its uncompressed content
+    are calculated in the same pass, so the saved file never needs to be read again.
+    """
+
+    def __init__(self, task: BlobTask, fileobj: BinaryIO, raw_fileobj: Optional[BinaryIO] = None):
+        """
+        fileobj: receives the blob, or its uncompressed content if `task.decompress`
+        raw_fileobj: receives the blob as well, it is used to keep the blob for resuming when decompressing
+        """
+        self.task = task
+        self._file = fileobj
+        self._raw_file = raw_fileobj
+        self.offset = 0
+        self._digester = Digester(task.ref.digest.algom)
+        self._decompressor = None
+        self._diff_digester: Optional[Digester] = None
+        # the compression is sniffed from the magic of the blob, the media type may be wrong
+        self.compression = task.compression
+        self._sniffing = task.decompress or task.diff_id is not None
+        self._pending: List[Tuple[bytes, bool]] = []
+        self._pending_size = 0
+
+    def _sniff(self):
+        self._sniffing = False
+        header = b"".join(content for content, _ in self._pending)[:MAGIC_SIZE]
+        self.compression = detect_compression(header)
+        if self.compression != self.task.compression:
+            logger.debug(
+                f"blob {self.task.ref.digest} is compressed by {self.compression}, not {self.task.compression}"
+            )
+        if self.compression is not None:
+            self._decompressor = new_decompressor(self.compression)
+            if self._decompressor is None:
+                logger.warning(f"unsupported compression {self.compression.value}, skip checking diff_id")
+            else:
+                self._diff_digester = Digester(
+                    self.task.diff_id.algom if self.task.diff_id else self._digester.algorithm
+                )
+        pending, self._pending = self._pending, []
+        for content, replay in pending:
+            self._consume(content, replay)
+
+    def write(self, content: bytes, replay: bool = False):
+        """
+        replay: the content was saved by an interrupted download, only rebuild the hash state from it
+        """
+        self._digester.update(content)
+        self.offset += len(content)
+        if self._raw_file is not None and not replay:
+            self._raw_file.write(content)
+        if not self._sniffing:
+            self._consume(content, replay)
+            return
+        self._pending.append((content, replay))
+        self._pending_size += len(content)
+        if self._pending_size >= MAGIC_SIZE:
+            self._sniff()
+
+    def _consume(self, content: bytes, replay: bool):
+        if self._decompressor is None:
+            if not replay:
+                self._file.write(content)
+            return
+        uncompressed = self._decompressor.decompress(content)
+        self._diff_digester.update(uncompressed)
+        if self.task.decompress:
+            self._file.write(uncompressed)
+        elif not replay:
+            self._file.write(content)
+
+    @property
+    def decompressing(self) -> bool:
+        return self.task.decompress and self._decompressor is not None
+
+    def state(self) -> Dict:
+        """
+        hash objects can't be saved, so save the digest of the received content to check the replay
+        """
+        return {
+            "digest": self.task.ref.digest.value,
+            "offset": self.offset,
+            "prefix_digest": self._digester.digest().value,
+        }
+
+    def verify(self):
+        """
+        Raises:
+            ErrDigestMismatch
+        """
+        if self._sniffing:
+            self._sniff()
+        if self._decompressor is not None:
+            uncompressed = self._decompressor.flush()
+            self._diff_digester.update(uncompressed)
+            if self.task.decompress:
+                self._file.write(uncompressed)
+        digest = self._digester.digest()
+        if digest != self.task.ref.digest:
+            raise errors.ErrDigestMismatch(self.task.ref.digest, digest)
+        if self.task.diff_id is None:
+            return
+        if self._diff_digester is not None:
+            diff_id = self._diff_digester.digest()
+        elif self.compression is None:
+            diff_id = digest
+        else:
+            return
+        if diff_id != self.task.diff_id:
+            raise errors.ErrDigestMismatch(self.task.diff_id, diff_id)
+
+
+class RangeNotSatisfiable(Exception):
+    """
+    the partial blob doesn't match the blob in registry, it has been dropped and should be downloaded again
+    """
+
+
+class RangeNotSupported(Exception):
+    """
+    the registry doesn't respond 206 to a range request, so the blob can't be downloaded in segments
+    """
+
+
+class BlobFile:
+    """
+    The files a blob is downloaded to.
+    A resumable blob is written to `<target>.partial` with a state file `<target>.partial.json`,
+    and moved to target when done. If the blob is decompressed, target receives the uncompressed content
+    while `<target>.partial` keeps the blob.
+    A downloaded blob is added to `cache` if given.
+    """
+
+    def __init__(self, task: BlobTask, cache: Optional[BlobCache] = None):
+        self.task = task
+        self.cache = cache
+        self.partial_path = task.target.with_name(task.target.name + PARTIAL_SUFFIX)
+        self.state_path = task.target.with_name(task.target.name + STATE_SUFFIX)
+        self.writer: Optional[BlobWriter] = None
+        self._file: Optional[BinaryIO] = None
+        self._raw_file: Optional[BinaryIO] = None
+        self._saved_offset = 0
+
+    @property
+    def completed(self) -> bool:
+        return self.task.resumable and self.task.target.exists() and not self.state_path.exists()
+
+    @property
+    def keep_blob(self) -> bool:
+        """
+        either or not keep the blob in `<target>.partial` besides the uncompressed content
+        """
+        return self.task.decompress and (self.task.resumable or self.cache is not None)
+
+    def load_from_cache(self) -> bool:
+        """
+        return False if the blob isn't cached
+        """
+        if self.cache is None:
+            return False
+        digest = self.task.ref.digest
+        if not self.task.decompress:
+            return self.cache.copy_to(digest, self.task.target)
+        diff_id = self.task.diff_id
+        if diff_id is not None and diff_id != digest and self.cache.exists(diff_id):
+            # the uncompressed content is cached as well, e.g. a layer of a seed image
+            if self.cache.copy_to(diff_id, self.task.target):
+                return True
+        f = self.cache.open(digest)
+        if f is None:
+            return False
+        try:
+            with f, open(self.task.target, "wb") as out:
+                writer = BlobWriter(self.task, out)
+                for content in iter(lambda: f.read(1024 * 1024), b""):
+                    writer.write(content)
+                writer.verify()
+        except errors.ErrDigestMismatch as e:
+            logger.warning(f"drop broken blob {digest} from cache: {e}")
+            self.cache.remove(digest)
+            return False
+        return True
+
+    @property
+    def offset(self) -> int:
+        return self.writer.offset
+
+    @property
+    def interrupted(self) -> bool:
+        """
+        a single stream download of the blob can be resumed
+        """
+        return self.task.resumable and self._load_state() is not None
+
+    def preallocate(self) -> pathlib.Path:
+        """
+        create `<target>.partial` with the size of the blob, segments are written into it at their offsets
+        """
+        self._remove()
+        with open(self.partial_path, "wb") as f:
+            f.truncate(self.task.size)
+        return self.partial_path
+
+    def _load_state(self) -> Optional[Dict]:
+        if not self.state_path.exists() or not self.partial_path.exists():
+            return None
+        try:
+            state = json.loads(self.state_path.read_text())
+        except ValueError:
+            return None
+        if state.get("digest") != self.task.ref.digest.value:
+            return None
+        if self.partial_path.stat().st_size < state.get("offset", 0):
+            return None
+        return state
+
+    def open(self) -> BlobWriter:
+        if not self.task.resumable:
+            self._file = open(self.task.target, "wb")
+            if self.keep_blob:
+                self._raw_file = open(self.partial_path, "wb")
+            self.writer = BlobWriter(self.task, self._file, self._raw_file)
+            return self.writer
+        state = self._load_state()
+        if state is None:
+            return self._open_partial(0)
+        writer = self._open_partial(state["offset"])
+        with open(self.partial_path, "rb") as f:
+            for content in iter(lambda: f.read(1024 * 1024), b""):
+                writer.write(content, replay=True)
+        if writer.state()["prefix_digest"] != state.get("prefix_digest"):
+            logger.warning(f"partial blob {self.partial_path} is broken, download again")
+            return self.reset()
+        logger.info(f"resume blob {self.task.ref.digest} from {writer.offset}")
+        self._saved_offset = writer.offset
+        return writer
+
+    def _open_partial(self, offset: int) -> BlobWriter:
+        with open(self.partial_path, "ab") as f:
+            f.truncate(offset)
+        if self.task.decompress:
+            self._file = open(self.task.target, "wb")
+            self._raw_file = open(self.partial_path, "ab")
+        else:
+            self._file = open(self.partial_path, "ab")
+        self.writer = BlobWriter(self.task, self._file, self._raw_file)
+        if offset == 0:
+            self.checkpoint()
+        return self.writer
+
+    def write(self, content: bytes):
+        self.writer.write(content)
+        if self.task.resumable and self.writer.offset - self._saved_offset >= STATE_SAVE_INTERVAL:
+            self.checkpoint()
+
+    def checkpoint(self):
+        if not self.task.resumable:
+            return
+        for f in (self._file, self._raw_file):
+            if f is not None:
+                f.flush()
+        tmp_path = self.state_path.with_name(self.state_path.name + ".tmp")
+        tmp_path.write_text(json.dumps(self.writer.state()))
+        os.replace(tmp_path, self.state_path)
+        self._saved_offset = self.writer.offset
+
+    def reset(self) -> BlobWriter:
+        """
+        drop everything received and start from the beginning
+        """
+        self.close()
+        self._remove()
+        return self.open()
+
+    def commit(self) -> pathlib.Path:
+        self.writer.verify()
+        self.close()
+        if self.task.resumable and not self.task.decompress:
+            os.replace(self.partial_path, self.task.target)
+        return self._finish()
+
+    def commit_segments(self) -> pathlib.Path:
+        """
+        verify the blob assembled in `<target>.partial`, the uncompressed content is written in the same pass
+        """
+        if self.task.decompress:
+            self._file = open(self.task.target, "wb")
+        self.writer = BlobWriter(self.task, self._file)
+        with open(self.partial_path, "rb") as f:
+            for content in iter(lambda: f.read(CHUNK_SIZE), b""):
+                self.writer.write(content, replay=True)
+        self.writer.verify()
+        self.close()
+        if not self.writer.decompressing:
+            os.replace(self.partial_path, self.task.target)
+        return self._finish()
+
+    def _finish(self) -> pathlib.Path:
+        if self.cache is not None:
+            if self.partial_path.exists():
+                self.cache.add(self.task.ref.digest, self.partial_path, move=True)
+            else:
+                self.cache.add(self.task.ref.digest, self.task.target)
+        self._remove(self.partial_path, self.state_path)
+        return self.task.target
+
+    def discard(self, exc: BaseException):
+        """
+        keep the received content of a resumable blob, unless it is broken
+        """
+        if self.writer is not None and self.task.resumable and not isinstance(exc, errors.ErrDigestMismatch):
+            self.checkpoint()
+            self.close()
+            return
+        self.close()
+        self._remove()
+
+    def close(self):
+        for f in (self._file, self._raw_file):
+            if f is not None:
+                f.close()
+        self._file = self._raw_file = None
+
+    def _remove(self, *paths: pathlib.Path):
+        for path in paths or (self.task.target, self.partial_path, self.state_path):
+            if path.exists():
+                path.unlink()
+
+
+class BlobStream:
+    """
+    A blob written to a file object which can't seek, such as an entry of a streaming tar.
+    It can be resumed with range requests but never restarted, the blob is also added to `cache` if given.
+    """
+
+    def __init__(self, task: BlobTask, fileobj: BinaryIO, cache: Optional[BlobCache] = None):
+        self.task = task
+        self.cache = cache
+        self.writer: Optional[BlobWriter] = None
+        self._file = fileobj
+        self._raw_file: Optional[BinaryIO] = None
+        self._ingest_path: Optional[pathlib.Path] = None
+
+    @property
+    def offset(self) -> int:
+        return self.writer.offset
+
+    def load_from_cache(self) -> bool:
+        """
+        return False if the blob isn't cached
+        """
+        if self.cache is None:
+            return False
+        f = self.cache.open(self.task.ref.digest)
+        if f is None:
+            return False
+        writer = BlobWriter(self.task, self._file)
+        with f:
+            for content in iter(lambda: f.read(CHUNK_SIZE), b""):
+                writer.write(content)
+        try:
+            writer.verify()
+        except errors.ErrDigestMismatch:
+            self.cache.remove(self.task.ref.digest)
+            raise
+        return True
+
+    def open(self) -> BlobWriter:
+        if self.cache is not None:
+            self._ingest_path = self.cache.ingest_path(self.task.ref.digest)
+            self._raw_file = open(self._ingest_path, "wb")
+        self.writer = BlobWriter(self.task, self._file, self._raw_file)
+        return self.writer
+
+    def write(self, content: bytes):
+        self.writer.write(content)
+
+    def reset(self):
+        raise RangeNotSupported(f"blob {self.task.ref.digest} can't be downloaded again from the beginning")
+
+    def commit(self):
+        self.writer.verify()
+        self.close()
+        if self._ingest_path is not None:
+            self.cache.add(self.task.ref.digest, self._ingest_path, move=True)
+
+    def discard(self, exc: BaseException):
+        self.close()
+        if self._ingest_path is not None and self._ingest_path.exists():
+            self._ingest_path.unlink()
+
+    def close(self):
+        if self._raw_file is not None:
+            self._raw_file.close()
+            self._raw_file = None
+
+
+class BlobPipe:
+    """
+    A bounded buffer between a blob streamed by `download_to` and its reader, the blob is never saved to a file.
+    The download waits while `max_size` bytes are unread, the reader iterates the content in a thread,
+    or in `loop` with `async for`, until the download is closed.
+    """
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None, max_size: int = PIPE_BUFFER_SIZE):
+        self.max_size = max_size
+        self._loop = loop
+        self._readable = asyncio.Event() if loop is not None else None
+        self._cond = threading.Condition()
+        self._chunks: Deque[bytes] = collections.deque()
+        self._size = 0
+        self._closed = False
+        self._aborted = False
+        self._error: Optional[BaseException] = None
+
+    def write(self, content: bytes) -> int:
+        with self._cond:
+            while self._size >= self.max_size and not self._aborted:
+                self._cond.wait()
+            if self._aborted:
+                raise BrokenPipeError("the reader of the blob is gone")
+            self._chunks.append(content)
+            self._size += len(content)
+            self._notify()
+        return len(content)
+
+    def close(self, error: Optional[BaseException] = None):
+        """
+        the download is done, or failed by error which is raised to the reader
+        """
+        with self._cond:
+            self._closed = True
+            self._error = error
+            self._notify()
+
+    def abort(self):
+        """
+        the reader is gone, the download fails at its next write
+        """
+        with self._cond:
+            self._aborted = True
+            self._chunks.clear()
+            self._size = 0
+            self._cond.notify_all()
+
+    def _notify(self):
+        self._cond.notify_all()
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._readable.set)
+
+    def _pop(self) -> Optional[bytes]:
+        """
+        the next content, None at the end of the blob
+        """
+        if self._chunks:
+            content = self._chunks.popleft()
+            self._size -= len(content)
+            self._cond.notify_all()
+            return content
+        if self._error is not None:
+            raise self._error
+        return None
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            with self._cond:
+                while not self._chunks and not self._closed:
+                    self._cond.wait()
+                content = self._pop()
+            if content is None:
+                return
+            yield content
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        while True:
+            with self._cond:
+                ready = bool(self._chunks) or self._closed
+                if ready:
+                    content = self._pop()
+                else:
+                    self._readable.clear()
+            if not ready:
+                await self._readable.wait()
+                continue
+            if content is None:
+                return
+            yield content
+
+
+class BlobMeter:
+    """
+    measure a download of a blob and emit its events, nothing is done if no one listens
+    """
+
+    def __init__(self, task: BlobTask, events: Events):
+        self.task = task
+        self.events = events
+        self.started = time.monotonic()
+        self.transferred = 0
+        self.time_to_first_byte: Optional[float] = None
+        self.verify_time = 0.0
+        self.host: Optional[str] = None
+        self.cached = False
+        self.retries = 0
+        self.wasted = 0
+        self._lock = threading.Lock()
+        if events.active:
+            events.emit(BlobStarted(task.ref.digest, task.size))
+
+    def response(self, resp: httpx.Response, sent: float):
+        """
+        sent: when the request was sent, the first response counts for time to first byte
+        """
+        with self._lock:
+            if self.time_to_first_byte is None:
+                self.time_to_first_byte = time.monotonic() - sent
+                self.host = (resp.history[0] if resp.history else resp).request.url.host
+
+    def received(self, amount: int):
+        with self._lock:
+            self.transferred += amount
+            transferred = self.transferred
+        if self.events.active:
+            self.events.emit(BlobProgress(self.task.ref.digest, amount, transferred, self.task.size))
+
+    def resumed(self):
+        with self._lock:
+            self.retries += 1
+
+    def discarded(self, amount: int):
+        """
+        amount bytes received are thrown away and will be downloaded again
+        """
+        with self._lock:
+            self.wasted += amount
+
+    @contextlib.contextmanager
+    def verifying(self):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.verify_time += time.monotonic() - started
+
+    def finished(self):
+        if not self.events.active:
+            return
+        self.events.emit(
+            BlobFinished(
+                digest=self.task.ref.digest,
+                size=self.task.size,
+                transferred=self.transferred,
+                elapsed=time.monotonic() - self.started,
+                time_to_first_byte=self.time_to_first_byte,
+                verify_time=self.verify_time,
+                host=self.host,
+                cached=self.cached,
+                retries=self.retries,
+                wasted=self.wasted,
+            )
+        )
+
+    def failed(self, error: BaseException):
+        if self.events.active:
+            self.events.emit(BlobFailed(self.task.ref.digest, error))
+
+
+def _use_segments(
+    task: BlobTask, segment_threshold: Optional[int], max_segments: int, supports_ranges: bool = True
+) -> bool:
+    """
+    a blob of a known size not below segment_threshold is split into segments, an empty blob has nothing to split
+    """
+    size = task.size
+    if segment_threshold is None or not size or max_segments < 2 or not supports_ranges:
+        return False
+    return size >= segment_threshold
+
+
+def _spooled(task: BlobTask, tmp_dir: pathlib.Path) -> BlobTask:
+    """
+    the task of a blob downloaded to tmp_dir before it is streamed
+    """
+    return dataclasses.replace(task, target=tmp_dir.joinpath("blob"), resumable=False)
+
+
+def _copy_to(path: pathlib.Path, fileobj: BinaryIO):
+    with open(path, "rb") as f:
+        shutil.copyfileobj(f, fileobj, CHUNK_SIZE)
+
+
+@contextlib.contextmanager
+def _writer_thread() -> Iterator[ThreadPoolExecutor]:
+    """
+    the thread an `AsyncDownloader` reads and writes the files of a blob in, the event loop only waits for it
+    """
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="blob_writer")
+    try:
+        yield executor
+    finally:
+        executor.shutdown(wait=False)
+
+
+_Started = TypeVar("_Started")
+
+
+def _run_ahead(
+    tasks: List[BlobTask], start: Callable[[BlobTask], _Started], max_ahead: int, schedule: SchedulePolicy
+) -> Iterator[_Started]:
+    """
+    start tasks at most max_ahead ahead of the consumer and yield what start returns in the order of tasks,
+    the first of them are started in the order of schedule, another one each time the consumer goes on.
+    Closing the iterator cancels the futures still running
+    """
+    futures: Dict[int, _Started] = {}
+
+    def submit(batch: List[BlobTask]):
+        for task in schedule(batch):
+            futures[id(task)] = start(task)
+
+    submit(tasks[:max_ahead])
+    try:
+        for index, task in enumerate(tasks):
+            yield futures[id(task)]
+            submit(tasks[index + max_ahead : index + max_ahead + 1])
+    finally:
+        for future in futures.values():
+            future.cancel()
+
+
+def _record_blob_response(capabilities: CapabilityCache, resp: httpx.Response, ranged: bool):
+    """
+    record if the host a blob was requested from redirects it, and if it answers range requests
+    """
+    if resp.status_code not in (200, 206):
+        return
+    record = {"redirects": bool(resp.history)}
+    if ranged:
+        record["ranges"] = resp.status_code == 206
+    capabilities.update(host_of((resp.history[0] if resp.history else resp).request.url), **record)
+
+
+class Downloader:
+    """
+    Download blobs with at most `max_concurrent_downloads` blobs in flight, started in the order of `schedule`.
+    Results are always returned in the order the tasks were given.
+    A blob larger than `segment_threshold` is split into `max_segments` byte ranges downloaded in parallel,
+    None disables it.
+    An interrupted download is resumed from the last byte received up to `max_resume_attempts` times,
+    waiting between attempts as `retry` does.
+    The progress and timings of every blob are emitted to `events`.
+    """
+
+    def __init__(
+        self,
+        blob_client: BlobClient,
+        max_concurrent_downloads: int = DEFAULT_MAX_CONCURRENT_DOWNLOADS,
+        max_resume_attempts: int = DEFAULT_MAX_RESUME_ATTEMPTS,
+        cache: Optional[BlobCache] = None,
+        segment_threshold: Optional[int] = DEFAULT_SEGMENT_THRESHOLD,
+        max_segments: int = DEFAULT_MAX_SEGMENTS,
+        schedule: SchedulePolicy = largest_first,
+        events: Optional[Events] = None,
+        retry: Optional[RetryPolicy] = None,
+    ):
+        if max_concurrent_downloads < 1:
+            raise ValueError("max_concurrent_downloads must be greater than 0")
+        self._blob_client = blob_client
+        self.max_concurrent_downloads = max_concurrent_downloads
+        self.max_resume_attempts = max_resume_attempts
+        self.cache = cache
+        self.segment_threshold = segment_threshold
+        self.max_segments = max_segments
+        self.schedule = schedule
+        self.events = events or Events()
+        self.retry = retry or RetryPolicy()
+
+    @property
+    def _capabilities(self) -> CapabilityCache:
+        return self._blob_client.client.capabilities
+
+    @property
+    def _supports_ranges(self) -> bool:
+        """
+        a registry known to ignore range requests isn't asked for segments
+        """
+        return self._capabilities.supports_ranges(host_of(self._blob_client.client.base_url))
+
+    def _use_segments(self, task: BlobTask) -> bool:
+        return _use_segments(task, self.segment_threshold, self.max_segments, self._supports_ranges)
+
+    def with_cache(self, cache: BlobCache) -> "Downloader":
+        """
+        a copy of the downloader sharing the same client, which stores blobs in cache
+        """
+        downloader = copy.copy(self)
+        downloader.cache = cache
+        return downloader
+
+    def _fetch_all(self, blob_file: Union[BlobFile, BlobStream], meter: BlobMeter):
+        attempts = 0
+        while True:
+            try:
+                self._fetch(blob_file, meter)
+                return
+            except (httpx.TransportError, RangeNotSatisfiable) as e:
+                attempts += 1
+                if attempts > self.max_resume_attempts:
+                    raise
+                logger.warning(f"download {blob_file.task.ref.digest} interrupted at {blob_file.offset}: {e!r}, resume")
+                meter.resumed()
+                self.retry.wait(attempts - 1)
+
+    def _fetch(self, blob_file: Union[BlobFile, BlobStream], meter: BlobMeter):
+        offset = blob_file.offset
+        sent = time.monotonic()
+        with self._blob_client.get(blob_file.task.ref, stream=True, offset=offset) as resp:
+            meter.response(resp, sent)
+            _record_blob_response(self._capabilities, resp, ranged=bool(offset))
+            if offset and resp.status_code == 416:
+                meter.discarded(offset)
+                blob_file.reset()
+                raise RangeNotSatisfiable()
+            resp.raise_for_status()
+            if offset and resp.status_code != 206:
+                logger.warning(f"registry ignored the range request of {blob_file.task.ref.digest}, restart")
+                meter.discarded(offset)
+                blob_file.reset()
+            for content in resp.iter_bytes():
+                blob_file.write(content)
+                meter.received(len(content))
+
+    def _fetch_segment(self, ref: CanonicalReference, path: pathlib.Path, segment: Segment, meter: BlobMeter):
+        attempts = 0
+        with open(path, "r+b") as f:
+            while segment.remaining:
+                f.seek(segment.position)
+                try:
+                    sent = time.monotonic()
+                    with self._blob_client.get(ref, stream=True, offset=segment.position, end=segment.end) as resp:
+                        meter.response(resp, sent)
+                        _record_blob_response(self._capabilities, resp, ranged=True)
+                        if resp.status_code != 206:
+                            raise RangeNotSupported(resp.status_code)
+                        for content in resp.iter_bytes():
+                            segment.write(f, content)
+                            meter.received(len(content))
+                    if not segment.remaining:
+                        break
+                    raise httpx.RemoteProtocolError(f"segment ended at {segment.position}")
+                except httpx.TransportError as e:
+                    attempts += 1
+                    if attempts > self.max_resume_attempts:
+                        raise
+                    logger.warning(f"segment {segment.start}-{segment.end} of {ref.digest} interrupted: {e!r}, resume")
+                    meter.resumed()
+                    self.retry.wait(attempts - 1)
+
+    def _download_segments(self, blob_file: BlobFile, meter: BlobMeter) -> pathlib.Path:
+        task = blob_file.task
+        path = blob_file.preallocate()
+        segments = split_segments(task.size, self.max_segments)
+        logger.debug(f"download blob {task.ref.digest} in {len(segments)} segments")
+        with ThreadPoolExecutor(max_workers=len(segments), thread_name_prefix="segment") as executor:
+            futures = [executor.submit(self._fetch_segment, task.ref, path, segment, meter) for segment in segments]
+            done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+            for future in not_done:
+                future.cancel()
+            for future in futures:
+                if future in done and future.exception() is not None:
+                    raise future.exception()
+        with meter.verifying():
+            return blob_file.commit_segments()
+
+    def download(self, task: BlobTask) -> pathlib.Path:
+        meter = BlobMeter(task, self.events)
+        try:
+            path = self._download(task, meter)
+        except BaseException as e:
+            meter.failed(e)
+            raise
+        meter.finished()
+        return path
+
+    def _download(self, task: BlobTask, meter: BlobMeter) -> pathlib.Path:
+        blob_file = BlobFile(task, cache=self.cache)
+        if blob_file.completed:
+            logger.debug(f"blob {task.ref.digest} already downloaded to {task.target}")
+            meter.cached = True
+            return task.target
+        with meter.verifying():
+            meter.cached = blob_file.load_from_cache()
+        if meter.cached:
+            logger.debug(f"blob {task.ref.digest} is loaded from cache")
+            return task.target
+        if not blob_file.interrupted and self._use_segments(task):
+            try:
+                return self._download_segments(blob_file, meter)
+            except RangeNotSupported as e:
+                logger.warning(f"registry doesn't support range requests, download {task.ref.digest} in one stream")
+                meter.discarded(meter.transferred)
+                blob_file.discard(e)
+            except BaseException as e:
+                blob_file.discard(e)
+                raise
+        logger.debug(f"download blob {task.ref.digest} to {task.target}")
+        try:
+            blob_file.open()
+            self._fetch_all(blob_file, meter)
+            with meter.verifying():
+                return blob_file.commit()
+        except BaseException as e:
+            blob_file.discard(e)
+            raise
+
+    def download_to(self, task: BlobTask, fileobj: BinaryIO):
+        """
+        download a blob into a file object which can't seek, `task.target` isn't used.
+        A blob large enough to be split into segments is downloaded into a temporary file first
+        """
+        if self._use_segments(task):
+            with tempfile.TemporaryDirectory(prefix="blob_download_") as tmp_dir:
+                _copy_to(self.download(_spooled(task, pathlib.Path(tmp_dir))), fileobj)
+            return
+        meter = BlobMeter(task, self.events)
+        blob_stream = BlobStream(task, fileobj, cache=self.cache)
+        try:
+            with meter.verifying():
+                meter.cached = blob_stream.load_from_cache()
+            if not meter.cached:
+                self._stream_to(blob_stream, meter)
+        except BaseException as e:
+            meter.failed(e)
+            raise
+        meter.finished()
+
+    def _stream_to(self, blob_stream: BlobStream, meter: BlobMeter):
+        try:
+            blob_stream.open()
+            self._fetch_all(blob_stream, meter)
+            with meter.verifying():
+                blob_stream.commit()
+        except BaseException as e:
+            blob_stream.discard(e)
+            raise
+
+    def download_all(self, tasks: List[BlobTask]) -> List[pathlib.Path]:
+        if self.max_concurrent_downloads == 1 or len(tasks) <= 1:
+            paths = {id(task): self.download(task) for task in self.schedule(tasks)}
+            return [paths[id(task)] for task in tasks]
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_downloads, thread_name_prefix="blob") as executor:
+            futures = {id(task): executor.submit(self.download, task) for task in self.schedule(tasks)}
+            done, not_done = wait(futures.values(), return_when=FIRST_EXCEPTION)
+            for future in not_done:
+                future.cancel()
+            for future in futures.values():
+                if future in done and future.exception() is not None:
+                    raise future.exception()
+            return [futures[id(task)].result() for task in tasks]
+
+    def download_iter(self, tasks: List[BlobTask], max_ahead: Optional[int] = None) -> Iterator[pathlib.Path]:
+        """
+        download blobs concurrently and yield them in the order of tasks. At most `max_ahead` blobs,
+        twice `max_concurrent_downloads` by default, are downloaded ahead of the consumer,
+        the first of them are started in the order of `schedule`, the others as the consumer goes on
+        """
+        max_ahead = max(max_ahead or 2 * self.max_concurrent_downloads, 1)
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_downloads, thread_name_prefix="blob") as executor:
+            futures = _run_ahead(tasks, lambda task: executor.submit(self.download, task), max_ahead, self.schedule)
+            with contextlib.closing(futures):
+                for future in futures:
+                    yield future.result()
+
+    def _download_to_pipe(self, task: BlobTask, pipe: BlobPipe):
+        try:
+            self.download_to(task, pipe)
+        except BaseException as e:
+            pipe.close(e)
+            raise
+        pipe.close()
+
+    def stream_iter(self, tasks: List[BlobTask]) -> Iterator[BlobPipe]:
+        """
+        download blobs concurrently into pipes and yield the pipes in the order of tasks,
+        a pipe must be read to its end before the next one is asked for. `max_concurrent_downloads` blobs
+        are streamed at the same time, those ahead of the reader wait once their pipes are full
+        """
+        pipes: Dict[int, BlobPipe] = {}
+
+        def start(task: BlobTask) -> Future:
+            pipes[id(task)] = BlobPipe()
+            return executor.submit(self._download_to_pipe, task, pipes[id(task)])
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_downloads, thread_name_prefix="blob") as executor:
+            futures = _run_ahead(tasks, start, self.max_concurrent_downloads, self.schedule)
+            try:
+                with contextlib.closing(futures):
+                    for task, future in zip(tasks, futures):
+                        yield pipes[id(task)]
+                        future.result()
+                        del pipes[id(task)]
+            finally:
+                for pipe in pipes.values():
+                    pipe.abort()
+
+
+class AsyncDownloader:
+    """
+    the asyncio version of `Downloader`
+    """
+
+    def __init__(
+        self,
+        blob_client: AsyncBlobClient,
+        max_concurrent_downloads: int = DEFAULT_MAX_CONCURRENT_DOWNLOADS,
+        max_resume_attempts: int = DEFAULT_MAX_RESUME_ATTEMPTS,
+        cache: Optional[BlobCache] = None,
+        segment_threshold: Optional[int] = DEFAULT_SEGMENT_THRESHOLD,
+        max_segments: int = DEFAULT_MAX_SEGMENTS,
+        schedule: SchedulePolicy = largest_first,
+        events: Optional[Events] = None,
+        retry: Optional[RetryPolicy] = None,
+    ):
+        if max_concurrent_downloads < 1:
+            raise ValueError("max_concurrent_downloads must be greater than 0")
+        self._blob_client = blob_client
+        self.max_concurrent_downloads = max_concurrent_downloads
+        self.max_resume_attempts = max_resume_attempts
+        self.cache = cache
+        self.segment_threshold = segment_threshold
+        self.max_segments = max_segments
+        self.schedule = schedule
+        self.events = events or Events()
+        self.retry = retry or RetryPolicy()
+
+    @property
+    def _capabilities(self) -> CapabilityCache:
+        return self._blob_client.client.capabilities
+
+    @property
+    def _supports_ranges(self) -> bool:
+        return self._capabilities.supports_ranges(host_of(self._blob_client.client.base_url))
+
+    def _use_segments(self, task: BlobTask) -> bool:
+        return _use_segments(task, self.segment_threshold, self.max_segments, self._supports_ranges)
+
+    def with_cache(self, cache: BlobCache) -> "AsyncDownloader":
+        """
+        a copy of the downloader sharing the same client, which stores blobs in cache
+        """
+        downloader = copy.copy(self)
+        downloader.cache = cache
+        return downloader
+
+    async def _fetch_all(self, blob_file: Union[BlobFile, BlobStream], meter: BlobMeter, writer: Executor):
+        attempts = 0
+        while True:
+            try:
+                await self._fetch(blob_file, meter, writer)
+                return
+            except (httpx.TransportError, RangeNotSatisfiable) as e:
+                attempts += 1
+                if attempts > self.max_resume_attempts:
+                    raise
+                logger.warning(f"download {blob_file.task.ref.digest} interrupted at {blob_file.offset}: {e!r}, resume")
+                meter.resumed()
+                await self.retry.async_wait(attempts - 1)
+
+    async def _fetch(self, blob_file: Union[BlobFile, BlobStream], meter: BlobMeter, writer: Executor):
+        loop = asyncio.get_event_loop()
+        offset = blob_file.offset
+        sent = time.monotonic()
+        async with self._blob_client.stream(blob_file.task.ref, offset=offset) as resp:
+            meter.response(resp, sent)
+            _record_blob_response(self._capabilities, resp, ranged=bool(offset))
+            if offset and resp.status_code == 416:
+                meter.discarded(offset)
+                await loop.run_in_executor(writer, blob_file.reset)
+                raise RangeNotSatisfiable()
+            resp.raise_for_status()
+            if offset and resp.status_code != 206:
+                logger.warning(f"registry ignored the range request of {blob_file.task.ref.digest}, restart")
+                meter.discarded(offset)
+                await loop.run_in_executor(writer, blob_file.reset)
+            async for content in resp.aiter_bytes():
+                await loop.run_in_executor(writer, blob_file.write, content)
+                meter.received(len(content))
+
+    async def _fetch_segment(
+        self, ref: CanonicalReference, path: pathlib.Path, segment: Segment, meter: BlobMeter, writer: Executor
+    ):
+        loop = asyncio.get_event_loop()
+        attempts = 0
+        with open(path, "r+b") as f:
+            while segment.remaining:
+                f.seek(segment.position)
+                try:
+                    sent = time.monotonic()
+                    async with self._blob_client.stream(ref, offset=segment.position, end=segment.end) as resp:
+                        meter.response(resp, sent)
+                        _record_blob_response(self._capabilities, resp, ranged=True)
+                        if resp.status_code != 206:
+                            raise RangeNotSupported(resp.status_code)
+                        async for content in resp.aiter_bytes():
+                            await loop.run_in_executor(writer, segment.write, f, content)
+                            meter.received(len(content))
+                    if not segment.remaining:
+                        break
+                    raise httpx.RemoteProtocolError(f"segment ended at {segment.position}")
+                except httpx.TransportError as e:
+                    attempts += 1
+                    if attempts > self.max_resume_attempts:
+                        raise
+                    logger.warning(f"segment {segment.start}-{segment.end} of {ref.digest} interrupted: {e!r}, resume")
+                    meter.resumed()
+                    await self.retry.async_wait(attempts - 1)
+
+    async def _download_segments(self, blob_file: BlobFile, meter: BlobMeter, writer: Executor) -> pathlib.Path:
+        loop = asyncio.get_event_loop()
+        task = blob_file.task
+        path = await loop.run_in_executor(writer, blob_file.preallocate)
+        segments = split_segments(task.size, self.max_segments)
+        futures = [
+            asyncio.ensure_future(self._fetch_segment(task.ref, path, segment, meter, writer)) for segment in segments
+        ]
+        done, not_done = await asyncio.wait(futures, return_when=asyncio.FIRST_EXCEPTION)
+        for future in not_done:
+            future.cancel()
+        if not_done:
+            await asyncio.wait(not_done)
+        for future in futures:
+            if future in done and future.exception() is not None:
+                raise future.exception()
+        with meter.verifying():
+            return await loop.run_in_executor(writer, blob_file.commit_segments)
+
+    async def download(self, task: BlobTask) -> pathlib.Path:
+        meter = BlobMeter(task, self.events)
+        try:
+            with _writer_thread() as writer:
+                path = await self._download(task, meter, writer)
+        except BaseException as e:
+            meter.failed(e)
+            raise
+        meter.finished()
+        return path
+
+    async def _download(self, task: BlobTask, meter: BlobMeter, writer: Executor) -> pathlib.Path:
+        blob_file = BlobFile(task, cache=self.cache)
+        loop = asyncio.get_event_loop()
+        with meter.verifying():
+            meter.cached = await loop.run_in_executor(
+                writer, lambda: blob_file.completed or blob_file.load_from_cache()
+            )
+        if meter.cached:
+            return task.target
+        if not blob_file.interrupted and self._use_segments(task):
+            try:
+                return await self._download_segments(blob_file, meter, writer)
+            except RangeNotSupported as e:
+                logger.warning(f"registry doesn't support range requests, download {task.ref.digest} in one stream")
+                meter.discarded(meter.transferred)
+                await loop.run_in_executor(writer, blob_file.discard, e)
+            except BaseException as e:
+                await loop.run_in_executor(writer, blob_file.discard, e)
+                raise
+        logger.debug(f"download blob {task.ref.digest} to {task.target}")
+        try:
+            await loop.run_in_executor(writer, blob_file.open)
+            await self._fetch_all(blob_file, meter, writer)
+            with meter.verifying():
+                return await loop.run_in_executor(writer, blob_file.commit)
+        except BaseException as e:
+            await loop.run_in_executor(writer, blob_file.discard, e)
+            raise
+
+    async def download_to(self, task: BlobTask, fileobj: BinaryIO):
+        """
+        the asyncio version of `Downloader.download_to`
+        """
+        loop = asyncio.get_event_loop()
+        if self._use_segments(task):
+            with tempfile.TemporaryDirectory(prefix="blob_download_") as tmp_dir:
+                path = await self.download(_spooled(task, pathlib.Path(tmp_dir)))
+                with _writer_thread() as writer:
+                    await loop.run_in_executor(writer, _copy_to, path, fileobj)
+            return
+        meter = BlobMeter(task, self.events)
+        blob_stream = BlobStream(task, fileobj, cache=self.cache)
+        try:
+            with _writer_thread() as writer:
+                with meter.verifying():
+                    meter.cached = await loop.run_in_executor(writer, blob_stream.load_from_cache)
+                if not meter.cached:
+                    await self._stream_to(blob_stream, meter, writer)
+        except BaseException as e:
+            meter.failed(e)
+            raise
+        meter.finished()
+
+    async def _stream_to(self, blob_stream: BlobStream, meter: BlobMeter, writer: Executor):
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(writer, blob_stream.open)
+            await self._fetch_all(blob_stream, meter, writer)
+            with meter.verifying():
+                await loop.run_in_executor(writer, blob_stream.commit)
+        except BaseException as e:
+            await loop.run_in_executor(writer, blob_stream.discard, e)
+            raise
+
+    def _limited(self) -> Callable[[BlobTask], Awaitable[pathlib.Path]]:
+        """
+        download with at most `max_concurrent_downloads` blobs in flight,
+        the downloads are started in the order they are called
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrent_downloads)
+
+        async def _download(task: BlobTask) -> pathlib.Path:
+            async with semaphore:
+                return await self.download(task)
+
+        return _download
+
+    async def download_all(self, tasks: List[BlobTask]) -> List[pathlib.Path]:
+        _download = self._limited()
+        futures = {id(task): asyncio.ensure_future(_download(task)) for task in self.schedule(tasks)}
+        if not futures:
+            return []
+        done, not_done = await asyncio.wait(futures.values(), return_when=asyncio.FIRST_EXCEPTION)
+        for future in not_done:
+            future.cancel()
+        for future in futures.values():
+            if future in done and future.exception() is not None:
+                raise future.exception()
+        return [futures[id(task)].result() for task in tasks]
+
+    async def download_iter(
+        self, tasks: List[BlobTask], max_ahead: Optional[int] = None
+    ) -> AsyncIterator[pathlib.Path]:
+        """
+        the asyncio version of `Downloader.download_iter`
+        """
+        max_ahead = max(max_ahead or 2 * self.max_concurrent_downloads, 1)
+        _download = self._limited()
+        futures = _run_ahead(tasks, lambda task: asyncio.ensure_future(_download(task)), max_ahead, self.schedule)
+        try:
+            for future in futures:
+                yield await future
+        finally:
+            futures.close()
+
+    async def _download_to_pipe(self, task: BlobTask, pipe: BlobPipe):
+        try:
+            await self.download_to(task, pipe)
+        except BaseException as e:
+            pipe.close(e)
+            raise
+        pipe.close()
+
+    async def stream_iter(self, tasks: List[BlobTask]) -> AsyncIterator[BlobPipe]:
+        """
+        the asyncio version of `Downloader.stream_iter`, the pipes are read with `async for`
+        """
+        loop = asyncio.get_event_loop()
+        pipes: Dict[int, BlobPipe] = {}
+
+        def start(task: BlobTask) -> asyncio.Future:
+            pipes[id(task)] = BlobPipe(loop)
+            return asyncio.ensure_future(self._download_to_pipe(task, pipes[id(task)]))
+
+        futures = _run_ahead(tasks, start, self.max_concurrent_downloads, self.schedule)
+        try:
+            for task, future in zip(tasks, futures):
+                yield pipes[id(task)]
+                await future
+                del pipes[id(task)]
+        finally:
+            futures.close()
+            for pipe in pipes.values():
+                pipe.abort()
@@ -61,5 +61,17 @@ class ErrManifest(Exception):
         super(ErrManifest, self).__init__("invalid image manifest")
 
 
+class ErrDigestMismatch(Exception):
+    def __init__(self, want, got):
+        super(ErrDigestMismatch, self).__init__(f"digest mismatch, want {want}, got {got}")
+        self.want = want
+        self.got = got
+
+
+class ErrUnknownImageLayout(Exception):
+    def __init__(self, path):
+        super(ErrUnknownImageLayout, self).__init__(f"{path} is neither an oci layout nor a docker v2 image")
+
+
 if __name__ == "__main__":
     raise ErrNameEmpty()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# encoding : utf-8
+import pathlib
+import queue
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional, Union
+
+from loguru import logger
+
+from registry_client.digest import Digest
+
+
+@dataclass
+class BlobStarted:
+    digest: Digest
+    size: Optional[int]
+
+
+@dataclass
+class BlobProgress:
+    """
+    amount: the bytes just received
+    transferred: the bytes of the blob received by this download so far
+    """
+
+    digest: Digest
+    amount: int
+    transferred: int
+    size: Optional[int]
+
+
+@dataclass
+class BlobFinished:
+    """
+    transferred: the bytes received from the network, 0 if the blob was cached
+    elapsed: the seconds from start to finish, including `verify_time`
+    time_to_first_byte: the seconds from sending the first request to receiving its response
+    verify_time: the seconds spent checking the digests and saving the blob after it was received
+    host: the host the blob was requested from, a mirror or the registry, a redirect isn't followed
+    cached: the blob was found in the blob cache or the work dir
+    retries: how many times the download was resumed after being interrupted
+    wasted: the bytes received but thrown away, e.g. by a registry ignoring the range to resume from
+    """
+
+    digest: Digest
+    size: Optional[int]
+    transferred: int
+    elapsed: float
+    time_to_first_byte: Optional[float] = None
+    verify_time: float = 0.0
+    host: Optional[str] = None
+    cached: bool = False
+    retries: int = 0
+    wasted: int = 0
+
+    @property
+    def throughput(self) -> float:
+        """
+        bytes per second while receiving the blob
+        """
+        seconds = self.elapsed - self.verify_time
+        return self.transferred / seconds if seconds > 0 else 0.0
+
+
+@dataclass
+class BlobFailed:
+    digest: Digest
+    error: BaseException
+
+
+@dataclass
+class RequestRetried:
+    """
+    attempt: the retry about to be sent, counted from 1
+    delay: the seconds waited before it
+    """
+
+    method: str
+    url: str
+    attempt: int
+    delay: float
+    reason: str
+
+
+@dataclass
+class TokenFetched:
+    realm: str
+    service: str
+    scope: str
+    elapsed: float
+    status_code: int
+
+
+@dataclass
+class PullFinished:
+    """
+    the last event of `RegistryClient.pull_image_events`
+    """
+
+    image: str
+    path: pathlib.Path
+
+
+Event = Union[BlobStarted, BlobProgress, BlobFinished, BlobFailed, RequestRetried, TokenFetched, PullFinished]
+Listener = Callable[[Event], None]
+
+
+class Events:
+    """
+    Dispatch the events of a client to its listeners.
+    A listener is called in the thread emitting the event, concurrent downloads call it from several threads,
+    so it must be quick and thread safe. A failing listener is logged and never breaks the pull.
+    """
+
+    def __init__(self):
+        self._listeners: List[Listener] = []
+        self._lock = threading.Lock()
+
+    @property
+    def active(self) -> bool:
+        return bool(self._listeners)
+
+    def subscribe(self, listener: Listener) -> Listener:
+        with self._lock:
+            self._listeners = [*self._listeners, listener]
+        return listener
+
+    def unsubscribe(self, listener: Listener):
+        with self._lock:
+            self._listeners = [item for item in self._listeners if item is not listener]
+
+    def emit(self, event: Event):
+        for listener in self._listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                logger.warning(f"event listener {listener!r} failed: {e!r}")
+
+
+class EventQueue:
+    """
+    a listener which can be iterated from another thread, the iteration ends after `close`
+    """
+
+    _CLOSED = object()
+
+    def __init__(self):
+        self._queue: "queue.Queue" = queue.Queue()
+
+    def __call__(self, event: Event):
+        self._queue.put(event)
+
+    def close(self):
+        self._queue.put(self._CLOSED)
+
+    def __iter__(self) -> Iterator[Event]:
+        while True:
+            event = self._queue.get()
+            if event is self._CLOSED:
+                return
+            yield event
+
+
+@dataclass
+class HostMetrics:
+    host: str
+    blobs: int = 0
+    transferred: int = 0
+    seconds: float = 0.0
+    time_to_first_byte: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """
+        bytes per second of a single download from host
+        """
+        return self.transferred / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def mean_time_to_first_byte(self) -> float:
+        return self.time_to_first_byte / self.blobs if self.blobs else 0.0
+
+
+class PullMetrics:
+    """
+    A listener collecting the downloads and token requests of pulls, to find slow mirrors and bottleneck layers.
+    Cached blobs aren't counted.
+    """
+
+    def __init__(self):
+        self.blobs: List[BlobFinished] = []
+        self.tokens: List[TokenFetched] = []
+        self.retries: List[RequestRetried] = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event: Event):
+        with self._lock:
+            if isinstance(event, BlobFinished) and not event.cached:
+                self.blobs.append(event)
+            elif isinstance(event, TokenFetched):
+                self.tokens.append(event)
+            elif isinstance(event, RequestRetried):
+                self.retries.append(event)
+
+    def hosts(self) -> Dict[str, HostMetrics]:
+        hosts: Dict[str, HostMetrics] = {}
+        with self._lock:
+            blobs = list(self.blobs)
+        for blob in blobs:
+            host = hosts.setdefault(blob.host or "", HostMetrics(blob.host or ""))
+            host.blobs += 1
+            host.transferred += blob.transferred
+            host.seconds += blob.elapsed - blob.verify_time
+            host.time_to_first_byte += blob.time_to_first_byte or 0.0
+        return hosts
+
+    def slowest(self, count: int = 5) -> List[BlobFinished]:
+        with self._lock:
+            return sorted(self.blobs, key=lambda blob: blob.elapsed, reverse=True)[:count]
+
+    def summary(self) -> str:
+        lines = []
+        for host in sorted(self.hosts().values(), key=lambda item: item.throughput):
+            lines.append(
+                f"{host.host}: {host.blobs} blobs, {host.transferred / 1024 / 1024:.1f} MiB, "
+                f"{host.throughput / 1024 / 1024:.2f} MiB/s, ttfb {host.mean_time_to_first_byte * 1000:.0f}ms"
+            )
+        for blob in self.slowest():
+            lines.append(
+                f"{blob.digest}: {blob.transferred / 1024 / 1024:.1f} MiB in {blob.elapsed:.2f}s "
+                f"({blob.throughput / 1024 / 1024:.2f} MiB/s, verify {blob.verify_time:.2f}s) from {blob.host}"
+            )
+        with self._lock:
+            tokens = list(self.tokens)
+            retries = len(self.retries)
+            resumes = sum(blob.retries for blob in self.blobs)
+            wasted = sum(blob.wasted for blob in self.blobs)
+        if tokens:
+            elapsed = sum(token.elapsed for token in tokens)
+            lines.append(f"{len(tokens)} token requests, {elapsed * 1000 / len(tokens):.0f}ms on average")
+        if retries or resumes or wasted:
+            lines.append(f"{retries} requests retried, {resumes} downloads resumed, {wasted} bytes wasted")
+        return "\n".join(lines)
@@ -1,23 +1,109 @@
 import dataclasses
 import gzip
+import io
 import json
 import os
 import pathlib
 import shutil
 import tarfile
-from typing import List, Tuple
+import time
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, List, Set, Tuple
 
 from loguru import logger
 
 from registry_client import spec
+from registry_client.compression import (
+    BZIP_MAGIC,
+    GZIP_MAGIC,
+    XZ_MAGIC,
+    ZSTD_MAGIC,
+    uncompressed_digest,
+)
 from registry_client.digest import Digest
 from registry_client.media_types import OCIImageMediaType
 from registry_client.utlis import diff_ids_to_chain_ids
 
-BZIP_MAGIC = b"\x42\x5A\x68"
-GZIP_MAGIC = b"\x1F\x8B\x8B"
-XZ_MAGIC = b"\xFD\x37\x7A\x58\x5A\x00"
-ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+class TarEntryWriter:
+    """
+    the content of a file in a `TarStreamWriter`, exactly `size` bytes must be written
+    """
+
+    def __init__(self, tar: tarfile.TarFile, info: tarfile.TarInfo):
+        self._tar = tar
+        self.info = info
+        self.written = 0
+        header = info.tobuf(tar.format, tar.encoding, tar.errors)
+        tar.fileobj.write(header)
+        tar.offset += len(header)
+
+    def write(self, content: bytes) -> int:
+        if self.written + len(content) > self.info.size:
+            raise ValueError(f"{self.info.name} is larger than {self.info.size} bytes")
+        self._tar.fileobj.write(content)
+        self.written += len(content)
+        return len(content)
+
+    def close(self):
+        if self.written != self.info.size:
+            raise ValueError(f"{self.info.name} has {self.written} bytes, want {self.info.size}")
+        blocks, remainder = divmod(self.info.size, tarfile.BLOCKSIZE)
+        if remainder:
+            self._tar.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            blocks += 1
+        self._tar.offset += blocks * tarfile.BLOCKSIZE
+        self._tar.members.append(self.info)
+
+
+class TarStreamWriter:
+    """
+    Write a tar to a file object which may not seek, such as a pipe or stdout,
+    so an image is archived while its blobs are downloading, without a staging directory.
+    The size of a file must be known before its content is written.
+    Call `close` to finish the tar, a tar without its end blocks is rejected by `docker load`.
+    """
+
+    def __init__(self, fileobj: BinaryIO):
+        self._tar = tarfile.open(fileobj=fileobj, mode="w|")
+        self._dirs: Set[str] = set()
+        self._mtime = int(time.time())
+
+    def _info(self, name: str, size: int = 0, dir_type: bool = False) -> tarfile.TarInfo:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = self._mtime
+        if dir_type:
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+        return info
+
+    def _add_parents(self, name: str):
+        parts = name.split("/")[:-1]
+        for index in range(1, len(parts) + 1):
+            dir_name = "/".join(parts[:index])
+            if dir_name not in self._dirs:
+                self._dirs.add(dir_name)
+                self._tar.addfile(self._info(dir_name, dir_type=True))
+
+    def add_bytes(self, name: str, content: bytes):
+        self._add_parents(name)
+        self._tar.addfile(self._info(name, len(content)), io.BytesIO(content))
+
+    def add_file(self, name: str, path: pathlib.Path):
+        self._add_parents(name)
+        with open(path, "rb") as f:
+            self._tar.addfile(self._info(name, os.fstat(f.fileno()).st_size), f)
+
+    @contextmanager
+    def open(self, name: str, size: int) -> Iterator[TarEntryWriter]:
+        self._add_parents(name)
+        entry = TarEntryWriter(self._tar, self._info(name, size))
+        yield entry
+        entry.close()
+
+    def close(self):
+        self._tar.close()
 
 
 class TarImageDir:
@@ -27,12 +113,14 @@ class TarImageDir:
         target_path: pathlib.Path,
         delete: bool = False,
         compress: bool = False,
+        verified: bool = False,
     ):
         """
         src_dir: the dir want to tar
         target_path: final image save path
         delete: either or not delete src_dir when tar done
         compress: either gzip image
+        verified: the layers in src_dir were verified when downloading, don't read them again to check digest
         """
         self.src_dir = src_dir
         assert self.src_dir.exists() and self.src_dir.is_dir()
@@ -40,13 +128,13 @@ class TarImageDir:
         assert not self.target_path.is_dir()
         self.delete_when_done = delete
         self.compress = compress
+        self.verified = verified
 
     @staticmethod
     def _check_digest(want: str, path: pathlib.Path):
         logger.info(f"check file:{path} digest == {want}")
         want_digest = Digest(want)
-        with open(path, "rb") as f:
-            get_digest = Digest.from_bytes(f.read())
+        get_digest = Digest.from_file(path, want_digest.algom)
         assert want_digest == get_digest, f"{get_digest}!={want_digest}"
 
     def do(self) -> pathlib.Path:
@@ -88,8 +176,9 @@ class ImageV2Tar(TarImageDir):
         target_path: pathlib.Path,
         delete: bool = False,
         compress: bool = False,
+        verified: bool = False,
     ):
-        super(ImageV2Tar, self).__init__(src_dir, target_path, delete=delete, compress=compress)
+        super(ImageV2Tar, self).__init__(src_dir, target_path, delete=delete, compress=compress, verified=verified)
 
     @classmethod
     def _check_manifest(cls, path: pathlib.Path):
@@ -103,12 +192,22 @@ class ImageV2Tar(TarImageDir):
         cls._check_digest(f"sha256:{image_config_path.stem}", image_config_path)
 
     @classmethod
-    def _check_layers(cls, layers_path: List[pathlib.Path], diff_ids: List[str]):
+    def _check_layers(cls, layers_path: List[pathlib.Path], diff_ids: List[str], verified: bool = False):
         assert layers_path
+        assert len(layers_path) == len(diff_ids), "the count of layers and diff_ids mismatch"
         for index, one_layer_path in enumerate(layers_path):
             assert one_layer_path.exists(), one_layer_path
+            if verified:
+                continue
             logger.info(f"check layer:{one_layer_path} digest")
-            cls._check_digest(diff_ids[index], one_layer_path)
+            want_digest = Digest(diff_ids[index])
+            # a layer may be kept compressed, the diff_id is the digest of the uncompressed content
+            with one_layer_path.open("rb") as f:
+                get_digest = uncompressed_digest(f, want_digest.algom)
+            if get_digest is None:
+                logger.warning(f"unsupported compression of {one_layer_path}, skip checking digest")
+                continue
+            assert want_digest == get_digest, f"{get_digest}!={want_digest}"
 
     def check(self):
         image_manifest_path = self.src_dir.joinpath("manifest.json")
@@ -125,7 +224,7 @@ class ImageV2Tar(TarImageDir):
         layer_paths = [self.src_dir.joinpath(layer_path) for layer_path in layer_paths]
         # diff_id is layer sha256sum
         layer_diff_ids: List[str] = image_config["rootfs"]["diff_ids"]
-        self._check_layers(layer_paths, layer_diff_ids)
+        self._check_layers(layer_paths, layer_diff_ids, verified=self.verified)
 
     def do(self) -> pathlib.Path:
         self.check()
@@ -170,6 +269,8 @@ class OCIImageTar(TarImageDir):
         assert blobs_dir.exists() and blobs_dir.is_dir()
         for file in blobs_dir.iterdir():
             assert file.is_file()
+            if self.verified:
+                continue
             want_digest = f"{algom}:{file.name}"
             self._check_digest(want=want_digest, path=file)
 
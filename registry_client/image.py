@@ -2,8 +2,9 @@
 # encoding: utf-8
 import pathlib
 import sys
+from contextlib import asynccontextmanager
 from enum import Enum
-from typing import Dict, Iterable, List, Optional, Union
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple, Union
 
 from registry_client import spec
 from registry_client.media_types import ImageMediaType
@@ -15,10 +16,12 @@ else:
 
 import httpx
 
-from registry_client.auth import AuthClient
+from registry_client.auth import AsyncAuthClient, AuthClient
+from registry_client.cache import BlobCache, ManifestCache, TagEntry
+from registry_client.capabilities import host_of
 from registry_client.digest import Digest
-from registry_client.errors import ImageNotFoundError
-from registry_client.manifest import ManifestClient
+from registry_client.errors import ErrDigestMismatch, ImageNotFoundError
+from registry_client.manifest import AsyncManifestClient, ManifestClient
 from registry_client.platforms import Platform, filter_by_platform
 from registry_client.reference import (
     CanonicalReference,
@@ -37,6 +40,193 @@ class ImageFormat(Enum):
     OCI = "oci"
 
 
+def _blob_url(ref: CanonicalReference) -> str:
+    if not isinstance(ref, CanonicalReference):
+        raise Exception("reference must be a digest")
+    return f"/v2/{ref.path}/blobs/{ref.digest}"
+
+
+def _range_header(offset: int = 0, end: Optional[int] = None) -> Optional[Dict]:
+    if not offset and end is None:
+        return None
+    return {"Range": f"bytes={offset}-{'' if end is None else end}"}
+
+
+def _cached_blob(cache: Optional[BlobCache], ref: CanonicalReference) -> Optional[httpx.Response]:
+    if cache is None:
+        return None
+    content = cache.read_bytes(ref.digest)
+    if content is None:
+        return None
+    return httpx.Response(200, content=content, request=httpx.Request("GET", _blob_url(ref)))
+
+
+def _cache_blob(cache: Optional[BlobCache], ref: CanonicalReference, resp: httpx.Response):
+    if cache is None or resp.status_code != 200:
+        return
+    digest = Digest.from_bytes(resp.content, ref.digest.algom)
+    if digest != ref.digest:
+        raise ErrDigestMismatch(ref.digest, digest)
+    cache.add_bytes(ref.digest, resp.content)
+
+
+def _manifest_url(ref: Reference) -> str:
+    return f"/v2/{ref.path}/manifests/{ref.target}"
+
+
+def _cached_manifest(cache: Optional[ManifestCache], ref: CanonicalReference, url: str) -> Optional[httpx.Response]:
+    """
+    a manifest or an image config from cache, as if it was just fetched from url
+    """
+    if cache is None or not isinstance(ref, CanonicalReference):
+        return None
+    entry = cache.get(ref.digest)
+    if entry is None:
+        return None
+    media_type, content = entry
+    headers = {"docker-content-digest": ref.digest.value}
+    if media_type:
+        headers["content-type"] = media_type
+    return httpx.Response(200, content=content, headers=headers, request=httpx.Request("GET", url))
+
+
+def _cache_manifest(cache: Optional[ManifestCache], ref: CanonicalReference, resp: httpx.Response):
+    if cache is None or resp.status_code != 200 or not isinstance(ref, CanonicalReference):
+        return
+    digest = Digest.from_bytes(resp.content, ref.digest.algom)
+    if digest != ref.digest:
+        raise ErrDigestMismatch(ref.digest, digest)
+    cache.put(ref.digest, resp.headers.get("content-type", ""), resp.content)
+
+
+def _tag_key(client: httpx.Client, ref: Reference) -> str:
+    return f"{client.base_url.netloc.decode()}/{ref.path}:{ref.target}"
+
+
+def _revalidate_headers(entry: Optional[TagEntry]) -> Optional[Dict]:
+    if entry is None or not entry.etag:
+        return None
+    return {"If-None-Match": entry.etag}
+
+
+def _manifest_digest(resp: httpx.Response, ref: Reference, entry: Optional[TagEntry] = None) -> Digest:
+    """
+    the digest of a manifest from the response of HEAD or GET, a 304 means `entry` is still valid
+    """
+    if entry is not None and resp.status_code == 304:
+        return entry.digest
+    if resp.status_code != 200:
+        raise ImageNotFoundError(ref)
+    manifest_digest_in_header = resp.headers.get("docker-content-digest")
+    if manifest_digest_in_header is None:
+        return Digest.from_bytes(resp.content)
+    return Digest(manifest_digest_in_header)
+
+
+def _record_head_digest(client: Union[AuthClient, AsyncAuthClient], resp: httpx.Response) -> bool:
+    """
+    record if the registry sends `docker-content-digest` on HEAD of a manifest,
+    return False if the digest of resp can't be known without the body
+    """
+    if resp.status_code != 200:
+        return True
+    head_digest = "docker-content-digest" in resp.headers
+    client.capabilities.update(host_of(client.base_url), head_digest=head_digest)
+    return head_digest
+
+
+def _update_tag(cache: ManifestCache, key: str, digest: Digest, resp: httpx.Response, entry: Optional[TagEntry]):
+    etag = resp.headers.get("etag")
+    if etag is None and entry is not None and resp.status_code == 304:
+        etag = entry.etag
+    cache.put_tag(key, digest, etag)
+
+
+def _canonical_manifest_ref(resp: httpx.Response, ref: Reference) -> CanonicalReference:
+    """
+    the canonical reference of a manifest fetched by tag, its digest is taken from `docker-content-digest`
+    and checked against the body, or computed from the body if the registry doesn't send it
+    """
+    if resp.status_code == 404:
+        raise ImageNotFoundError(ref)
+    resp.raise_for_status()
+    digest_in_header = resp.headers.get("docker-content-digest")
+    digest = Digest(digest_in_header) if digest_in_header else Digest.from_bytes(resp.content)
+    content_digest = Digest.from_bytes(resp.content, digest.algom)
+    if content_digest != digest:
+        raise ErrDigestMismatch(digest, content_digest)
+    return CanonicalReference(ref.domain, ref.path, digest=digest)
+
+
+def _cached_tag(
+    cache: Optional[ManifestCache], client: httpx.Client, ref: Reference
+) -> Tuple[Optional[TagEntry], Optional[Tuple[CanonicalReference, httpx.Response]]]:
+    """
+    the entry of a tag and the manifest it pointed to, if they are cached
+    """
+    if cache is None:
+        return None, None
+    entry = cache.get_tag(_tag_key(client, ref))
+    if entry is None:
+        return None, None
+    digest_ref = CanonicalReference(ref.domain, ref.path, digest=entry.digest)
+    resp = _cached_manifest(cache, digest_ref, _manifest_url(ref))
+    return entry, (digest_ref, resp) if resp is not None else None
+
+
+def _resolve_response(
+    cache: Optional[ManifestCache],
+    client: httpx.Client,
+    ref: Reference,
+    resp: httpx.Response,
+    entry: Optional[TagEntry],
+    cached: Optional[Tuple[CanonicalReference, httpx.Response]],
+) -> Tuple[CanonicalReference, httpx.Response]:
+    """
+    handle the response of GET by tag, a 304 means the cached manifest is still valid
+    """
+    if cached is not None and resp.status_code == 304:
+        digest_ref, resp_to_return = cached
+    else:
+        digest_ref, resp_to_return = _canonical_manifest_ref(resp, ref), resp
+        _cache_manifest(cache, digest_ref, resp)
+    if cache is not None:
+        _update_tag(cache, _tag_key(client, ref), digest_ref.digest, resp, entry)
+    return digest_ref, resp_to_return
+
+
+def _tag_list_params(limit: Optional[int] = None, last: Optional[str] = None) -> Dict:
+    params = {}
+    if limit:
+        params["n"] = limit
+    if last:
+        params["last"] = last
+    return params
+
+
+def _next_manifest_ref(
+    resp: httpx.Response, ref: CanonicalReference, platform: Platform = None
+) -> Optional[CanonicalReference]:
+    """
+    check a manifest response, return None if it is an image manifest, or the reference of the manifest
+    matching `platform` if it is a manifest list
+    """
+    if resp.status_code == 404:
+        raise ImageNotFoundError(ref)
+    resp.raise_for_status()
+    media_type = resp.headers.get("Content-Type")
+    if media_type == ImageMediaType.MediaTypeDockerSchema2Manifest.value:
+        return None
+    elif media_type == ImageMediaType.MediaTypeDockerSchema2ManifestList.value:
+        manifest_list = spec.Index(**resp.json())
+        match_manifests = filter_by_platform(manifest_list.manifests, target_platform=platform)
+        if not match_manifests:
+            raise ImageNotFoundError(f"{ref} for platform {platform}")
+        return CanonicalReference(ref.domain, ref.path, digest=match_manifests[0].digest)
+    else:
+        raise Exception("no match handler")
+
+
 class BlobClient:
     def __init__(self, client: AuthClient):
         self.client = client
@@ -48,24 +238,32 @@ class BlobClient:
         method: str = Literal["GET", "STREAM", "DELETE", "HEAD", "POST"],
         params: Optional[Dict] = None,
         body: Optional[Dict] = None,
+        headers: Optional[Dict] = None,
     ) -> Union[Iterable[httpx.Response], httpx.Response]:
-        if not isinstance(ref, CanonicalReference):
-            raise Exception("reference must be a digest")
+        url = _blob_url(ref)
         scope = RepositoryScope(ref.path, actions=actions)
-        url = f"/v2/{ref.path}/blobs/{ref.digest}"
         if method == "STREAM":
-            return self.client.stream("GET", url=url, auth=self.client.new_auth(auth_by=scope), params=params)
+            return self.client.stream(
+                "GET", url=url, auth=self.client.new_auth(auth_by=scope), params=params, headers=headers
+            )
         return self.client.request(
             method,
             url=url,
             auth=self.client.new_auth(auth_by=scope),
             params=params,
             json=body,
+            headers=headers,
         )
 
-    def get(self, ref: CanonicalReference, stream=False) -> Union[Iterable[httpx.Response], httpx.Response]:
+    def get(
+        self, ref: CanonicalReference, stream=False, offset: int = 0, end: Optional[int] = None
+    ) -> Union[Iterable[httpx.Response], httpx.Response]:
+        """
+        offset: request the blob from this byte, the registry responds 206 if it supports range requests
+        end: the last byte requested, inclusive
+        """
         method = "STREAM" if stream else "GET"
-        return self._send_req(method=method, ref=ref, actions=["pull"])
+        return self._send_req(method=method, ref=ref, actions=["pull"], headers=_range_header(offset, end))
 
     def delete(self, ref: CanonicalReference) -> httpx.Response:
         return self._send_req(method="DELETE", ref=ref, actions=["pull"])
@@ -75,8 +273,24 @@ class BlobClient:
 
 
 class ImageClient:
-    def __init__(self, client: AuthClient):
+    def __init__(
+        self,
+        client: AuthClient,
+        blob_cache: Optional[BlobCache] = None,
+        manifest_cache: Optional[ManifestCache] = None,
+        prefer_head: bool = False,
+    ):
+        """
+        blob_cache: image configs are read from and added to it
+        manifest_cache: manifests, image configs and the digests of tags are cached in it
+        prefer_head: resolve a tag by HEAD before getting the manifest by digest, it costs one more request,
+            but docker hub doesn't count HEAD requests into the pull rate limit, and a cached manifest isn't got again
+            A registry known to answer HEAD without `docker-content-digest` is always resolved by GET
+        """
         self.client = client
+        self.blob_cache = blob_cache
+        self.manifest_cache = manifest_cache
+        self.prefer_head = prefer_head
         self._blob_client = BlobClient(client)
         self._manifest_client = ManifestClient(client)
 
@@ -88,27 +302,54 @@ class ImageClient:
     ) -> httpx.Response:
         name = ref.path
         scope = RepositoryScope(repo_name=name, actions=["pull"])
-        params = {}
-        if limit:
-            params["n"] = limit
-        if last:
-            params["last"] = last
+        params = _tag_list_params(limit, last)
         return self.client.get(
             f"/v2/{name}/tags/list",
             auth=self.client.new_auth(auth_by=scope),
             params=params,
         )
 
+    def resolve_manifest(self, ref: Reference) -> Tuple[CanonicalReference, httpx.Response]:
+        """
+        the manifest of ref and its canonical reference, a tag is resolved by a single GET
+        """
+        if isinstance(ref, (DigestReference, CanonicalReference)) or (self.prefer_head and self._head_resolves_tags):
+            digest_ref = CanonicalReference(ref.domain, ref.path, digest=self.get_manifest_digest(ref))
+            return digest_ref, self.get_manifest(digest_ref)
+        entry, cached = _cached_tag(self.manifest_cache, self.client, ref)
+        if cached is not None and entry.is_fresh(self.manifest_cache.tag_ttl):
+            return cached
+        resp = self._manifest_client.get(ref, headers=_revalidate_headers(entry) if cached else None)
+        return _resolve_response(self.manifest_cache, self.client, ref, resp, entry, cached)
+
     def get_manifest_digest(self, ref: Reference) -> Digest:
         if isinstance(ref, (DigestReference, CanonicalReference)):
             return ref.digest
-        manifest_content_digest_resp = self._manifest_client.head(ref)
-        if manifest_content_digest_resp.status_code != 200:
-            raise ImageNotFoundError(ref)
-        manifest_digest_in_header = manifest_content_digest_resp.headers.get("docker-content-digest")
-        if manifest_digest_in_header is None:
-            return Digest.from_bytes(manifest_content_digest_resp.content)
-        return Digest(manifest_digest_in_header)
+        if self.manifest_cache is None:
+            return _manifest_digest(self._head_manifest(ref), ref)
+        key = _tag_key(self.client, ref)
+        entry = self.manifest_cache.get_tag(key)
+        if entry is not None and entry.is_fresh(self.manifest_cache.tag_ttl):
+            return entry.digest
+        resp = self._head_manifest(ref, headers=_revalidate_headers(entry))
+        digest = _manifest_digest(resp, ref, entry)
+        _update_tag(self.manifest_cache, key, digest, resp, entry)
+        return digest
+
+    @property
+    def _head_resolves_tags(self) -> bool:
+        return self.client.capabilities.sends_head_digest(host_of(self.client.base_url))
+
+    def _head_manifest(self, ref: Reference, headers: Optional[Dict] = None) -> httpx.Response:
+        """
+        HEAD a manifest for its digest, or GET it if the registry doesn't send `docker-content-digest` on HEAD
+        """
+        if not self._head_resolves_tags:
+            return self._manifest_client.get(ref, headers=headers)
+        resp = self._manifest_client.head(ref, headers=headers)
+        if _record_head_digest(self.client, resp):
+            return resp
+        return self._manifest_client.get(ref, headers=headers)
 
     @classmethod
     def push(cls, image_path: pathlib.Path, force=False):
@@ -126,7 +367,12 @@ class ImageClient:
         return resp.status_code == 200
 
     def get_manifest(self, ref: CanonicalReference) -> httpx.Response:
-        return self._manifest_client.get(ref)
+        resp = _cached_manifest(self.manifest_cache, ref, _manifest_url(ref))
+        if resp is not None:
+            return resp
+        resp = self._manifest_client.get(ref)
+        _cache_manifest(self.manifest_cache, ref, resp)
+        return resp
 
     def put_manifest(self):
         pass
@@ -135,23 +381,176 @@ class ImageClient:
         pass
 
     def get_config(self, ref: CanonicalReference) -> httpx.Response:
-        return self._blob_client.get(ref)
+        resp = _cached_manifest(self.manifest_cache, ref, _blob_url(ref))
+        if resp is not None:
+            return resp
+        resp = _cached_blob(self.blob_cache, ref)
+        if resp is None:
+            resp = self._blob_client.get(ref)
+            _cache_blob(self.blob_cache, ref, resp)
+        _cache_manifest(self.manifest_cache, ref, resp)
+        return resp
 
     def _handle_manifest(
         self, resp: httpx.Response, ref: CanonicalReference, platform: Platform = None
     ) -> httpx.Response:
-        if resp.status_code == 404:
-            raise ImageNotFoundError(ref)
-        resp.raise_for_status()
-        media_type = resp.headers.get("Content-Type")
-        if media_type == ImageMediaType.MediaTypeDockerSchema2Manifest.value:
+        new_ref = _next_manifest_ref(resp, ref, platform)
+        if new_ref is None:
+            return resp
+        resp = self.get_manifest(new_ref)
+        return self._handle_manifest(resp, ref, platform)
+
+
+class AsyncBlobClient:
+    def __init__(self, client: AsyncAuthClient):
+        self.client = client
+
+    async def _send_req(
+        self,
+        ref: CanonicalReference,
+        actions: List[str],
+        method: str = Literal["GET", "DELETE", "HEAD", "POST"],
+        params: Optional[Dict] = None,
+        body: Optional[Dict] = None,
+    ) -> httpx.Response:
+        url = _blob_url(ref)
+        scope = RepositoryScope(ref.path, actions=actions)
+        return await self.client.request(
+            method,
+            url=url,
+            auth=await self.client.new_auth(auth_by=scope),
+            params=params,
+            json=body,
+        )
+
+    @asynccontextmanager
+    async def stream(
+        self, ref: CanonicalReference, offset: int = 0, end: Optional[int] = None
+    ) -> AsyncIterator[httpx.Response]:
+        url = _blob_url(ref)
+        scope = RepositoryScope(ref.path, actions=["pull"])
+        auth = await self.client.new_auth(auth_by=scope)
+        async with self.client.stream("GET", url=url, auth=auth, headers=_range_header(offset, end)) as resp:
+            yield resp
+
+    async def iter_bytes(self, ref: CanonicalReference, chunk_size: Optional[int] = None) -> AsyncIterator[bytes]:
+        async with self.stream(ref) as resp:
+            resp.raise_for_status()
+            async for content in resp.aiter_bytes(chunk_size):
+                yield content
+
+    async def get(self, ref: CanonicalReference) -> httpx.Response:
+        return await self._send_req(method="GET", ref=ref, actions=["pull"])
+
+    async def delete(self, ref: CanonicalReference) -> httpx.Response:
+        return await self._send_req(method="DELETE", ref=ref, actions=["pull"])
+
+    async def head(self, ref: CanonicalReference) -> httpx.Response:
+        return await self._send_req(method="HEAD", ref=ref, actions=["pull"])
+
+
+class AsyncImageClient:
+    def __init__(
+        self,
+        client: AsyncAuthClient,
+        blob_cache: Optional[BlobCache] = None,
+        manifest_cache: Optional[ManifestCache] = None,
+        prefer_head: bool = False,
+    ):
+        self.client = client
+        self.blob_cache = blob_cache
+        self.manifest_cache = manifest_cache
+        self.prefer_head = prefer_head
+        self._blob_client = AsyncBlobClient(client)
+        self._manifest_client = AsyncManifestClient(client)
+
+    async def list_tag(
+        self,
+        ref: NamedReference,
+        limit: Optional[int] = None,
+        last: Optional[str] = None,
+    ) -> httpx.Response:
+        name = ref.path
+        scope = RepositoryScope(repo_name=name, actions=["pull"])
+        return await self.client.get(
+            f"/v2/{name}/tags/list",
+            auth=await self.client.new_auth(auth_by=scope),
+            params=_tag_list_params(limit, last),
+        )
+
+    async def resolve_manifest(self, ref: Reference) -> Tuple[CanonicalReference, httpx.Response]:
+        """
+        the same as `ImageClient.resolve_manifest`
+        """
+        if isinstance(ref, (DigestReference, CanonicalReference)) or (self.prefer_head and self._head_resolves_tags):
+            digest_ref = CanonicalReference(ref.domain, ref.path, digest=await self.get_manifest_digest(ref))
+            return digest_ref, await self.get_manifest(digest_ref)
+        entry, cached = _cached_tag(self.manifest_cache, self.client, ref)
+        if cached is not None and entry.is_fresh(self.manifest_cache.tag_ttl):
+            return cached
+        resp = await self._manifest_client.get(ref, headers=_revalidate_headers(entry) if cached else None)
+        return _resolve_response(self.manifest_cache, self.client, ref, resp, entry, cached)
+
+    async def get_manifest_digest(self, ref: Reference) -> Digest:
+        if isinstance(ref, (DigestReference, CanonicalReference)):
+            return ref.digest
+        if self.manifest_cache is None:
+            return _manifest_digest(await self._head_manifest(ref), ref)
+        key = _tag_key(self.client, ref)
+        entry = self.manifest_cache.get_tag(key)
+        if entry is not None and entry.is_fresh(self.manifest_cache.tag_ttl):
+            return entry.digest
+        resp = await self._head_manifest(ref, headers=_revalidate_headers(entry))
+        digest = _manifest_digest(resp, ref, entry)
+        _update_tag(self.manifest_cache, key, digest, resp, entry)
+        return digest
+
+    @property
+    def _head_resolves_tags(self) -> bool:
+        return self.client.capabilities.sends_head_digest(host_of(self.client.base_url))
+
+    async def _head_manifest(self, ref: Reference, headers: Optional[Dict] = None) -> httpx.Response:
+        if not self._head_resolves_tags:
+            return await self._manifest_client.get(ref, headers=headers)
+        resp = await self._manifest_client.head(ref, headers=headers)
+        if _record_head_digest(self.client, resp):
+            return resp
+        return await self._manifest_client.get(ref, headers=headers)
+
+    async def delete(self, ref: CanonicalReference) -> httpx.Response:
+        name = ref.path
+        target = ref.target
+        scope = RepositoryScope(repo_name=name, actions=["delete"])
+        return await self.client.delete(f"/v2/{name}/manifests/{target}", auth=await self.client.new_auth(scope))
+
+    async def exist(self, ref: Reference) -> bool:
+        resp = await self._manifest_client.head(ref)
+        return resp.status_code == 200
+
+    async def get_manifest(self, ref: CanonicalReference) -> httpx.Response:
+        resp = _cached_manifest(self.manifest_cache, ref, _manifest_url(ref))
+        if resp is not None:
+            return resp
+        resp = await self._manifest_client.get(ref)
+        _cache_manifest(self.manifest_cache, ref, resp)
+        return resp
+
+    async def get_config(self, ref: CanonicalReference) -> httpx.Response:
+        resp = _cached_manifest(self.manifest_cache, ref, _blob_url(ref))
+        if resp is not None:
+            return resp
+        resp = _cached_blob(self.blob_cache, ref)
+        if resp is None:
+            resp = await self._blob_client.get(ref)
+            _cache_blob(self.blob_cache, ref, resp)
+        _cache_manifest(self.manifest_cache, ref, resp)
+        return resp
+
+    async def _handle_manifest(
+        self, resp: httpx.Response, ref: CanonicalReference, platform: Platform = None
+    ) -> httpx.Response:
+        new_ref = _next_manifest_ref(resp, ref, platform)
+        if new_ref is None:
             return resp
-        elif media_type == ImageMediaType.MediaTypeDockerSchema2ManifestList.value:
-            manifest_list = spec.Index(**resp.json())
-            match_manifests = filter_by_platform(manifest_list.manifests, target_platform=platform)
-            for match in match_manifests:
-                new_ref = CanonicalReference(ref.domain, ref.path, digest=match.digest)
-                resp = self._manifest_client.get(new_ref)
-                return self._handle_manifest(resp, ref, platform)
-        else:
-            raise Exception("no match handler")
+        resp = await self.get_manifest(new_ref)
+        return await self._handle_manifest(resp, ref, platform)
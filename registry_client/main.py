@@ -1,16 +1,33 @@
 #!/usr/bin/env python3
 # encoding : utf-8
 # create at: 2022/10/4-下午10:16
+import json
 import pathlib
-from typing import Optional, cast
+import sys
+from typing import Dict, List, Optional, cast
 
 from pydantic import BaseModel
 from typer import Argument, BadParameter, Context, Exit, Option, Typer, echo
 
-from registry_client.client import RegistryClient
+from registry_client.auth import GLOBAL_TOKEN_CACHE
+from registry_client.cache import DEFAULT_TAG_TTL, BlobCache, ManifestCache
+from registry_client.capabilities import GLOBAL_CAPABILITY_CACHE
+from registry_client.client import DEFAULT_MAX_CONCURRENT_INSPECTS, RegistryClient
+from registry_client.download import (
+    DEFAULT_MAX_CONCURRENT_DOWNLOADS,
+    DEFAULT_MAX_SEGMENTS,
+    DEFAULT_SEGMENT_THRESHOLD,
+    DownloadOrder,
+)
+from registry_client.events import PullMetrics
 from registry_client.image import ImageFormat
 from registry_client.platforms import OS, Arch, Platform
+from registry_client.progress import ProgressBars
 from registry_client.reference import NamedReference, Reference, parse_normalized_named
+from registry_client.retry import DEFAULT_MAX_RETRIES, RetryPolicy
+from registry_client.throttle import GLOBAL_RATE_LIMITER
+from registry_client.token_cache import new_token_store
+from registry_client.utlis import DEFAULT_REGISTRY_HOST
 
 app = Typer(name="registry_client")
 
@@ -28,6 +45,18 @@ def platform_callback(ctx: Context, value: str):
         return
     if value is None:
         return None
+    return parse_platform(value)
+
+
+def platforms_callback(ctx: Context, value: str):
+    if ctx.resilient_parsing:
+        return
+    if value is None:
+        return None
+    return [parse_platform(one.strip()) for one in value.split(",") if one.strip()]
+
+
+def parse_platform(value: str) -> Platform:
     tmp = value.split("/")
     if len(tmp) != 2:
         raise BadParameter("Formatter Error, it should be like linux/amd64")
@@ -64,17 +93,31 @@ image_name_option = Argument(
 )
 
 
-def new_client(ref: Reference) -> RegistryClient:
+def new_client(ref: Reference, **kwargs) -> RegistryClient:
     global_options: "GlobalOptions" = Context.global_options
     scheme = "https"
     if global_options.plain_http:
         scheme = "http"
-    domain = ref.domain or "registry-1.docker.io"
+    domain = ref.domain or DEFAULT_REGISTRY_HOST
+    blob_cache = None
+    manifest_cache = None
+    if global_options.cache_dir is not None:
+        max_size = global_options.cache_max_size * 1024 * 1024 or None
+        blob_cache = BlobCache(global_options.cache_dir, max_size=max_size)
+        manifest_cache = ManifestCache(global_options.cache_dir.joinpath("manifests"), tag_ttl=global_options.tag_ttl)
     return RegistryClient(
         host=f"{scheme}://{domain}",
         username=global_options.username,
         password=global_options.password,
         skip_verify=global_options.ignore_cert_error,
+        blob_cache=blob_cache,
+        manifest_cache=manifest_cache,
+        prefer_head=global_options.prefer_head,
+        # like the registry-mirrors of dockerd, mirrors only serve docker hub
+        mirrors=global_options.mirrors if domain == DEFAULT_REGISTRY_HOST else None,
+        retry=RetryPolicy(max_retries=global_options.max_retries),
+        http2=global_options.http2,
+        **kwargs,
     )
 
 
@@ -94,7 +137,8 @@ def list_tags(
 
 @app.command("inspect")
 def inspect_image(
-    name: str = image_name_option,
+    names: Optional[List[str]] = Argument(None, help="image names, like: hello-world:latest alpine:3"),
+    file: Optional[pathlib.Path] = Option(None, "--file", "-i", help="read image names from this file, one per line"),
     platform: str = Option(
         None,
         "--platform",
@@ -103,11 +147,34 @@ def inspect_image(
         callback=platform_callback,
         autocompletion=platform_complete,
     ),
+    concurrency: int = Option(
+        DEFAULT_MAX_CONCURRENT_INSPECTS, help="max number of images inspected at the same time", min=1
+    ),
 ):
-    ref: Reference = cast(Reference, name)
-    client = new_client(ref)
-    image_config = client.inspect_image(str(ref), platform=platform)
-    echo(image_config.json())
+    """
+    print the image config, one json line with name and image or error per image if many images are given
+    """
+    refs = read_image_names(names or [], file)
+    if len(refs) == 1:
+        ref: Reference = cast(Reference, refs[0])
+        client = new_client(ref)
+        image_config = client.inspect_image(str(ref), platform=platform)
+        echo(image_config.json())
+        return
+    refs_by_domain: Dict[str, List[Reference]] = {}
+    for ref in refs:
+        refs_by_domain.setdefault(ref.domain, []).append(ref)
+    failed = False
+    for domain_refs in refs_by_domain.values():
+        client = new_client(domain_refs[0])
+        for result in client.inspect_images([str(ref) for ref in domain_refs], platform, concurrency):
+            if result.error is not None:
+                failed = True
+                echo(json.dumps({"name": result.name, "error": str(result.error)}))
+            else:
+                echo(json.dumps({"name": result.name, "image": json.loads(result.image.json())}))
+    if failed:
+        raise Exit(1)
 
 
 @app.command("pull")
@@ -122,20 +189,162 @@ def pull_image(
         autocompletion=platform_complete,
     ),
     image_format: ImageFormat = Option(ImageFormat.V2.value, "--format", "-f"),
-    save_to: pathlib.Path = Option(..., help="save image to which dir"),
+    save_to: Optional[pathlib.Path] = Option(None, help="save image to which dir"),
+    output: Optional[str] = Option(
+        None, "--output", "-o", help="write the image tar to this file while downloading, `-` means stdout"
+    ),
     just_download: bool = Option(False, help="just download image config and layer, don't tar them to image"),
+    max_concurrent_downloads: int = Option(
+        DEFAULT_MAX_CONCURRENT_DOWNLOADS, help="max number of layers downloaded at the same time", min=1
+    ),
+    work_dir: Optional[pathlib.Path] = Option(
+        None, help="keep downloading layers here, pull again with the same work dir to resume an interrupted pull"
+    ),
+    segment_threshold: int = Option(
+        DEFAULT_SEGMENT_THRESHOLD // 1024 // 1024,
+        help="download layers larger than it (MiB) in parallel byte ranges, 0 means never",
+        min=0,
+    ),
+    max_segments: int = Option(DEFAULT_MAX_SEGMENTS, help="max number of byte ranges of a layer", min=1),
+    download_order: DownloadOrder = Option(
+        DownloadOrder.LargestFirst.value,
+        help="the order layers are started in, largest-first finishes soonest, smallest-first shows progress early",
+    ),
+    keep_compressed: bool = Option(False, help="keep the layers of a v2 image compressed, `docker load` accepts it"),
+    seed: Optional[pathlib.Path] = Option(
+        None, exists=True, help="a previous pull of the image, its layers are reused instead of downloaded again"
+    ),
+    progress: bool = Option(False, help="show the progress of every layer on stderr"),
+    metrics: bool = Option(False, help="print the throughput of every host and the slowest layers when done"),
 ):
     want_platform: Optional[Platform] = platform
-    if save_to.exists() and not save_to.is_dir():
+    if save_to is None and output is None:
+        raise BadParameter("either --save-to or --output is required")
+    if seed is not None and output is not None:
+        raise BadParameter("--seed only works with --save-to")
+    if save_to is not None and save_to.exists() and not save_to.is_dir():
         raise BadParameter(f"param:save_to({save_to}) must be a directory")
     ref = name
-    client = new_client(ref)
-    image_path = client.pull_image(
-        image_name=str(ref),
-        save_dir=save_to,
-        image_format=image_format,
-        platform=platform,
+    client = new_client(
+        ref,
+        max_concurrent_downloads=max_concurrent_downloads,
+        segment_threshold=segment_threshold * 1024 * 1024 or None,
+        max_segments=max_segments,
+        schedule=download_order.policy,
     )
+    progress_bars = client.events.subscribe(ProgressBars()) if progress else None
+    pull_metrics = client.events.subscribe(PullMetrics()) if metrics else None
+    if output == "-":
+        client.export_image(
+            str(ref), sys.stdout.buffer, platform=platform, image_format=image_format, keep_compressed=keep_compressed
+        )
+        sys.stdout.buffer.flush()
+        image_path = "stdout"
+    elif output is not None:
+        with open(output, "wb") as f:
+            client.export_image(
+                str(ref), f, platform=platform, image_format=image_format, keep_compressed=keep_compressed
+            )
+        image_path = output
+    else:
+        image_path = client.pull_image(
+            image_name=str(ref),
+            save_dir=save_to,
+            image_format=image_format,
+            platform=platform,
+            work_dir=work_dir,
+            keep_compressed=keep_compressed,
+            seed=seed,
+        )
+    if progress_bars is not None:
+        progress_bars.close()
+    # don't mix messages into the image tar
+    to_stderr = output == "-"
+    if pull_metrics is not None:
+        echo(pull_metrics.summary(), err=True)
+    if client.blob_cache is not None:
+        stats = client.blob_cache.stats
+        echo(f"blob cache: {stats.hits} hits, {stats.misses} misses", err=to_stderr)
+    echo(f"image save to {image_path}", err=to_stderr)
+
+
+def read_image_names(names: List[str], file: Optional[pathlib.Path]) -> List[Reference]:
+    names = list(names)
+    if file is not None:
+        lines = file.read_text().splitlines()
+        names.extend(line.strip() for line in lines if line.strip() and not line.strip().startswith("#"))
+    if not names:
+        raise BadParameter("no image name given")
+    return [parse_normalized_named(name) for name in names]
+
+
+@app.command("pull-images")
+def pull_images(
+    names: Optional[List[str]] = Argument(None, help="image names, like: hello-world:latest alpine:3"),
+    file: Optional[pathlib.Path] = Option(None, "--file", "-i", help="read image names from this file, one per line"),
+    platform: str = Option(
+        None,
+        "--platform",
+        "-p",
+        help="default linux/amd64, exec `docker info -f '{{.OSType}}/{{.Architecture}}'` to view",
+        callback=platform_callback,
+        autocompletion=platform_complete,
+    ),
+    image_format: ImageFormat = Option(ImageFormat.V2.value, "--format", "-f"),
+    save_to: pathlib.Path = Option(..., help="save images to which dir"),
+    max_concurrent_downloads: int = Option(
+        DEFAULT_MAX_CONCURRENT_DOWNLOADS, help="max number of blobs downloaded at the same time", min=1
+    ),
+    keep_compressed: bool = Option(False, help="keep the layers of a v2 image compressed, `docker load` accepts it"),
+    concurrency: int = Option(
+        DEFAULT_MAX_CONCURRENT_INSPECTS, help="max number of image manifests resolved at the same time", min=1
+    ),
+):
+    """
+    pull many images, the blobs shared by them are downloaded only once
+    """
+    if save_to.exists() and not save_to.is_dir():
+        raise BadParameter(f"param:save_to({save_to}) must be a directory")
+    refs_by_domain: Dict[str, List[Reference]] = {}
+    for ref in read_image_names(names or [], file):
+        refs_by_domain.setdefault(ref.domain, []).append(ref)
+    for refs in refs_by_domain.values():
+        client = new_client(refs[0], max_concurrent_downloads=max_concurrent_downloads)
+        image_paths = client.pull_images(
+            [str(ref) for ref in refs],
+            save_dir=save_to,
+            platform=platform,
+            image_format=image_format,
+            keep_compressed=keep_compressed,
+            concurrency=concurrency,
+        )
+        for image_path in image_paths:
+            echo(f"image save to {image_path}")
+
+
+@app.command("pull-index")
+def pull_index(
+    name: str = image_name_option,
+    platforms: str = Option(
+        None,
+        "--platforms",
+        "-p",
+        help="comma separated platforms to keep, like linux/amd64,linux/arm64, default all platforms",
+        callback=platforms_callback,
+    ),
+    save_to: pathlib.Path = Option(..., help="save image to which dir"),
+    max_concurrent_downloads: int = Option(
+        DEFAULT_MAX_CONCURRENT_DOWNLOADS, help="max number of blobs downloaded at the same time", min=1
+    ),
+):
+    """
+    pull a multi-platform image into one oci image tar, which keeps the original index
+    """
+    if save_to.exists() and not save_to.is_dir():
+        raise BadParameter(f"param:save_to({save_to}) must be a directory")
+    ref = name
+    client = new_client(ref, max_concurrent_downloads=max_concurrent_downloads)
+    image_path = client.pull_index(str(ref), save_dir=save_to, platforms=platforms)
     echo(f"image save to {image_path}")
 
 
@@ -165,6 +374,13 @@ class GlobalOptions(BaseModel):
     plain_http: bool = False
     username: str = ""
     password: str = ""
+    cache_dir: Optional[pathlib.Path] = None
+    cache_max_size: int = 0
+    tag_ttl: int = DEFAULT_TAG_TTL
+    prefer_head: bool = False
+    mirrors: List[str] = []
+    max_retries: int = DEFAULT_MAX_RETRIES
+    http2: bool = False
 
 
 @app.callback()
@@ -174,10 +390,50 @@ def main(
     plain_http: bool = Option(False, help="allow connections using plain HTTP"),
     username: str = Option("", help="registry username"),
     password: str = Option("", help="registry password", hide_input=True),
+    cache_dir: Optional[pathlib.Path] = Option(
+        None,
+        help="cache downloaded blobs, manifests, registry capabilities and tokens encrypted "
+        "with the key of REGISTRY_CLIENT_TOKEN_KEY or the keyring here and reuse them",
+    ),
+    cache_max_size: int = Option(0, help="max size of the blob cache in MiB, 0 means unlimited", min=0),
+    tag_ttl: int = Option(
+        DEFAULT_TAG_TTL, help="seconds to trust a cached tag before asking the registry again", min=0
+    ),
+    prefer_head: bool = Option(
+        False, help="resolve tags by HEAD requests, which docker hub doesn't count into the pull rate limit"
+    ),
+    mirror: Optional[List[str]] = Option(
+        None, help="a docker hub mirror like https://mirror.gcr.io, repeat it to give many, docker hub is the fallback"
+    ),
+    max_bandwidth: float = Option(0, help="max MiB/s of all blob downloads, 0 means unlimited", min=0),
+    max_requests: float = Option(0, help="max blob requests per second, 0 means unlimited", min=0),
+    host_max_bandwidth: float = Option(0, help="max MiB/s of blob downloads from each host", min=0),
+    host_max_requests: float = Option(0, help="max blob requests per second to each host", min=0),
+    max_retries: int = Option(
+        DEFAULT_MAX_RETRIES, help="times to retry a request failed by a network error, 429 or 5xx", min=0
+    ),
+    http2: bool = Option(False, help="use HTTP/2 if the registry supports it, needs registry_client[http2]"),
 ):
+    GLOBAL_RATE_LIMITER.set_limits(
+        bytes_per_second=max_bandwidth * 1024 * 1024 or None,
+        requests_per_second=max_requests or None,
+        host_bytes_per_second=host_max_bandwidth * 1024 * 1024 or None,
+        host_requests_per_second=host_max_requests or None,
+    )
+    # later commands of the same user reuse the tokens which haven't expired
+    GLOBAL_TOKEN_CACHE.store = new_token_store(cache_dir.joinpath("tokens")) if cache_dir is not None else None
+    # and what the registries are known to do, instead of pinging them for every command
+    GLOBAL_CAPABILITY_CACHE.root = cache_dir.joinpath("capabilities") if cache_dir is not None else None
     Context.global_options = GlobalOptions(
         ignore_cert_error=ignore_cert_error,
         plain_http=plain_http,
         username=username,
         password=password,
+        cache_dir=cache_dir,
+        cache_max_size=cache_max_size,
+        tag_ttl=tag_ttl,
+        prefer_head=prefer_head,
+        mirrors=mirror or [],
+        max_retries=max_retries,
+        http2=http2,
     )
@@ -2,7 +2,7 @@
 # encoding : utf-8
 # create at: 2022/9/27-下午6:40
 import sys
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Union
 
 from registry_client.utlis import CustomModel
 
@@ -13,37 +13,57 @@ else:
 
 import httpx
 
-from registry_client.auth import AuthClient
+from registry_client.auth import AsyncAuthClient, AuthClient
 from registry_client.media_types import ImageMediaType, OCIImageMediaType
 from registry_client.reference import Reference
 from registry_client.scope import RepositoryScope
 
+MANIFEST_ACCEPT = ", ".join(
+    (
+        ImageMediaType.MediaTypeDockerSchema2Manifest.value,
+        ImageMediaType.MediaTypeDockerSchema2ManifestList.value,
+        OCIImageMediaType.MediaTypeImageManifest.value,
+        OCIImageMediaType.MediaTypeImageIndex.value,
+        "*/*",
+    )
+)
+
 
 class ManifestClient:
     def __init__(self, client: AuthClient):
         self.client = client
-        self.client.headers.update(
-            {
-                "accept": ", ".join(
-                    (
-                        ImageMediaType.MediaTypeDockerSchema2Manifest.value,
-                        ImageMediaType.MediaTypeDockerSchema2ManifestList.value,
-                        OCIImageMediaType.MediaTypeImageManifest.value,
-                        OCIImageMediaType.MediaTypeImageIndex.value,
-                        "*/*",
-                    )
-                )
-            }
-        )
-
-    def _send_request(self, method: Literal["GET", "HEAD"], ref: Reference) -> httpx.Response:
+        self.client.headers.update({"accept": MANIFEST_ACCEPT})
+
+    def _send_request(
+        self, method: Literal["GET", "HEAD"], ref: Reference, headers: Optional[Dict] = None
+    ) -> httpx.Response:
+        scope = RepositoryScope(ref.path, actions=["pull"])
+        target = ref.target
+        url = f"/v2/{ref.path}/manifests/{target}"
+        return self.client.request(method, url, auth=self.client.new_auth(auth_by=scope), headers=headers)
+
+    def head(self, ref: Reference, headers: Optional[Dict] = None) -> httpx.Response:
+        return self._send_request("HEAD", ref, headers)
+
+    def get(self, ref: Reference, headers: Optional[Dict] = None) -> httpx.Response:
+        return self._send_request("GET", ref, headers)
+
+
+class AsyncManifestClient:
+    def __init__(self, client: AsyncAuthClient):
+        self.client = client
+        self.client.headers.update({"accept": MANIFEST_ACCEPT})
+
+    async def _send_request(
+        self, method: Literal["GET", "HEAD"], ref: Reference, headers: Optional[Dict] = None
+    ) -> httpx.Response:
         scope = RepositoryScope(ref.path, actions=["pull"])
         target = ref.target
         url = f"/v2/{ref.path}/manifests/{target}"
-        return self.client.request(method, url, auth=self.client.new_auth(auth_by=scope))
+        return await self.client.request(method, url, auth=await self.client.new_auth(auth_by=scope), headers=headers)
 
-    def head(self, ref: Reference) -> httpx.Response:
-        return self._send_request("HEAD", ref)
+    async def head(self, ref: Reference, headers: Optional[Dict] = None) -> httpx.Response:
+        return await self._send_request("HEAD", ref, headers)
 
-    def get(self, ref: Reference) -> httpx.Response:
-        return self._send_request("GET", ref)
+    async def get(self, ref: Reference, headers: Optional[Dict] = None) -> httpx.Response:
+        return await self._send_request("GET", ref, headers)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# encoding : utf-8
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, Iterator, List, Optional, Union
+
+import httpx
+from loguru import logger
+
+DEFAULT_MIRROR_COOLDOWN = 30
+MAX_MIRROR_COOLDOWN = 600
+LATENCY_SMOOTHING = 0.3
+# a request to one of them is answered the same by every mirror
+MIRRORED_METHODS = ("GET", "HEAD")
+MIRRORED_PATH = re.compile(r"^/v2/.+/(manifests|blobs)/[^/]+$")
+
+
+@dataclass
+class HostStats:
+    url: httpx.URL
+    latency: Optional[float] = None
+    requests: int = 0
+    errors: int = 0
+    consecutive_errors: int = 0
+    down_until: float = 0.0
+
+    @property
+    def error_rate(self) -> float:
+        return self.errors / self.requests if self.requests else 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+    @property
+    def score(self) -> float:
+        """
+        the expected seconds of a successful request, a failed one is sent again
+        """
+        if self.latency is None:
+            return float("inf")
+        return self.latency / max(1 - self.error_rate, 0.1)
+
+
+def is_mirrored(request: httpx.Request) -> bool:
+    return request.method in MIRRORED_METHODS and MIRRORED_PATH.match(request.url.path) is not None
+
+
+def with_host(request: httpx.Request, url: httpx.URL) -> httpx.Request:
+    """
+    a copy of request sent to another host
+    """
+    headers = request.headers.copy()
+    del headers["host"]
+    return httpx.Request(
+        request.method,
+        url.copy_with(raw_path=request.url.raw_path),
+        headers=headers,
+        extensions=request.extensions,
+    )
+
+
+class MirrorPool:
+    """
+    Registry mirrors serving the same images as a registry, such as pull-through caches in front of docker hub.
+
+    Manifest and blob requests are sent to the healthy mirror with the lowest score, the latency smoothed
+    over requests and weighed by the error rate, mirrors never measured are kept in the given order.
+    A mirror is down for `cooldown` seconds after an error, doubled by every error in a row.
+    The next mirror is tried when one fails or doesn't have the content, the registry itself is the last resort.
+    A download interrupted on one mirror is resumed on the next one.
+    """
+
+    def __init__(
+        self,
+        mirrors: List[Union[str, httpx.URL]],
+        fallback: Union[str, httpx.URL],
+        cooldown: float = DEFAULT_MIRROR_COOLDOWN,
+    ):
+        self.mirrors = [HostStats(httpx.URL(url)) for url in mirrors]
+        self.fallback = HostStats(httpx.URL(fallback))
+        self.cooldown = cooldown
+        self.probed = False
+        self._lock = threading.Lock()
+
+    @property
+    def hosts(self) -> List[HostStats]:
+        return [*self.mirrors, self.fallback]
+
+    def get(self, url: httpx.URL) -> Optional[HostStats]:
+        for host in self.hosts:
+            if host.url.netloc == url.netloc:
+                return host
+        return None
+
+    def candidates(self) -> List[HostStats]:
+        """
+        hosts in the order they are tried, down mirrors are tried only before the registry itself
+        """
+        with self._lock:
+            order = {id(host): index for index, host in enumerate(self.mirrors)}
+            mirrors = sorted(self.mirrors, key=lambda host: (not host.healthy, host.score, order[id(host)]))
+        return [*mirrors, self.fallback]
+
+    def record_success(self, host: HostStats, latency: float):
+        with self._lock:
+            host.requests += 1
+            host.consecutive_errors = 0
+            host.down_until = 0.0
+            if host.latency is None:
+                host.latency = latency
+            else:
+                host.latency += LATENCY_SMOOTHING * (latency - host.latency)
+
+    def record_failure(self, host: HostStats, error: Union[str, Exception]):
+        with self._lock:
+            host.requests += 1
+            host.errors += 1
+            host.consecutive_errors += 1
+            cooldown = min(self.cooldown * 2 ** (host.consecutive_errors - 1), MAX_MIRROR_COOLDOWN)
+            host.down_until = time.monotonic() + cooldown
+        logger.warning(f"{host.url} failed: {error!r}, skip it for {cooldown:.0f}s")
+
+    def _accept(self, host: HostStats, resp: httpx.Response, latency: float, last: bool) -> bool:
+        if resp.status_code == 429 or resp.status_code >= 500:
+            self.record_failure(host, f"status {resp.status_code}")
+            return last
+        self.record_success(host, latency)
+        # a pull-through cache may not reach every repository the registry has
+        return last or resp.status_code != 404
+
+    def _track(self, host: HostStats, resp: httpx.Response, stream_class):
+        """
+        a streaming response breaking midway counts as an error of host
+        """
+        if not resp.is_closed:
+            resp.stream = stream_class(resp.stream, lambda error: self.record_failure(host, error))
+
+    def send(self, request: httpx.Request, send: Callable[[httpx.Request], httpx.Response]) -> httpx.Response:
+        candidates = self.candidates()
+        for index, host in enumerate(candidates):
+            last = index == len(candidates) - 1
+            started = time.monotonic()
+            try:
+                resp = send(with_host(request, host.url))
+            except httpx.TransportError as e:
+                self.record_failure(host, e)
+                if last:
+                    raise
+                continue
+            if self._accept(host, resp, time.monotonic() - started, last):
+                self._track(host, resp, _TrackedStream)
+                return resp
+            resp.close()
+
+    async def async_send(
+        self, request: httpx.Request, send: Callable[[httpx.Request], Awaitable[httpx.Response]]
+    ) -> httpx.Response:
+        candidates = self.candidates()
+        for index, host in enumerate(candidates):
+            last = index == len(candidates) - 1
+            started = time.monotonic()
+            try:
+                resp = await send(with_host(request, host.url))
+            except httpx.TransportError as e:
+                self.record_failure(host, e)
+                if last:
+                    raise
+                continue
+            if self._accept(host, resp, time.monotonic() - started, last):
+                self._track(host, resp, _AsyncTrackedStream)
+                return resp
+            await resp.aclose()
+
+
+class _TrackedStream(httpx.SyncByteStream):
+    def __init__(self, stream: httpx.SyncByteStream, on_error: Callable[[Exception], None]):
+        self._stream = stream
+        self._on_error = on_error
+
+    def __iter__(self) -> Iterator[bytes]:
+        try:
+            yield from self._stream
+        except httpx.TransportError as e:
+            self._on_error(e)
+            raise
+
+    def close(self):
+        self._stream.close()
+
+
+class _AsyncTrackedStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, on_error: Callable[[Exception], None]):
+        self._stream = stream
+        self._on_error = on_error
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        try:
+            async for content in self._stream:
+                yield content
+        except httpx.TransportError as e:
+            self._on_error(e)
+            raise
+
+    async def aclose(self):
+        await self._stream.aclose()
+
+
+class MirrorAuth(httpx.Auth):
+    """
+    the auth of a request is selected by the host it is sent to
+    """
+
+    def __init__(self, select: Callable[[httpx.URL], httpx.Auth]):
+        self._select = select
+
+    def sync_auth_flow(self, request: httpx.Request):
+        return (yield from self._select(request.url).sync_auth_flow(request))
+
+
+class AsyncMirrorAuth(httpx.Auth):
+    def __init__(self, select: Callable[[httpx.URL], Awaitable[httpx.Auth]]):
+        self._select = select
+
+    async def async_auth_flow(self, request: httpx.Request):
+        flow = (await self._select(request.url)).async_auth_flow(request)
+        request = await flow.__anext__()
+        while True:
+            response = yield request
+            try:
+                request = await flow.asend(response)
+            except StopAsyncIteration:
+                break
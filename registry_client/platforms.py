@@ -224,7 +224,7 @@ class Platform(BaseModel):
 
 
 def platform_vector(p: Platform) -> List[Platform]:
-    vector: List[Platform] = []
+    vector: List[Platform] = [p]
     if p.architecture == "amd64":
         if p.variant.strip("v").isnumeric():
             amd64_version = int(p.variant.strip("v"))
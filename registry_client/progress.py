@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# encoding : utf-8
+import sys
+import threading
+from typing import Dict, TextIO
+
+from tqdm import tqdm
+
+from registry_client.digest import Digest
+from registry_client.events import (
+    BlobFailed,
+    BlobFinished,
+    BlobProgress,
+    BlobStarted,
+    Event,
+)
+
+
+class ProgressBars:
+    """
+    A listener of `Events` showing a progress bar for every blob being downloaded,
+    a line is written when a blob is done, with its throughput and where it came from.
+    """
+
+    def __init__(self, file: TextIO = sys.stderr):
+        self._file = file
+        self._bars: Dict[Digest, tqdm] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event: Event):
+        with self._lock:
+            if isinstance(event, BlobStarted):
+                self._bars[event.digest] = tqdm(
+                    total=event.size,
+                    desc=event.digest.short,
+                    unit="B",
+                    unit_scale=True,
+                    unit_divisor=1024,
+                    leave=False,
+                    file=self._file,
+                )
+            elif isinstance(event, BlobProgress):
+                bar = self._bars.get(event.digest)
+                if bar is not None:
+                    bar.update(event.amount)
+            elif isinstance(event, (BlobFinished, BlobFailed)):
+                bar = self._bars.pop(event.digest, None)
+                if bar is not None:
+                    bar.close()
+                tqdm.write(self._describe(event), file=self._file)
+
+    @staticmethod
+    def _describe(event: Event) -> str:
+        if isinstance(event, BlobFailed):
+            return f"{event.digest.short}: failed, {event.error!r}"
+        if event.cached:
+            return f"{event.digest.short}: cached"
+        return (
+            f"{event.digest.short}: {event.transferred / 1024 / 1024:.1f} MiB in {event.elapsed:.2f}s, "
+            f"{event.throughput / 1024 / 1024:.2f} MiB/s from {event.host}"
+        )
+
+    def close(self):
+        with self._lock:
+            for bar in self._bars.values():
+                bar.close()
+            self._bars.clear()
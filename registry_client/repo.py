@@ -5,24 +5,43 @@ from typing import Dict, Optional
 
 import httpx
 
-from registry_client.auth import AuthClient
+from registry_client.auth import AsyncAuthClient, AuthClient
 
 HeaderType = Dict[str, str]
 
 
+def _list_params(count: Optional[int] = None, last: Optional[str] = None) -> Dict:
+    params = {}
+    if count:
+        params["n"] = count
+    if last:
+        params["last"] = str(last)
+    return params
+
+
 class RepoClient:
     def __init__(self, client: AuthClient):
         self.client = client
 
     def list(self, count: Optional[int] = None, last: Optional[str] = None) -> httpx.Response:
-        params = {}
-        if count:
-            params["n"] = count
-        if last:
-            params["last"] = str(last)
+        params = _list_params(count, last)
         resp = self.client.get(
             url="/v2/_catalog",
             params=params,
             auth=self.client.new_auth(auth_by=(self.client._username, self.client._password)),
         )
         return resp
+
+
+class AsyncRepoClient:
+    def __init__(self, client: AsyncAuthClient):
+        self.client = client
+
+    async def list(self, count: Optional[int] = None, last: Optional[str] = None) -> httpx.Response:
+        params = _list_params(count, last)
+        resp = await self.client.get(
+            url="/v2/_catalog",
+            params=params,
+            auth=await self.client.new_auth(auth_by=(self.client._username, self.client._password)),
+        )
+        return resp
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# encoding : utf-8
+import asyncio
+import datetime
+import email.utils
+import random
+import time
+from typing import Awaitable, Callable, Optional
+
+import httpx
+from loguru import logger
+
+from registry_client.events import RequestRetried
+
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+MAX_BACKOFF = 30
+# a registry asking for longer is treated as down
+MAX_RETRY_AFTER = 300
+# sending them again has the same effect
+RETRYABLE_METHODS = ("GET", "HEAD")
+RETRYABLE_STATUS = (408, 429, 500, 502, 503, 504)
+# the request may not have reached the registry, or the connection broke, other transport errors won't go away
+RETRYABLE_ERRORS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    the seconds of a Retry-After header, which is either seconds or an http date
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class RetryPolicy:
+    """
+    Send a GET or HEAD request again when it fails for a reason which may go away,
+    a connection error, a timeout, 429 or a 5xx status.
+    It waits `Retry-After` if the registry asks for it, or a random time up to `backoff` doubled by every retry,
+    so clients failing at the same time don't come back at the same time.
+    An interrupted blob download is resumed with the same delays, see `Downloader`.
+    """
+
+    def __init__(
+        self,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        backoff: float = DEFAULT_BACKOFF,
+        max_backoff: float = MAX_BACKOFF,
+    ):
+        """
+        max_retries: 0 disables retrying
+        """
+        if max_retries < 0:
+            raise ValueError("max_retries must not be negative")
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    @staticmethod
+    def retryable_request(request: httpx.Request) -> bool:
+        return request.method in RETRYABLE_METHODS
+
+    @staticmethod
+    def retryable_error(error: Exception) -> bool:
+        return isinstance(error, RETRYABLE_ERRORS)
+
+    @staticmethod
+    def retryable_response(resp: httpx.Response) -> bool:
+        return resp.status_code in RETRYABLE_STATUS
+
+    def delay(self, attempt: int, resp: Optional[httpx.Response] = None) -> float:
+        """
+        the seconds to wait before retry `attempt`, counted from 0
+        """
+        retry_after = parse_retry_after(resp.headers.get("retry-after")) if resp is not None else None
+        if retry_after is not None:
+            return min(retry_after, MAX_RETRY_AFTER)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    def _should_retry(self, attempt: int, resp: Optional[httpx.Response], error: Optional[Exception]) -> bool:
+        if attempt >= self.max_retries:
+            return False
+        if error is not None:
+            return self.retryable_error(error)
+        return self.retryable_response(resp)
+
+    def _retried(
+        self,
+        request: httpx.Request,
+        attempt: int,
+        resp: Optional[httpx.Response],
+        error: Optional[Exception],
+        on_retry: Optional[Callable[[RequestRetried], None]],
+    ) -> float:
+        delay = self.delay(attempt, resp)
+        reason = repr(error) if error is not None else f"status {resp.status_code}"
+        logger.warning(f"{request.method} {request.url} failed: {reason}, retry in {delay:.2f}s")
+        if on_retry is not None:
+            on_retry(RequestRetried(request.method, str(request.url), attempt + 1, delay, reason))
+        return delay
+
+    def send(
+        self,
+        request: httpx.Request,
+        send: Callable[[httpx.Request], httpx.Response],
+        on_retry: Optional[Callable[[RequestRetried], None]] = None,
+    ) -> httpx.Response:
+        if not self.max_retries or not self.retryable_request(request):
+            return send(request)
+        attempt = 0
+        while True:
+            resp: Optional[httpx.Response] = None
+            error: Optional[Exception] = None
+            try:
+                resp = send(request)
+            except httpx.TransportError as e:
+                error = e
+            if not self._should_retry(attempt, resp, error):
+                if error is not None:
+                    raise error
+                return resp
+            delay = self._retried(request, attempt, resp, error, on_retry)
+            if resp is not None:
+                resp.close()
+            time.sleep(delay)
+            attempt += 1
+
+    async def async_send(
+        self,
+        request: httpx.Request,
+        send: Callable[[httpx.Request], Awaitable[httpx.Response]],
+        on_retry: Optional[Callable[[RequestRetried], None]] = None,
+    ) -> httpx.Response:
+        if not self.max_retries or not self.retryable_request(request):
+            return await send(request)
+        attempt = 0
+        while True:
+            resp: Optional[httpx.Response] = None
+            error: Optional[Exception] = None
+            try:
+                resp = await send(request)
+            except httpx.TransportError as e:
+                error = e
+            if not self._should_retry(attempt, resp, error):
+                if error is not None:
+                    raise error
+                return resp
+            delay = self._retried(request, attempt, resp, error, on_retry)
+            if resp is not None:
+                await resp.aclose()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def wait(self, attempt: int):
+        """
+        wait before resuming an interrupted download for the `attempt` time
+        """
+        time.sleep(self.delay(attempt))
+
+    async def async_wait(self, attempt: int):
+        await asyncio.sleep(self.delay(attempt))
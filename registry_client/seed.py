@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# encoding : utf-8
+import json
+import pathlib
+import tarfile
+from typing import BinaryIO, Dict, List, Optional
+
+from loguru import logger
+
+from registry_client import errors, spec
+from registry_client.cache import BlobCache
+from registry_client.compression import MAGIC_SIZE, detect_compression
+from registry_client.digest import CHUNK_SIZE, Digest, Digester
+from registry_client.download import BlobTask
+
+
+class Seed:
+    """
+    A previously saved image, so pulling a newer version of it only downloads the blobs it doesn't have.
+    It is an oci layout or a docker v2 image, either a directory or a tar.
+
+    Blobs are found by digest, the uncompressed layers of a docker v2 image by their diff_ids.
+    A blob is verified before it's added to a cache, files of a directory are hard linked if possible.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self._tar: Optional[tarfile.TarFile] = None
+        self._members: Dict[str, tarfile.TarInfo] = {}
+        if not path.is_dir():
+            self._tar = tarfile.open(path)
+            self._members = {_member_name(member): member for member in self._tar if member.isfile()}
+        # digest -> the name of the file in the seed
+        self._blobs: Dict[str, str] = {}
+        try:
+            self._index()
+        except BaseException:
+            self.close()
+            raise
+
+    def _exists(self, name: str) -> bool:
+        if self._tar is None:
+            return self.path.joinpath(name).is_file()
+        return name in self._members
+
+    def _names(self) -> List[str]:
+        if self._tar is None:
+            return [path.relative_to(self.path).as_posix() for path in self.path.rglob("*") if path.is_file()]
+        return list(self._members)
+
+    def _open(self, name: str) -> BinaryIO:
+        if self._tar is None:
+            return self.path.joinpath(name).open("rb")
+        return self._tar.extractfile(self._members[name])
+
+    def _index(self):
+        if self._exists(spec.ImageLayoutFile):
+            for name in self._names():
+                parts = name.split("/")
+                if len(parts) == 3 and parts[0] == "blobs":
+                    self._blobs[f"{parts[1]}:{parts[2]}"] = name
+        elif self._exists("manifest.json"):
+            with self._open("manifest.json") as f:
+                images = json.load(f)
+            for image in images:
+                self._index_docker_v2_image(image["Config"], image["Layers"])
+        else:
+            raise errors.ErrUnknownImageLayout(self.path)
+
+    def _index_docker_v2_image(self, config_name: str, layer_names: List[str]):
+        with self._open(config_name) as f:
+            config = f.read()
+        self._blobs[Digest.from_bytes(config).value] = config_name
+        diff_ids = json.loads(config)["rootfs"]["diff_ids"]
+        for layer_name, diff_id in zip(layer_names, diff_ids):
+            if not self._exists(layer_name):
+                continue
+            with self._open(layer_name) as f:
+                compressed = detect_compression(f.read(MAGIC_SIZE)) is not None
+            if not compressed:
+                self._blobs[diff_id] = layer_name
+                continue
+            # a layer kept compressed is the blob itself, its digest is unknown without hashing it
+            digester = Digester(Digest(diff_id).algom)
+            with self._open(layer_name) as f:
+                for content in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    digester.update(content)
+            self._blobs[digester.digest().value] = layer_name
+
+    def __contains__(self, digest: Digest) -> bool:
+        return digest.value in self._blobs
+
+    def add_to(self, cache: BlobCache, digest: Digest) -> bool:
+        """
+        verify the blob and add it to cache, return False if it isn't in the seed or doesn't match digest
+        """
+        name = self._blobs.get(digest.value)
+        if name is None:
+            return False
+        if self._tar is None:
+            path = self.path.joinpath(name)
+            if Digest.from_file(path, digest.algom) != digest:
+                logger.warning(f"skip {name} of seed {self.path}, it doesn't match {digest}")
+                return False
+            cache.add(digest, path)
+            return True
+        tmp_path = cache.ingest_path(digest)
+        digester = Digester(digest.algom)
+        try:
+            with self._open(name) as f, open(tmp_path, "wb") as out:
+                for content in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    digester.update(content)
+                    out.write(content)
+            if digester.digest() != digest:
+                logger.warning(f"skip {name} of seed {self.path}, it doesn't match {digest}")
+                return False
+            cache.add(digest, tmp_path, move=True)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        return True
+
+    def fill(self, cache: BlobCache, tasks: List[BlobTask]):
+        """
+        add the blobs of tasks found in the seed to cache, and the uncompressed layers of the tasks which decompress
+        """
+        digests = []
+        for task in tasks:
+            digests.append(task.ref.digest)
+            if task.decompress and task.diff_id is not None:
+                digests.append(task.diff_id)
+        added = 0
+        for digest in digests:
+            if digest in self and not cache.exists(digest) and self.add_to(cache, digest):
+                added += 1
+        logger.info(f"{added} blobs are reused from seed {self.path}")
+
+    def close(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+
+    def __enter__(self) -> "Seed":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _member_name(member: tarfile.TarInfo) -> str:
+    return member.name[2:] if member.name.startswith("./") else member.name
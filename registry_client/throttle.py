@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# encoding : utf-8
+import asyncio
+import re
+import threading
+import time
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+
+import httpx
+
+BLOB_PATH = re.compile(r"^/v2/.+/blobs/[^/]+$")
+
+
+class TokenBucket:
+    """
+    `rate` tokens are added every second, at most `burst` tokens are kept.
+    A consumer reserves tokens and waits until they are paid back, the tokens may go negative,
+    so consumers share the rate in the order they come, an idle consumer holds nothing.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        """
+        burst: one second of tokens by default
+        """
+        if rate <= 0:
+            raise ValueError("rate must be greater than 0")
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """
+        take amount tokens, return the seconds to wait before using them
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            return max(0.0, -self._tokens / self.rate)
+
+
+class _Limits:
+    def __init__(self, bytes_per_second: Optional[float] = None, requests_per_second: Optional[float] = None):
+        self.bytes = TokenBucket(bytes_per_second) if bytes_per_second else None
+        self.requests = TokenBucket(requests_per_second) if requests_per_second else None
+
+
+class RateLimiter:
+    """
+    Bandwidth and request rate limits of blob downloads, shared by every stream of the clients using it.
+    A request or a chunk of content waits for both the global limit and the limit of its host,
+    every concurrent download may use the bandwidth others leave, no stream is throttled on its own.
+    None means unlimited.
+    """
+
+    def __init__(
+        self,
+        bytes_per_second: Optional[float] = None,
+        requests_per_second: Optional[float] = None,
+        host_bytes_per_second: Optional[float] = None,
+        host_requests_per_second: Optional[float] = None,
+    ):
+        """
+        host_bytes_per_second, host_requests_per_second: the limits of every host, see `limit_host` for one host
+        """
+        self._lock = threading.Lock()
+        self._hosts: Dict[str, _Limits] = {}
+        self._host_overrides: Dict[str, _Limits] = {}
+        self.set_limits(bytes_per_second, requests_per_second, host_bytes_per_second, host_requests_per_second)
+
+    def set_limits(
+        self,
+        bytes_per_second: Optional[float] = None,
+        requests_per_second: Optional[float] = None,
+        host_bytes_per_second: Optional[float] = None,
+        host_requests_per_second: Optional[float] = None,
+    ):
+        with self._lock:
+            self._global = _Limits(bytes_per_second, requests_per_second)
+            self._host_bytes_per_second = host_bytes_per_second
+            self._host_requests_per_second = host_requests_per_second
+            self._hosts = dict(self._host_overrides)
+
+    def limit_host(
+        self, host: str, bytes_per_second: Optional[float] = None, requests_per_second: Optional[float] = None
+    ):
+        """
+        the limits of host instead of the limits of every host
+        """
+        with self._lock:
+            self._host_overrides[host] = self._hosts[host] = _Limits(bytes_per_second, requests_per_second)
+
+    @property
+    def unlimited(self) -> bool:
+        return (
+            self._global.bytes is None
+            and self._global.requests is None
+            and not self._host_bytes_per_second
+            and not self._host_requests_per_second
+            and not self._host_overrides
+        )
+
+    def _buckets(self, host: str) -> List[_Limits]:
+        with self._lock:
+            limits = self._hosts.get(host)
+            if limits is None:
+                limits = self._hosts[host] = _Limits(self._host_bytes_per_second, self._host_requests_per_second)
+            return [self._global, limits]
+
+    def request_delay(self, host: str) -> float:
+        """
+        reserve a request to host, return the seconds to wait before sending it
+        """
+        buckets = [limits.requests for limits in self._buckets(host) if limits.requests is not None]
+        return max((bucket.reserve(1) for bucket in buckets), default=0.0)
+
+    def bytes_delay(self, host: str, amount: int) -> float:
+        """
+        reserve amount bytes received from host, return the seconds to wait before reading more
+        """
+        buckets = [limits.bytes for limits in self._buckets(host) if limits.bytes is not None]
+        return max((bucket.reserve(amount) for bucket in buckets), default=0.0)
+
+    def throttle_request(self, host: str):
+        delay = self.request_delay(host)
+        if delay:
+            time.sleep(delay)
+
+    def throttle_bytes(self, host: str, amount: int):
+        delay = self.bytes_delay(host, amount)
+        if delay:
+            time.sleep(delay)
+
+    async def async_throttle_request(self, host: str):
+        delay = self.request_delay(host)
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def async_throttle_bytes(self, host: str, amount: int):
+        delay = self.bytes_delay(host, amount)
+        if delay:
+            await asyncio.sleep(delay)
+
+    def throttle_response(self, host: str, resp: httpx.Response):
+        """
+        throttle the content of resp while it is read, or pay for the content already read.
+        host: the host the request was sent to, the content may come from another host it redirects to
+        """
+        if resp.is_closed:
+            self.throttle_bytes(host, len(resp.content))
+        else:
+            resp.stream = _ThrottledStream(resp.stream, self, host)
+
+    async def async_throttle_response(self, host: str, resp: httpx.Response):
+        if resp.is_closed:
+            await self.async_throttle_bytes(host, len(resp.content))
+        else:
+            resp.stream = _AsyncThrottledStream(resp.stream, self, host)
+
+
+class _ThrottledStream(httpx.SyncByteStream):
+    def __init__(self, stream: httpx.SyncByteStream, limiter: RateLimiter, host: str):
+        self._stream = stream
+        self._limiter = limiter
+        self._host = host
+
+    def __iter__(self) -> Iterator[bytes]:
+        for content in self._stream:
+            self._limiter.throttle_bytes(self._host, len(content))
+            yield content
+
+    def close(self):
+        self._stream.close()
+
+
+class _AsyncThrottledStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, limiter: RateLimiter, host: str):
+        self._stream = stream
+        self._limiter = limiter
+        self._host = host
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for content in self._stream:
+            await self._limiter.async_throttle_bytes(self._host, len(content))
+            yield content
+
+    async def aclose(self):
+        await self._stream.aclose()
+
+
+def is_blob_request(request: httpx.Request) -> bool:
+    return BLOB_PATH.match(request.url.path) is not None
+
+
+# shared by every client of the process which isn't given a limiter, unlimited until `set_limits`
+GLOBAL_RATE_LIMITER = RateLimiter()
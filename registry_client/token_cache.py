@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# encoding : utf-8
+import hashlib
+import json
+import os
+import pathlib
+import time
+import uuid
+from typing import NamedTuple, Optional, Tuple
+
+from loguru import logger
+
+TOKEN_KEY_ENV = "REGISTRY_CLIENT_TOKEN_KEY"
+KEYRING_SERVICE = "registry_client"
+KEYRING_USERNAME = "token-store"
+
+
+class TokenKey(NamedTuple):
+    """
+    a token is only valid for the account it was issued to, by the realm and service of a registry
+    """
+
+    realm: str
+    service: str
+    account: str
+    scope: str
+
+    @property
+    def hash(self) -> str:
+        return hashlib.sha256(json.dumps(list(self)).encode()).hexdigest()
+
+
+class Cipher:
+    def encrypt(self, content: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decrypt(self, content: bytes) -> bytes:
+        """
+        raise ValueError if content wasn't encrypted by the same key or has been changed
+        """
+        raise NotImplementedError
+
+
+class FernetCipher(Cipher):
+    def __init__(self, key: bytes):
+        from cryptography.fernet import Fernet
+
+        self._fernet = Fernet(key)
+
+    def encrypt(self, content: bytes) -> bytes:
+        return self._fernet.encrypt(content)
+
+    def decrypt(self, content: bytes) -> bytes:
+        from cryptography.fernet import InvalidToken
+
+        try:
+            return self._fernet.decrypt(content)
+        except InvalidToken as e:
+            raise ValueError("invalid token file") from e
+
+
+class TokenStore:
+    """
+    Tokens encrypted at rest in a directory, shared by the processes using it.
+    The key is never written to the directory.
+
+    └── 0b5d0bb1c4a8e9f5d2a6d3b2a8f3e1c1b8f4c7d2e6f5a9b3c4d8e7f6a5b4c3d2
+
+    Every file is readable by its owner only. A token file which can't be decrypted, e.g. written with another key,
+    is treated as missing.
+    """
+
+    def __init__(self, root: pathlib.Path, cipher: Cipher):
+        self.root = root
+        self._cipher = cipher
+        root.mkdir(parents=True, exist_ok=True, mode=0o700)
+
+    def _path(self, key: TokenKey) -> pathlib.Path:
+        return self.root.joinpath(key.hash)
+
+    def get(self, key: TokenKey) -> Optional[Tuple[str, float]]:
+        """
+        the token of key and the unix time it expires at, None if it isn't stored or has expired
+        """
+        path = self._path(key)
+        try:
+            data = json.loads(self._cipher.decrypt(path.read_bytes()))
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logger.debug(f"ignore token file {path}: {e}")
+            return None
+        if data.get("key") != list(key):
+            return None
+        if data["expires_at"] <= time.time():
+            self.remove(key)
+            return None
+        return data["token"], data["expires_at"]
+
+    def put(self, key: TokenKey, token: str, expires_at: float):
+        data = {"key": list(key), "token": token, "expires_at": expires_at}
+        _write_private(self._path(key), self._cipher.encrypt(json.dumps(data).encode()))
+
+    def remove(self, key: TokenKey):
+        try:
+            self._path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+    def clean(self):
+        """
+        remove expired and unreadable tokens
+        """
+        now = time.time()
+        for path in self.root.iterdir():
+            if len(path.name) != 64:
+                continue
+            try:
+                expires_at = json.loads(self._cipher.decrypt(path.read_bytes()))["expires_at"]
+            except FileNotFoundError:
+                continue
+            except (ValueError, KeyError):
+                expires_at = 0
+            if expires_at <= now:
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+
+
+def load_key() -> Optional[bytes]:
+    """
+    the key of token stores, from the environment variable `REGISTRY_CLIENT_TOKEN_KEY`,
+    or from the keyring of the user, where the first process using it generates the key.
+    return None if neither has a key
+    """
+    key = os.environ.get(TOKEN_KEY_ENV)
+    if key:
+        return key.encode()
+    try:
+        import keyring
+        from keyring.errors import KeyringError
+    except ImportError:
+        return None
+    from cryptography.fernet import Fernet
+
+    try:
+        if keyring.get_password(KEYRING_SERVICE, KEYRING_USERNAME) is None:
+            keyring.set_password(KEYRING_SERVICE, KEYRING_USERNAME, Fernet.generate_key().decode())
+        # another process may have set its key at the same time, every process uses the one kept
+        key = keyring.get_password(KEYRING_SERVICE, KEYRING_USERNAME)
+    except KeyringError as e:
+        logger.debug(f"the key of token stores can't be kept in the keyring: {e}")
+        return None
+    return key.encode() if key else None
+
+
+def new_token_store(root: pathlib.Path, key: Optional[bytes] = None) -> Optional[TokenStore]:
+    """
+    return None if cryptography isn't installed or there is no key, tokens are never stored unencrypted
+    key: a Fernet key, see `load_key` by default
+    """
+    try:
+        import cryptography.fernet  # noqa: F401
+    except ImportError:
+        logger.warning("storing tokens needs the cryptography package, tokens are only cached in memory")
+        return None
+    key = key or load_key()
+    if key is None:
+        logger.warning(
+            f"storing tokens needs a key in {TOKEN_KEY_ENV} or the keyring package, tokens are only cached in memory"
+        )
+        return None
+    try:
+        cipher = FernetCipher(key)
+    except ValueError as e:
+        logger.warning(f"invalid key of the token store: {e}, tokens are only cached in memory")
+        return None
+    root.mkdir(parents=True, exist_ok=True, mode=0o700)
+    return TokenStore(root, cipher)
+
+
+def _write_private(path: pathlib.Path, content: bytes):
+    tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
@@ -1,6 +1,12 @@
+import gzip
+import io
+import json
 import os
 import shutil
-from typing import NamedTuple
+import tarfile
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional
 
 import docker
 import httpx
@@ -8,10 +14,12 @@ import pytest
 import respx
 
 from registry_client.auth import AuthClient, encode_auth
+from registry_client.capabilities import GLOBAL_CAPABILITY_CACHE
 from registry_client.client import RegistryClient
 from registry_client.digest import Digest
 from registry_client.image import BlobClient, ImageClient
 from registry_client.manifest import ManifestClient
+from registry_client.media_types import ImageMediaType, OCIImageMediaType
 from registry_client.repo import RepoClient
 from tests.local_docker import LocalDockerChecker
 
@@ -65,6 +73,17 @@ class RegistryInfo(NamedTuple):
     password: str = ""
 
 
+@pytest.fixture(autouse=True)
+def forget_capabilities():
+    """
+    the fake registries of a test answer differently from the ones of other tests
+    """
+    GLOBAL_CAPABILITY_CACHE.clear_memory()
+    yield
+    GLOBAL_CAPABILITY_CACHE.clear_memory()
+    GLOBAL_CAPABILITY_CACHE.root = None
+
+
 @pytest.fixture(scope="session")
 def registry_info(pytestconfig: pytest.Config) -> RegistryInfo:
     host = pytestconfig.option.registry_host
@@ -237,3 +256,226 @@ def registry_manifest(registry_mock):
 @pytest.fixture(scope="function")
 def registry_blobs(registry_mock):
     yield registry_mock.route(path__regex="/v2/(?P<repo>.*?)/(?P<name>.*?)/blobs/(?P<digest>.*)", name="blobs")
+
+
+class InFlight:
+    """
+    a side effect of a route counting the requests it handles at the same time, each is delayed to overlap the others
+    """
+
+    def __init__(self, side_effect, delay: float = 0.05):
+        self.side_effect = side_effect
+        self.delay = delay
+        self.now = 0
+        self.max = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        with self._lock:
+            self.now += 1
+            self.max = max(self.max, self.now)
+        try:
+            time.sleep(self.delay)
+            return self.side_effect(request, **kwargs)
+        finally:
+            with self._lock:
+                self.now -= 1
+
+
+class FakeImage(NamedTuple):
+    manifest: bytes
+    config: bytes
+    layers: List[bytes]
+    blobs: Dict[str, bytes]
+
+    @property
+    def digest(self) -> Digest:
+        return Digest.from_bytes(self.manifest)
+
+
+def make_layer(name: str, content: bytes) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+def gzip_compress(content: bytes) -> bytes:
+    """
+    the same content is always compressed to the same bytes, `gzip.compress` has no mtime on python 3.7
+    """
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", mtime=0) as f:
+        f.write(content)
+    return buffer.getvalue()
+
+
+def make_fake_image(layer_sizes=(16, 32, 64), base: Optional[FakeImage] = None) -> FakeImage:
+    """
+    base: the new layers are added on top of the layers of base
+    """
+    layers = list(base.layers) if base else []
+    layers.extend(make_layer(f"file-{index}", os.urandom(size)) for index, size in enumerate(layer_sizes))
+    compressed = [gzip_compress(layer) for layer in layers]
+    config = json.dumps(
+        {
+            "architecture": "amd64",
+            "os": "linux",
+            "rootfs": {"type": "layers", "diff_ids": [Digest.from_bytes(layer).value for layer in layers]},
+        }
+    ).encode()
+    manifest = json.dumps(
+        {
+            "schemaVersion": 2,
+            "mediaType": ImageMediaType.MediaTypeDockerSchema2Manifest.value,
+            "config": {
+                "mediaType": ImageMediaType.MediaTypeDockerSchema2Config.value,
+                "digest": Digest.from_bytes(config).value,
+                "size": len(config),
+            },
+            "layers": [
+                {
+                    "mediaType": ImageMediaType.MediaTypeDockerSchema2LayerGzip.value,
+                    "digest": Digest.from_bytes(blob).value,
+                    "size": len(blob),
+                }
+                for blob in compressed
+            ],
+        }
+    ).encode()
+    blobs = {Digest.from_bytes(blob).value: blob for blob in compressed}
+    blobs[Digest.from_bytes(config).value] = config
+    return FakeImage(manifest=manifest, config=config, layers=layers, blobs=blobs)
+
+
+@pytest.fixture(scope="function")
+def fake_image():
+    return make_fake_image()
+
+
+@pytest.fixture(scope="function")
+def fake_registry(registry_manifest, registry_blobs, fake_image):
+    def manifest_side_effect(request: httpx.Request, repo, name, target):
+        etag = f'"{fake_image.digest.value}"'
+        if request.headers.get("if-none-match") == etag:
+            return httpx.Response(304, headers={"etag": etag})
+        return httpx.Response(
+            200,
+            content=fake_image.manifest if request.method == "GET" else b"",
+            headers={
+                "content-type": ImageMediaType.MediaTypeDockerSchema2Manifest.value,
+                "docker-content-digest": fake_image.digest.value,
+                "etag": etag,
+            },
+        )
+
+    def blobs_side_effect(request: httpx.Request, repo, name, digest):
+        if digest not in fake_image.blobs:
+            return httpx.Response(404)
+        return httpx.Response(200, content=fake_image.blobs[digest])
+
+    registry_manifest.side_effect = manifest_side_effect
+    registry_blobs.side_effect = blobs_side_effect
+    yield fake_image
+
+
+class FakeIndex(NamedTuple):
+    index: bytes
+    images: Dict[str, FakeImage]
+    manifests: Dict[str, bytes]
+    blobs: Dict[str, bytes]
+
+    @property
+    def digest(self) -> Digest:
+        return Digest.from_bytes(self.index)
+
+
+def make_fake_index(architectures=("amd64", "arm64")) -> FakeIndex:
+    """
+    a multi-platform image with an attestation manifest for every platform, like the images built by buildkit,
+    the attestation manifests share their config and layer
+    """
+    images = {arch: make_fake_image() for arch in architectures}
+    statement = b'{"_type": "https://in-toto.io/Statement/v0.1"}'
+    attestation_config = b'{"architecture": "unknown", "os": "unknown", "rootfs": {"type": "layers"}}'
+    manifests = {image.digest.value: image.manifest for image in images.values()}
+    blobs = {digest: blob for image in images.values() for digest, blob in image.blobs.items()}
+    blobs[Digest.from_bytes(statement).value] = statement
+    blobs[Digest.from_bytes(attestation_config).value] = attestation_config
+
+    descriptors = []
+    for arch, image in images.items():
+        attestation = json.dumps(
+            {
+                "schemaVersion": 2,
+                "mediaType": OCIImageMediaType.MediaTypeImageManifest.value,
+                "config": {
+                    "mediaType": OCIImageMediaType.MediaTypeImageConfig.value,
+                    "digest": Digest.from_bytes(attestation_config).value,
+                    "size": len(attestation_config),
+                },
+                "layers": [
+                    {
+                        "mediaType": "application/vnd.in-toto+json",
+                        "digest": Digest.from_bytes(statement).value,
+                        "size": len(statement),
+                    }
+                ],
+                "annotations": {"vnd.docker.reference.digest": image.digest.value},
+            }
+        ).encode()
+        manifests[Digest.from_bytes(attestation).value] = attestation
+        descriptors.append(
+            {
+                "mediaType": ImageMediaType.MediaTypeDockerSchema2Manifest.value,
+                "digest": image.digest.value,
+                "size": len(image.manifest),
+                "platform": {"architecture": arch, "os": "linux"},
+            }
+        )
+        descriptors.append(
+            {
+                "mediaType": OCIImageMediaType.MediaTypeImageManifest.value,
+                "digest": Digest.from_bytes(attestation).value,
+                "size": len(attestation),
+                "platform": {"architecture": "unknown", "os": "unknown"},
+                "annotations": {
+                    "vnd.docker.reference.digest": image.digest.value,
+                    "vnd.docker.reference.type": "attestation-manifest",
+                },
+            }
+        )
+    index = json.dumps(
+        {"schemaVersion": 2, "mediaType": OCIImageMediaType.MediaTypeImageIndex.value, "manifests": descriptors}
+    ).encode()
+    return FakeIndex(index=index, images=images, manifests=manifests, blobs=blobs)
+
+
+@pytest.fixture(scope="function")
+def fake_index_registry(registry_manifest, registry_blobs):
+    fake_index = make_fake_index()
+
+    def manifest_side_effect(request: httpx.Request, repo, name, target):
+        if target.startswith("sha256:") and target != fake_index.digest.value:
+            content = fake_index.manifests.get(target)
+            if content is None:
+                return httpx.Response(404)
+            media_type = json.loads(content)["mediaType"]
+        else:
+            content, media_type = fake_index.index, OCIImageMediaType.MediaTypeImageIndex.value
+        return httpx.Response(
+            200,
+            content=content if request.method == "GET" else b"",
+            headers={"content-type": media_type, "docker-content-digest": Digest.from_bytes(content).value},
+        )
+
+    def blobs_side_effect(request: httpx.Request, repo, name, digest):
+        if digest not in fake_index.blobs:
+            return httpx.Response(404)
+        return httpx.Response(200, content=fake_index.blobs[digest])
+
+    registry_manifest.side_effect = manifest_side_effect
+    registry_blobs.side_effect = blobs_side_effect
+    yield fake_index
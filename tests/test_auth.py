@@ -1,17 +1,23 @@
 #!/usr/bin/env python3
 # encoding : utf-8
 # create at: 2022/10/13-下午5:32
+import asyncio
 import base64
 import datetime
+import json
 import uuid
 from typing import Optional
 
 import httpx
 import pytest
+import respx
 
 from registry_client.auth import (
+    DEFAULT_KEEPALIVE_EXPIRY,
     GLOBAL_TOKEN_CACHE,
     TOKEN_CACHE_MIN_TIME,
+    AsyncAuthClient,
+    AsyncBearerAuth,
     AuthClient,
     BasicToken,
     BearerAuth,
@@ -21,9 +27,13 @@ from registry_client.auth import (
     RegistryChallenge,
     Token,
     encode_auth,
+    granted_access,
+    http2_available,
     parse_challenge,
+    pool_limits,
 )
 from registry_client.scope import EmptyScope, RepositoryScope
+from registry_client.token_cache import TokenKey
 from tests.conftest import FAKE_REGISTRY_AUTH_HOST
 
 
@@ -162,7 +172,7 @@ class TestBearerAuth:
         flow = auth.sync_auth_flow(request)
         request = next(flow)
         assert "Authorization" not in request.headers
-        assert str(scope) not in GLOBAL_TOKEN_CACHE
+        assert auth.token_key not in GLOBAL_TOKEN_CACHE
         resp_401 = httpx.Response(401)
 
         return_value = httpx.Response(
@@ -183,14 +193,14 @@ class TestBearerAuth:
         )
         request = flow.send(resp_401)
         assert request.headers.get("Authorization") == f"Bearer {token}"
-        assert GLOBAL_TOKEN_CACHE.get(str(scope))
+        assert GLOBAL_TOKEN_CACHE.get(TokenKey(FAKE_REGISTRY_AUTH_HOST, service, username, str(scope)))
         with pytest.raises(StopIteration):
             flow.send(httpx.Response(200))
 
-    def test_get_token_from_cache(self, monkeypatch):
+    def test_get_token_from_cache(self):
         random_key = uuid.uuid1().hex
         token = FakeToken({"Authorization": random_key})
-        monkeypatch.setitem(GLOBAL_TOKEN_CACHE, random_key, value=token)
+        GLOBAL_TOKEN_CACHE.put(TokenKey(FAKE_REGISTRY_AUTH_HOST, "", "", random_key), token)
         req = httpx.Request("GET", "https://example.com")
         auth = self.gen_bearer_auth(scope=random_key)
         flow = auth.sync_auth_flow(req)
@@ -199,10 +209,10 @@ class TestBearerAuth:
         with pytest.raises(StopIteration):
             flow.send(httpx.Response(200))
 
-    def test_token_expired_and_auth_again(self, monkeypatch, registry_auth_root):
+    def test_token_expired_and_auth_again(self, registry_auth_root):
         scope = uuid.uuid1().hex
         token = FakeToken({"token_key": "token_value"})
-        monkeypatch.setitem(GLOBAL_TOKEN_CACHE, scope, token)
+        GLOBAL_TOKEN_CACHE.put(TokenKey(FAKE_REGISTRY_AUTH_HOST, "", "", scope), token)
         req = httpx.Request("GET", "https://example.com")
         auth = self.gen_bearer_auth(scope=scope)
         flow = auth.sync_auth_flow(req)
@@ -241,6 +251,35 @@ class TestBearerAuth:
         auth_request_checker(no_need_auth=True, return_value=return_value)
         req = flow.send(resp)
 
+    def test_async_401_resp(self, registry_auth_root):
+        token = uuid.uuid1().hex
+        scope = RepositoryScope(repo_name=uuid.uuid1().hex, actions=["pull"])
+        challenge = RegistryChallenge(scheme=ChallengeScheme.Bearer, realm=FAKE_REGISTRY_AUTH_HOST)
+        auth = AsyncBearerAuth("", "", challenge=challenge, scope=scope)
+        registry_auth_root.mock(
+            return_value=httpx.Response(
+                200,
+                json={
+                    "token": token,
+                    "access_token": token,
+                    "issued_at": datetime.datetime.now().isoformat(),
+                    "expires_in": 1800,
+                },
+            )
+        )
+
+        async def run():
+            flow = auth.async_auth_flow(httpx.Request("GET", url="http://example.com"))
+            request = await flow.__anext__()
+            assert "Authorization" not in request.headers
+            request = await flow.asend(httpx.Response(401))
+            assert request.headers.get("Authorization") == f"Bearer {token}"
+            with pytest.raises(StopAsyncIteration):
+                await flow.asend(httpx.Response(200))
+
+        asyncio.run(run())
+        assert auth.token_key in GLOBAL_TOKEN_CACHE
+
     def test_error_challenge_scheme(self):
         challenge = RegistryChallenge(ChallengeScheme.Basic, realm="http://example.com")
         with pytest.raises(AssertionError):
@@ -346,3 +385,250 @@ class TestAuthClient:
         auth_client.ping()
         auth = auth_client._build_auth(None)
         assert auth.__class__ == httpx.Auth
+
+
+class TestAsyncAuthClient:
+    @pytest.mark.parametrize(
+        "challenge_scheme, auth_by, want_auth_type",
+        (
+            ("Bearer", ("", ""), httpx.BasicAuth),
+            ("Bearer", EmptyScope(), AsyncBearerAuth),
+            ("Bearer", None, httpx.Auth),
+            ("Basic", EmptyScope(), httpx.BasicAuth),
+            (None, EmptyScope(), httpx.Auth),
+        ),
+    )
+    def test_new_auth(self, registry_info, registry_v2, challenge_scheme, auth_by, want_auth_type):
+        if challenge_scheme:
+            registry_v2.respond(headers={"www-authenticate": f"{challenge_scheme} realm='http://example.com'"})
+
+        async def run():
+            async with AsyncAuthClient(base_url=registry_info.host) as client:
+                auther = await client.new_auth(auth_by=auth_by)
+                return client, auther
+
+        client, auther = asyncio.run(run())
+        assert auther.__class__ == want_auth_type
+        if auth_by is not None:
+            assert client.need_auth is bool(challenge_scheme)
+
+
+class TestConnectionPool:
+    @staticmethod
+    def handler(requests: list, headers: Optional[dict] = None):
+        def handle(request: httpx.Request) -> httpx.Response:
+            requests.append(request)
+            if request.url.path == "/token":
+                return httpx.Response(
+                    200,
+                    json={
+                        "token": "foo",
+                        "access_token": "foo",
+                        "issued_at": datetime.datetime.now().isoformat(),
+                        "expires_in": 1800,
+                    },
+                )
+            return httpx.Response(401 if headers else 200, headers=headers)
+
+        return handle
+
+    def test_pool_limits(self):
+        limits = pool_limits(12)
+        assert limits.max_connections == 100
+        assert limits.max_keepalive_connections == 16
+        assert limits.keepalive_expiry == DEFAULT_KEEPALIVE_EXPIRY
+        assert pool_limits(200).max_connections == 200
+
+    def test_limits(self):
+        client = AuthClient(base_url="https://registry.fake.yy", limits=pool_limits(20))
+        pool = client._transport._pool
+        assert pool._max_keepalive_connections == 24
+        assert client._token_client._transport._pool._max_keepalive_connections == 24
+
+    def test_ping_pooled(self):
+        requests = []
+        headers = {"www-authenticate": 'Bearer realm="https://auth.fake.yy/token", service="fake"'}
+        client = AuthClient(
+            base_url="https://registry.fake.yy", transport=httpx.MockTransport(self.handler(requests, headers))
+        )
+        client.ping()
+        assert [request.url.path for request in requests] == ["/v2/"]
+        assert client.challenge.service == "fake"
+
+    def test_token_client_reused(self):
+        requests = []
+        token_client = httpx.Client(transport=httpx.MockTransport(self.handler(requests)))
+        challenge = RegistryChallenge(scheme=ChallengeScheme.Bearer, realm="https://auth.fake.yy/token", service="fake")
+        for _ in range(2):
+            scope = RepositoryScope(repo_name=uuid.uuid1().hex, actions=["pull"])
+            auth = BearerAuth("", "", challenge=challenge, scope=scope, client=token_client)
+            flow = auth.sync_auth_flow(httpx.Request("GET", url="https://registry.fake.yy/v2/"))
+            next(flow)
+            request = flow.send(httpx.Response(401))
+            assert request.headers["Authorization"] == "Bearer foo"
+        assert len(requests) == 2
+        assert not token_client.is_closed
+
+    def test_close(self):
+        with AuthClient(base_url="https://registry.fake.yy") as client:
+            token_client = client._token_client
+        assert token_client.is_closed
+        client = AuthClient(base_url="https://registry.fake.yy")
+        client.close()
+        assert client._token_client.is_closed
+
+    def test_async_close(self):
+        async def run():
+            async with AsyncAuthClient(base_url="https://registry.fake.yy") as client:
+                return client._token_client
+
+        assert asyncio.run(run()).is_closed
+
+    def test_http2_fallback(self, monkeypatch):
+        monkeypatch.setattr("registry_client.auth.http2_available", lambda: False)
+        client = AuthClient(base_url="https://registry.fake.yy", http2=True)
+        assert not client._transport._pool._http2
+        assert not client._token_client._transport._pool._http2
+
+    def test_http2(self):
+        pytest.importorskip("h2")
+        assert http2_available()
+        client = AuthClient(base_url="https://registry.fake.yy", http2=True)
+        assert client._transport._pool._http2
+
+
+REGISTRY = "https://registry.fake.yy"
+
+
+def jwt(access: list) -> str:
+    def encode(data: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip("=")
+
+    return f"{encode({'alg': 'none'})}.{encode({'access': access})}.c2ln"
+
+
+def token_resp(token: str) -> httpx.Response:
+    return httpx.Response(
+        200,
+        json={
+            "token": token,
+            "access_token": token,
+            "issued_at": datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+            "expires_in": 1800,
+        },
+    )
+
+
+@pytest.fixture(scope="function")
+def bearer_registry():
+    """
+    a registry asking for bearer tokens
+    """
+    with respx.mock(assert_all_called=False) as mock:
+        mock.get(f"{REGISTRY}/v2/").respond(
+            401, headers={"www-authenticate": f'Bearer realm="{FAKE_REGISTRY_AUTH_HOST}",service="fake"'}
+        )
+        yield mock
+
+
+@pytest.fixture(scope="function")
+def token_route(bearer_registry):
+    yield bearer_registry.route(method="GET", host=httpx.URL(FAKE_REGISTRY_AUTH_HOST).host)
+
+
+class TestPrefetchTokens:
+    @staticmethod
+    def scopes(count: int):
+        prefix = uuid.uuid1().hex
+        return [RepositoryScope(repo_name=f"{prefix}/repo-{index}", actions=["pull"]) for index in range(count)]
+
+    def test_granted_access(self):
+        access = [{"type": "repository", "name": "foo", "actions": ["pull"]}]
+        assert granted_access(jwt(access)) == {("repository", "foo"): {"pull"}}
+        assert granted_access(jwt([])) == {}
+        assert granted_access("opaque") is None
+        assert granted_access("a.b.c") is None
+
+    def test_prefetch(self, token_route):
+        client = AuthClient(base_url=REGISTRY)
+        scopes = self.scopes(120)
+        refused = scopes[7]
+
+        def grant(request: httpx.Request):
+            names = [scope.split(":")[1] for scope in request.url.params.get_list("scope")]
+            access = [{"type": "repository", "name": name, "actions": ["pull"]} for name in names]
+            return token_resp(jwt([item for item in access if item["name"] != refused.repo_name]))
+
+        token_route.mock(side_effect=grant)
+        granted = client.prefetch_tokens(scopes)
+        assert token_route.call_count == 3
+        assert len(granted) == 119 and refused not in granted
+        key = TokenKey(FAKE_REGISTRY_AUTH_HOST, "fake", "", str(scopes[0]))
+        assert key in client.token_cache
+        assert key._replace(scope=str(refused)) not in client.token_cache
+        # cached tokens are not requested again, the refused one gets a token of its own on its 401
+        assert client.prefetch_tokens(scopes) == []
+        assert token_route.call_count == 4
+
+    def test_opaque_token(self, token_route):
+        client = AuthClient(base_url=REGISTRY)
+        scopes = self.scopes(3)
+        token_route.mock(return_value=token_resp("opaque"))
+        assert client.prefetch_tokens(scopes) == scopes
+        assert token_route.calls.last.request.url.params.get_list("scope") == [str(scope) for scope in scopes]
+
+    def test_refused(self, token_route):
+        client = AuthClient(base_url=REGISTRY)
+        token_route.mock(return_value=httpx.Response(400, json={"errors": [{"code": "DENIED"}]}))
+        assert client.prefetch_tokens(self.scopes(120)) == []
+        # a registry refusing the first request isn't asked again
+        assert token_route.call_count == 1
+
+    def test_need_not_auth(self):
+        with respx.mock() as mock:
+            mock.get(f"{REGISTRY}/v2/").respond(200)
+            assert AuthClient(base_url=REGISTRY).prefetch_tokens(self.scopes(3)) == []
+            assert mock.calls.call_count == 1
+
+    def test_async_prefetch(self, token_route):
+        scopes = self.scopes(60)
+        token_route.mock(return_value=token_resp("opaque"))
+
+        async def run():
+            async with AsyncAuthClient(base_url=REGISTRY) as client:
+                return await client.prefetch_tokens(scopes)
+
+        assert asyncio.run(run()) == scopes
+        assert token_route.call_count == 2
+
+
+class TestPreemptiveAuth:
+    @pytest.mark.parametrize("preemptive_auth, sent", ((True, 1), (False, 2)))
+    def test_first_request(self, bearer_registry, token_route, preemptive_auth, sent):
+        token_route.mock(return_value=token_resp("foo"))
+        manifests = bearer_registry.get(url__regex=rf"{REGISTRY}/v2/.+/manifests/latest")
+        manifests.side_effect = lambda request: httpx.Response(
+            200 if request.headers.get("Authorization") == "Bearer foo" else 401
+        )
+        client = AuthClient(base_url=REGISTRY, preemptive_auth=preemptive_auth)
+        scope = RepositoryScope(repo_name=uuid.uuid1().hex, actions=["pull"])
+        resp = client.get(f"/v2/{scope.repo_name}/manifests/latest", auth=client.new_auth(scope))
+        assert resp.status_code == 200
+        assert manifests.call_count == sent
+        assert token_route.call_count == 1
+
+    def test_async_first_request(self, bearer_registry, token_route):
+        token_route.mock(return_value=token_resp("foo"))
+        manifests = bearer_registry.get(url__regex=rf"{REGISTRY}/v2/.+/manifests/latest")
+        manifests.side_effect = lambda request: httpx.Response(
+            200 if request.headers.get("Authorization") == "Bearer foo" else 401
+        )
+        scope = RepositoryScope(repo_name=uuid.uuid1().hex, actions=["pull"])
+
+        async def run():
+            async with AsyncAuthClient(base_url=REGISTRY) as client:
+                auth = await client.new_auth(scope)
+                return await client.get(f"/v2/{scope.repo_name}/manifests/latest", auth=auth)
+
+        assert asyncio.run(run()).status_code == 200
+        assert manifests.call_count == 1
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+import os
+import threading
+
+import pytest
+
+from registry_client.cache import BlobCache, FileLock, ManifestCache
+from registry_client.digest import Digest
+
+
+def add_blob(cache: BlobCache, content: bytes) -> Digest:
+    digest = Digest.from_bytes(content)
+    cache.add_bytes(digest, content)
+    return digest
+
+
+class TestBlobCache:
+    def test_add(self, tmp_path):
+        cache = BlobCache(tmp_path)
+        source = tmp_path.joinpath("source")
+        source.write_bytes(b"foo")
+        digest = Digest.from_bytes(b"foo")
+        cache.add(digest, source)
+        assert source.exists()
+        assert cache.read_bytes(digest) == b"foo"
+        assert not list(cache.ingest_dir.iterdir())
+
+        target = tmp_path.joinpath("target")
+        assert cache.copy_to(digest, target)
+        assert target.read_bytes() == b"foo"
+
+    def test_add_move(self, tmp_path):
+        cache = BlobCache(tmp_path)
+        source = tmp_path.joinpath("source")
+        source.write_bytes(b"foo")
+        digest = Digest.from_bytes(b"foo")
+        cache.add(digest, source, move=True)
+        assert not source.exists()
+        assert cache.path(digest).read_bytes() == b"foo"
+
+    def test_miss(self, tmp_path):
+        cache = BlobCache(tmp_path)
+        digest = Digest.from_bytes(b"foo")
+        assert cache.open(digest) is None
+        assert not cache.copy_to(digest, tmp_path.joinpath("target"))
+        assert cache.read_bytes(digest) is None
+        assert cache.stats.misses == 3
+        assert cache.stats.hit_rate == 0
+
+    def test_stats(self, tmp_path):
+        cache = BlobCache(tmp_path)
+        digest = add_blob(cache, b"foo")
+        cache.read_bytes(digest)
+        cache.read_bytes(Digest.from_bytes(b"bar"))
+        assert cache.stats.hits == 1
+        assert cache.stats.misses == 1
+        assert cache.stats.hit_bytes == 3
+        assert cache.stats.added_bytes == 3
+        assert cache.stats.hit_rate == 0.5
+
+    def test_remove(self, tmp_path):
+        cache = BlobCache(tmp_path)
+        digest = add_blob(cache, b"foo")
+        cache.remove(digest)
+        assert not cache.exists(digest)
+        cache.remove(digest)
+
+    def test_evict_lru(self, tmp_path):
+        cache = BlobCache(tmp_path, max_size=8)
+        first = add_blob(cache, b"1234")
+        second = add_blob(cache, b"5678")
+        os.utime(cache.path(first), (1, 1))
+        os.utime(cache.path(second), (2, 2))
+        cache.read_bytes(first)  # first is used recently
+        third = add_blob(cache, b"abcd")
+        assert cache.exists(first)
+        assert not cache.exists(second)
+        assert cache.exists(third)
+        assert cache.size() == 8
+        assert cache.stats.evictions == 1
+
+    def test_evict_unlimited(self, tmp_path):
+        cache = BlobCache(tmp_path)
+        digests = [add_blob(cache, bytes([i]) * 1024) for i in range(4)]
+        cache.evict()
+        assert all(cache.exists(digest) for digest in digests)
+
+    def test_clean_ingest(self, tmp_path):
+        cache = BlobCache(tmp_path)
+        left = cache.ingest_dir.joinpath("left")
+        left.write_bytes(b"foo")
+        cache.clean_ingest()
+        assert left.exists()
+        os.utime(left, (1, 1))
+        cache.clean_ingest()
+        assert not left.exists()
+
+    @pytest.mark.parametrize("workers", (1, 4))
+    def test_concurrent_add(self, tmp_path, workers):
+        cache = BlobCache(tmp_path, max_size=1024)
+        contents = [bytes([i]) * 256 for i in range(16)]
+
+        def run(items):
+            for content in items:
+                add_blob(cache, content)
+                cache.read_bytes(Digest.from_bytes(content))
+
+        threads = [threading.Thread(target=run, args=(contents[i::workers],)) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert cache.size() <= 1024
+        for path in cache.blobs_dir.glob("*/*"):
+            assert Digest.from_bytes(path.read_bytes()).hex == path.name
+
+
+def test_file_lock(tmp_path):
+    lock = FileLock(tmp_path.joinpath("lock"))
+    counter = {"value": 0, "max": 0}
+
+    def run():
+        for _ in range(50):
+            with lock:
+                counter["value"] += 1
+                counter["max"] = max(counter["max"], counter["value"])
+                counter["value"] -= 1
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter["max"] == 1
+
+
+class TestManifestCache:
+    @pytest.mark.parametrize("on_disk", (False, True))
+    def test_put_get(self, tmp_path, on_disk):
+        cache = ManifestCache(tmp_path if on_disk else None)
+        digest = Digest.from_bytes(b'{"foo": "bar"}')
+        assert cache.get(digest) is None
+        cache.put(digest, "application/json", b'{"foo": "bar"}')
+        assert cache.get(digest) == ("application/json", b'{"foo": "bar"}')
+        cache.clear_memory()
+        assert cache.get(digest) == (("application/json", b'{"foo": "bar"}') if on_disk else None)
+
+    def test_shared_directory(self, tmp_path):
+        digest = Digest.from_bytes(b"{}")
+        ManifestCache(tmp_path).put(digest, "", b"{}")
+        assert ManifestCache(tmp_path).get(digest) == ("", b"{}")
+
+    def test_memory_lru(self):
+        cache = ManifestCache(max_memory_entries=2)
+        digests = [Digest.from_bytes(str(index).encode()) for index in range(3)]
+        for digest in digests[:2]:
+            cache.put(digest, "", digest.value.encode())
+        assert cache.get(digests[0]) is not None
+        cache.put(digests[2], "", digests[2].value.encode())
+        assert cache.get(digests[1]) is None
+        assert cache.get(digests[0]) is not None
+        assert cache.stats.evictions == 1
+
+    @pytest.mark.parametrize("on_disk", (False, True))
+    def test_tag(self, tmp_path, on_disk):
+        cache = ManifestCache(tmp_path if on_disk else None, tag_ttl=60)
+        digest = Digest.from_bytes(b"foo")
+        assert cache.get_tag("docker.io/library/foo:latest") is None
+        cache.put_tag("docker.io/library/foo:latest", digest, etag='"foo"')
+        entry = cache.get_tag("docker.io/library/foo:latest")
+        assert entry.digest == digest and entry.etag == '"foo"'
+        assert entry.is_fresh(cache.tag_ttl)
+        assert not entry.is_fresh(0)
+        if on_disk:
+            assert ManifestCache(tmp_path).get_tag("docker.io/library/foo:latest") == entry
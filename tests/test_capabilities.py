@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+
+from registry_client import capabilities as capabilities_module
+from registry_client.auth import (
+    AsyncAuthClient,
+    AuthClient,
+    BearerAuth,
+    ChallengeScheme,
+)
+from registry_client.capabilities import CapabilityCache, host_of
+from registry_client.digest import Digest
+from registry_client.download import BlobTask, Downloader
+from registry_client.image import BlobClient, ImageClient
+from registry_client.media_types import ImageMediaType
+from registry_client.reference import CanonicalReference, parse_normalized_named
+from registry_client.scope import RepositoryScope
+from tests.conftest import FAKE_REGISTRY_AUTH_HOST, InFlight
+from tests.test_download import RangeRegistry
+
+BEARER_CHALLENGE = f'Bearer realm="{FAKE_REGISTRY_AUTH_HOST}/token",service="fake"'
+
+
+class TestCapabilityCache:
+    def test_update(self):
+        cache = CapabilityCache()
+        assert cache.get("registry.fake.yy") is None
+        record = cache.update("registry.fake.yy", ranges=True)
+        assert cache.get("registry.fake.yy") == record
+        cache.update("registry.fake.yy", head_digest=False)
+        record = cache.get("registry.fake.yy")
+        assert (record.ranges, record.head_digest, record.challenge) == (True, False, None)
+        assert cache.supports_ranges("other.fake.yy")
+        assert not cache.sends_head_digest("registry.fake.yy")
+
+    def test_expired(self, monkeypatch):
+        cache = CapabilityCache(ttl=60)
+        now = 1000.0
+        monkeypatch.setattr(capabilities_module.time, "time", lambda: now)
+        cache.update("registry.fake.yy", ranges=False)
+        assert not cache.supports_ranges("registry.fake.yy")
+        now += 60
+        assert cache.get("registry.fake.yy") is None
+        assert cache.supports_ranges("registry.fake.yy")
+        record = cache.update("registry.fake.yy", head_digest=True)
+        assert (record.ranges, record.checked_at) == (None, now)
+
+    def test_shared_by_directory(self, tmp_path):
+        CapabilityCache(tmp_path).update("registry.fake.yy", challenge="", http2=True)
+        other = CapabilityCache(tmp_path)
+        assert other.get("registry.fake.yy").http2
+        other.update("registry.fake.yy", ranges=True)
+        record = CapabilityCache(tmp_path).get("registry.fake.yy")
+        assert (record.challenge, record.http2, record.ranges) == ("", True, True)
+        other.remove("registry.fake.yy")
+        assert CapabilityCache(tmp_path).get("registry.fake.yy") is None
+
+    def test_unchanged_not_written(self, tmp_path, monkeypatch):
+        writes = []
+        write_atomic = capabilities_module._write_atomic
+        monkeypatch.setattr(capabilities_module, "_write_atomic", lambda *args: writes.append(write_atomic(*args)))
+        cache = CapabilityCache(tmp_path)
+        cache.update("registry.fake.yy", ranges=True, redirects=False)
+        cache.update("registry.fake.yy", ranges=True)
+        assert len(writes) == 1
+
+    @pytest.mark.parametrize("content", (b"", b"{}", b'{"host": "other.fake.yy", "checked_at": 0}'))
+    def test_unreadable_file(self, tmp_path, content):
+        cache = CapabilityCache(tmp_path)
+        cache.update("registry.fake.yy", ranges=True)
+        tmp_path.joinpath(os.listdir(tmp_path)[0]).write_bytes(content)
+        assert CapabilityCache(tmp_path).get("registry.fake.yy") is None
+
+
+class TestPing:
+    @pytest.mark.parametrize("challenge", (BEARER_CHALLENGE, None))
+    def test_pinged_once(self, registry_info, registry_v2, challenge):
+        headers = {"www-authenticate": challenge} if challenge else {}
+        registry_v2.return_value = httpx.Response(401 if challenge else 200, headers=headers)
+        cache = CapabilityCache()
+        scope = RepositoryScope("library/foo", actions=["pull"])
+        for _ in range(3):
+            client = AuthClient(base_url=registry_info.host, capabilities=cache)
+            client.new_auth(auth_by=scope)
+            assert client.need_auth == bool(challenge)
+            if challenge:
+                assert client.challenge.scheme == ChallengeScheme.Bearer
+        assert registry_v2.call_count == 1
+        record = cache.get(host_of(client.base_url))
+        assert (record.challenge, record.http2) == (challenge or "", False)
+
+    def test_pinged_once_by_threads(self, registry_info, registry_v2):
+        registry_v2.side_effect = InFlight(
+            lambda request: httpx.Response(401, headers={"www-authenticate": BEARER_CHALLENGE})
+        )
+        client = AuthClient(base_url=registry_info.host, capabilities=CapabilityCache())
+        scope = RepositoryScope("library/foo", actions=["pull"])
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            auths = list(executor.map(lambda _: client.new_auth(auth_by=scope), range(8)))
+        assert registry_v2.call_count == 1
+        assert all(isinstance(auth, BearerAuth) for auth in auths)
+
+    def test_ping_refreshes(self, registry_info, registry_v2):
+        registry_v2.return_value = httpx.Response(200)
+        cache = CapabilityCache()
+        cache.update(host_of(httpx.URL(registry_info.host)), challenge=BEARER_CHALLENGE)
+        client = AuthClient(base_url=registry_info.host, capabilities=cache)
+        client.ping()
+        assert not client.need_auth
+        assert cache.get(host_of(client.base_url)).challenge == ""
+
+    def test_async_pinged_once(self, registry_info, registry_v2):
+        registry_v2.return_value = httpx.Response(401, headers={"www-authenticate": BEARER_CHALLENGE})
+        cache = CapabilityCache()
+        scope = RepositoryScope("library/foo", actions=["pull"])
+
+        async def run():
+            for _ in range(3):
+                async with AsyncAuthClient(base_url=registry_info.host, capabilities=cache) as client:
+                    await client.new_auth(auth_by=scope)
+                    assert client.challenge.scheme == ChallengeScheme.Bearer
+
+        asyncio.run(run())
+        assert registry_v2.call_count == 1
+
+
+class TestRanges:
+    @staticmethod
+    def make_task(tmp_path, content: bytes, name: str) -> BlobTask:
+        return BlobTask(
+            ref=CanonicalReference(path="library/foo", digest=Digest.from_bytes(content)),
+            target=tmp_path.joinpath(name),
+            size=len(content),
+        )
+
+    @pytest.mark.parametrize("support_range", (True, False))
+    def test_recorded(self, registry_info, registry_blobs, tmp_path, support_range):
+        content = os.urandom(10000)
+        registry = RangeRegistry(content, break_at=-1, broken=0, support_range=support_range)
+        registry_blobs.side_effect = registry
+        cache = CapabilityCache()
+        client = AuthClient(base_url=registry_info.host, capabilities=cache)
+        downloader = Downloader(BlobClient(client), segment_threshold=1024, max_segments=4)
+        for name in ("first", "second"):
+            registry.ranges.clear()
+            assert downloader.download(self.make_task(tmp_path, content, name)).read_bytes() == content
+        record = cache.get(host_of(client.base_url))
+        assert (record.ranges, record.redirects) == (support_range, False)
+        # the second blob isn't asked for segments once the registry is known to ignore them
+        assert sorted(registry.ranges, key=str) == (
+            ["bytes=0-2499", "bytes=2500-4999", "bytes=5000-7499", "bytes=7500-9999"] if support_range else [None]
+        )
+
+
+class TestHeadDigest:
+    def test_resolved_by_get(self, registry_info, registry_manifest, fake_image):
+        def manifest_side_effect(request: httpx.Request, repo, name, target):
+            return httpx.Response(
+                200,
+                content=fake_image.manifest if request.method == "GET" else b"",
+                headers={"content-type": ImageMediaType.MediaTypeDockerSchema2Manifest.value},
+            )
+
+        registry_manifest.side_effect = manifest_side_effect
+        cache = CapabilityCache()
+        client = ImageClient(AuthClient(base_url=registry_info.host, capabilities=cache), prefer_head=True)
+        ref = parse_normalized_named("foo/bar:latest")
+        for _ in range(2):
+            digest_ref, resp = client.resolve_manifest(ref)
+            assert digest_ref.digest == fake_image.digest
+            assert resp.content == fake_image.manifest
+        requests = [
+            (call.request.method, "latest" if call.request.url.path.endswith("latest") else "digest")
+            for call in registry_manifest.calls
+        ]
+        assert requests == [("HEAD", "latest"), ("GET", "latest"), ("GET", "digest"), ("GET", "latest")]
+        assert cache.get(host_of(client.client.base_url)).head_digest is False
@@ -1,15 +1,31 @@
 #!/usr/bin/env python3
 # encoding: utf-8
+import asyncio
+import gzip
+import io
+import json
+import os
+import tarfile
+import tempfile
+import threading
 import typing
 
 import httpx
 import pytest
 
-from registry_client import platforms
-from registry_client.client import RegistryClient
-from registry_client.image import ImageClient
-from registry_client.reference import parse_normalized_named
-from registry_client.utlis import DEFAULT_REGISTRY_HOST, DEFAULT_REPO
+from registry_client import errors, platforms
+from registry_client.cache import BlobCache, ManifestCache
+from registry_client.client import AsyncRegistryClient, RegistryClient
+from registry_client.digest import Digest
+from registry_client.image import ImageClient, ImageFormat
+from registry_client.media_types import ImageMediaType
+from registry_client.reference import CanonicalReference, parse_normalized_named
+from registry_client.utlis import (
+    DEFAULT_REGISTRY_HOST,
+    DEFAULT_REPO,
+    diff_ids_to_chain_ids,
+)
+from tests.conftest import InFlight, make_fake_image
 from tests.test_image import DEFAULT_IMAGE_NAME
 
 
@@ -43,6 +59,446 @@ class TestRegistryClient:
             options["platform"] = platforms.parse(options.get("platform"))
         self._check_pull_image(docker_registry_client, image_name=image_name, options=options)
 
+    @pytest.mark.parametrize("max_concurrent_downloads", (1, 3))
+    def test_pull_v2_layer_order(self, registry_info, fake_registry, image_save_dir, max_concurrent_downloads):
+        client = RegistryClient(host=registry_info.host, max_concurrent_downloads=max_concurrent_downloads)
+        image_path = client.pull_image("foo/bar:latest", save_dir=image_save_dir)
+        with tarfile.open(image_path) as tar:
+            manifest = json.load(tar.extractfile("manifest.json"))[0]
+            config = json.loads(fake_registry.config)
+            chain_ids = list(diff_ids_to_chain_ids(config["rootfs"]["diff_ids"]))
+            assert manifest["Layers"] == [f"{chain_id.split(':')[1]}/layer.tar" for chain_id in chain_ids]
+            for layer_path, layer in zip(manifest["Layers"], fake_registry.layers):
+                assert tar.extractfile(layer_path).read() == layer
+
+    @pytest.mark.parametrize("work_dir", (True, False))
+    def test_pull_keep_compressed(self, registry_info, fake_registry, image_save_dir, tmp_path_factory, work_dir):
+        client = RegistryClient(host=registry_info.host)
+        image_path = client.pull_image(
+            "foo/bar:latest",
+            save_dir=image_save_dir,
+            work_dir=tmp_path_factory.mktemp("work_dir") if work_dir else None,
+            keep_compressed=True,
+        )
+        manifest = json.loads(fake_registry.manifest)
+        with tarfile.open(image_path) as tar:
+            layer_paths = json.load(tar.extractfile("manifest.json"))[0]["Layers"]
+            for layer_path, layer in zip(layer_paths, manifest["layers"]):
+                assert tar.extractfile(layer_path).read() == fake_registry.blobs[layer["digest"]]
+
+    @pytest.mark.parametrize("image_format", (ImageFormat.V2, ImageFormat.OCI))
+    def test_pull_corrupted_layer(self, registry_info, fake_registry, image_save_dir, image_format):
+        layer_digest = json.loads(fake_registry.manifest)["layers"][0]["digest"]
+        fake_registry.blobs[layer_digest] = fake_registry.blobs[layer_digest][:-1]
+        client = RegistryClient(host=registry_info.host)
+        with pytest.raises(errors.ErrDigestMismatch):
+            client.pull_image("foo/bar:latest", save_dir=image_save_dir, image_format=image_format)
+        assert not list(image_save_dir.glob("*.tar"))
+
+    @pytest.mark.parametrize("image_format", (ImageFormat.V2, ImageFormat.OCI))
+    @pytest.mark.parametrize("keep_compressed", (True, False))
+    def test_export_to_pipe(self, registry_info, fake_registry, image_format, keep_compressed):
+        client = RegistryClient(host=registry_info.host, max_concurrent_downloads=2)
+        read_fd, write_fd = os.pipe()
+        received = io.BytesIO()
+        reader = threading.Thread(target=lambda: received.write(os.fdopen(read_fd, "rb").read()))
+        reader.start()
+        with os.fdopen(write_fd, "wb") as pipe:
+            client.export_image("foo/bar:latest", pipe, image_format=image_format, keep_compressed=keep_compressed)
+        reader.join()
+        received.seek(0)
+        with tarfile.open(fileobj=received, mode="r|") as tar:
+            files = {member.name: tar.extractfile(member).read() for member in tar if member.isfile()}
+        if image_format == ImageFormat.V2:
+            manifest = json.loads(files["manifest.json"])[0]
+            layers = [files[layer_path] for layer_path in manifest["Layers"]]
+            if keep_compressed:
+                layers = [gzip.decompress(layer) for layer in layers]
+            assert layers == fake_registry.layers
+        else:
+            for digest, blob in fake_registry.blobs.items():
+                assert files[f"blobs/sha256/{digest.split(':')[1]}"] == blob
+            assert json.loads(files["index.json"])["manifests"]
+
+    @pytest.mark.parametrize("fake_image", [make_fake_image(layer_sizes=(16,) * 6)])
+    @pytest.mark.parametrize(
+        "image_format, keep_compressed", ((ImageFormat.OCI, False), (ImageFormat.V2, False), (ImageFormat.V2, True))
+    )
+    def test_export_downloads_concurrently(
+        self, registry_info, fake_registry, registry_blobs, fake_image, image_format, keep_compressed
+    ):
+        in_flight = InFlight(registry_blobs.side_effect)
+        registry_blobs.side_effect = in_flight
+        client = RegistryClient(host=registry_info.host, max_concurrent_downloads=4)
+        received = io.BytesIO()
+        client.export_image("foo/bar:latest", received, image_format=image_format, keep_compressed=keep_compressed)
+        assert 1 < in_flight.max <= 4
+        received.seek(0)
+        with tarfile.open(fileobj=received, mode="r|") as tar:
+            files = {member.name: tar.extractfile(member).read() for member in tar if member.isfile()}
+        if image_format == ImageFormat.V2:
+            layer_names = json.loads(files["manifest.json"])[0]["Layers"]
+        else:
+            layers = json.loads(fake_image.manifest)["layers"]
+            layer_names = [f"blobs/sha256/{layer['digest'].split(':')[1]}" for layer in layers]
+        # entries are written in the order of the manifest, whichever is downloaded first
+        assert [name for name in files if name in layer_names] == layer_names
+
+    @pytest.mark.parametrize(
+        "image_format, keep_compressed, spooled",
+        ((ImageFormat.OCI, False, 0), (ImageFormat.V2, True, 0), (ImageFormat.V2, False, 1)),
+    )
+    def test_export_streams_known_sizes(
+        self, registry_info, fake_registry, monkeypatch, image_format, keep_compressed, spooled
+    ):
+        spool_dirs = []
+        temporary_directory = tempfile.TemporaryDirectory
+
+        def record(*args, **kwargs):
+            spool_dirs.append(kwargs.get("prefix"))
+            return temporary_directory(*args, **kwargs)
+
+        monkeypatch.setattr(tempfile, "TemporaryDirectory", record)
+        client = RegistryClient(host=registry_info.host)
+        received = io.BytesIO()
+        client.export_image("foo/bar:latest", received, image_format=image_format, keep_compressed=keep_compressed)
+        # only decompressed layers, whose sizes are unknown, are spooled before they are added to the tar
+        assert len(spool_dirs) == spooled
+        received.seek(0)
+        with tarfile.open(fileobj=received, mode="r|") as tar:
+            files = {member.name: tar.extractfile(member).read() for member in tar if member.isfile()}
+        want = fake_registry.layers if spooled else fake_registry.blobs.values()
+        assert set(want) <= set(files.values())
+
+    @pytest.mark.parametrize("image_format", (ImageFormat.V2, ImageFormat.OCI))
+    def test_pull_with_work_dir(self, registry_info, fake_registry, image_save_dir, tmp_path_factory, image_format):
+        work_dir = tmp_path_factory.mktemp("work_dir")
+        client = RegistryClient(host=registry_info.host)
+        image_path = client.pull_image(
+            "foo/bar:latest", save_dir=image_save_dir, image_format=image_format, work_dir=work_dir
+        )
+        assert image_path.exists()
+        assert not list(work_dir.iterdir())
+
+    @pytest.mark.parametrize("image_format", (ImageFormat.V2, ImageFormat.OCI))
+    def test_pull_with_cache(
+        self, registry_info, fake_registry, registry_blobs, image_save_dir, tmp_path_factory, image_format
+    ):
+        cache = BlobCache(tmp_path_factory.mktemp("cache"))
+        client = RegistryClient(host=registry_info.host, blob_cache=cache)
+
+        def pull() -> typing.Dict[str, bytes]:
+            image_path = client.pull_image("foo/bar:latest", save_dir=image_save_dir, image_format=image_format)
+            with tarfile.open(image_path) as tar:
+                return {member.name: tar.extractfile(member).read() for member in tar if member.isfile()}
+
+        first = pull()
+        assert all(cache.exists(Digest(digest)) for digest in fake_registry.blobs)
+        call_count = registry_blobs.call_count
+        assert pull() == first
+        assert registry_blobs.call_count == call_count
+        assert cache.stats.hits == len(fake_registry.blobs)
+
+    def test_inspect_with_cache(self, registry_info, fake_registry, registry_blobs, tmp_path):
+        client = RegistryClient(host=registry_info.host, blob_cache=BlobCache(tmp_path))
+        want = client.inspect_image("foo/bar:latest", platform=platforms.Platform())
+        call_count = registry_blobs.call_count
+        assert client.inspect_image("foo/bar:latest", platform=platforms.Platform()) == want
+        assert registry_blobs.call_count == call_count
+
+    @pytest.mark.parametrize(
+        "prefer_head, want",
+        (
+            (False, [("GET", "latest")]),
+            (True, [("HEAD", "latest"), ("GET", "digest")]),
+        ),
+    )
+    def test_resolve_manifest(self, registry_info, fake_registry, registry_manifest, prefer_head, want):
+        client = RegistryClient(host=registry_info.host, prefer_head=prefer_head)
+        client.inspect_image("foo/bar:latest", platform=platforms.Platform())
+        requests = [
+            (call.request.method, "latest" if call.request.url.path.endswith("latest") else "digest")
+            for call in registry_manifest.calls
+        ]
+        assert requests == want
+
+    @pytest.mark.parametrize(
+        "digest_in_header, want", ((None, None), (Digest.from_bytes(b"foo"), errors.ErrDigestMismatch))
+    )
+    def test_resolve_manifest_digest(self, registry_info, fake_registry, registry_manifest, digest_in_header, want):
+        headers = {"content-type": ImageMediaType.MediaTypeDockerSchema2Manifest.value}
+        if digest_in_header is not None:
+            headers["docker-content-digest"] = digest_in_header.value
+        registry_manifest.side_effect = lambda request, repo, name, target: httpx.Response(
+            200, content=fake_registry.manifest, headers=headers
+        )
+        client = ImageClient(RegistryClient(host=registry_info.host).client)
+        ref = parse_normalized_named("foo/bar:latest")
+        if want is not None:
+            with pytest.raises(want):
+                client.resolve_manifest(ref)
+            return
+        digest_ref, resp = client.resolve_manifest(ref)
+        assert digest_ref.digest == fake_registry.digest
+        assert resp.content == fake_registry.manifest
+
+    @pytest.mark.parametrize("concurrency", (1, 4))
+    def test_inspect_images(self, registry_info, fake_registry, registry_manifest, concurrency):
+        side_effect = registry_manifest.side_effect
+
+        def manifest_side_effect(request: httpx.Request, repo, name, target):
+            if name == "missing":
+                return httpx.Response(404)
+            return side_effect(request, repo, name, target)
+
+        registry_manifest.side_effect = manifest_side_effect
+        client = RegistryClient(host=registry_info.host)
+        names = [f"foo/bar:{index}" for index in range(10)] + ["foo/missing:latest", "foo/baz:latest", "Invalid:"]
+        results = {result.name: result for result in client.inspect_images(names, concurrency=concurrency)}
+        assert sorted(results) == sorted(names)
+        assert isinstance(results["foo/missing:latest"].error, errors.ImageNotFoundError)
+        assert results["Invalid:"].error is not None
+        for name in names[:10] + ["foo/baz:latest"]:
+            assert results[name].error is None
+            assert results[name].image.os == "linux"
+        # the others of a repository wait for the first one
+        bar_calls = [call.request.url.path for call in registry_manifest.calls if "/foo/bar/" in call.request.url.path]
+        assert bar_calls[0].endswith("/manifests/0")
+
+    def test_inspect_images_stop_early(self, registry_info, fake_registry):
+        client = RegistryClient(host=registry_info.host)
+        results = client.inspect_images([f"foo/bar:{index}" for index in range(20)], concurrency=2)
+        assert next(results).error is None
+        results.close()
+
+    def test_inspect_with_manifest_cache(self, registry_info, fake_registry, registry_manifest, registry_blobs):
+        cache = ManifestCache(tag_ttl=60)
+        client = RegistryClient(host=registry_info.host, manifest_cache=cache)
+        want = client.inspect_image("foo/bar:latest", platform=platforms.Platform())
+        calls = registry_manifest.call_count + registry_blobs.call_count
+        assert client.inspect_image("foo/bar:latest", platform=platforms.Platform()) == want
+        assert registry_manifest.call_count + registry_blobs.call_count == calls
+
+    def test_revalidate_tag(self, registry_info, fake_registry, registry_manifest, registry_blobs, tmp_path):
+        client = RegistryClient(host=registry_info.host, manifest_cache=ManifestCache(tmp_path, tag_ttl=0))
+        want = client.inspect_image("foo/bar:latest", platform=platforms.Platform())
+        manifest_calls, blob_calls = registry_manifest.call_count, registry_blobs.call_count
+        client = RegistryClient(host=registry_info.host, manifest_cache=ManifestCache(tmp_path, tag_ttl=0))
+        assert client.inspect_image("foo/bar:latest", platform=platforms.Platform()) == want
+        assert [call.request.method for call in registry_manifest.calls[manifest_calls:]] == ["GET"]
+        assert registry_manifest.calls.last.response.status_code == 304
+        assert registry_blobs.call_count == blob_calls
+
+    def test_tag_moved(self, registry_info, fake_registry, registry_manifest):
+        client = RegistryClient(host=registry_info.host, manifest_cache=ManifestCache(tag_ttl=0))
+        client.inspect_image("foo/bar:latest", platform=platforms.Platform())
+        moved = make_fake_image()
+        registry_manifest.side_effect = lambda request, repo, name, target: httpx.Response(
+            200,
+            content=moved.manifest if request.method == "GET" else b"",
+            headers={
+                "content-type": ImageMediaType.MediaTypeDockerSchema2Manifest.value,
+                "docker-content-digest": moved.digest.value,
+            },
+        )
+        fake_registry.blobs.update(moved.blobs)
+        image = client.inspect_image("foo/bar:latest", platform=platforms.Platform())
+        assert [diff_id.value for diff_id in image.rootfs.diff_ids] == json.loads(moved.config)["rootfs"]["diff_ids"]
+
+    @pytest.mark.parametrize("image_format", (ImageFormat.V2, ImageFormat.OCI))
+    @pytest.mark.parametrize("keep_compressed", (False, True))
+    def test_pull_images(
+        self, registry_info, fake_registry, registry_blobs, image_save_dir, image_format, keep_compressed
+    ):
+        client = RegistryClient(host=registry_info.host, max_concurrent_downloads=2)
+        image_paths = client.pull_images(
+            ["foo/bar:latest", "foo/bar:linux"],
+            save_dir=image_save_dir,
+            image_format=image_format,
+            keep_compressed=keep_compressed,
+        )
+        assert [path.name for path in image_paths] == [
+            "registry-1_docker_io_foo_bar_latest.tar",
+            "registry-1_docker_io_foo_bar_linux.tar",
+        ]
+        requested = [call.request.url.path.rsplit("/", 1)[-1] for call in registry_blobs.calls]
+        for layer in json.loads(fake_registry.manifest)["layers"]:
+            assert requested.count(layer["digest"]) == 1
+        for image_path in image_paths:
+            with tarfile.open(image_path) as tar:
+                if image_format == ImageFormat.V2:
+                    manifest = json.load(tar.extractfile("manifest.json"))[0]
+                    assert len(manifest["Layers"]) == len(fake_registry.layers)
+                else:
+                    assert json.load(tar.extractfile("index.json"))["manifests"]
+
+    def test_pull_images_resolve_concurrently(self, registry_info, fake_registry, registry_manifest, image_save_dir):
+        in_flight = InFlight(registry_manifest.side_effect)
+        registry_manifest.side_effect = in_flight
+        client = RegistryClient(host=registry_info.host)
+        names = [f"foo/bar{index}:latest" for index in range(6)]
+        image_paths = client.pull_images(names, save_dir=image_save_dir, concurrency=4)
+        assert [path.name for path in image_paths] == [
+            f"registry-1_docker_io_foo_bar{index}_latest.tar" for index in range(6)
+        ]
+        assert 1 < in_flight.max <= 4
+
+    @pytest.mark.parametrize(
+        "architectures",
+        (None, ["arm64"], ["amd64", "arm64"]),
+    )
+    def test_pull_index(self, registry_info, fake_index_registry, registry_blobs, image_save_dir, architectures):
+        client = RegistryClient(host=registry_info.host, max_concurrent_downloads=2)
+        platforms_ = None
+        if architectures is not None:
+            platforms_ = [platforms.Platform(os="linux", architecture=arch) for arch in architectures]
+        image_path = client.pull_index("foo/bar:latest", save_dir=image_save_dir, platforms=platforms_)
+        with tarfile.open(image_path) as tar:
+            files = {member.name: tar.extractfile(member).read() for member in tar if member.isfile()}
+        index_desc = json.loads(files["index.json"])["manifests"]
+        assert [desc["digest"] for desc in index_desc] == [fake_index_registry.digest.value]
+        assert files[f"blobs/sha256/{fake_index_registry.digest.hex}"] == fake_index_registry.index
+
+        kept = fake_index_registry.images if architectures is None else architectures
+        for arch, image in fake_index_registry.images.items():
+            for digest, blob in image.blobs.items():
+                assert files.get(f"blobs/sha256/{digest.split(':')[1]}") == (blob if arch in kept else None)
+        for digest in fake_index_registry.blobs:
+            if f"blobs/sha256/{digest.split(':')[1]}" in files:
+                assert files[f"blobs/sha256/{digest.split(':')[1]}"] == fake_index_registry.blobs[digest]
+        requested = [call.request.url.path.rsplit("/", 1)[-1] for call in registry_blobs.calls]
+        assert len(requested) == len(set(requested))
+
+    def test_pull_index_platform_not_found(self, registry_info, fake_index_registry, image_save_dir):
+        client = RegistryClient(host=registry_info.host)
+        with pytest.raises(errors.ImageNotFoundError):
+            client.pull_index(
+                "foo/bar:latest",
+                save_dir=image_save_dir,
+                platforms=[platforms.Platform(os="linux", architecture="s390x")],
+            )
+        assert not list(image_save_dir.iterdir())
+
+    def test_pull_index_of_single_image(self, registry_info, fake_registry, image_save_dir):
+        client = RegistryClient(host=registry_info.host)
+        image_path = client.pull_index("foo/bar:latest", save_dir=image_save_dir)
+        with tarfile.open(image_path) as tar:
+            index = json.load(tar.extractfile("index.json"))
+            for digest, blob in fake_registry.blobs.items():
+                assert tar.extractfile(f"blobs/sha256/{digest.split(':')[1]}").read() == blob
+        assert index["manifests"][0]["digest"] == fake_registry.digest.value
+
+    def test_pull_oci(self, registry_info, fake_registry, image_save_dir):
+        client = RegistryClient(host=registry_info.host, max_concurrent_downloads=3)
+        image_path = client.pull_image("foo/bar:latest", save_dir=image_save_dir, image_format=ImageFormat.OCI)
+        with tarfile.open(image_path) as tar:
+            for digest, blob in fake_registry.blobs.items():
+                assert tar.extractfile(f"blobs/sha256/{digest.split(':')[1]}").read() == blob
+            assert json.load(tar.extractfile("index.json"))["manifests"]
+
+    @staticmethod
+    def _push_moved_image(registry_manifest, fake_registry):
+        """
+        push a new image to the tag, which shares every layer of the old one and adds a new layer
+        """
+        moved = make_fake_image(layer_sizes=(128,), base=fake_registry)
+        registry_manifest.side_effect = lambda request, repo, name, target: httpx.Response(
+            200,
+            content=moved.manifest if request.method == "GET" else b"",
+            headers={
+                "content-type": ImageMediaType.MediaTypeDockerSchema2Manifest.value,
+                "docker-content-digest": moved.digest.value,
+            },
+        )
+        fake_registry.blobs.update(moved.blobs)
+        return moved
+
+    @staticmethod
+    def _check_image_layers(image_path, image, image_format, keep_compressed):
+        with tarfile.open(image_path) as tar:
+            if image_format == ImageFormat.V2:
+                manifest = json.load(tar.extractfile("manifest.json"))[0]
+                layers = [tar.extractfile(layer_path).read() for layer_path in manifest["Layers"]]
+                if keep_compressed:
+                    layers = [gzip.decompress(layer) for layer in layers]
+                assert layers == image.layers
+            else:
+                for digest, blob in image.blobs.items():
+                    assert tar.extractfile(f"blobs/sha256/{digest.split(':')[1]}").read() == blob
+
+    @pytest.mark.parametrize(
+        "seed_format, seed_compressed, image_format, keep_compressed",
+        (
+            (ImageFormat.OCI, False, ImageFormat.OCI, False),
+            (ImageFormat.OCI, False, ImageFormat.V2, False),
+            (ImageFormat.OCI, False, ImageFormat.V2, True),
+            (ImageFormat.V2, True, ImageFormat.OCI, False),
+            (ImageFormat.V2, True, ImageFormat.V2, False),
+            (ImageFormat.V2, False, ImageFormat.V2, False),
+        ),
+    )
+    @pytest.mark.parametrize("extract", (False, True))
+    @pytest.mark.parametrize("use_work_dir", (False, True))
+    def test_pull_with_seed(
+        self,
+        registry_info,
+        fake_registry,
+        registry_manifest,
+        registry_blobs,
+        tmp_path_factory,
+        seed_format,
+        seed_compressed,
+        image_format,
+        keep_compressed,
+        extract,
+        use_work_dir,
+    ):
+        client = RegistryClient(host=registry_info.host)
+        seed_dir = tmp_path_factory.mktemp("seed")
+        seed = client.pull_image(
+            "foo/bar:latest", save_dir=seed_dir, image_format=seed_format, keep_compressed=seed_compressed
+        )
+        if extract:
+            with tarfile.open(seed) as tar:
+                tar.extractall(seed_dir.joinpath("layout"))
+            seed = seed_dir.joinpath("layout")
+        moved = self._push_moved_image(registry_manifest, fake_registry)
+        call_count = registry_blobs.call_count
+
+        image_path = client.pull_image(
+            "foo/bar:latest",
+            save_dir=tmp_path_factory.mktemp("save"),
+            image_format=image_format,
+            keep_compressed=keep_compressed,
+            work_dir=tmp_path_factory.mktemp("work_dir") if use_work_dir else None,
+            seed=seed,
+        )
+        layers = [layer["digest"] for layer in json.loads(moved.manifest)["layers"]]
+        requested = [call.request.url.path.rsplit("/", 1)[-1] for call in registry_blobs.calls[call_count:]]
+        assert [digest for digest in requested if digest in layers] == layers[-1:]
+        self._check_image_layers(image_path, moved, image_format, keep_compressed)
+
+    def test_pull_with_unusable_seed(self, registry_info, fake_registry, registry_blobs, tmp_path_factory):
+        client = RegistryClient(host=registry_info.host)
+        seed_dir = tmp_path_factory.mktemp("seed")
+        # gzip isn't reproducible, the uncompressed layers of a v2 image can't be the blobs of an oci image
+        seed = client.pull_image("foo/bar:latest", save_dir=seed_dir, image_format=ImageFormat.V2)
+        call_count = registry_blobs.call_count
+        image_path = client.pull_image(
+            "foo/bar:latest", save_dir=tmp_path_factory.mktemp("save"), image_format=ImageFormat.OCI, seed=seed
+        )
+        assert registry_blobs.call_count - call_count == len(fake_registry.blobs)
+        self._check_image_layers(image_path, fake_registry, ImageFormat.OCI, False)
+
+    def test_pull_with_seed_and_cache(self, registry_info, fake_registry, registry_blobs, tmp_path_factory):
+        cache = BlobCache(tmp_path_factory.mktemp("cache"))
+        seed = RegistryClient(host=registry_info.host).pull_image(
+            "foo/bar:latest", save_dir=tmp_path_factory.mktemp("seed"), image_format=ImageFormat.OCI
+        )
+        client = RegistryClient(host=registry_info.host, blob_cache=cache)
+        client.pull_image("foo/bar:latest", save_dir=tmp_path_factory.mktemp("save"), seed=seed)
+        assert all(cache.exists(Digest(layer["digest"])) for layer in json.loads(fake_registry.manifest)["layers"])
+
     @pytest.mark.parametrize(
         "params, want",
         (
@@ -97,3 +553,168 @@ class TestRegistryClient:
         ref_str = f"{host}/{image_name}{target}"
         ref = parse_normalized_named(ref_str)
         assert docker_registry_client.repo_tag(ref) == want
+
+
+class TestAsyncRegistryClient:
+    @staticmethod
+    def run(registry_info, func):
+        async def _run():
+            async with AsyncRegistryClient(host=registry_info.host, max_concurrent_downloads=2) as client:
+                return await func(client)
+
+        return asyncio.run(_run())
+
+    @pytest.mark.parametrize("image_format", (ImageFormat.V2, ImageFormat.OCI))
+    def test_pull(self, registry_info, fake_registry, image_save_dir, image_format):
+        image_path = self.run(
+            registry_info,
+            lambda client: client.pull_image("foo/bar:latest", save_dir=image_save_dir, image_format=image_format),
+        )
+        assert image_path.parent == image_save_dir
+        with tarfile.open(image_path) as tar:
+            if image_format == ImageFormat.V2:
+                manifest = json.load(tar.extractfile("manifest.json"))[0]
+                layers = [tar.extractfile(layer_path).read() for layer_path in manifest["Layers"]]
+                assert layers == fake_registry.layers
+            else:
+                assert json.load(tar.extractfile("index.json"))["manifests"]
+
+    def test_pull_images(self, registry_info, fake_registry, registry_blobs, image_save_dir):
+        image_paths = self.run(
+            registry_info,
+            lambda client: client.pull_images(["foo/bar:latest", "foo/bar:linux"], save_dir=image_save_dir),
+        )
+        assert len(image_paths) == 2 and all(path.exists() for path in image_paths)
+        requested = [call.request.url.path.rsplit("/", 1)[-1] for call in registry_blobs.calls]
+        for layer in json.loads(fake_registry.manifest)["layers"]:
+            assert requested.count(layer["digest"]) == 1
+
+    def test_inspect_images(self, registry_info, fake_registry):
+        async def inspect_all(client: AsyncRegistryClient):
+            return [result async for result in client.inspect_images(names, concurrency=4)]
+
+        names = [f"foo/bar:{index}" for index in range(10)] + ["foo/baz:latest", "Invalid:"]
+        results = {result.name: result for result in self.run(registry_info, inspect_all)}
+        assert sorted(results) == sorted(names)
+        assert results["Invalid:"].error is not None
+        assert all(results[name].image.os == "linux" for name in names[:-1])
+
+    def test_pull_index(self, registry_info, fake_index_registry, registry_blobs, image_save_dir):
+        image_path = self.run(
+            registry_info,
+            lambda client: client.pull_index(
+                "foo/bar:latest",
+                save_dir=image_save_dir,
+                platforms=[platforms.Platform(os="linux", architecture="amd64")],
+            ),
+        )
+        with tarfile.open(image_path) as tar:
+            names = [member.name for member in tar if member.isfile()]
+            index = json.load(tar.extractfile("index.json"))
+        assert index["manifests"][0]["digest"] == fake_index_registry.digest.value
+        for digest in fake_index_registry.images["amd64"].blobs:
+            assert f"blobs/sha256/{digest.split(':')[1]}" in names
+        for digest in fake_index_registry.images["arm64"].blobs:
+            assert f"blobs/sha256/{digest.split(':')[1]}" not in names
+        requested = [call.request.url.path.rsplit("/", 1)[-1] for call in registry_blobs.calls]
+        assert len(requested) == len(set(requested))
+
+    @pytest.mark.parametrize("image_format", (ImageFormat.V2, ImageFormat.OCI))
+    @pytest.mark.parametrize("use_work_dir", (False, True))
+    def test_pull_with_seed(
+        self,
+        registry_info,
+        fake_registry,
+        registry_manifest,
+        registry_blobs,
+        tmp_path_factory,
+        image_format,
+        use_work_dir,
+    ):
+        seed = self.run(
+            registry_info,
+            lambda client: client.pull_image(
+                "foo/bar:latest", save_dir=tmp_path_factory.mktemp("seed"), image_format=ImageFormat.OCI
+            ),
+        )
+        moved = TestRegistryClient._push_moved_image(registry_manifest, fake_registry)
+        call_count = registry_blobs.call_count
+        image_path = self.run(
+            registry_info,
+            lambda client: client.pull_image(
+                "foo/bar:latest",
+                save_dir=tmp_path_factory.mktemp("save"),
+                image_format=image_format,
+                work_dir=tmp_path_factory.mktemp("work_dir") if use_work_dir else None,
+                seed=seed,
+            ),
+        )
+        layers = [layer["digest"] for layer in json.loads(moved.manifest)["layers"]]
+        requested = [call.request.url.path.rsplit("/", 1)[-1] for call in registry_blobs.calls[call_count:]]
+        assert [digest for digest in requested if digest in layers] == layers[-1:]
+        TestRegistryClient._check_image_layers(image_path, moved, image_format, False)
+
+    @pytest.mark.parametrize("image_format", (ImageFormat.V2, ImageFormat.OCI))
+    def test_export(self, registry_info, fake_registry, image_format):
+        received = io.BytesIO()
+        self.run(
+            registry_info, lambda client: client.export_image("foo/bar:latest", received, image_format=image_format)
+        )
+        received.seek(0)
+        with tarfile.open(fileobj=received, mode="r|") as tar:
+            names = [member.name for member in tar]
+        assert ("manifest.json" if image_format == ImageFormat.V2 else "index.json") in names
+
+    @pytest.mark.parametrize("keep_compressed", (True, False))
+    def test_export_layers(self, registry_info, fake_registry, keep_compressed):
+        received = io.BytesIO()
+        self.run(
+            registry_info,
+            lambda client: client.export_image("foo/bar:latest", received, keep_compressed=keep_compressed),
+        )
+        received.seek(0)
+        with tarfile.open(fileobj=received, mode="r|") as tar:
+            files = {member.name: tar.extractfile(member).read() for member in tar if member.isfile()}
+        layers = [files[name] for name in json.loads(files["manifest.json"])[0]["Layers"]]
+        assert layers == (list(fake_registry.blobs.values())[:-1] if keep_compressed else fake_registry.layers)
+
+    def test_inspect(self, registry_info, fake_registry):
+        image = self.run(registry_info, lambda client: client.inspect_image("foo/bar:latest", platform=None))
+        assert image.os == "linux"
+        assert [diff_id.value for diff_id in image.rootfs.diff_ids] == json.loads(fake_registry.config)["rootfs"][
+            "diff_ids"
+        ]
+
+    def test_inspect_many(self, registry_info, fake_registry):
+        async def inspect_many(client: AsyncRegistryClient):
+            return await asyncio.gather(
+                *(client.inspect_image(f"foo/bar:{index}", platform=None) for index in range(50))
+            )
+
+        images = self.run(registry_info, inspect_many)
+        assert len(images) == 50
+
+    def test_iter_blob(self, registry_info, fake_registry):
+        digest, blob = next(iter(fake_registry.blobs.items()))
+        ref = CanonicalReference(path="foo/bar", digest=digest)
+
+        async def read_blob(client: AsyncRegistryClient):
+            return b"".join([content async for content in client.iter_blob(ref, chunk_size=4)])
+
+        assert self.run(registry_info, read_blob) == blob
+
+    def test_catalog_and_tags(self, registry_info, registry_catalog, registry_tags):
+        registry_catalog.respond(200, json={"repositories": ["foo/bar"]})
+        registry_tags.respond(200, json={"tags": ["latest"]})
+        assert self.run(registry_info, lambda client: client.catalog()) == ["foo/bar"]
+        assert self.run(registry_info, lambda client: client.list_tags("foo/bar")) == ["latest"]
+        registry_tags.respond(404)
+        assert self.run(registry_info, lambda client: client.list_tags("foo/bar")) == []
+
+    def test_delete(self, registry_info, registry_manifest, random_digest):
+        image_name = f"foo/bar@{random_digest.value}"
+        registry_manifest.respond(202)
+        assert self.run(registry_info, lambda client: client.delete_image(image_name))
+        registry_manifest.respond(404)
+        with pytest.raises(errors.ImageNotFoundError):
+            self.run(registry_info, lambda client: client.delete_image(image_name))
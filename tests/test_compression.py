@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+import bz2
+import gzip
+import io
+import lzma
+import os
+
+import pytest
+
+from registry_client.compression import (
+    Compression,
+    detect_compression,
+    new_decompressor,
+    uncompressed_digest,
+)
+from registry_client.digest import Algorithm, Digest
+
+CONTENT = os.urandom(4096) * 4
+
+COMPRESSED = {
+    Compression.Gzip: gzip.compress(CONTENT),
+    Compression.Bzip2: bz2.compress(CONTENT),
+    Compression.Xz: lzma.compress(CONTENT),
+    None: CONTENT,
+}
+
+
+@pytest.mark.parametrize("compression, blob", COMPRESSED.items())
+def test_detect_compression(compression, blob):
+    assert detect_compression(blob[:8]) == compression
+
+
+@pytest.mark.parametrize("compression", (Compression.Gzip, Compression.Bzip2, Compression.Xz))
+def test_decompress_concatenated(compression):
+    blob = COMPRESSED[compression] * 2
+    decompressor = new_decompressor(compression)
+    result = b"".join(decompressor.decompress(blob[i : i + 1000]) for i in range(0, len(blob), 1000))
+    assert result + decompressor.flush() == CONTENT * 2
+
+
+def test_unsupported_decompressor():
+    assert new_decompressor(Compression.Zstd) is None
+    assert new_decompressor(None) is None
+
+
+@pytest.mark.parametrize("blob", COMPRESSED.values())
+def test_uncompressed_digest(blob):
+    assert uncompressed_digest(io.BytesIO(blob), Algorithm.SHA256) == Digest.from_bytes(CONTENT)
+
+
+def test_uncompressed_digest_unsupported():
+    assert uncompressed_digest(io.BytesIO(b"\x28\xb5\x2f\xfd" + CONTENT), Algorithm.SHA256) is None
@@ -0,0 +1,659 @@
+import asyncio
+import bz2
+import gzip
+import io
+import json
+import os
+import pathlib
+import threading
+import time
+
+import httpx
+import pytest
+
+from registry_client import errors
+from registry_client.auth import AsyncAuthClient
+from registry_client.compression import Compression
+from registry_client.digest import Digest, Digester
+from registry_client.download import (
+    PARTIAL_SUFFIX,
+    STATE_SUFFIX,
+    AsyncDownloader,
+    BlobFile,
+    BlobPipe,
+    BlobTask,
+    Downloader,
+    DownloadOrder,
+    Segment,
+    largest_first,
+    manifest_order,
+    smallest_first,
+    split_segments,
+)
+from registry_client.events import BlobFinished, EventQueue, Events
+from registry_client.image import AsyncBlobClient
+from registry_client.reference import CanonicalReference
+from registry_client.retry import RetryPolicy
+
+
+def make_tasks(tmp_path: pathlib.Path, count: int):
+    return [
+        BlobTask(
+            ref=CanonicalReference(path="library/foo", digest=Digest.from_bytes(str(index).encode())),
+            target=tmp_path.joinpath(str(index)),
+        )
+        for index in range(count)
+    ]
+
+
+class TestDownloader:
+    def test_invalid_max_concurrent_downloads(self, blob_client):
+        with pytest.raises(ValueError):
+            Downloader(blob_client, max_concurrent_downloads=0)
+
+    @pytest.mark.parametrize("max_concurrent_downloads", (1, 2, 4))
+    def test_download_all_bounded_and_ordered(self, blob_client, tmp_path, monkeypatch, max_concurrent_downloads):
+        lock = threading.Lock()
+        running = {"now": 0, "max": 0}
+
+        def fake_download(self, task: BlobTask):
+            with lock:
+                running["now"] += 1
+                running["max"] = max(running["max"], running["now"])
+            # the first tasks finish last
+            time.sleep(0.01 * (10 - int(task.target.name)))
+            with lock:
+                running["now"] -= 1
+            return task.target
+
+        monkeypatch.setattr(Downloader, "download", fake_download)
+        tasks = make_tasks(tmp_path, 8)
+        downloader = Downloader(blob_client, max_concurrent_downloads=max_concurrent_downloads)
+        assert downloader.download_all(tasks) == [task.target for task in tasks]
+        assert running["max"] <= max_concurrent_downloads
+        if max_concurrent_downloads > 1:
+            assert running["max"] > 1
+
+    def test_download_all_raise(self, blob_client, tmp_path, monkeypatch):
+        def fake_download(self, task: BlobTask):
+            if task.target.name == "3":
+                raise RuntimeError("broken")
+            return task.target
+
+        monkeypatch.setattr(Downloader, "download", fake_download)
+        with pytest.raises(RuntimeError):
+            Downloader(blob_client, max_concurrent_downloads=3).download_all(make_tasks(tmp_path, 6))
+
+    def test_download(self, blob_client, tmp_path, registry_blobs):
+        content = b"blob content"
+        registry_blobs.return_value = httpx.Response(200, content=content)
+        task = BlobTask(
+            ref=CanonicalReference(path="library/foo", digest=Digest.from_bytes(content)),
+            target=tmp_path.joinpath("blob"),
+            diff_id=Digest.from_bytes(content),
+        )
+        assert Downloader(blob_client).download(task).read_bytes() == content
+
+    @pytest.mark.parametrize("decompress", (True, False))
+    def test_download_gzip(self, blob_client, tmp_path, registry_blobs, decompress):
+        content = b"layer content" * 1024
+        blob = gzip.compress(content[:4096]) + gzip.compress(content[4096:])
+        registry_blobs.return_value = httpx.Response(200, content=blob)
+        task = BlobTask(
+            ref=CanonicalReference(path="library/foo", digest=Digest.from_bytes(blob)),
+            target=tmp_path.joinpath("blob"),
+            compression=Compression.Gzip,
+            decompress=decompress,
+            diff_id=Digest.from_bytes(content),
+        )
+        saved = Downloader(blob_client).download(task).read_bytes()
+        assert saved == (content if decompress else blob)
+
+    @pytest.mark.parametrize("decompress", (True, False))
+    @pytest.mark.parametrize("wrong", ("digest", "diff_id"))
+    def test_download_digest_mismatch(self, blob_client, tmp_path, registry_blobs, wrong, decompress):
+        content = b"layer content"
+        blob = gzip.compress(content)
+        registry_blobs.return_value = httpx.Response(200, content=blob)
+        task = BlobTask(
+            ref=CanonicalReference(
+                path="library/foo", digest=Digest.from_bytes(b"other" if wrong == "digest" else blob)
+            ),
+            target=tmp_path.joinpath("blob"),
+            compression=Compression.Gzip,
+            decompress=decompress,
+            diff_id=Digest.from_bytes(b"other" if wrong == "diff_id" else content),
+        )
+        with pytest.raises(errors.ErrDigestMismatch):
+            Downloader(blob_client).download(task)
+        assert not task.target.exists()
+
+    @pytest.mark.parametrize(
+        "compression, compress",
+        (
+            (Compression.Gzip, lambda content: content),
+            (None, gzip.compress),
+            (None, bz2.compress),
+            (Compression.Gzip, bz2.compress),
+        ),
+    )
+    @pytest.mark.parametrize("decompress", (True, False))
+    def test_sniff_compression(self, blob_client, tmp_path, registry_blobs, compression, compress, decompress):
+        content = b"layer content" * 1024
+        blob = compress(content)
+        registry_blobs.return_value = httpx.Response(200, content=blob)
+        task = BlobTask(
+            ref=CanonicalReference(path="library/foo", digest=Digest.from_bytes(blob)),
+            target=tmp_path.joinpath("blob"),
+            compression=compression,
+            decompress=decompress,
+            diff_id=Digest.from_bytes(content),
+        )
+        saved = Downloader(blob_client).download(task).read_bytes()
+        assert saved == (content if decompress else blob)
+
+    def test_download_error_status(self, blob_client, tmp_path, registry_blobs):
+        registry_blobs.return_value = httpx.Response(404)
+        task = make_tasks(tmp_path, 1)[0]
+        with pytest.raises(httpx.HTTPStatusError):
+            Downloader(blob_client).download(task)
+
+
+class TestSchedule:
+    SIZES = (30, None, 10, 50, 10)
+
+    def make_tasks(self, tmp_path):
+        tasks = make_tasks(tmp_path, len(self.SIZES))
+        for task, size in zip(tasks, self.SIZES):
+            task.size = size
+        return tasks
+
+    @pytest.mark.parametrize(
+        "policy, want",
+        (
+            (manifest_order, ["0", "1", "2", "3", "4"]),
+            (largest_first, ["3", "0", "2", "4", "1"]),
+            (smallest_first, ["2", "4", "0", "3", "1"]),
+        ),
+    )
+    def test_policy(self, tmp_path, policy, want):
+        tasks = self.make_tasks(tmp_path)
+        assert [task.target.name for task in policy(tasks)] == want
+        # blobs of unknown size keep the manifest order
+        assert [task.target.name for task in policy(make_tasks(tmp_path, 3))] == ["0", "1", "2"]
+
+    def test_download_order(self):
+        assert DownloadOrder("largest-first").policy is largest_first
+        assert DownloadOrder.Manifest.policy is manifest_order
+
+    @pytest.mark.parametrize("max_concurrent_downloads", (1, 2))
+    @pytest.mark.parametrize("policy", (manifest_order, largest_first, smallest_first))
+    def test_download_all(self, blob_client, tmp_path, monkeypatch, max_concurrent_downloads, policy):
+        started = []
+
+        def fake_download(self, task: BlobTask):
+            started.append(task.target.name)
+            time.sleep(0.01)
+            return task.target
+
+        monkeypatch.setattr(Downloader, "download", fake_download)
+        tasks = self.make_tasks(tmp_path)
+        downloader = Downloader(blob_client, max_concurrent_downloads=max_concurrent_downloads, schedule=policy)
+        assert downloader.download_all(tasks) == [task.target for task in tasks]
+        want = [task.target.name for task in policy(tasks)]
+        if max_concurrent_downloads == 1:
+            assert started == want
+        else:
+            assert sorted(started[:2]) == sorted(want[:2])
+
+    def test_async_download_all(self, registry_info, tmp_path, monkeypatch):
+        started = []
+
+        async def fake_download(self, task: BlobTask):
+            started.append(task.target.name)
+            await asyncio.sleep(0.01)
+            return task.target
+
+        monkeypatch.setattr(AsyncDownloader, "download", fake_download)
+        tasks = self.make_tasks(tmp_path)
+
+        async def run():
+            async with AsyncAuthClient(base_url=registry_info.host) as client:
+                downloader = AsyncDownloader(AsyncBlobClient(client), max_concurrent_downloads=2)
+                return await downloader.download_all(tasks)
+
+        assert asyncio.run(run()) == [task.target for task in tasks]
+        assert started == [task.target.name for task in largest_first(tasks)]
+
+    @pytest.mark.parametrize("policy", (manifest_order, largest_first, smallest_first))
+    def test_download_iter(self, blob_client, tmp_path, monkeypatch, policy):
+        started = []
+        consumed = []
+
+        def fake_download(self, task: BlobTask):
+            started.append(task.target.name)
+            assert len(started) <= len(consumed) + 3
+            return task.target
+
+        monkeypatch.setattr(Downloader, "download", fake_download)
+        tasks = self.make_tasks(tmp_path)
+        downloader = Downloader(blob_client, max_concurrent_downloads=1, schedule=policy)
+        for path in downloader.download_iter(tasks, max_ahead=3):
+            consumed.append(path)
+        # blobs are yielded in the order of tasks, the window ahead of the consumer is started in the order of policy
+        assert consumed == [task.target for task in tasks]
+        assert started[:3] == [task.target.name for task in policy(tasks[:3])]
+        assert started[3:] == ["3", "4"]
+
+    def test_async_download_iter(self, registry_info, tmp_path, monkeypatch):
+        started = []
+
+        async def fake_download(self, task: BlobTask):
+            started.append(task.target.name)
+            await asyncio.sleep(0.01)
+            return task.target
+
+        monkeypatch.setattr(AsyncDownloader, "download", fake_download)
+        tasks = self.make_tasks(tmp_path)
+
+        async def run():
+            async with AsyncAuthClient(base_url=registry_info.host) as client:
+                downloader = AsyncDownloader(AsyncBlobClient(client), max_concurrent_downloads=1)
+                return [path async for path in downloader.download_iter(tasks, max_ahead=3)]
+
+        assert asyncio.run(run()) == [task.target for task in tasks]
+        assert started == ["0", "2", "1", "3", "4"]
+
+    @pytest.mark.parametrize("policy", (manifest_order, largest_first))
+    def test_stream_iter(self, blob_client, tmp_path, monkeypatch, policy):
+        started = []
+
+        def fake_download_to(self, task: BlobTask, fileobj):
+            started.append(task.target.name)
+            for _ in range(4):
+                fileobj.write(task.target.name.encode() * 8)
+
+        monkeypatch.setattr(Downloader, "download_to", fake_download_to)
+        tasks = self.make_tasks(tmp_path)
+        downloader = Downloader(blob_client, max_concurrent_downloads=2, schedule=policy)
+        streamed = [b"".join(pipe) for pipe in downloader.stream_iter(tasks)]
+        assert streamed == [task.target.name.encode() * 32 for task in tasks]
+        assert sorted(started[:2]) == sorted(task.target.name for task in policy(tasks[:2]))
+
+    def test_stream_iter_closed(self, blob_client, tmp_path, monkeypatch):
+        broken = []
+
+        def fake_download_to(self, task: BlobTask, fileobj):
+            try:
+                while True:
+                    fileobj.write(b"0" * 1024)
+            except BrokenPipeError:
+                broken.append(task.target.name)
+                raise
+
+        monkeypatch.setattr(Downloader, "download_to", fake_download_to)
+        tasks = self.make_tasks(tmp_path)
+        pipes = Downloader(blob_client, max_concurrent_downloads=2, schedule=manifest_order).stream_iter(tasks)
+        assert next(iter(next(pipes))) == b"0" * 1024
+        # the downloads waiting on full pipes fail once the reader is gone
+        pipes.close()
+        assert sorted(broken) == ["0", "1"]
+
+    def test_stream_iter_failed(self, blob_client, tmp_path, monkeypatch):
+        def fake_download_to(self, task: BlobTask, fileobj):
+            fileobj.write(b"0")
+            raise httpx.ReadError(task.target.name)
+
+        monkeypatch.setattr(Downloader, "download_to", fake_download_to)
+        pipes = Downloader(blob_client).stream_iter(self.make_tasks(tmp_path))
+        with pytest.raises(httpx.ReadError):
+            b"".join(next(pipes))
+
+    def test_async_stream_iter(self, registry_info, tmp_path, monkeypatch):
+        async def fake_download_to(self, task: BlobTask, fileobj):
+            loop = asyncio.get_event_loop()
+            for _ in range(4):
+                await loop.run_in_executor(None, fileobj.write, task.target.name.encode() * 8)
+
+        monkeypatch.setattr(AsyncDownloader, "download_to", fake_download_to)
+        tasks = self.make_tasks(tmp_path)
+
+        async def run():
+            streamed = []
+            async with AsyncAuthClient(base_url=registry_info.host) as client:
+                downloader = AsyncDownloader(AsyncBlobClient(client), max_concurrent_downloads=2)
+                async for pipe in downloader.stream_iter(tasks):
+                    streamed.append(b"".join([content async for content in pipe]))
+            return streamed
+
+        assert asyncio.run(run()) == [task.target.name.encode() * 32 for task in tasks]
+
+
+class TestBlobPipe:
+    def test_bounded(self):
+        pipe = BlobPipe(max_size=4)
+        written = []
+
+        def write():
+            for content in (b"01", b"23", b"45", b"67"):
+                pipe.write(content)
+                written.append(content)
+            pipe.close()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        time.sleep(0.05)
+        # the writer waits until the reader takes the content it buffered
+        assert written == [b"01", b"23"]
+        assert b"".join(pipe) == b"01234567"
+        writer.join()
+
+    def test_abort(self):
+        pipe = BlobPipe()
+        pipe.abort()
+        with pytest.raises(BrokenPipeError):
+            pipe.write(b"0")
+
+
+class BrokenStream(httpx.SyncByteStream, httpx.AsyncByteStream):
+    """
+    a response stream which is broken after sending `size` bytes
+    """
+
+    def __init__(self, content: bytes, size: int):
+        self.content = content
+        self.size = size
+
+    def __iter__(self):
+        yield self.content[: self.size]
+        raise httpx.ReadError("connection reset")
+
+    async def __aiter__(self):
+        yield self.content[: self.size]
+        raise httpx.ReadError("connection reset")
+
+
+class RangeRegistry:
+    """
+    serve a blob with range requests, the first `broken` responses containing `break_at` are interrupted there
+    """
+
+    def __init__(self, blob: bytes, break_at: int, broken: int = 1, support_range: bool = True):
+        self.blob = blob
+        self.break_at = break_at
+        self.broken = broken
+        self.support_range = support_range
+        self.ranges = []
+
+    def __call__(self, request: httpx.Request, repo, name, digest):
+        range_header = request.headers.get("Range")
+        self.ranges.append(range_header)
+        start, end = 0, len(self.blob) - 1
+        status_code = 200
+        if range_header and self.support_range:
+            first, last = range_header[len("bytes=") :].split("-")
+            start, end = int(first), int(last or end)
+            status_code = 206
+        content = self.blob[start : end + 1]
+        if self.broken and start <= self.break_at <= end:
+            self.broken -= 1
+            return httpx.Response(status_code, stream=BrokenStream(content, self.break_at - start))
+        return httpx.Response(status_code, content=content)
+
+
+class TestResume:
+    @staticmethod
+    def make_task(tmp_path: pathlib.Path, content: bytes, blob: bytes, resumable: bool, decompress: bool = True):
+        return BlobTask(
+            ref=CanonicalReference(path="library/foo", digest=Digest.from_bytes(blob)),
+            target=tmp_path.joinpath("layer.tar"),
+            compression=Compression.Gzip if content != blob else None,
+            decompress=decompress,
+            diff_id=Digest.from_bytes(content),
+            resumable=resumable,
+        )
+
+    @pytest.mark.parametrize("support_range", (True, False))
+    @pytest.mark.parametrize("resumable", (True, False))
+    def test_resume_in_process(self, blob_client, tmp_path, registry_blobs, support_range, resumable):
+        content = os.urandom(4096)
+        blob = gzip.compress(content)
+        registry = RangeRegistry(blob, break_at=len(blob) // 2, support_range=support_range)
+        registry_blobs.side_effect = registry
+        task = self.make_task(tmp_path, content, blob, resumable=resumable)
+        assert Downloader(blob_client).download(task).read_bytes() == content
+        assert registry.ranges == [None, f"bytes={len(blob) // 2}-"]
+        assert [path.name for path in tmp_path.iterdir()] == ["layer.tar"]
+
+    @pytest.mark.parametrize("support_range", (True, False))
+    def test_resume_metrics(self, blob_client, tmp_path, registry_blobs, support_range):
+        content = os.urandom(4096)
+        blob = gzip.compress(content)
+        break_at = len(blob) // 2
+        registry_blobs.side_effect = RangeRegistry(blob, break_at=break_at, support_range=support_range)
+        events = Events()
+        received = events.subscribe(EventQueue())
+        downloader = Downloader(blob_client, events=events, retry=RetryPolicy(backoff=0))
+        downloader.download(self.make_task(tmp_path, content, blob, resumable=True))
+        received.close()
+        (finished,) = [event for event in received if isinstance(event, BlobFinished)]
+        assert finished.retries == 1
+        # a registry ignoring the range sends the received bytes again
+        wasted = 0 if support_range else break_at
+        assert finished.wasted == wasted
+        assert finished.transferred == len(blob) + wasted
+
+    def test_give_up(self, blob_client, tmp_path, registry_blobs):
+        content = os.urandom(4096)
+        registry_blobs.side_effect = RangeRegistry(content, break_at=100, broken=10)
+        task = self.make_task(tmp_path, content, content, resumable=False)
+        with pytest.raises(httpx.ReadError):
+            Downloader(blob_client, max_resume_attempts=2).download(task)
+        assert not list(tmp_path.iterdir())
+
+    @pytest.mark.parametrize("decompress", (True, False))
+    def test_resume_next_run(self, blob_client, tmp_path, registry_blobs, decompress):
+        content = os.urandom(4096)
+        blob = gzip.compress(content)
+        break_at = len(blob) // 3
+        registry = RangeRegistry(blob, break_at=break_at)
+        registry_blobs.side_effect = registry
+        task = self.make_task(tmp_path, content, blob, resumable=True, decompress=decompress)
+        with pytest.raises(httpx.ReadError):
+            Downloader(blob_client, max_resume_attempts=0).download(task)
+        partial = tmp_path.joinpath("layer.tar" + PARTIAL_SUFFIX)
+        state = json.loads(tmp_path.joinpath("layer.tar" + STATE_SUFFIX).read_text())
+        assert partial.read_bytes() == blob[:break_at]
+        assert state["offset"] == break_at
+        assert state["prefix_digest"] == Digest.from_bytes(blob[:break_at]).value
+
+        assert Downloader(blob_client).download(task).read_bytes() == (content if decompress else blob)
+        assert registry.ranges == [None, f"bytes={break_at}-"]
+        assert [path.name for path in tmp_path.iterdir()] == ["layer.tar"]
+
+        # a completed blob isn't downloaded again
+        Downloader(blob_client).download(task)
+        assert len(registry.ranges) == 2
+
+    def test_broken_partial(self, blob_client, tmp_path, registry_blobs):
+        content = os.urandom(4096)
+        registry = RangeRegistry(content, break_at=1000)
+        registry_blobs.side_effect = registry
+        task = self.make_task(tmp_path, content, content, resumable=True)
+        with pytest.raises(httpx.ReadError):
+            Downloader(blob_client, max_resume_attempts=0).download(task)
+        partial = tmp_path.joinpath("layer.tar" + PARTIAL_SUFFIX)
+        partial.write_bytes(b"x" * 1000)
+        assert Downloader(blob_client).download(task).read_bytes() == content
+        assert registry.ranges == [None, None]
+
+
+class TestSegments:
+    @staticmethod
+    def make_task(tmp_path: pathlib.Path, content: bytes, blob: bytes, resumable: bool = False):
+        task = TestResume.make_task(tmp_path, content, blob, resumable=resumable)
+        task.size = len(blob)
+        return task
+
+    @staticmethod
+    def segment_ranges(registry: RangeRegistry):
+        return sorted(registry.ranges, key=lambda value: int(value[len("bytes=") :].split("-")[0]))
+
+    @pytest.mark.parametrize("compressed", (True, False))
+    @pytest.mark.parametrize("resumable", (True, False))
+    def test_download(self, blob_client, tmp_path, registry_blobs, compressed, resumable):
+        content = os.urandom(10000)
+        blob = gzip.compress(content) if compressed else content
+        registry = RangeRegistry(blob, break_at=-1, broken=0)
+        registry_blobs.side_effect = registry
+        task = self.make_task(tmp_path, content, blob, resumable=resumable)
+        downloader = Downloader(blob_client, segment_threshold=1024, max_segments=4)
+        assert downloader.download(task).read_bytes() == content
+        want = [f"bytes={segment.start}-{segment.end}" for segment in split_segments(len(blob), 4)]
+        assert self.segment_ranges(registry) == want
+        assert [path.name for path in tmp_path.iterdir()] == ["layer.tar"]
+
+    def test_below_threshold(self, blob_client, tmp_path, registry_blobs):
+        content = os.urandom(1000)
+        registry = RangeRegistry(content, break_at=-1, broken=0)
+        registry_blobs.side_effect = registry
+        task = self.make_task(tmp_path, content, content)
+        Downloader(blob_client, segment_threshold=1024).download(task)
+        assert registry.ranges == [None]
+
+    def test_resume_segment(self, blob_client, tmp_path, registry_blobs):
+        content = os.urandom(10000)
+        registry = RangeRegistry(content, break_at=6000)
+        registry_blobs.side_effect = registry
+        task = self.make_task(tmp_path, content, content)
+        downloader = Downloader(blob_client, segment_threshold=1024, max_segments=4)
+        assert downloader.download(task).read_bytes() == content
+        assert "bytes=6000-7499" in registry.ranges
+        assert len(registry.ranges) == 5
+
+    def test_range_not_supported(self, blob_client, tmp_path, registry_blobs):
+        content = os.urandom(10000)
+        registry = RangeRegistry(content, break_at=-1, broken=0, support_range=False)
+        registry_blobs.side_effect = registry
+        task = self.make_task(tmp_path, content, content)
+        downloader = Downloader(blob_client, segment_threshold=1024, max_segments=4)
+        assert downloader.download(task).read_bytes() == content
+        assert registry.ranges[-1] is None
+        assert [path.name for path in tmp_path.iterdir()] == ["layer.tar"]
+
+    def test_digest_mismatch(self, blob_client, tmp_path, registry_blobs):
+        content = os.urandom(10000)
+        registry_blobs.side_effect = RangeRegistry(content, break_at=-1, broken=0)
+        task = self.make_task(tmp_path, content, content)
+        task.ref = CanonicalReference(path="library/foo", digest=Digest.from_bytes(b"other"))
+        with pytest.raises(errors.ErrDigestMismatch):
+            Downloader(blob_client, segment_threshold=1024).download(task)
+        assert not list(tmp_path.iterdir())
+
+    def test_async_download(self, registry_info, tmp_path, registry_blobs):
+        content = os.urandom(10000)
+        blob = gzip.compress(content)
+        registry = RangeRegistry(blob, break_at=len(blob) // 2)
+        registry_blobs.side_effect = registry
+        task = self.make_task(tmp_path, content, blob)
+
+        async def run():
+            async with AsyncAuthClient(base_url=registry_info.host) as client:
+                downloader = AsyncDownloader(AsyncBlobClient(client), segment_threshold=1024, max_segments=4)
+                return await downloader.download(task)
+
+        assert asyncio.run(run()).read_bytes() == content
+        assert len(registry.ranges) == 5
+
+    @pytest.mark.parametrize("compressed", (True, False))
+    def test_download_to(self, blob_client, tmp_path, registry_blobs, compressed):
+        content = os.urandom(10000)
+        blob = gzip.compress(content) if compressed else content
+        registry = RangeRegistry(blob, break_at=-1, broken=0)
+        registry_blobs.side_effect = registry
+        task = self.make_task(tmp_path, content, blob)
+        fileobj = io.BytesIO()
+        Downloader(blob_client, segment_threshold=1024, max_segments=4).download_to(task, fileobj)
+        assert fileobj.getvalue() == content
+        want = [f"bytes={segment.start}-{segment.end}" for segment in split_segments(len(blob), 4)]
+        assert self.segment_ranges(registry) == want
+        assert not list(tmp_path.iterdir())
+
+    def test_async_download_to(self, registry_info, tmp_path, registry_blobs):
+        content = os.urandom(10000)
+        registry = RangeRegistry(content, break_at=-1, broken=0)
+        registry_blobs.side_effect = registry
+        task = self.make_task(tmp_path, content, content)
+        fileobj = io.BytesIO()
+
+        async def run():
+            async with AsyncAuthClient(base_url=registry_info.host) as client:
+                downloader = AsyncDownloader(AsyncBlobClient(client), segment_threshold=1024, max_segments=4)
+                await downloader.download_to(task, fileobj)
+
+        asyncio.run(run())
+        assert fileobj.getvalue() == content
+        assert len(registry.ranges) == 4
+
+    @pytest.mark.parametrize(
+        "segment_threshold, want",
+        (
+            (1024, {"BlobFile.load_from_cache", "Segment.write", "BlobFile.commit_segments"}),
+            (None, {"BlobFile.load_from_cache", "BlobFile.write", "BlobFile.commit"}),
+        ),
+    )
+    def test_async_files_off_the_loop(
+        self, registry_info, tmp_path, registry_blobs, monkeypatch, segment_threshold, want
+    ):
+        content = os.urandom(10000)
+        registry_blobs.side_effect = RangeRegistry(content, break_at=-1, broken=0)
+        threads = {}
+        for cls, name in (
+            (BlobFile, "load_from_cache"),
+            (BlobFile, "write"),
+            (BlobFile, "commit"),
+            (BlobFile, "commit_segments"),
+            (Segment, "write"),
+        ):
+            method = getattr(cls, name)
+
+            def wrapped(self, *args, method=method, name=f"{cls.__name__}.{name}"):
+                threads.setdefault(name, set()).add(threading.current_thread())
+                return method(self, *args)
+
+            monkeypatch.setattr(cls, name, wrapped)
+        task = self.make_task(tmp_path, content, content)
+
+        async def run():
+            async with AsyncAuthClient(base_url=registry_info.host) as client:
+                downloader = AsyncDownloader(
+                    AsyncBlobClient(client), segment_threshold=segment_threshold, max_segments=4
+                )
+                return await downloader.download(task)
+
+        assert asyncio.run(run()).read_bytes() == content
+        assert set(threads) == want
+        # every file of the blob is read and written by one thread, the event loop never waits for the disk
+        (writer,) = set.union(*threads.values())
+        assert writer is not threading.main_thread()
+
+    def test_empty_blob(self, blob_client, tmp_path, registry_blobs):
+        registry = RangeRegistry(b"", break_at=-1, broken=0)
+        registry_blobs.side_effect = registry
+        task = self.make_task(tmp_path, b"", b"")
+        assert Downloader(blob_client, segment_threshold=0).download(task).read_bytes() == b""
+        assert registry.ranges == [None]
+
+
+def test_split_segments():
+    assert [(segment.start, segment.end) for segment in split_segments(10, 3)] == [(0, 3), (4, 7), (8, 9)]
+    assert [(segment.start, segment.end) for segment in split_segments(2, 4)] == [(0, 0), (1, 1)]
+    assert split_segments(0, 4) == []
+
+
+def test_digester():
+    digester = Digester()
+    for content in (b"foo", b"bar"):
+        digester.update(content)
+    assert digester.digest() == Digest.from_bytes(b"foobar")
+    assert digester.size == 6
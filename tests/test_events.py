@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+import asyncio
+import datetime
+import io
+import json
+import uuid
+
+import httpx
+import pytest
+
+from registry_client.auth import BearerAuth, ChallengeScheme, RegistryChallenge
+from registry_client.cache import BlobCache
+from registry_client.client import AsyncRegistryClient, RegistryClient
+from registry_client.digest import Digest
+from registry_client.events import (
+    BlobFailed,
+    BlobFinished,
+    BlobProgress,
+    BlobStarted,
+    EventQueue,
+    Events,
+    PullFinished,
+    PullMetrics,
+    TokenFetched,
+)
+from registry_client.progress import ProgressBars
+from registry_client.scope import RepositoryScope
+from tests.conftest import FAKE_REGISTRY_AUTH_HOST
+
+
+def layer_digests(fake_registry):
+    return [layer["digest"] for layer in json.loads(fake_registry.manifest)["layers"]]
+
+
+def finished(digest: Digest, transferred: int, elapsed: float, host: str = "a", **kwargs) -> BlobFinished:
+    return BlobFinished(digest=digest, size=transferred, transferred=transferred, elapsed=elapsed, host=host, **kwargs)
+
+
+class TestEvents:
+    def test_subscribe(self):
+        events = Events()
+        received = []
+        assert not events.active
+        listener = events.subscribe(received.append)
+        assert events.active
+        events.emit(BlobStarted(Digest.from_bytes(b"a"), 1))
+        events.unsubscribe(listener)
+        events.emit(BlobStarted(Digest.from_bytes(b"b"), 1))
+        assert [event.digest for event in received] == [Digest.from_bytes(b"a")]
+
+    def test_broken_listener(self):
+        events = Events()
+        received = []
+
+        def broken(event):
+            raise RuntimeError("broken")
+
+        events.subscribe(broken)
+        events.subscribe(received.append)
+        events.emit(BlobStarted(Digest.from_bytes(b"a"), 1))
+        assert len(received) == 1
+
+    def test_event_queue(self):
+        queue = EventQueue()
+        event = BlobStarted(Digest.from_bytes(b"a"), 1)
+        queue(event)
+        queue.close()
+        assert list(queue) == [event]
+
+    def test_throughput(self):
+        event = finished(Digest.from_bytes(b"a"), 100, 2.0, verify_time=1.0)
+        assert event.throughput == 100
+        assert finished(Digest.from_bytes(b"a"), 0, 0).throughput == 0
+
+
+class TestPullMetrics:
+    def test_hosts(self):
+        metrics = PullMetrics()
+        for event in (
+            finished(Digest.from_bytes(b"a"), 100, 1.0, time_to_first_byte=0.2),
+            finished(Digest.from_bytes(b"b"), 300, 1.0, time_to_first_byte=0.4),
+            finished(Digest.from_bytes(b"c"), 100, 4.0, host="b"),
+            finished(Digest.from_bytes(b"d"), 0, 0.1, cached=True),
+            TokenFetched("realm", "service", "scope", 0.5, 200),
+        ):
+            metrics(event)
+        hosts = metrics.hosts()
+        assert hosts["a"].blobs == 2 and hosts["a"].throughput == 200
+        assert hosts["a"].mean_time_to_first_byte == pytest.approx(0.3)
+        assert hosts["b"].throughput == 25
+        assert metrics.slowest(1)[0].digest == Digest.from_bytes(b"c")
+        summary = metrics.summary().splitlines()
+        # the slowest host first
+        assert summary[0].startswith("b:")
+        assert summary[-1] == "1 token requests, 500ms on average"
+
+
+class TestPullEvents:
+    def test_pull(self, registry_info, fake_registry, image_save_dir, tmp_path):
+        client = RegistryClient(host=registry_info.host, blob_cache=BlobCache(tmp_path.joinpath("cache")))
+        received = client.events.subscribe(EventQueue())
+        client.pull_image("foo/bar:latest", save_dir=image_save_dir)
+        received.close()
+        events = list(received)
+        done = {event.digest: event for event in events if isinstance(event, BlobFinished)}
+        # the image config is fetched with the manifest, not downloaded
+        assert set(done) == set(layer_digests(fake_registry))
+        for digest, event in done.items():
+            assert not event.cached
+            assert event.transferred == len(fake_registry.blobs[digest])
+            assert event.time_to_first_byte is not None and event.elapsed >= event.time_to_first_byte
+            assert event.host == httpx.URL(registry_info.host).host
+        for digest in done:
+            progress = [event for event in events if isinstance(event, BlobProgress) and event.digest == digest]
+            assert sum(event.amount for event in progress) == len(fake_registry.blobs[digest])
+
+        pulled_again = client.events.subscribe(PullMetrics())
+        cached = client.events.subscribe(EventQueue())
+        client.pull_image("foo/bar:latest", save_dir=image_save_dir)
+        cached.close()
+        assert all(event.cached for event in cached if isinstance(event, BlobFinished))
+        assert not pulled_again.blobs
+
+    def test_pull_image_events(self, registry_info, fake_registry, image_save_dir):
+        client = RegistryClient(host=registry_info.host)
+        events = list(client.pull_image_events("foo/bar:latest", save_dir=image_save_dir))
+        assert isinstance(events[-1], PullFinished) and events[-1].path.exists()
+        assert sum(isinstance(event, BlobFinished) for event in events) == len(layer_digests(fake_registry))
+        assert not client.events.active
+
+    def test_pull_image_events_failed(self, registry_info, fake_registry, registry_blobs, image_save_dir):
+        layers = layer_digests(fake_registry)
+        blobs_side_effect = registry_blobs.side_effect
+
+        def broken_side_effect(request: httpx.Request, repo, name, digest):
+            if digest == layers[-1]:
+                return httpx.Response(500)
+            return blobs_side_effect(request, repo=repo, name=name, digest=digest)
+
+        registry_blobs.side_effect = broken_side_effect
+        client = RegistryClient(host=registry_info.host)
+        events = []
+        with pytest.raises(httpx.HTTPStatusError):
+            for event in client.pull_image_events("foo/bar:latest", save_dir=image_save_dir):
+                events.append(event)
+        assert any(isinstance(event, BlobFailed) for event in events)
+
+    def test_async_pull_image_events(self, registry_info, fake_registry, image_save_dir):
+        async def pull():
+            async with AsyncRegistryClient(host=registry_info.host) as client:
+                return [event async for event in client.pull_image_events("foo/bar:latest", save_dir=image_save_dir)]
+
+        events = asyncio.run(pull())
+        assert isinstance(events[-1], PullFinished) and events[-1].path.exists()
+        done = [event for event in events if isinstance(event, BlobFinished)]
+        assert sorted(event.digest for event in done) == sorted(layer_digests(fake_registry))
+
+    def test_token_fetched(self, registry_auth_root):
+        scope = RepositoryScope(repo_name=uuid.uuid1().hex, actions=["pull"])
+        challenge = RegistryChallenge(scheme=ChallengeScheme.Bearer, realm=FAKE_REGISTRY_AUTH_HOST, service="fake")
+        events = Events()
+        received = events.subscribe(EventQueue())
+        auth = BearerAuth("", "", challenge=challenge, scope=scope, events=events)
+        registry_auth_root.mock(
+            return_value=httpx.Response(
+                200,
+                json={
+                    "token": "foo",
+                    "access_token": "foo",
+                    "issued_at": datetime.datetime.now().isoformat(),
+                    "expires_in": 1800,
+                },
+            )
+        )
+        flow = auth.sync_auth_flow(httpx.Request("GET", url="http://example.com"))
+        next(flow)
+        flow.send(httpx.Response(401))
+        received.close()
+        (event,) = received
+        assert event.realm == FAKE_REGISTRY_AUTH_HOST and event.service == "fake"
+        assert event.scope == str(scope) and event.status_code == 200
+
+
+def test_progress_bars():
+    output = io.StringIO()
+    bars = ProgressBars(file=output)
+    digest = Digest.from_bytes(b"a")
+    bars(BlobStarted(digest, 100))
+    bars(BlobProgress(digest, 60, 60, 100))
+    bars(BlobProgress(digest, 40, 100, 100))
+    bars(finished(digest, 100, 1.0, host="registry.fake.yy"))
+    bars(BlobFailed(Digest.from_bytes(b"b"), RuntimeError("broken")))
+    bars.close()
+    lines = output.getvalue().splitlines()
+    assert any("from registry.fake.yy" in line for line in lines)
+    assert any("failed" in line for line in lines)
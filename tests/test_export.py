@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+import gzip
+import io
+import tarfile
+
+import pytest
+
+from registry_client.digest import Digest
+from registry_client.export import ImageV2Tar, TarStreamWriter
+
+
+class TestTarStreamWriter:
+    def test_write(self, tmp_path):
+        path = tmp_path.joinpath("file")
+        path.write_bytes(b"file content")
+        out = io.BytesIO()
+        archive = TarStreamWriter(out)
+        archive.add_bytes("manifest.json", b"[]")
+        archive.add_file("a/b/file", path)
+        with archive.open("a/c/entry", 1000) as entry:
+            entry.write(b"x" * 600)
+            entry.write(b"y" * 400)
+        archive.close()
+
+        out.seek(0)
+        with tarfile.open(fileobj=out) as tar:
+            assert tar.getnames() == ["manifest.json", "a", "a/b", "a/b/file", "a/c", "a/c/entry"]
+            assert tar.getmember("a/b").isdir()
+            assert tar.extractfile("manifest.json").read() == b"[]"
+            assert tar.extractfile("a/b/file").read() == b"file content"
+            assert tar.extractfile("a/c/entry").read() == b"x" * 600 + b"y" * 400
+
+    @pytest.mark.parametrize("written", (b"x" * 9, b"x" * 11))
+    def test_entry_size_mismatch(self, written):
+        archive = TarStreamWriter(io.BytesIO())
+        with pytest.raises(ValueError):
+            with archive.open("entry", 10) as entry:
+                entry.write(written)
+
+
+@pytest.mark.parametrize("compress", (gzip.compress, lambda content: content))
+def test_check_compressed_layers(tmp_path, compress):
+    content = b"layer content" * 100
+    layer_path = tmp_path.joinpath("layer.tar")
+    layer_path.write_bytes(compress(content))
+    ImageV2Tar._check_layers([layer_path], [Digest.from_bytes(content).value])
+    with pytest.raises(AssertionError):
+        ImageV2Tar._check_layers([layer_path], [Digest.from_bytes(b"other").value])
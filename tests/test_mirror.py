@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+import asyncio
+import json
+import tarfile
+import time
+
+import httpx
+import pytest
+
+from registry_client.client import AsyncRegistryClient, RegistryClient
+from registry_client.image import ImageFormat
+from registry_client.mirror import MirrorPool, is_mirrored, with_host
+
+MIRRORS = ["https://mirror-a.registry-fake.yy", "https://mirror-b.registry-fake.yy"]
+
+
+@pytest.fixture(scope="function")
+def fake_mirrors(registry_mock, registry_manifest, registry_blobs, fake_registry):
+    """
+    every mirror serves the images of fake_registry until a test changes its routes
+    """
+    routes = {}
+    for index, url in enumerate(MIRRORS):
+        host = httpx.URL(url).host
+        routes[url] = {
+            "v2": registry_mock.route(host=host, path="/v2/", name=f"{host}-v2"),
+            "manifest": registry_mock.route(
+                host=host, path__regex="/v2/(?P<repo>.*?)/(?P<name>.*?)/manifests/(?P<target>.*)", name=f"{host}-m"
+            ),
+            "blobs": registry_mock.route(
+                host=host, path__regex="/v2/(?P<repo>.*?)/(?P<name>.*?)/blobs/(?P<digest>.*)", name=f"{host}-b"
+            ),
+        }
+        # the later mirrors are farther away
+        routes[url]["v2"].side_effect = slow_response(0.05 * index)
+        routes[url]["manifest"].side_effect = registry_manifest.side_effect
+        routes[url]["blobs"].side_effect = serve_range(registry_blobs.side_effect)
+    yield routes
+
+
+def slow_response(delay: float):
+    def side_effect(request: httpx.Request):
+        time.sleep(delay)
+        return httpx.Response(200)
+
+    return side_effect
+
+
+def serve_range(side_effect):
+    def range_side_effect(request: httpx.Request, **kwargs):
+        resp = side_effect(request, **kwargs)
+        range_header = request.headers.get("range")
+        if resp.status_code != 200 or not range_header:
+            return resp
+        start = int(range_header.split("=")[1].split("-")[0])
+        return httpx.Response(206, content=resp.content[start:])
+
+    return range_side_effect
+
+
+class BrokenStream(httpx.SyncByteStream):
+    def __init__(self, content: bytes):
+        self._content = content
+
+    def __iter__(self):
+        yield self._content
+        raise httpx.ReadError("connection reset")
+
+
+def layer_digests(fake_registry):
+    return [layer["digest"] for layer in json.loads(fake_registry.manifest)["layers"]]
+
+
+def requested_digests(route):
+    return [call.request.url.path.rsplit("/", 1)[-1] for call in route.calls]
+
+
+class TestMirrorPool:
+    def test_candidates(self):
+        pool = MirrorPool(MIRRORS, "https://registry.fake.yy")
+        assert [host.url for host in pool.candidates()] == [*map(httpx.URL, MIRRORS), pool.fallback.url]
+        first, second = pool.mirrors
+        pool.record_success(first, 0.5)
+        pool.record_success(second, 0.1)
+        assert pool.candidates()[0] is second
+        pool.record_failure(second, "status 503")
+        assert pool.candidates() == [first, second, pool.fallback]
+        assert second.error_rate == 0.5
+
+    def test_cooldown(self, monkeypatch):
+        pool = MirrorPool(MIRRORS[:1], "https://registry.fake.yy", cooldown=0)
+        host = pool.mirrors[0]
+        pool.record_failure(host, "status 503")
+        assert host.healthy
+        pool.record_success(host, 0.1)
+        assert host.consecutive_errors == 0
+        pool.cooldown = 10
+        pool.record_failure(host, "status 503")
+        pool.record_failure(host, "status 503")
+        assert not host.healthy and host.consecutive_errors == 2
+
+    def test_latency_is_smoothed(self):
+        pool = MirrorPool(MIRRORS[:1], "https://registry.fake.yy")
+        host = pool.mirrors[0]
+        pool.record_success(host, 1.0)
+        pool.record_success(host, 2.0)
+        assert 1.0 < host.latency < 2.0
+
+    @pytest.mark.parametrize(
+        "method, path, want",
+        (
+            ("GET", "/v2/library/foo/manifests/latest", True),
+            ("HEAD", "/v2/library/foo/blobs/sha256:abcd", True),
+            ("DELETE", "/v2/library/foo/manifests/latest", False),
+            ("GET", "/v2/library/foo/tags/list", False),
+            ("GET", "/v2/_catalog", False),
+        ),
+    )
+    def test_is_mirrored(self, method, path, want):
+        assert is_mirrored(httpx.Request(method, f"https://registry.fake.yy{path}")) is want
+
+    def test_with_host(self):
+        request = httpx.Request("GET", "https://registry.fake.yy/v2/foo/blobs/sha256:abcd?x=1", headers={"a": "b"})
+        mirror_request = with_host(request, httpx.URL(MIRRORS[0]))
+        assert str(mirror_request.url) == f"{MIRRORS[0]}/v2/foo/blobs/sha256:abcd?x=1"
+        assert mirror_request.headers["host"] == httpx.URL(MIRRORS[0]).host
+        assert mirror_request.headers["a"] == "b"
+
+
+class TestMirrors:
+    def test_pull_from_mirror(self, registry_info, fake_registry, registry_blobs, fake_mirrors, image_save_dir):
+        client = RegistryClient(host=registry_info.host, mirrors=MIRRORS)
+        image_path = client.pull_image("foo/bar:latest", save_dir=image_save_dir)
+        assert image_path.exists()
+        assert not registry_blobs.called
+        assert sorted(requested_digests(fake_mirrors[MIRRORS[0]]["blobs"])) == sorted(fake_registry.blobs)
+        assert not fake_mirrors[MIRRORS[1]]["blobs"].called
+
+    def test_prefer_fastest_mirror(self, registry_info, fake_registry, fake_mirrors, image_save_dir):
+        fake_mirrors[MIRRORS[0]]["v2"].side_effect = slow_response(0.1)
+        client = RegistryClient(host=registry_info.host, mirrors=MIRRORS)
+        client.pull_image("foo/bar:latest", save_dir=image_save_dir)
+        assert not fake_mirrors[MIRRORS[0]]["blobs"].called
+        assert sorted(requested_digests(fake_mirrors[MIRRORS[1]]["blobs"])) == sorted(fake_registry.blobs)
+
+    def test_skip_down_mirror(self, registry_info, fake_registry, registry_blobs, fake_mirrors, image_save_dir):
+        fake_mirrors[MIRRORS[0]]["v2"].side_effect = httpx.ConnectError
+        client = RegistryClient(host=registry_info.host, mirrors=MIRRORS)
+        client.pull_image("foo/bar:latest", save_dir=image_save_dir)
+        assert not fake_mirrors[MIRRORS[0]]["manifest"].called
+        assert sorted(requested_digests(fake_mirrors[MIRRORS[1]]["blobs"])) == sorted(fake_registry.blobs)
+        assert not client.client.mirrors.mirrors[0].healthy
+
+    def test_fallback_to_registry(self, registry_info, fake_registry, registry_blobs, fake_mirrors, image_save_dir):
+        for routes in fake_mirrors.values():
+            routes["manifest"].side_effect = None
+            routes["manifest"].respond(404)
+        client = RegistryClient(host=registry_info.host, mirrors=MIRRORS)
+        client.pull_image("foo/bar:latest", save_dir=image_save_dir)
+        # a mirror without the image isn't down
+        assert all(host.healthy for host in client.client.mirrors.mirrors)
+        assert fake_mirrors[MIRRORS[1]]["manifest"].called
+
+    @pytest.mark.parametrize("image_format", (ImageFormat.V2, ImageFormat.OCI))
+    @pytest.mark.parametrize("midway", (False, True))
+    def test_failover(
+        self, registry_info, fake_registry, registry_blobs, fake_mirrors, image_save_dir, image_format, midway
+    ):
+        layers = layer_digests(fake_registry)
+        blobs_side_effect = fake_mirrors[MIRRORS[0]]["blobs"].side_effect
+
+        def broken_side_effect(request: httpx.Request, repo, name, digest):
+            if digest != layers[-1]:
+                return blobs_side_effect(request, repo=repo, name=name, digest=digest)
+            if not midway:
+                raise httpx.ConnectError("connection refused", request=request)
+            return httpx.Response(200, stream=BrokenStream(fake_registry.blobs[digest][:8]))
+
+        fake_mirrors[MIRRORS[0]]["blobs"].side_effect = broken_side_effect
+        client = RegistryClient(host=registry_info.host, mirrors=MIRRORS, max_concurrent_downloads=1)
+        image_path = client.pull_image("foo/bar:latest", save_dir=image_save_dir, image_format=image_format)
+        with tarfile.open(image_path) as tar:
+            assert tar.getmembers()
+        # the finished layers aren't downloaded again
+        first, second = (requested_digests(fake_mirrors[url]["blobs"]) for url in MIRRORS)
+        assert first.count(layers[0]) == 1 and layers[0] not in second
+        assert second == [layers[-1]]
+        assert not registry_blobs.called
+
+    def test_credentials_stay_with_registry(self, fake_registry, fake_mirrors, image_save_dir):
+        client = RegistryClient(host="https://registry-1.docker.io", username="foo", password="bar", mirrors=MIRRORS)
+        client.pull_image("foo/bar:latest", save_dir=image_save_dir)
+        for route in fake_mirrors[MIRRORS[0]].values():
+            assert all("authorization" not in call.request.headers for call in route.calls)
+
+    def test_async_failover(self, registry_info, fake_registry, registry_blobs, fake_mirrors, image_save_dir):
+        for route in fake_mirrors[MIRRORS[0]].values():
+            route.side_effect = None
+            route.respond(503)
+
+        async def pull():
+            async with AsyncRegistryClient(host=registry_info.host, mirrors=MIRRORS) as client:
+                return await client.pull_image("foo/bar:latest", save_dir=image_save_dir)
+
+        assert asyncio.run(pull()).exists()
+        assert sorted(requested_digests(fake_mirrors[MIRRORS[1]]["blobs"])) == sorted(fake_registry.blobs)
+        assert not registry_blobs.called
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+import asyncio
+import email.utils
+import json
+import time
+
+import httpx
+import pytest
+
+from registry_client import retry
+from registry_client.client import AsyncRegistryClient, RegistryClient
+from registry_client.events import EventQueue, RequestRetried
+from registry_client.retry import MAX_RETRY_AFTER, RetryPolicy, parse_retry_after
+
+URL = "https://registry.fake.yy/v2/foo/bar/manifests/latest"
+
+
+@pytest.fixture(scope="function")
+def sleeps(monkeypatch):
+    """
+    record the seconds waited between retries instead of sleeping
+    """
+    recorded = []
+    monkeypatch.setattr(retry.time, "sleep", recorded.append)
+    yield recorded
+
+
+def responses(*results):
+    """
+    a send function answering with results in turn, an exception in them is raised
+    """
+    results = list(results)
+    requests = []
+
+    def send(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return httpx.Response(result[0], headers=result[1]) if isinstance(result, tuple) else httpx.Response(result)
+
+    send.requests = requests
+    return send
+
+
+@pytest.mark.parametrize(
+    "value, want",
+    (
+        (None, None),
+        ("", None),
+        ("3", 3),
+        (" 10 ", 10),
+        ("soon", None),
+        (email.utils.formatdate(time.time() - 60, usegmt=True), 0),
+    ),
+)
+def test_parse_retry_after(value, want):
+    assert parse_retry_after(value) == want
+
+
+def test_parse_retry_after_date():
+    assert parse_retry_after(email.utils.formatdate(time.time() + 60, usegmt=True)) == pytest.approx(60, abs=2)
+
+
+class TestRetryPolicy:
+    def test_delay(self):
+        policy = RetryPolicy(backoff=1, max_backoff=5)
+        for attempt in range(6):
+            assert 0 <= policy.delay(attempt) <= min(5, 2**attempt)
+        resp = httpx.Response(429, headers={"Retry-After": "7"})
+        assert policy.delay(0, resp) == 7
+        resp = httpx.Response(429, headers={"Retry-After": str(MAX_RETRY_AFTER * 2)})
+        assert policy.delay(0, resp) == MAX_RETRY_AFTER
+
+    def test_invalid_max_retries(self):
+        with pytest.raises(ValueError):
+            RetryPolicy(max_retries=-1)
+
+    @pytest.mark.parametrize(
+        "results, status_code, sent",
+        (
+            ((503, 502, 200), 200, 3),
+            ((httpx.ConnectError("refused"), httpx.ReadTimeout("timeout"), 200), 200, 3),
+            ((429, 429, 429, 429), 429, 4),
+            ((404,), 404, 1),
+            ((401,), 401, 1),
+        ),
+    )
+    def test_send(self, sleeps, results, status_code, sent):
+        send = responses(*results)
+        retried = []
+        resp = RetryPolicy(max_retries=3).send(httpx.Request("GET", URL), send, retried.append)
+        assert resp.status_code == status_code
+        assert len(send.requests) == sent
+        assert len(sleeps) == sent - 1
+        assert [event.attempt for event in retried] == list(range(1, sent))
+
+    def test_retry_after(self, sleeps):
+        send = responses((429, {"Retry-After": "2"}), 200)
+        assert RetryPolicy().send(httpx.Request("GET", URL), send).status_code == 200
+        assert sleeps == [2]
+
+    def test_give_up(self, sleeps):
+        send = responses(*[httpx.ConnectError("refused")] * 3)
+        with pytest.raises(httpx.ConnectError):
+            RetryPolicy(max_retries=2).send(httpx.Request("GET", URL), send)
+        assert len(sleeps) == 2
+
+    @pytest.mark.parametrize(
+        "method, results, max_retries",
+        (
+            ("POST", (503,), 3),
+            ("PUT", (503,), 3),
+            ("GET", (503,), 0),
+            ("GET", (httpx.UnsupportedProtocol("ftp"),), 3),
+        ),
+    )
+    def test_not_retried(self, sleeps, method, results, max_retries):
+        send = responses(*results)
+        try:
+            RetryPolicy(max_retries=max_retries).send(httpx.Request(method, URL), send)
+        except httpx.TransportError:
+            pass
+        assert len(send.requests) == 1
+        assert not sleeps
+
+    def test_async_send(self):
+        send = responses(503, httpx.ReadError("reset"), 200)
+
+        async def async_send(request: httpx.Request) -> httpx.Response:
+            return send(request)
+
+        resp = asyncio.run(RetryPolicy(backoff=0).async_send(httpx.Request("HEAD", URL), async_send))
+        assert resp.status_code == 200
+        assert len(send.requests) == 3
+
+
+class TestRetriedPull:
+    def test_pull(self, registry_info, fake_registry, registry_manifest, registry_blobs, image_save_dir, sleeps):
+        manifest_side_effect = registry_manifest.side_effect
+        blobs_side_effect = registry_blobs.side_effect
+        layer = json.loads(fake_registry.manifest)["layers"][-1]["digest"]
+        failures = {"manifest": [503], "blob": [429, 500]}
+
+        def flaky_manifest(request: httpx.Request, **kwargs):
+            if failures["manifest"]:
+                return httpx.Response(failures["manifest"].pop())
+            return manifest_side_effect(request, **kwargs)
+
+        def flaky_blobs(request: httpx.Request, repo, name, digest):
+            if digest == layer and failures["blob"]:
+                return httpx.Response(failures["blob"].pop(), headers={"Retry-After": "1"})
+            return blobs_side_effect(request, repo=repo, name=name, digest=digest)
+
+        registry_manifest.side_effect = flaky_manifest
+        registry_blobs.side_effect = flaky_blobs
+        client = RegistryClient(host=registry_info.host)
+        received = client.events.subscribe(EventQueue())
+        assert client.pull_image("foo/bar:latest", save_dir=image_save_dir).exists()
+        received.close()
+        retried = [event for event in received if isinstance(event, RequestRetried)]
+        assert [event.reason for event in retried] == ["status 503", "status 500", "status 429"]
+        assert sleeps.count(1) == 2
+
+    def test_no_retry(self, registry_info, fake_registry, registry_manifest, image_save_dir, sleeps):
+        registry_manifest.side_effect = None
+        registry_manifest.respond(503)
+        client = RegistryClient(host=registry_info.host, retry=RetryPolicy(max_retries=0))
+        with pytest.raises(httpx.HTTPStatusError):
+            client.pull_image("foo/bar:latest", save_dir=image_save_dir)
+        assert registry_manifest.call_count == 1
+
+    def test_async_pull(self, registry_info, fake_registry, registry_blobs, image_save_dir):
+        blobs_side_effect = registry_blobs.side_effect
+        failed = set()
+
+        def flaky_blobs(request: httpx.Request, repo, name, digest):
+            if digest not in failed:
+                failed.add(digest)
+                raise httpx.ConnectError("refused", request=request)
+            return blobs_side_effect(request, repo=repo, name=name, digest=digest)
+
+        registry_blobs.side_effect = flaky_blobs
+
+        async def pull():
+            async with AsyncRegistryClient(host=registry_info.host, retry=RetryPolicy(backoff=0.01)) as client:
+                return await client.pull_image("foo/bar:latest", save_dir=image_save_dir)
+
+        assert asyncio.run(pull()).exists()
+        assert failed == set(fake_registry.blobs)
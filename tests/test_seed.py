@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+import gzip
+import json
+import tarfile
+
+import pytest
+
+from registry_client import errors
+from registry_client.cache import BlobCache
+from registry_client.digest import Digest
+from registry_client.seed import Seed
+from tests.conftest import make_fake_image
+
+
+def write_docker_v2_image(path, image, keep_compressed=False):
+    config_name = f"{Digest.from_bytes(image.config).hex}.json"
+    path.joinpath(config_name).write_bytes(image.config)
+    layer_names = []
+    for index, layer in enumerate(image.layers):
+        layer_name = f"layer-{index}/layer.tar"
+        path.joinpath(layer_name).parent.mkdir()
+        path.joinpath(layer_name).write_bytes(gzip.compress(layer) if keep_compressed else layer)
+        layer_names.append(layer_name)
+    path.joinpath("manifest.json").write_text(json.dumps([{"Config": config_name, "Layers": layer_names}]))
+
+
+def write_oci_layout(path, image):
+    path.joinpath("oci-layout").write_text('{"imageLayoutVersion": "1.0.0"}')
+    path.joinpath("blobs", "sha256").mkdir(parents=True)
+    for digest, blob in image.blobs.items():
+        path.joinpath("blobs", "sha256", Digest(digest).hex).write_bytes(blob)
+
+
+class TestSeed:
+    def test_oci_layout(self, tmp_path_factory):
+        image = make_fake_image()
+        layout = tmp_path_factory.mktemp("layout")
+        write_oci_layout(layout, image)
+        cache = BlobCache(tmp_path_factory.mktemp("cache"))
+        with Seed(layout) as seed:
+            for digest, blob in image.blobs.items():
+                assert Digest(digest) in seed
+                assert seed.add_to(cache, Digest(digest))
+                assert cache.read_bytes(Digest(digest)) == blob
+        assert not list(cache.ingest_dir.iterdir())
+
+    @pytest.mark.parametrize("keep_compressed", (False, True))
+    def test_docker_v2_tar(self, tmp_path_factory, keep_compressed):
+        image = make_fake_image()
+        image_dir = tmp_path_factory.mktemp("image")
+        write_docker_v2_image(image_dir, image, keep_compressed)
+        image_path = tmp_path_factory.mktemp("tar").joinpath("image.tar")
+        with tarfile.open(image_path, "w") as tar:
+            tar.add(image_dir, arcname=".")
+        with Seed(image_path) as seed:
+            assert Digest.from_bytes(image.config) in seed
+            diff_ids = [Digest.from_bytes(layer) for layer in image.layers]
+            assert all((diff_id in seed) != keep_compressed for diff_id in diff_ids)
+            cache = BlobCache(tmp_path_factory.mktemp("cache"))
+            assert seed.add_to(cache, diff_ids[0]) != keep_compressed
+
+    def test_broken_blob(self, tmp_path_factory):
+        image = make_fake_image()
+        layout = tmp_path_factory.mktemp("layout")
+        write_oci_layout(layout, image)
+        digest = Digest(next(iter(image.blobs)))
+        layout.joinpath("blobs", "sha256", digest.hex).write_bytes(b"broken")
+        cache = BlobCache(tmp_path_factory.mktemp("cache"))
+        with Seed(layout) as seed:
+            assert not seed.add_to(cache, digest)
+        assert not cache.exists(digest)
+
+    def test_unknown_layout(self, tmp_path):
+        with pytest.raises(errors.ErrUnknownImageLayout):
+            Seed(tmp_path)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+import asyncio
+import time
+
+import pytest
+
+from registry_client import platforms, throttle
+from registry_client.client import AsyncRegistryClient, RegistryClient
+from registry_client.throttle import RateLimiter, TokenBucket
+
+
+@pytest.fixture(scope="function")
+def sleeps(monkeypatch):
+    """
+    record the seconds slept by throttling instead of sleeping
+    """
+    recorded = []
+    monkeypatch.setattr(throttle.time, "sleep", recorded.append)
+    yield recorded
+
+
+class TestTokenBucket:
+    def test_reserve(self):
+        bucket = TokenBucket(rate=100)
+        assert bucket.reserve(100) == 0
+        assert bucket.reserve(50) == pytest.approx(0.5, abs=0.01)
+        # the next consumer waits after the ones before it
+        assert bucket.reserve(50) == pytest.approx(1, abs=0.01)
+
+    def test_refill(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(throttle.time, "monotonic", lambda: now[0])
+        bucket = TokenBucket(rate=100, burst=200)
+        assert bucket.reserve(300) == pytest.approx(1)
+        now[0] += 10
+        # an idle bucket keeps at most burst tokens
+        assert bucket.reserve(200) == 0
+        assert bucket.reserve(100) == pytest.approx(1)
+
+    def test_invalid_rate(self):
+        with pytest.raises(ValueError):
+            TokenBucket(rate=0)
+
+
+class TestRateLimiter:
+    def test_unlimited(self):
+        limiter = RateLimiter()
+        assert limiter.unlimited
+        assert limiter.request_delay("a") == 0 and limiter.bytes_delay("a", 1 << 30) == 0
+        limiter.set_limits(host_requests_per_second=1)
+        assert not limiter.unlimited
+
+    def test_host_limits(self):
+        limiter = RateLimiter(host_requests_per_second=1)
+        assert limiter.request_delay("a") == 0
+        assert limiter.request_delay("b") == 0
+        assert limiter.request_delay("a") == pytest.approx(1, abs=0.01)
+
+    def test_global_limits(self):
+        limiter = RateLimiter(bytes_per_second=100, host_bytes_per_second=1000)
+        assert limiter.bytes_delay("a", 100) == 0
+        assert limiter.bytes_delay("b", 100) == pytest.approx(1, abs=0.01)
+
+    def test_limit_host(self):
+        limiter = RateLimiter(host_requests_per_second=100)
+        limiter.limit_host("a", requests_per_second=1)
+        limiter.set_limits(host_requests_per_second=100)
+        limiter.request_delay("a")
+        assert limiter.request_delay("a") == pytest.approx(1, abs=0.01)
+        limiter.request_delay("b")
+        assert limiter.request_delay("b") < 0.1
+
+
+class TestThrottledPull:
+    @pytest.mark.parametrize("max_concurrent_downloads", (1, 3))
+    def test_bandwidth(self, registry_info, fake_registry, image_save_dir, sleeps, max_concurrent_downloads):
+        total = sum(len(blob) for blob in fake_registry.blobs.values())
+        limiter = RateLimiter(bytes_per_second=total / 4)
+        client = RegistryClient(
+            host=registry_info.host, rate_limiter=limiter, max_concurrent_downloads=max_concurrent_downloads
+        )
+        client.pull_image("foo/bar:latest", save_dir=image_save_dir)
+        # one second of burst, the rest of the blobs are paid at the rate shared by every stream
+        assert max(sleeps) == pytest.approx(3, rel=0.05)
+
+    def test_request_rate(self, registry_info, fake_registry, image_save_dir, sleeps):
+        client = RegistryClient(host=registry_info.host, rate_limiter=RateLimiter(host_requests_per_second=1))
+        client.pull_image("foo/bar:latest", save_dir=image_save_dir)
+        assert max(sleeps) == pytest.approx(len(fake_registry.blobs) - 1, rel=0.05)
+
+    def test_manifests_are_not_throttled(self, registry_info, fake_registry, sleeps):
+        client = RegistryClient(host=registry_info.host, rate_limiter=RateLimiter(requests_per_second=0.001))
+        for _ in range(3):
+            client.inspect_image("foo/bar:latest", platform=platforms.Platform())
+        # only the image config is a blob
+        assert len(sleeps) == 3
+
+    def test_async(self, registry_info, fake_registry, image_save_dir):
+        total = sum(len(blob) for blob in fake_registry.blobs.values())
+        limiter = RateLimiter(bytes_per_second=total / 1.2)
+
+        async def pull():
+            async with AsyncRegistryClient(host=registry_info.host, rate_limiter=limiter) as client:
+                return await client.pull_image("foo/bar:latest", save_dir=image_save_dir)
+
+        started = time.monotonic()
+        asyncio.run(pull())
+        assert time.monotonic() - started >= 0.15
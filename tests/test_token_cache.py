@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+import asyncio
+import base64
+import datetime
+import os
+import sys
+import threading
+import time
+import uuid
+
+import httpx
+import pytest
+
+from registry_client.auth import (
+    TOKEN_CACHE_MIN_TIME,
+    TOKEN_REFRESH_AHEAD,
+    BearerAuth,
+    BearerToken,
+    ChallengeScheme,
+    FakeToken,
+    RegistryChallenge,
+    TokenCache,
+)
+from registry_client.scope import RepositoryScope
+from registry_client.token_cache import (
+    TOKEN_KEY_ENV,
+    Cipher,
+    TokenKey,
+    TokenStore,
+    new_token_store,
+)
+from tests.conftest import FAKE_REGISTRY_AUTH_HOST
+
+
+class ReversedCipher(Cipher):
+    """
+    not a cipher at all, it only tells its content apart from other bytes
+    """
+
+    PREFIX = b"reversed:"
+
+    def encrypt(self, content: bytes) -> bytes:
+        return self.PREFIX + base64.b64encode(content[::-1])
+
+    def decrypt(self, content: bytes) -> bytes:
+        if not content.startswith(self.PREFIX):
+            raise ValueError("not encrypted by ReversedCipher")
+        return base64.b64decode(content[len(self.PREFIX) :])[::-1]
+
+
+def token_key(scope: str = "repository:foo/bar:pull", account: str = "") -> TokenKey:
+    return TokenKey("https://auth.fake.yy/token", "fake", account, scope)
+
+
+def bearer_token(value: str, expires_in: int = 1800) -> BearerToken:
+    return BearerToken.restore(value, time.time() + expires_in)
+
+
+@pytest.fixture(scope="function")
+def store(tmp_path):
+    yield TokenStore(tmp_path.joinpath("tokens"), ReversedCipher())
+
+
+class TestTokenCache:
+    def test_keys(self):
+        cache = TokenCache()
+        cache.put(token_key(), bearer_token("a"))
+        cache.put(token_key(account="foo"), bearer_token("b"))
+        cache.put(token_key()._replace(realm="https://auth.other.yy/token"), bearer_token("c"))
+        assert cache.get(token_key()).value == "a"
+        assert cache.get(token_key(account="foo")).value == "b"
+        assert cache.get(token_key()._replace(service="other")) is None
+        cache.remove(token_key())
+        assert token_key() not in cache
+
+    def test_expired(self):
+        cache = TokenCache()
+        cache.put(token_key(), bearer_token("a", expires_in=1))
+        assert cache.get(token_key()) is None
+
+    def test_fake_token(self, store):
+        cache = TokenCache(store)
+        cache.put(token_key(), FakeToken({"Authorization": "foo"}))
+        assert cache.get(token_key()).token == {"Authorization": "foo"}
+        assert store.get(token_key()) is None
+
+    def test_threads(self):
+        cache = TokenCache()
+        keys = [token_key(scope=str(i)) for i in range(50)]
+
+        def put(key):
+            for _ in range(20):
+                cache.put(key, bearer_token(key.scope))
+                assert cache.get(key).value == key.scope
+
+        threads = [threading.Thread(target=put, args=(key,)) for key in keys]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert all(cache.get(key).value == key.scope for key in keys)
+
+    def test_store(self, store):
+        cache = TokenCache(store)
+        cache.put(token_key(), bearer_token("a"))
+        # another process using the same directory
+        cache = TokenCache(TokenStore(store.root, ReversedCipher()))
+        token = cache.get(token_key())
+        assert token.token == {"Authorization": "Bearer a"}
+        assert not token.expired
+
+
+class TestTokenStore:
+    def test_encrypted(self, store):
+        expires_at = time.time() + 600
+        store.put(token_key(), "secret", expires_at)
+        (path,) = store.root.iterdir()
+        assert b"secret" not in path.read_bytes()
+        assert store.get(token_key()) == ("secret", expires_at)
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="no unix permissions")
+    def test_private(self, store):
+        store.put(token_key(), "secret", time.time() + 600)
+        (path,) = store.root.iterdir()
+        assert path.stat().st_mode & 0o777 == 0o600
+
+    def test_expired(self, store):
+        store.put(token_key(), "secret", time.time() - 1)
+        assert store.get(token_key()) is None
+        assert not list(store.root.iterdir())
+
+    def test_unreadable(self, store):
+        store.put(token_key(), "secret", time.time() + 600)
+        (path,) = store.root.iterdir()
+        path.write_bytes(b"garbage")
+        assert store.get(token_key()) is None
+        store.clean()
+        assert not path.exists()
+
+    def test_clean(self, store):
+        store.put(token_key("a"), "a", time.time() - 1)
+        store.put(token_key("b"), "b", time.time() + 600)
+        store.clean()
+        assert len(list(store.root.iterdir())) == 1
+        assert store.get(token_key("b"))
+
+    def test_fernet(self, tmp_path, monkeypatch):
+        fernet = pytest.importorskip("cryptography.fernet")
+        monkeypatch.setenv(TOKEN_KEY_ENV, fernet.Fernet.generate_key().decode())
+        store = new_token_store(tmp_path)
+        store.put(token_key(), "secret", time.time() + 600)
+        assert new_token_store(tmp_path).get(token_key())[0] == "secret"
+        # the key isn't kept beside the tokens
+        assert [path.name for path in tmp_path.iterdir()] == [token_key().hash]
+        other = new_token_store(tmp_path.joinpath("other"), key=fernet.Fernet.generate_key())
+        os.replace(store._path(token_key()), other._path(token_key()))
+        assert other.get(token_key()) is None
+
+    def test_keyring(self, tmp_path, monkeypatch):
+        pytest.importorskip("cryptography")
+        keyring = pytest.importorskip("keyring")
+
+        class MemoryKeyring:
+            def __init__(self):
+                self.passwords = {}
+
+            def get_password(self, service, username):
+                return self.passwords.get((service, username))
+
+            def set_password(self, service, username, password):
+                self.passwords[(service, username)] = password
+
+        backend = MemoryKeyring()
+        monkeypatch.setattr(keyring.core, "_keyring_backend", backend)
+        monkeypatch.delenv(TOKEN_KEY_ENV, raising=False)
+        new_token_store(tmp_path).put(token_key(), "secret", time.time() + 600)
+        assert len(backend.passwords) == 1
+        assert new_token_store(tmp_path).get(token_key())[0] == "secret"
+
+    def test_without_key(self, tmp_path, monkeypatch):
+        pytest.importorskip("cryptography")
+        monkeypatch.delenv(TOKEN_KEY_ENV, raising=False)
+        monkeypatch.setitem(sys.modules, "keyring", None)
+        assert new_token_store(tmp_path) is None
+        monkeypatch.setenv(TOKEN_KEY_ENV, "not a key")
+        assert new_token_store(tmp_path) is None
+        assert not list(tmp_path.iterdir())
+
+    def test_without_cryptography(self, tmp_path, monkeypatch):
+        monkeypatch.setitem(sys.modules, "cryptography.fernet", None)
+        assert new_token_store(tmp_path) is None
+
+
+class TestSingleFlight:
+    def test_fetch(self):
+        cache = TokenCache()
+        fetched = []
+
+        def fetch():
+            fetched.append(threading.current_thread())
+            time.sleep(0.1)
+            return bearer_token("a")
+
+        threads = [threading.Thread(target=cache.fetch, args=(token_key(), fetch)) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(fetched) == 1
+        assert cache.get(token_key()).value == "a"
+
+    def test_rejected(self):
+        cache = TokenCache()
+        rejected = bearer_token("a")
+        cache.put(token_key(), rejected)
+        assert cache.fetch(token_key(), lambda: bearer_token("b"), rejected=rejected).value == "b"
+        # refreshed by another request since the token was rejected
+        assert cache.fetch(token_key(), lambda: bearer_token("c"), rejected=rejected).value == "b"
+
+    def test_failed(self):
+        cache = TokenCache()
+
+        def fail():
+            raise httpx.ConnectError("refused")
+
+        with pytest.raises(httpx.ConnectError):
+            cache.fetch(token_key(), fail)
+        assert cache.fetch(token_key(), lambda: bearer_token("a")).value == "a"
+
+    def test_async_fetch(self):
+        cache = TokenCache()
+        fetched = []
+
+        async def fetch():
+            fetched.append(1)
+            await asyncio.sleep(0.05)
+            return bearer_token("a")
+
+        async def run():
+            return await asyncio.gather(*(cache.async_fetch(token_key(), fetch) for _ in range(20)))
+
+        tokens = asyncio.run(run())
+        assert len(fetched) == 1
+        assert {token.value for token in tokens} == {"a"}
+        # another loop
+        cache.remove(token_key())
+        asyncio.run(run())
+        assert len(fetched) == 2
+
+    def test_async_failed(self):
+        cache = TokenCache()
+
+        async def fail():
+            await asyncio.sleep(0.05)
+            raise httpx.ConnectError("refused")
+
+        async def run():
+            return await asyncio.gather(
+                *(cache.async_fetch(token_key(), fail) for _ in range(5)), return_exceptions=True
+            )
+
+        errors = asyncio.run(run())
+        assert all(isinstance(error, httpx.ConnectError) for error in errors)
+        assert not cache._futures
+
+    def test_async_cancelled(self):
+        cache = TokenCache()
+
+        async def fetch():
+            await asyncio.sleep(0.05)
+            return bearer_token("a")
+
+        async def run():
+            first = asyncio.ensure_future(cache.async_fetch(token_key(), fetch))
+            await asyncio.sleep(0)
+            second = asyncio.ensure_future(cache.async_fetch(token_key(), fetch))
+            await asyncio.sleep(0)
+            first.cancel()
+            return await second
+
+        assert asyncio.run(run()).value == "a"
+
+    def test_bearer_auth(self, registry_auth_root):
+        scope = RepositoryScope(repo_name=uuid.uuid1().hex, actions=["pull"])
+        challenge = RegistryChallenge(scheme=ChallengeScheme.Bearer, realm=FAKE_REGISTRY_AUTH_HOST, service="fake")
+
+        def slow_token(request: httpx.Request):
+            time.sleep(0.1)
+            return httpx.Response(
+                200,
+                json={
+                    "token": "foo",
+                    "access_token": "foo",
+                    "issued_at": datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+                    "expires_in": 1800,
+                },
+            )
+
+        registry_auth_root.mock(side_effect=slow_token)
+        cache = TokenCache()
+        headers = []
+
+        def request():
+            auth = BearerAuth("", "", challenge=challenge, scope=scope, token_cache=cache)
+            flow = auth.sync_auth_flow(httpx.Request("GET", url="https://registry.fake.yy/v2/"))
+            next(flow)
+            headers.append(flow.send(httpx.Response(401)).headers["Authorization"])
+
+        threads = [threading.Thread(target=request) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert registry_auth_root.call_count == 1
+        assert headers == ["Bearer foo"] * 20
+
+
+class TestRefresh:
+    # used within the refresh window, before the token is treated as expired
+    EXPIRES_IN = TOKEN_CACHE_MIN_TIME + TOKEN_REFRESH_AHEAD / 2
+
+    def test_refresh(self):
+        cache = TokenCache()
+        old = bearer_token("a", expires_in=self.EXPIRES_IN)
+        cache.put(token_key(), old)
+        fetched = threading.Event()
+
+        def fetch():
+            fetched.set()
+            return bearer_token("b")
+
+        for _ in range(10):
+            cache.refresh(token_key(), old, fetch)
+        assert fetched.wait(5)
+        for _ in range(100):
+            if not cache._refreshing:
+                break
+            time.sleep(0.01)
+        assert cache.get(token_key()).value == "b"
+
+    @pytest.mark.parametrize("refresh_ahead, expires_in", ((TOKEN_REFRESH_AHEAD, 1800), (0, EXPIRES_IN)))
+    def test_not_refreshed(self, refresh_ahead, expires_in):
+        cache = TokenCache(refresh_ahead=refresh_ahead)
+        token = bearer_token("a", expires_in=expires_in)
+
+        def fetch():
+            raise AssertionError("refreshed")
+
+        cache.refresh(token_key(), token, fetch)
+        cache.refresh(token_key(), FakeToken({"Authorization": "foo"}), fetch)
+        assert not cache._refreshing
+
+    def test_refresh_failed(self):
+        cache = TokenCache()
+        old = bearer_token("a", expires_in=self.EXPIRES_IN)
+        cache.put(token_key(), old)
+        called = threading.Event()
+
+        def fail():
+            called.set()
+            raise httpx.ConnectError("refused")
+
+        cache.refresh(token_key(), old, fail)
+        assert called.wait(5)
+        for _ in range(100):
+            if not cache._refreshing:
+                break
+            time.sleep(0.01)
+        assert not cache._refreshing
+        assert cache.get(token_key()).value == "a"
+
+    def test_async_refresh(self):
+        cache = TokenCache()
+        old = bearer_token("a", expires_in=self.EXPIRES_IN)
+        cache.put(token_key(), old)
+        fetched = []
+
+        async def fetch():
+            fetched.append(1)
+            return bearer_token("b")
+
+        async def run():
+            for _ in range(10):
+                cache.async_refresh(token_key(), old, fetch)
+            await asyncio.gather(*cache._tasks)
+
+        asyncio.run(run())
+        assert len(fetched) == 1
+        assert cache.get(token_key()).value == "b"
+
+    def test_bearer_auth(self, registry_auth_root):
+        cache = TokenCache()
+        scope = RepositoryScope(repo_name=uuid.uuid1().hex, actions=["pull"])
+        challenge = RegistryChallenge(scheme=ChallengeScheme.Bearer, realm=FAKE_REGISTRY_AUTH_HOST, service="fake")
+        auth = BearerAuth("", "", challenge=challenge, scope=scope, token_cache=cache)
+        cache.put(auth.token_key, bearer_token("old", expires_in=self.EXPIRES_IN))
+        registry_auth_root.mock(
+            return_value=httpx.Response(
+                200,
+                json={
+                    "token": "new",
+                    "access_token": "new",
+                    "issued_at": datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+                    "expires_in": 1800,
+                },
+            )
+        )
+        flow = auth.sync_auth_flow(httpx.Request("GET", url="https://registry.fake.yy/v2/"))
+        # the request isn't delayed by the refresh
+        assert next(flow).headers["Authorization"] == "Bearer old"
+        for _ in range(100):
+            if cache.get(auth.token_key).value == "new":
+                break
+            time.sleep(0.01)
+        assert cache.get(auth.token_key).value == "new"
+        assert registry_auth_root.call_count == 1
+
+
+def test_bearer_auth_store(store, registry_auth_root):
+    scope = RepositoryScope(repo_name=uuid.uuid1().hex, actions=["pull"])
+    challenge = RegistryChallenge(scheme=ChallengeScheme.Bearer, realm=FAKE_REGISTRY_AUTH_HOST, service="fake")
+    registry_auth_root.mock(
+        return_value=httpx.Response(
+            200,
+            json={
+                "token": "foo",
+                "access_token": "foo",
+                "issued_at": datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+                "expires_in": 1800,
+            },
+        )
+    )
+    auth = BearerAuth("", "", challenge=challenge, scope=scope, token_cache=TokenCache(store))
+    flow = auth.sync_auth_flow(httpx.Request("GET", url="https://registry.fake.yy/v2/"))
+    next(flow)
+    flow.send(httpx.Response(401))
+    assert registry_auth_root.call_count == 1
+
+    # a new process finds the token on disk and doesn't request it again
+    auth = BearerAuth("", "", challenge=challenge, scope=scope, token_cache=TokenCache(store))
+    flow = auth.sync_auth_flow(httpx.Request("GET", url="https://registry.fake.yy/v2/"))
+    request = next(flow)
+    assert request.headers["Authorization"] == "Bearer foo"
+    assert registry_auth_root.call_count == 1